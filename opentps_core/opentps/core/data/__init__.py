@@ -1,5 +1,6 @@
 
 from opentps.core.data._dvh import *
+from opentps.core.data._dvhEngine import *
 from opentps.core.data._patient import *
 from opentps.core.data._patientData import *
 from opentps.core.data._patientList import *
@@ -207,18 +207,38 @@ class DVH:
 
         d = dose[mask]
         h, _ = np.histogram(d, bin_edges)
-        h = np.flip(h, 0)
+        self._setHistogram(h, len(d), spacing, np.mean(d), np.std(d), d.min() if len(d) > 0 else 0,
+                           d.max() if len(d) > 0 else 0)
+
+    def _setHistogram(self, histogram:np.ndarray, nbVoxels:int, spacing, Dmean:float, Dstd:float, Dmin:float,
+                      Dmax:float):
+        """
+        Set the cumulative volumes and the metrics from the dose histogram of the ROI. self._dose must hold the bin
+        centers.
+
+        Parameters
+        ----------
+        histogram: np.ndarray
+            Number of ROI voxels in each dose bin
+        nbVoxels: int
+            Number of voxels in the ROI
+        spacing: array-like
+            Voxel spacing of the dose grid in mm
+        Dmean, Dstd, Dmin, Dmax: float
+            Statistics of the dose in the ROI
+        """
+        h = np.flip(histogram, 0)
         h = np.cumsum(h)
         h = np.flip(h, 0)
-        self._volume = h * 100 / len(d)  # volume in %
+        self._volume = h * 100 / nbVoxels  # volume in %
         self._volume_absolute = h * spacing[0] * spacing[1] * spacing[2] / 1000  # volume in cm3
         # self._volume and self._volume_absolute are decreasing from 100% of the volume to 0%
 
         # compute metrics
-        self._Dmean = np.mean(d)
-        self._Dstd = np.std(d)
-        self._Dmin = d.min() if len(d) > 0 else 0
-        self._Dmax = d.max() if len(d) > 0 else 0
+        self._Dmean = Dmean
+        self._Dstd = Dstd
+        self._Dmin = Dmin
+        self._Dmax = Dmax
         self._D98 = self.computeDx(98)
         self._D95 = self.computeDx(95)
         self._D50 = self.computeDx(50)
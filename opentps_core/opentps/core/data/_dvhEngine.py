@@ -0,0 +1,482 @@
+__all__ = ['DVHEngine']
+
+import logging
+import time
+import unittest
+from collections import OrderedDict
+from typing import Sequence, Union
+
+import numpy as np
+
+from opentps.core.data.images._doseImage import DoseImage
+from opentps.core.data.images._roiMask import ROIMask
+from opentps.core.data._dvh import DVH
+from opentps.core.data._roiContour import ROIContour
+from opentps.core.processing.imageProcessing import resampler3D
+
+logger = logging.getLogger(__name__)
+
+_MAX_GATHERED_VALUES = 2 ** 25
+
+
+class DVHEngine:
+    """
+    Compute DVHs and DVH metrics of many ROIs for many dose distributions.
+
+    The voxel indices of each ROI are computed once per dose grid geometry (contour rasterization or mask resampling
+    included) and reused for every dose sharing this grid. Binned DVHs of all ROIs and all doses of a same grid are
+    computed in one vectorized pass. Exact Dx, Vg and Vx metrics are computed from the sorted ROI doses, which are kept
+    in a least recently used cache, as are the ROI indices.
+
+    The caches are validated with the identity of the image arrays: replacing the imageArray of a ROIMask or of a
+    DoseImage invalidates its entries. Call invalidate() after modifying an array in place.
+
+    Attributes
+    ----------
+    maxDVH: float
+        The maximum dose of the binned DVHs
+    bin_size: float
+        The bin size in Gy of the binned DVHs. If None, 4096 bins are used.
+    cacheSize: int
+        Maximum number of sorted ROI doses kept in cache
+    maskCacheSize: int
+        Maximum number of ROI masks (ROI and dose grid pairs) kept in cache
+    statistics: dict
+        Cache hits and misses and time spent in each step
+    """
+    def __init__(self, maxDVH:float=100.0, bin_size:float=None, cacheSize:int=256, maskCacheSize:int=64):
+        self.maxDVH = maxDVH
+        self.bin_size = bin_size
+        self.cacheSize = cacheSize
+        self.maskCacheSize = maskCacheSize
+
+        self._masks = OrderedDict()
+        self._sortedDoses = OrderedDict()
+        self._statistics = {}
+        self.resetStatistics()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_masks'] = OrderedDict()
+        state['_sortedDoses'] = OrderedDict()
+        return state
+
+    @property
+    def statistics(self) -> dict:
+        return dict(self._statistics)
+
+    def resetStatistics(self):
+        """
+        Reset the cache and timing statistics.
+        """
+        self._statistics = {'maskHits': 0, 'maskMisses': 0, 'sortHits': 0, 'sortMisses': 0,
+                            'maskTime': 0., 'histogramTime': 0., 'sortTime': 0.}
+
+    def clearCache(self):
+        """
+        Remove all cached ROI indices and sorted doses.
+        """
+        self._masks.clear()
+        self._sortedDoses.clear()
+
+    def invalidate(self, data:Union[ROIContour, ROIMask, DoseImage]):
+        """
+        Remove the cached entries of a ROI or of a dose, e.g. after its image array was modified in place.
+
+        Parameters
+        ----------
+        data: ROIContour, ROIMask or DoseImage
+            The ROI or the dose
+        """
+        self._masks = OrderedDict((key, entry) for key, entry in self._masks.items() if entry[0] is not data)
+        self._sortedDoses = OrderedDict((key, entry) for key, entry in self._sortedDoses.items()
+                                        if entry[0] is not data and entry[1] is not data)
+
+    def getResampledMask(self, roi:Union[ROIContour, ROIMask], dose:DoseImage) -> ROIMask:
+        """
+        Get the mask of a ROI on the grid of a dose.
+
+        Parameters
+        ----------
+        roi: ROIContour or ROIMask
+            The ROI
+        dose: DoseImage
+            Dose image defining the grid
+
+        Returns
+        -------
+        ROIMask
+            The ROI mask on the dose grid
+        """
+        return self._getMaskEntry(roi, dose)[2]
+
+    def getROIIndex(self, roi:Union[ROIContour, ROIMask], dose:DoseImage) -> np.ndarray:
+        """
+        Get the flat indices of the ROI voxels on the grid of a dose.
+
+        Parameters
+        ----------
+        roi: ROIContour or ROIMask
+            The ROI
+        dose: DoseImage
+            Dose image defining the grid
+
+        Returns
+        -------
+        np.ndarray
+            Sorted flat indices of the ROI voxels in dose.imageArray
+        """
+        return self._getMaskEntry(roi, dose)[3]
+
+    def computeDVH(self, roi:Union[ROIContour, ROIMask], dose:DoseImage, prescription:float=None) -> DVH:
+        """
+        Compute the binned DVH of a ROI.
+
+        Parameters
+        ----------
+        roi: ROIContour or ROIMask
+            The ROI
+        dose: DoseImage
+            The dose image
+        prescription: float, optional
+            Prescription dose
+
+        Returns
+        -------
+        DVH
+            The DVH, without signal connections
+        """
+        return self.computeDVHs([roi], [dose], prescription)[0][0]
+
+    def computeDVHs(self, rois:Sequence[Union[ROIContour, ROIMask]], doses:Sequence[DoseImage],
+                    prescription:float=None) -> list:
+        """
+        Compute the binned DVHs of several ROIs for several doses. The DVHs are equal to the ones computed by
+        DVH.computeDVH with the same maxDVH and bin_size.
+
+        Parameters
+        ----------
+        rois: Sequence[ROIContour or ROIMask]
+            The ROIs
+        doses: Sequence[DoseImage]
+            The dose images
+        prescription: float, optional
+            Prescription dose
+
+        Returns
+        -------
+        list[list[DVH]]
+            DVHs indexed by dose then by ROI. The DVHs are not connected to the signals of the ROIs and doses.
+        """
+        binCenters, binEdges = self._binning()
+        nbBins = len(binCenters)
+        dvhs = [[None] * len(rois) for _ in doses]
+
+        for doseIndices in self._groupByGrid(doses).values():
+            reference = doses[doseIndices[0]]
+            entries = [self._getMaskEntry(roi, reference) for roi in rois]
+            counts = np.array([len(entry[3]) for entry in entries], dtype=np.int64)
+            roiIndex = np.concatenate([entry[3] for entry in entries])
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            nonEmpty = counts > 0
+            roiOfValue = np.repeat(np.arange(len(rois)), counts)
+            for r in np.flatnonzero(~nonEmpty):
+                logger.warning('ROI ' + str(rois[r].name) + ' is empty on the dose grid')
+
+            startTime = time.perf_counter()
+            chunkSize = max(1, _MAX_GATHERED_VALUES // max(1, len(roiIndex)))
+            for c0 in range(0, len(doseIndices), chunkSize):
+                chunk = doseIndices[c0:c0 + chunkSize]
+                values = np.stack([doses[d].imageArray.reshape(-1)[roiIndex] for d in chunk])
+
+                bins, inRange = self._binIndex(values, binEdges)
+                bins += (np.arange(len(chunk))[:, None] * len(rois) + roiOfValue) * nbBins
+                histograms = np.bincount(bins[inRange], minlength=len(chunk) * len(rois) * nbBins)
+                histograms = histograms.reshape(len(chunk), len(rois), nbBins)
+
+                means, variances, minima, maxima = self._segmentStatistics(values, starts, counts, nonEmpty)
+
+                for i, d in enumerate(chunk):
+                    for r, roi in enumerate(rois):
+                        dvh = DVH(roi, None, prescription=prescription, maxDVH=self.maxDVH, bin_size=self.bin_size,
+                                  use_signals=False)
+                        dvh._roiMask = entries[r][2]
+                        dvh._doseImage = doses[d]
+                        dvh._dose = binCenters
+                        dvh._setHistogram(histograms[i, r], counts[r], doses[d].spacing,
+                                          means[i, r], np.sqrt(variances[i, r]), minima[i, r], maxima[i, r])
+                        dvhs[d][r] = dvh
+            self._statistics['histogramTime'] += time.perf_counter() - startTime
+
+        return dvhs
+
+    def computeDx(self, rois:Sequence[Union[ROIContour, ROIMask]], doses:Sequence[DoseImage],
+                  percentiles:Sequence[float]) -> np.ndarray:
+        """
+        Compute exact Dx metrics (dose received by at least x % of the ROI volume) from the sorted ROI doses.
+
+        Parameters
+        ----------
+        rois: Sequence[ROIContour or ROIMask]
+            The ROIs
+        doses: Sequence[DoseImage]
+            The dose images
+        percentiles: Sequence[float]
+            Percentages of volume
+
+        Returns
+        -------
+        np.ndarray
+            Dx values of shape (len(doses), len(rois), len(percentiles)). NaN for empty ROIs.
+        """
+        percentiles = np.asarray(percentiles, dtype=float).reshape(-1)
+        result = np.full((len(doses), len(rois), len(percentiles)), np.nan)
+        for d, dose in enumerate(doses):
+            for r, roi in enumerate(rois):
+                sortedDose = self._getSortedDose(roi, dose)
+                n = len(sortedDose)
+                if n == 0:
+                    continue
+                # Number of voxels that must receive at least Dx, the sorted dose is increasing
+                k = np.clip(np.ceil(percentiles * n / 100. - 1e-9).astype(np.int64), 1, n)
+                result[d, r] = sortedDose[n - k]
+        return result
+
+    def computeVg(self, rois:Sequence[Union[ROIContour, ROIMask]], doses:Sequence[DoseImage],
+                  doseLevels:Sequence[float], return_percentage:bool=True) -> np.ndarray:
+        """
+        Compute exact Vg metrics (volume receiving at least g Gy) from the sorted ROI doses.
+
+        Parameters
+        ----------
+        rois: Sequence[ROIContour or ROIMask]
+            The ROIs
+        doses: Sequence[DoseImage]
+            The dose images
+        doseLevels: Sequence[float]
+            Doses in Gy
+        return_percentage: bool
+            Whether to return the volume in percentage or in cm^3
+
+        Returns
+        -------
+        np.ndarray
+            Vg values of shape (len(doses), len(rois), len(doseLevels)). NaN for empty ROIs in percentage.
+        """
+        doseLevels = np.asarray(doseLevels, dtype=float).reshape(-1)
+        result = np.full((len(doses), len(rois), len(doseLevels)), np.nan)
+        for d, dose in enumerate(doses):
+            voxelVolume = np.prod(dose.spacing) / 1000
+            for r, roi in enumerate(rois):
+                sortedDose = self._getSortedDose(roi, dose)
+                n = len(sortedDose)
+                nbVoxels = n - np.searchsorted(sortedDose, doseLevels, side='left')
+                if return_percentage:
+                    if n > 0:
+                        result[d, r] = nbVoxels * 100. / n
+                else:
+                    result[d, r] = nbVoxels * voxelVolume
+        return result
+
+    def computeVx(self, rois:Sequence[Union[ROIContour, ROIMask]], doses:Sequence[DoseImage],
+                  percentages:Sequence[float], prescription:float, return_percentage:bool=True) -> np.ndarray:
+        """
+        Compute exact Vx metrics (volume receiving at least x % of the prescription) from the sorted ROI doses.
+
+        Parameters
+        ----------
+        rois: Sequence[ROIContour or ROIMask]
+            The ROIs
+        doses: Sequence[DoseImage]
+            The dose images
+        percentages: Sequence[float]
+            Doses in % of the prescription
+        prescription: float
+            Prescription dose in Gy
+        return_percentage: bool
+            Whether to return the volume in percentage or in cm^3
+
+        Returns
+        -------
+        np.ndarray
+            Vx values of shape (len(doses), len(rois), len(percentages))
+        """
+        doseLevels = np.asarray(percentages, dtype=float).reshape(-1) * prescription / 100.
+        return self.computeVg(rois, doses, doseLevels, return_percentage=return_percentage)
+
+    def _binning(self):
+        if self.bin_size is None:
+            bin_size = self.maxDVH / 4096
+            binEdges = np.arange(0, self.maxDVH + 0.5 * bin_size, bin_size)
+            nbBins = 4096
+        else:
+            bin_size = self.bin_size
+            binEdges = np.arange(0, self.maxDVH + 0.5 * bin_size, bin_size)
+            nbBins = len(binEdges) - 1
+        # The last edge of DVH.computeDVH depends on the dose maximum but no dose value can lie above it
+        return binEdges[:nbBins] + 0.5 * bin_size, binEdges[:nbBins + 1]
+
+    @staticmethod
+    def _binIndex(values, binEdges):
+        """
+        Bin of each value as in np.histogram(values, binEdges), the last bin being unbounded. The bins are computed
+        from the uniform bin size then corrected against the edges so that values on an edge fall in the same bin as
+        with np.histogram.
+        """
+        nbBins = len(binEdges) - 1
+        bins = np.floor((values - binEdges[0]) * (nbBins / (binEdges[-1] - binEdges[0]))).astype(np.int64)
+        np.clip(bins, 0, nbBins - 1, out=bins)
+        bins -= values < binEdges[bins]
+        bins += (values >= binEdges[bins + 1]) & (bins + 1 < nbBins)
+        inRange = bins >= 0
+        np.maximum(bins, 0, out=bins)
+        return bins, inRange
+
+    @staticmethod
+    def _gridKey(image):
+        return (tuple(int(n) for n in image.gridSize), tuple(np.round(np.asarray(image.origin, dtype=float), 3)),
+                tuple(np.round(np.asarray(image.spacing, dtype=float), 3)))
+
+    def _groupByGrid(self, doses):
+        groups = {}
+        for d, dose in enumerate(doses):
+            groups.setdefault(self._gridKey(dose), []).append(d)
+        return groups
+
+    def _getMaskEntry(self, roi, dose):
+        key = (id(roi), self._gridKey(dose))
+        roiArray = roi.imageArray if isinstance(roi, ROIMask) else None
+
+        entry = self._masks.get(key)
+        if not (entry is None) and entry[0] is roi and entry[1] is roiArray:
+            self._statistics['maskHits'] += 1
+            self._masks.move_to_end(key)
+            return entry
+        self._statistics['maskMisses'] += 1
+
+        startTime = time.perf_counter()
+        if isinstance(roi, ROIContour):
+            mask = roi.getBinaryMask(dose.origin, dose.gridSize, dose.spacing)
+        elif dose.hasSameGrid(roi):
+            mask = roi
+        else:
+            mask = resampler3D.resampleImage3DOnImage3D(roi, dose, inPlace=False, fillValue=0.)
+            mask.patient = None
+        roiIndex = np.flatnonzero(mask.imageArray.astype(bool))
+        self._statistics['maskTime'] += time.perf_counter() - startTime
+
+        entry = (roi, roiArray, mask, roiIndex)
+        self._masks[key] = entry
+        while len(self._masks) > self.maskCacheSize:
+            self._masks.popitem(last=False)
+        return entry
+
+    def _getSortedDose(self, roi, dose):
+        key = (id(roi), id(dose))
+        roiArray = roi.imageArray if isinstance(roi, ROIMask) else None
+
+        entry = self._sortedDoses.get(key)
+        if not (entry is None) and entry[0] is roi and entry[1] is dose and entry[2] is roiArray \
+                and entry[3] is dose.imageArray:
+            self._statistics['sortHits'] += 1
+            self._sortedDoses.move_to_end(key)
+            return entry[4]
+        self._statistics['sortMisses'] += 1
+
+        roiIndex = self.getROIIndex(roi, dose)
+        startTime = time.perf_counter()
+        sortedDose = np.sort(dose.imageArray.reshape(-1)[roiIndex])
+        self._statistics['sortTime'] += time.perf_counter() - startTime
+
+        self._sortedDoses[key] = (roi, dose, roiArray, dose.imageArray, sortedDose)
+        while len(self._sortedDoses) > self.cacheSize:
+            self._sortedDoses.popitem(last=False)
+        return sortedDose
+
+    @staticmethod
+    def _segmentStatistics(values, starts, counts, nonEmpty):
+        """
+        Mean, variance, minimum and maximum of the ROI segments of each row of values
+        """
+        shape = (values.shape[0], len(counts))
+        means = np.zeros(shape)
+        variances = np.zeros(shape)
+        minima = np.zeros(shape, dtype=values.dtype)
+        maxima = np.zeros(shape, dtype=values.dtype)
+        if not np.any(nonEmpty):
+            return means, variances, minima, maxima
+
+        # Empty segments hold no value so the non-empty starts delimit the non-empty segments
+        segmentStarts = starts[nonEmpty]
+        sizes = counts[nonEmpty]
+        segmentMeans = np.add.reduceat(values, segmentStarts, axis=1, dtype=np.float64) / sizes
+        deviations = values - np.repeat(segmentMeans, sizes, axis=1)
+        means[:, nonEmpty] = segmentMeans
+        variances[:, nonEmpty] = np.add.reduceat(deviations * deviations, segmentStarts, axis=1) / sizes
+        minima[:, nonEmpty] = np.minimum.reduceat(values, segmentStarts, axis=1)
+        maxima[:, nonEmpty] = np.maximum.reduceat(values, segmentStarts, axis=1)
+        return means, variances, minima, maxima
+
+
+class DVHEngineTestCase(unittest.TestCase):
+    """
+    Test case for the DVH engine.
+    """
+    def testDVHs(self):
+        """
+        Test that binned DVHs match DVH.computeDVH and that exact metrics match the sorted ROI doses.
+        """
+        rng = np.random.default_rng(0)
+        doses = [DoseImage(imageArray=rng.uniform(0, 70, (20, 20, 10)).astype(np.float32), spacing=(2, 2, 3))
+                 for _ in range(3)]
+        rois = []
+        for name, box in (('target', (slice(5, 15), slice(5, 15), slice(2, 8))), ('oar', (slice(0, 8),) * 3)):
+            mask = np.zeros((20, 20, 10), dtype=bool)
+            mask[box] = True
+            rois.append(ROIMask(imageArray=mask, name=name, spacing=(2, 2, 3)))
+
+        engine = DVHEngine()
+        dvhs = engine.computeDVHs(rois, doses, prescription=60.)
+        for d, dose in enumerate(doses):
+            for r, roi in enumerate(rois):
+                reference = DVH(roi, dose, prescription=60., use_signals=False)
+                np.testing.assert_allclose(dvhs[d][r].histogram[1], reference.histogram[1])
+                self.assertAlmostEqual(dvhs[d][r].Dmean, reference.Dmean, places=4)
+                self.assertAlmostEqual(dvhs[d][r].Dstd, reference.Dstd, places=4)
+                self.assertEqual(dvhs[d][r].Dmax, reference.Dmax)
+                self.assertAlmostEqual(dvhs[d][r].D95, reference.D95)
+        self.assertEqual(engine.statistics['maskMisses'], 2)
+
+        D95 = engine.computeDx(rois, doses, [95, 50])
+        V60 = engine.computeVx(rois, doses, [100], prescription=60.)
+        for d, dose in enumerate(doses):
+            for r, roi in enumerate(rois):
+                values = dose.imageArray[roi.imageArray]
+                self.assertGreaterEqual(np.mean(values >= D95[d, r, 0]), 0.95)
+                self.assertLess(np.mean(values > D95[d, r, 0]), 0.95)
+                self.assertAlmostEqual(V60[d, r, 0], np.mean(values >= 60.) * 100)
+        self.assertEqual(engine.statistics['sortMisses'], 6)
+        self.assertEqual(engine.statistics['sortHits'], 6)
+
+        doses[0].imageArray = doses[0].imageArray * 2
+        engine.computeDx(rois, doses[:1], [95])
+        self.assertEqual(engine.statistics['sortMisses'], 8)
+
+    def testMaskCacheSize(self):
+        """
+        Test that the least recently used ROI masks are evicted.
+        """
+        dose = DoseImage(imageArray=np.ones((10, 10, 10), dtype=np.float32))
+        rois = []
+        for r in range(3):
+            mask = np.zeros((10, 10, 10), dtype=bool)
+            mask[r:r + 5] = True
+            rois.append(ROIMask(imageArray=mask))
+
+        engine = DVHEngine(maskCacheSize=2)
+        for roi in rois + rois[2:]:
+            engine.getROIIndex(roi, dose)
+        self.assertEqual(len(engine._masks), 2)
+        self.assertEqual(engine.statistics['maskMisses'], 3)
+        self.assertEqual(engine.statistics['maskHits'], 1)
+        self.assertFalse(any(entry[0] is rois[0] for entry in engine._masks.values()))
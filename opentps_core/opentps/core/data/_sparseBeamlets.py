@@ -2,11 +2,11 @@ __all__ = ['SparseBeamlets']
 
 import logging
 import pickle
-from typing import Sequence, Optional
+from typing import Sequence, Optional, Union
 
 import numpy as np
 
-from opentps.core.io.serializedObjectIO import saveData
+from opentps.core.io import sparseBeamletsIO
 from scipy.sparse import csc_matrix
 
 from opentps.core.data.images._image3D import Image3D
@@ -150,20 +150,62 @@ class SparseBeamlets(PatientData):
 
         
 
+    def toSparseSubMatrix(self, spots:Optional[Union[Sequence[int], slice, np.ndarray]]=None,
+                          voxels:Optional[Union[Sequence[int], np.ndarray]]=None) -> csc_matrix:
+        """
+        Get a sub-matrix of the sparse beamlets. If the beamlets are unloaded and stored in the native format, only
+        the selected spots are read from the file system and the full matrix is not reloaded.
+
+        Parameters
+        ----------
+        spots : Optional[Union[Sequence[int], slice, np.ndarray]]
+            Indices (or slice) of the spots (columns) to select, by default None (all spots)
+        voxels : Optional[Union[Sequence[int], np.ndarray]]
+            Indices of the voxels (rows) to select or flat boolean mask, by default None (all voxels)
+
+        Returns
+        -------
+        csc_matrix
+            The sparse sub-matrix of shape (len(voxels), len(spots))
+        """
+        if self._sparseBeamlets is None and not (self._savedBeamletFile is None) \
+                and sparseBeamletsIO.isSparseBeamletsFolder(self._savedBeamletFile):
+            return sparseBeamletsIO.readSparseMatrix(self._savedBeamletFile, columns=spots, rows=voxels)
+
+        matrix = self.toSparseMatrix()
+        if spots is not None:
+            matrix = matrix[:, spots]
+        if voxels is not None:
+            voxels = np.asarray(voxels)
+            matrix = matrix[np.flatnonzero(voxels) if voxels.dtype == bool else voxels, :]
+        return csc_matrix(matrix)
+
     def reloadFromFS(self):
         """
         Reloads the sparse beamlets matrix from the file system
         """
+        if sparseBeamletsIO.isSparseBeamletsFolder(self._savedBeamletFile):
+            self._sparseBeamlets = sparseBeamletsIO.readSparseMatrix(self._savedBeamletFile)
+            return
+
+        # Beamlets stored with pickle by previous versions
         with open(self._savedBeamletFile, 'rb') as fid:
             tmp = pickle.load(fid)
         self.__dict__.update(tmp)
 
-    def storeOnFS(self, filePath):
+    def storeOnFS(self, filePath, compressed=False):
         """
-        Stores the sparse beamlets matrix on the file system
+        Stores the sparse beamlets matrix on the file system (native format, see sparseBeamletsIO) and unloads it
+
+        Parameters
+        ----------
+        filePath : str
+            Folder in which the beamlets are stored
+        compressed : bool
+            If True, the CSC arrays are compressed, by default False
         """
+        sparseBeamletsIO.writeSparseBeamlets(self, filePath, compressed=compressed)
         self._savedBeamletFile = filePath
-        saveData(self, self._savedBeamletFile)
         self.unload()
 
     def unload(self):
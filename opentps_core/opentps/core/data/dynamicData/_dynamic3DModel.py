@@ -3,6 +3,7 @@ import logging
 
 from opentps.core.data._patientData import PatientData
 import opentps.core.processing.registration.midPosition as midPosition
+from opentps.core.processing.imageProcessing.fieldExponentiation import ScalingAndSquaring
 from concurrent.futures import ProcessPoolExecutor
 
 logger = logging.getLogger(__name__)
@@ -122,16 +123,27 @@ class Dynamic3DModel(PatientData):
 
 
 
-    def computeAllDisplacementFields(self):
-        """
-        Compute all model displacement fields.
+    def computeAllDisplacementFields(self, tryGPU=True, tolerance=None):
         """
+        Compute all model displacement fields. On CPU, the exponentiation buffers are shared by the fields of a same grid.
 
+        Parameters
+        ----------
+        tryGPU : bool (default = True)
+            boolean indicating if GPU should be used if available
+        tolerance : float (default = None)
+            if not None, early stop threshold of the squaring steps on CPU (see ScalingAndSquaring.exponentiate)
+        """
+        scalingAndSquaring = None
         for field in self.deformationList:
-            self.computeDisplacementField(field)
+            velocity = field.velocity
+            if scalingAndSquaring is None or scalingAndSquaring.gridSize != tuple(velocity.gridSize) or \
+                    not np.array_equal(scalingAndSquaring.spacing, np.float32(velocity.spacing)):
+                scalingAndSquaring = ScalingAndSquaring(velocity.gridSize, velocity.spacing)
+            self.computeDisplacementField(field, tryGPU=tryGPU, tolerance=tolerance, scalingAndSquaring=scalingAndSquaring)
 
 
-    def computeDisplacementField(self, field):
+    def computeDisplacementField(self, field, tryGPU=True, tolerance=None, scalingAndSquaring=None):
         """
         Compute the displacement field of a deformation field.
 
@@ -139,8 +151,14 @@ class Dynamic3DModel(PatientData):
         ----------
         field : Deformation3D
             displacement field
+        tryGPU : bool (default = True)
+            boolean indicating if GPU should be used if available
+        tolerance : float (default = None)
+            if not None, early stop threshold of the squaring steps on CPU (see ScalingAndSquaring.exponentiate)
+        scalingAndSquaring : ScalingAndSquaring (default = None)
+            exponentiation buffers reused on CPU
         """
-        field.displacement = field.velocity.exponentiateField()
+        field.displacement = field.velocity.exponentiateField(tryGPU=tryGPU, tolerance=tolerance, scalingAndSquaring=scalingAndSquaring)
 
 
     def getMaskByName(self, name):
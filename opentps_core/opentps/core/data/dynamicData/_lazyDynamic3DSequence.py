@@ -0,0 +1,340 @@
+import logging
+import threading
+import unittest
+from collections import OrderedDict
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from opentps.core.data._patientData import PatientData
+from opentps.core.data.dynamicData._dynamic3DSequence import Dynamic3DSequence
+from opentps.core.processing.deformableDataAugmentationToolBox.weightMaps import getWeightMapsAsImage3DList, generateDeformationFromTrackersAndWeightMaps
+
+logger = logging.getLogger(__name__)
+
+
+class LazyDynamic3DSequence(Dynamic3DSequence):
+    """
+    Dynamic 3D sequence whose images are generated on demand by deforming the mid-position image of a model. Inherits
+    from Dynamic3DSequence.
+
+    Only the phases and amplitudes of the frames are stored. The recently used frames are kept in a least recently used
+    cache, the next frames can be generated in advance by a background thread, and the generated frames can be stored in
+    a memory-mapped file so that they are read back instead of generated again once evicted from the cache.
+
+    Attributes
+    ----------
+    model : Dynamic3DModel
+        Model from which the frames are generated.
+    phaseList : list
+        Phases of each frame, one phase per tracker (see generateDeformationFromTrackers).
+    amplitudeList : list
+        Amplitudes of each frame, one amplitude per tracker.
+    ROIList : list
+        Tracker positions [X, Y, Z] in absolute coordinates. With a single tracker, the frames are generated with
+        Dynamic3DModel.generate3DDeformation.
+    dyn3DImageList : Sequence
+        Read-only view of the frames, generated on access.
+    cacheSize : int (default = 8)
+        Maximum number of frames kept in memory.
+    prefetch : int (default = 0)
+        Number of frames following the accessed frame that are generated in a background thread.
+    memmapPath : str (default = None)
+        Path of the memory-mapped file storing the generated frames. If None, evicted frames are generated again.
+    statistics : dict
+        Number of cache hits, memory-mapped file reads, generated frames and evictions.
+    """
+
+    def __init__(self, model, phaseList, amplitudeList, ROIList=None, name="3D Dyn Seq", timingsList=[], repetitionMode='LOOP',
+                 outputType=np.float32, tryGPU=True, cacheSize=8, prefetch=0, memmapPath=None):
+        PatientData.__init__(self, name=name)
+
+        if len(phaseList) != len(amplitudeList):
+            raise ValueError('Numbers of phases and amplitudes do not match')
+
+        self.model = model
+        self.phaseList = [list(np.atleast_1d(phases)) for phases in phaseList]
+        self.amplitudeList = [list(np.atleast_1d(amplitudes)) for amplitudes in amplitudeList]
+        self.ROIList = ROIList if ROIList is not None else []
+        self.outputType = outputType
+        self.tryGPU = tryGPU
+        self.cacheSize = cacheSize
+        self.prefetch = prefetch
+        self.memmapPath = memmapPath
+        self.repetitionMode = repetitionMode
+        self.dyn3DImageList = _LazyImageList(self)
+
+        if len(timingsList) > 0:
+            self.timingsList = timingsList
+        else:
+            self.breathingPeriod = 4000
+            self.inhaleDuration = 1800
+            self.prepareTimings()
+
+        self._weightMaps = None
+        self._resampling = None
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._lock = threading.RLock()
+        self._executor = None
+        self._memmap = None
+        self._spilled = np.zeros(len(self.phaseList), dtype=bool)
+        self._statistics = {}
+        self.resetStatistics()
+
+    def __str__(self):
+        return "Lazy dyn series: " + self.name + ' - ' + str(len(self)) + ' frames\n'
+
+    def __len__(self):
+        return len(self.phaseList)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('Frame index out of range')
+
+        image = self._getFrame(index)
+        self._prefetchFrames(index)
+        return image
+
+    def __setitem__(self, index, value):
+        raise TypeError('The frames of a LazyDynamic3DSequence are generated from the model and cannot be set')
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def statistics(self) -> dict:
+        return dict(self._statistics)
+
+    def resetStatistics(self):
+        """
+        Reset the hit, memory-mapped file read, generation and eviction counters.
+        """
+        self._statistics = {'hits': 0, 'memmapReads': 0, 'generated': 0, 'evictions': 0}
+
+    def close(self):
+        """
+        Stop the prefetch thread, and release the cached frames and the memory-mapped file.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        self.clearCache()
+
+    def clearCache(self):
+        """
+        Remove the frames from the cache and forget the frames stored in the memory-mapped file.
+        """
+        with self._lock:
+            self._cache.clear()
+            self._memmap = None
+            self._spilled[:] = False
+
+    def resampleOn(self, otherImage, fillValue=0, outputType=None, tryGPU=True):
+        """
+        Resample the frames on another image. The resampling is applied to the frames when they are generated.
+
+        Parameters
+        ----------
+        otherImage : 3DImage
+            Image on which the dynamic 3D sequence is resampled.
+        fillValue : int (default = 0)
+            Fill value.
+        outputType : str (default = None)
+            Output type.
+        tryGPU : bool (default = True)
+            Boolean indicating if the GPU is used.
+        """
+        self.resample(otherImage.spacing, otherImage.gridSize, otherImage.origin, fillValue=fillValue, outputType=outputType, tryGPU=tryGPU)
+
+    def resample(self, spacing, gridSize, origin, fillValue=0, outputType=None, tryGPU=True):
+        """
+        Resample the frames. The resampling is applied to the frames when they are generated.
+
+        Parameters
+        ----------
+        spacing : array_like
+            Spacing in mm.
+        gridSize : array_like
+            Grid size.
+        origin : array_like
+            Origin.
+        fillValue : int (default = 0)
+            Fill value.
+        outputType : str (default = None)
+            Output type.
+        tryGPU : bool (default = True)
+            Boolean indicating if the GPU is used.
+        """
+        self._waitForPrefetch()
+        self._resampling = (spacing, gridSize, origin, fillValue, outputType, tryGPU)
+        self.clearCache()
+
+    def dumpableCopy(self):
+        """
+        Create a dumpable copy of the sequence, in which all frames are generated.
+
+        Returns
+        -------
+        Dynamic3DSequence
+            Dumpable copy of the dynamic 3D sequence.
+        """
+        dumpableImageCopiesList = [image.dumpableCopy() for image in self]
+        return Dynamic3DSequence(dyn3DImageList=dumpableImageCopiesList, timingsList=self.timingsList, name=self.name)
+
+    def _getFrame(self, index):
+        with self._lock:
+            image = self._cache.get(index)
+            if image is not None:
+                self._cache.move_to_end(index)
+                self._statistics['hits'] += 1
+                return image
+            future = self._pending.get(index)
+
+        if future is not None:
+            future.result()
+            with self._lock:
+                image = self._cache.get(index)
+                if image is not None:
+                    self._statistics['hits'] += 1
+                    return image
+
+        return self._loadFrame(index)
+
+    def _loadFrame(self, index):
+        with self._lock:
+            spilled = self._memmap is not None and self._spilled[index]
+            if spilled:
+                imageArray = np.array(self._memmap[index])
+
+        if spilled:
+            image = self._frameImage(index, imageArray)
+            statistic = 'memmapReads'
+        else:
+            image = self._generateFrame(index)
+            statistic = 'generated'
+
+        with self._lock:
+            self._statistics[statistic] += 1
+            if not spilled and self.memmapPath is not None:
+                self._spill(index, image.imageArray)
+            self._cache[index] = image
+            self._cache.move_to_end(index)
+            while len(self._cache) > max(self.cacheSize, 1):
+                self._cache.popitem(last=False)
+                self._statistics['evictions'] += 1
+        return image
+
+    def _generateFrame(self, index):
+        phases, amplitudes = self.phaseList[index], self.amplitudeList[index]
+        if len(self.ROIList) > 1:
+            with self._lock:
+                if self._weightMaps is None:
+                    self._weightMaps = getWeightMapsAsImage3DList(self.ROIList, self.model.deformationList[0])
+            deformation = generateDeformationFromTrackersAndWeightMaps(self.model, phases, amplitudes, self._weightMaps)
+        else:
+            deformation = self.model.generate3DDeformation(phases[0], amplitude=amplitudes[0])
+
+        image = deformation.deformImage(self.model.midp, fillValue='closest', outputType=self.outputType, tryGPU=self.tryGPU)
+        if self._resampling is not None:
+            spacing, gridSize, origin, fillValue, outputType, tryGPU = self._resampling
+            image.resample(spacing, gridSize, origin, fillValue=fillValue, outputType=outputType, tryGPU=tryGPU)
+        image.name = self.name + '_' + str(index)
+        return image
+
+    def _frameImage(self, index, imageArray):
+        midp = self.model.midp
+        spacing, origin = midp.spacing, midp.origin
+        if self._resampling is not None:
+            spacing, _, origin = self._resampling[:3]
+        return midp.__class__(imageArray=imageArray, name=self.name + '_' + str(index), origin=origin, spacing=spacing, angles=midp.angles)
+
+    def _spill(self, index, imageArray):
+        if self._memmap is None:
+            self._memmap = np.memmap(self.memmapPath, dtype=imageArray.dtype, mode='w+', shape=(len(self),) + imageArray.shape)
+        self._memmap[index] = imageArray
+        self._spilled[index] = True
+
+    def _prefetchFrames(self, index):
+        if self.prefetch <= 0:
+            return
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+            for nextIndex in range(index + 1, min(index + 1 + self.prefetch, len(self))):
+                if nextIndex not in self._cache and nextIndex not in self._pending:
+                    future = self._executor.submit(self._loadFrame, nextIndex)
+                    self._pending[nextIndex] = future
+                    future.add_done_callback(lambda _, i=nextIndex: self._pending.pop(i, None))
+
+    def _waitForPrefetch(self):
+        with self._lock:
+            futures = list(self._pending.values())
+        for future in futures:
+            future.result()
+
+
+class _LazyImageList(Sequence):
+    # read-only list view of the frames of a LazyDynamic3DSequence
+    def __init__(self, sequence):
+        self._sequence = sequence
+
+    def __len__(self):
+        return len(self._sequence)
+
+    def __getitem__(self, index):
+        return self._sequence[index]
+
+
+class LazyDynamic3DSequenceTestCase(unittest.TestCase):
+    def testFrames(self):
+        import os
+        import tempfile
+        from opentps.core.data.dynamicData._dynamic3DModel import Dynamic3DModel
+        from opentps.core.data.images import CTImage
+        from opentps.core.data.images._deformation3D import Deformation3D
+        from opentps.core.data.images._vectorField3D import VectorField3D
+
+        rng = np.random.default_rng(0)
+        midp = CTImage(imageArray=rng.normal(size=(8, 7, 6)).astype(np.float32), spacing=(2., 2., 2.))
+        deformationList = []
+        for phase in range(4):
+            deformation = Deformation3D()
+            deformation.velocity = VectorField3D(imageArray=rng.normal(0., 0.5, (8, 7, 6, 3)).astype(np.float32), spacing=midp.spacing)
+            deformationList.append(deformation)
+        model = Dynamic3DModel(midp=midp, deformationList=deformationList)
+
+        phaseList = [[0.1], [0.35], [0.6], [0.8], [0.95]]
+        amplitudeList = [[1.], [1.], [0.5], [1.2], [1.]]
+        expected = [model.generate3DImage(phases[0], amplitude=amplitudes[0], tryGPU=False).imageArray for phases, amplitudes in zip(phaseList, amplitudeList)]
+
+        with tempfile.TemporaryDirectory() as directory:
+            sequence = LazyDynamic3DSequence(model, phaseList, amplitudeList, tryGPU=False, cacheSize=2, prefetch=1,
+                                             memmapPath=os.path.join(directory, 'frames.dat'))
+            self.assertEqual(len(sequence.dyn3DImageList), 5)
+            for image, expectedArray in zip(sequence, expected):
+                np.testing.assert_allclose(image.imageArray, expectedArray, atol=1e-5)
+            np.testing.assert_allclose(sequence[-1].imageArray, expected[-1], atol=1e-5)
+            np.testing.assert_allclose(sequence.dyn3DImageList[0].imageArray, expected[0], atol=1e-5)
+
+            # frames 0 and 1 (prefetched) were evicted and are read back from the file
+            sequence._waitForPrefetch()
+            statistics = sequence.statistics
+            self.assertEqual(statistics['generated'], 5)
+            self.assertEqual(statistics['memmapReads'], 2)
+            sequence.close()
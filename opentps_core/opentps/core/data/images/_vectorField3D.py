@@ -3,12 +3,12 @@ __all__ = ['VectorField3D']
 
 
 import numpy as np
-import math
 import copy
 import logging
 
 from opentps.core.data.images._image3D import Image3D
 import opentps.core.processing.imageProcessing.resampler3D as resampler3D
+from opentps.core.processing.imageProcessing.fieldExponentiation import ScalingAndSquaring
 
 logger = logging.getLogger(__name__)
 
@@ -94,7 +94,7 @@ class VectorField3D(Image3D):
 
         return resampler3D.warp(data, self._imageArray, self.spacing, fillValue=fillValue, outputType=outputType, tryGPU=tryGPU)
 
-    def exponentiateField(self, outputType=np.float32, tryGPU=True):
+    def exponentiateField(self, outputType=np.float32, tryGPU=True, tolerance=None, scalingAndSquaring=None):
         """
         Exponentiate the vector field (e.g. to convert velocity in to displacement).
 
@@ -104,6 +104,12 @@ class VectorField3D(Image3D):
             output data type.
         tryGPU : bool (default: True)
             if True, try to use GPU for warping.
+        tolerance : float (default: None)
+            if not None, the squaring steps on CPU stop once their correction is below tolerance (in voxels), see
+            ScalingAndSquaring.exponentiate.
+        scalingAndSquaring : ScalingAndSquaring (default: None)
+            exponentiation on CPU, whose buffers can be reused for several fields of the same grid. If None, it is
+            created for this field.
 
         Returns
         -------
@@ -135,21 +141,9 @@ class VectorField3D(Image3D):
                 tryGPU = False
 
         if tryGPU is False:
-            norm = np.square(self._imageArray[:, :, :, 0]/self.spacing[0]) + np.square(self._imageArray[:, :, :, 1]/self.spacing[1]) + np.square(self._imageArray[:, :, :, 2]/self.spacing[2])
-            N = math.ceil(2 + math.log2(np.maximum(1.0, np.amax(np.sqrt(norm)))) / 2) + 1
-            if N < 1: N = 1
-
-            displacement._imageArray = displacement._imageArray * 2 ** (-N)
-
-            for r in range(N):
-                new_0 = displacement.warp(displacement._imageArray[:, :, :, 0], fillValue='closest', tryGPU=tryGPU)
-                new_1 = displacement.warp(displacement._imageArray[:, :, :, 1], fillValue='closest', tryGPU=tryGPU)
-                new_2 = displacement.warp(displacement._imageArray[:, :, :, 2], fillValue='closest', tryGPU=tryGPU)
-                displacement._imageArray[:, :, :, 0] += new_0
-                displacement._imageArray[:, :, :, 1] += new_1
-                displacement._imageArray[:, :, :, 2] += new_2
-
-            displacement._imageArray = displacement._imageArray.astype(outputType)
+            if scalingAndSquaring is None:
+                scalingAndSquaring = ScalingAndSquaring(self.gridSize, self.spacing)
+            displacement._imageArray = scalingAndSquaring.exponentiate(self._imageArray, tolerance=tolerance).astype(outputType, copy=False)
 
         return displacement
 
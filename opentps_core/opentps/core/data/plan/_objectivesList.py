@@ -209,6 +209,31 @@ class ObjectivesList:
         objective.weight = weight
         self.exoticObjList.append(objective)
 
+    def getRoiRows(self, robust=False) -> np.ndarray:
+        """
+        Get the voxels (rows of the beamlet matrix) belonging to at least one Fidelity Objective.
+        The masks of the objectives must be up to date (see RTPlanDesign.setScoringParameters).
+
+        Parameters
+        ----------
+        robust: bool (default: False)
+            if True, only the robust objectives are considered
+
+        Returns
+        -------
+        np.ndarray
+            sorted indices of the voxels in the flattened dose grid
+        """
+        roiUnion = None
+        for objective in self.fidObjList:
+            if robust and not objective.robust:
+                continue
+            roiUnion = objective.maskVec.copy() if roiUnion is None else np.logical_or(roiUnion, objective.maskVec)
+
+        if roiUnion is None:
+            return np.zeros(0, dtype=np.int64)
+        return np.flatnonzero(roiUnion)
+
 
 class FidObjective:
     """
@@ -228,6 +253,10 @@ class FidObjective:
         kind of the objective : "Soft" or "Hard"
     maskVec: np.ndarray
         mask vector
+    roiIndex: np.ndarray
+        indices of the mask voxels in the ROI-restricted dose vector of the nominal scenario
+    robustRoiIndex: np.ndarray
+        indices of the mask voxels in the ROI-restricted dose vector of the error scenarios (robust objectives only)
     roi: ROIContour or ROIMask
         region of interest
     roiName: str
@@ -261,6 +290,8 @@ class FidObjective:
         self.robust = False
         self.kind = "Soft"
         self.maskVec = None
+        self.roiIndex = None
+        self.robustRoiIndex = None
         self._roi = roi
         self.volume = None
         self.EUDa = None
@@ -277,6 +308,24 @@ class FidObjective:
     def roiName(self) -> str:
         return self.roi.name
 
+    def _updateRoiIndex(self, roiRows:np.ndarray, robustRoiRows:Optional[np.ndarray]=None):
+        """
+        Compute the indices of the mask voxels in the ROI-restricted dose vectors.
+
+        Parameters
+        ----------
+        roiRows: np.ndarray
+            sorted voxels kept in the nominal beamlet matrix. They must contain the mask.
+        robustRoiRows: np.ndarray (default: None)
+            sorted voxels kept in the scenario beamlet matrices. They must contain the mask of robust objectives.
+        """
+        voxels = np.flatnonzero(self.maskVec)
+        self.roiIndex = np.searchsorted(roiRows, voxels)
+        if self.robust and robustRoiRows is not None:
+            self.robustRoiIndex = np.searchsorted(robustRoiRows, voxels)
+        else:
+            self.robustRoiIndex = None
+
 
     def _updateMaskVec(self, spacing:Sequence[float], gridSize:Sequence[int], origin:Sequence[float]):
         from opentps.core.data._roiContour import ROIContour
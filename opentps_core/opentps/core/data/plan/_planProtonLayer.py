@@ -345,9 +345,13 @@ class PlanProtonLayer:
         return (exist, where)
 
     def _singleSpotCheck(self, x: float, y: float) -> Tuple[bool, Optional[int]]:
-        for i, (x_xy, y_xy) in enumerate(self.spotXY):
-            if (np.isclose(x , x_xy, atol=0.1) and np.isclose(y , y_xy, atol=0.1)):
-                return (True, i)
+        # same tolerance as np.isclose(x, x_xy, atol=0.1) for all spots at once
+        spotX = np.asarray(self._x, dtype=float)
+        spotY = np.asarray(self._y, dtype=float)
+        matches = np.flatnonzero((np.abs(x - spotX) <= 0.1 + 1e-5 * np.abs(spotX))
+                                 & (np.abs(y - spotY) <= 0.1 + 1e-5 * np.abs(spotY)))
+        if len(matches) > 0:
+            return (True, int(matches[0]))
         return (False, None)
 
     def reorderSpots(self, order: Union[str, Sequence[int]] = 'scanAlgo'):
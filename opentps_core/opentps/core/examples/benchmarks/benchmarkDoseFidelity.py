@@ -0,0 +1,86 @@
+import time
+import logging
+
+import numpy as np
+import scipy.sparse as sp
+
+from opentps.core.data import SparseBeamlets
+from opentps.core.data.plan import ProtonPlan, ProtonPlanDesign, FidObjective
+from opentps.core.processing.planOptimization.objectives.doseFidelity import DoseFidelity
+from opentps.core.processing.planOptimization.objectives.fusedDoseFidelity import FusedDoseFidelity
+
+logger = logging.getLogger(__name__)
+
+
+def createSyntheticPlan(nbVoxels=300000, nbSpots=1000, density=0.004, nbObjectives=10, nbScenarios=0, seed=0):
+    """
+    Create a plan with random beamlet matrices and nbObjectives objectives cycling through all metrics. The masks are
+    random boxes of the flattened grid. One objective out of three is robust if nbScenarios > 0.
+    """
+    rng = np.random.default_rng(seed)
+
+    def randomBeamlets(seed):
+        scenarioRng = np.random.default_rng(seed)
+        nbValues = int(density * nbVoxels)
+        indices = np.sort(scenarioRng.integers(0, nbVoxels, (nbSpots, nbValues)), axis=1).ravel()
+        data = scenarioRng.random(len(indices), dtype=np.float32)
+        matrix = sp.csc_matrix((data, indices, np.arange(nbSpots + 1) * nbValues), shape=(nbVoxels, nbSpots))
+        matrix.sum_duplicates()
+        beamlets = SparseBeamlets()
+        beamlets.setUnitaryBeamlets(matrix)
+        return beamlets
+
+    plan = ProtonPlan()
+    plan.planDesign = ProtonPlanDesign()
+    plan.planDesign.beamlets = randomBeamlets(seed)
+    plan.planDesign.robustness.scenarios = [randomBeamlets(seed + s + 1) for s in range(nbScenarios)]
+
+    metrics = list(FidObjective.Metrics)
+    for i in range(nbObjectives):
+        objective = FidObjective(metric=metrics[i % len(metrics)], limitValue=rng.uniform(0.5, 2.), weight=rng.uniform(1, 10))
+        objective.robust = nbScenarios > 0 and i % 3 == 0
+        objective.volume = 0.5
+        objective.EUDa = 3.
+        start = rng.integers(0, nbVoxels // 2)
+        objective.maskVec = np.zeros(nbVoxels, dtype=bool)
+        objective.maskVec[start:start + rng.integers(nbVoxels // 100, nbVoxels // 10)] = True
+        objective.voxelwiseLimitValue = rng.uniform(0.5, 2., objective.maskVec.sum()).astype(np.float32)
+        plan.planDesign.objectives.fidObjList.append(objective)
+
+    return plan
+
+
+def timeFidelity(fidelity, x, nbEvaluations):
+    start_time = time.time()
+    for i in range(nbEvaluations):
+        xi = x * (1 + 0.01 * i)
+        f = fidelity.computeFidelityFunction(xi)
+        g = fidelity.computeFidelityGradient(xi)
+    return (time.time() - start_time) / nbEvaluations, f, g
+
+
+def run():
+    nbEvaluations = 5
+
+    for nbObjectives, nbScenarios in ((10, 0), (25, 0), (50, 0), (25, 21)):
+        plan = createSyntheticPlan(nbObjectives=nbObjectives, nbScenarios=nbScenarios)
+        x = np.random.default_rng(1).uniform(0.5, 1.5, plan.planDesign.beamlets.shape[1])
+
+        reference = DoseFidelity(plan)
+        referenceTime, referenceValue, referenceGradient = timeFidelity(reference, x, nbEvaluations)
+
+        fused = FusedDoseFidelity(plan)
+        fusedTime, fusedValue, fusedGradient = timeFidelity(fused, x, nbEvaluations)
+
+        assert np.isclose(referenceValue, fusedValue, rtol=1e-4), "Fused objective value does not match DoseFidelity"
+        assert np.allclose(referenceGradient, fusedGradient, rtol=1e-3, atol=1e-4 * np.abs(referenceGradient).max()), \
+            "Fused gradient does not match DoseFidelity"
+
+        print('Objectives:', nbObjectives, '- scenarios:', nbScenarios, '- ROI voxels:', len(fused.roiRows))
+        print('DoseFidelity (value + gradient):', referenceTime, 's')
+        print('FusedDoseFidelity (value + gradient):', fusedTime, 's')
+        print('Speed-up:', referenceTime / fusedTime, '\n')
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,64 @@
+import time
+import logging
+
+import numpy as np
+
+from opentps.core.data.images import DoseImage
+from opentps.core.processing.dataComparison.gammaIndex import gammaIndex, computePassRate
+
+logger = logging.getLogger(__name__)
+
+
+def createSyntheticDoses(gridSize=(80, 80, 60), spacing=(2., 2., 2.5), shift=(1.5, -1., 0.5), scaling=1.04,
+                         noise=1., seed=0):
+    """
+    Create a reference dose made of Gaussian fields and an evaluation dose shifted by shift mm, scaled by scaling and
+    with Gaussian noise of standard deviation noise Gy.
+    """
+    rng = np.random.default_rng(seed)
+    coordinates = np.meshgrid(*[np.arange(n) * s for n, s in zip(gridSize, spacing)], indexing='ij')
+    centers = [np.array(gridSize) * np.array(spacing) * f for f in (0.45, 0.55)]
+
+    def dose(offset):
+        total = np.zeros(gridSize)
+        for center, amplitude in zip(centers, (60., 40.)):
+            total += amplitude * np.exp(-sum((c - x0 - o) ** 2 for c, x0, o in zip(coordinates, center, offset)) / 400.)
+        return total
+
+    reference = DoseImage(imageArray=dose((0., 0., 0.)), spacing=spacing)
+    evaluation = DoseImage(imageArray=scaling * dose(shift) + rng.normal(0, noise, gridSize), spacing=spacing)
+    return reference, evaluation
+
+
+def run():
+    reference, evaluation = createSyntheticDoses()
+
+    for dose_percent_threshold, distance_mm_threshold in ((3, 3), (2, 2)):
+        print('Gamma', str(dose_percent_threshold) + '%/' + str(distance_mm_threshold) + 'mm', '- grid',
+              reference.gridSize)
+
+        start_time = time.time()
+        nativeGamma = gammaIndex(reference, evaluation, dose_percent_threshold, distance_mm_threshold, engine='native')
+        nativeTime = time.time() - start_time
+        print('Native engine:', nativeTime, 's - pass rate', computePassRate(nativeGamma), '%')
+
+        try:
+            start_time = time.time()
+            pymedphysGamma = gammaIndex(reference, evaluation, dose_percent_threshold, distance_mm_threshold,
+                                        engine='pymedphys')
+            pymedphysTime = time.time() - start_time
+        except ImportError as error:
+            print('pymedphys engine unavailable:', error, '\n')
+            continue
+        print('pymedphys engine:', pymedphysTime, 's - pass rate', computePassRate(pymedphysGamma), '%')
+
+        valid = ~np.isnan(pymedphysGamma.imageArray)
+        difference = np.abs(nativeGamma.imageArray[valid] - pymedphysGamma.imageArray[valid])
+        assert np.array_equal(np.isnan(nativeGamma.imageArray), ~valid), "Gamma is not computed on the same voxels"
+        assert abs(computePassRate(nativeGamma) - computePassRate(pymedphysGamma)) < 2, "Pass rates do not match"
+        print('Gamma difference: median', np.median(difference), '- 99th percentile', np.percentile(difference, 99))
+        print('Speed-up:', pymedphysTime / nativeTime, '\n')
+
+
+if __name__ == "__main__":
+    run()
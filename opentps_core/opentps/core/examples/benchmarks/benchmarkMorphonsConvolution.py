@@ -0,0 +1,42 @@
+import time
+import logging
+
+import numpy as np
+
+from opentps.core.data.images import CTImage
+import opentps.core.processing.registration.morphonsConvolution as morphonsConvolution
+from opentps.core.processing.registration.registrationMorphons import applyMorphonsKernels, loadMorphonsKernels
+
+logger = logging.getLogger(__name__)
+
+
+def run():
+    kernels = loadMorphonsKernels()
+    rng = np.random.default_rng(0)
+
+    # the small grids are the coarse Morphons scales, they set the threshold of the 'auto' backend
+    for gridSize in ((8, 8, 8), (16, 16, 16), (10, 10, 3), (32, 32, 32), (64, 64, 50), (128, 128, 100), (192, 192, 150)):
+        image = CTImage(imageArray=rng.normal(size=gridSize).astype(np.float32))
+
+        start_time = time.time()
+        reference = applyMorphonsKernels(image, kernels, is_fixed=0, tryGPU=False, backend='fftconvolve')
+        fftconvolveTime = time.time() - start_time
+
+        # the first call of a block shape computes the kernel spectra, the next ones (registration iterations) reuse them
+        morphonsConvolution._spectraCache.clear()
+        start_time = time.time()
+        applyMorphonsKernels(image, kernels, is_fixed=0, tryGPU=False, backend='blockFFT')
+        firstBlockFFTTime = time.time() - start_time
+
+        start_time = time.time()
+        responses = applyMorphonsKernels(image, kernels, is_fixed=0, tryGPU=False, backend='blockFFT')
+        blockFFTTime = time.time() - start_time
+
+        error = max(np.abs(response - ref).max() / np.abs(ref).max() for response, ref in zip(responses, reference))
+        assert error < 1e-5, "Block FFT responses do not match fftconvolve"
+        print('Grid size', gridSize, '- fftconvolve:', fftconvolveTime, 's - block FFT:', blockFFTTime,
+              's (first call:', firstBlockFFTTime, 's) - max relative difference', error)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,61 @@
+import time
+import logging
+
+import numpy as np
+
+from opentps.core.data.images import RSPImage, ROIMask
+from opentps.core.processing.C_libraries import libRayTracing_numpy, nativeBackend
+from opentps.core.processing.C_libraries.libRayTracing_wrapper import WET_raytracing
+
+logger = logging.getLogger(__name__)
+
+
+def createSyntheticPhantom(gridSize=(120, 120, 90), spacing=(2., 2., 2.5), seed=0):
+    """
+    Create a SPR phantom made of a water cylinder containing a bone and a lung insert, and a spherical target.
+    """
+    rng = np.random.default_rng(seed)
+    coordinates = np.meshgrid(*[(np.arange(n) - n / 2) * s for n, s in zip(gridSize, spacing)], indexing='ij')
+    radius = min(gridSize[0] * spacing[0], gridSize[1] * spacing[1]) * 0.45
+
+    spr = np.full(gridSize, 0.001, dtype=np.float32)
+    spr[coordinates[0] ** 2 + coordinates[1] ** 2 < radius ** 2] = 1.
+    spr[(coordinates[0] - radius / 2) ** 2 + coordinates[1] ** 2 < (radius / 5) ** 2] = 1.6
+    spr[(coordinates[0] + radius / 2) ** 2 + coordinates[1] ** 2 < (radius / 4) ** 2] = 0.3
+    spr += rng.normal(0., 0.01, gridSize).astype(np.float32)
+    rsp = RSPImage(imageArray=spr, spacing=spacing, origin=(-gridSize[0] * spacing[0] / 2, -gridSize[1] * spacing[1] / 2, 0.))
+
+    target = sum(c ** 2 for c in coordinates[:2]) + (coordinates[2] - 10.) ** 2 < (radius / 3) ** 2
+    roi = ROIMask(imageArray=target, spacing=spacing, origin=rsp.origin)
+    return rsp, roi
+
+
+def run():
+    rsp, roi = createSyntheticPhantom()
+    print('SPR phantom', rsp.gridSize, '-', np.count_nonzero(roi.imageArray), 'target voxels')
+
+    for beamDirection in ((1., 0., 0.), (0.6, 0.8, 0.), (0.36, -0.48, 0.8)):
+        beamDirection = np.array(beamDirection) / np.linalg.norm(beamDirection)
+
+        start_time = time.time()
+        wet = WET_raytracing(rsp, beamDirection, roi)
+        wrapperTime = time.time() - start_time
+
+        start_time = time.time()
+        numpyWET = np.zeros(rsp.gridSize, dtype=np.float32)
+        libRayTracing_numpy.raytrace_WET(nativeBackend.asFloat32(rsp.imageArray), roi.imageArray, numpyWET,
+                                         np.array(rsp.origin, dtype=np.float32), np.array(rsp.spacing, dtype=np.float32),
+                                         np.array(rsp.gridSize), np.array(beamDirection, dtype=np.float32))
+        numpyTime = time.time() - start_time
+
+        print('Beam direction', np.round(beamDirection, 2))
+        if nativeBackend.loadLibrary('libRayTracing') is None:
+            print('libRayTracing unavailable, numpy implementation:', numpyTime, 's\n')
+            continue
+        assert np.allclose(wet, numpyWET, rtol=1e-5, atol=1e-3), "Numpy WET does not match libRayTracing"
+        print('libRayTracing:', wrapperTime, 's - numpy:', numpyTime, 's - max WET difference',
+              np.abs(wet - numpyWET).max(), 'mm\n')
+
+
+if __name__ == "__main__":
+    run()
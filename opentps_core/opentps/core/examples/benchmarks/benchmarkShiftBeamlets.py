@@ -0,0 +1,58 @@
+import time
+import logging
+
+import numpy as np
+import scipy.sparse as sp
+
+from opentps.core.processing.doseCalculation.photons import _utils
+
+logger = logging.getLogger(__name__)
+
+
+def createSyntheticBeamlets(gridSize=(100, 100, 80), nbBeamlets=200, beamletSize=(12, 12, 30), seed=0):
+    """
+    Create a synthetic photon beamlet matrix. Each beamlet is a box of random doses, which mimics the voxels of the
+    dose grid reached by a beamlet.
+    """
+    rng = np.random.default_rng(seed)
+    nbVoxels = int(np.prod(gridSize))
+    boxSize = np.array(beamletSize)
+    boxIndexes = np.ravel_multi_index(np.indices(beamletSize).reshape((3, -1)), gridSize, order='F')
+
+    indexes, values = [], []
+    for beamlet in range(nbBeamlets):
+        corner = rng.integers(2, np.array(gridSize) - boxSize - 2)
+        indexes.append(boxIndexes + np.ravel_multi_index(corner, gridSize, order='F'))
+        values.append(rng.random(boxIndexes.size, dtype=np.float32) + 0.1)
+
+    indptr = np.arange(nbBeamlets + 1) * boxIndexes.size
+    beamlets = sp.csc_matrix((np.concatenate(values), np.concatenate(indexes), indptr), shape=(nbVoxels, nbBeamlets))
+    beamlets.sort_indices()
+    return beamlets, rng.uniform(0, 2 * np.pi, nbBeamlets)
+
+
+def run():
+    gridSize = (100, 100, 80)
+    beamlets, beamletAngles_rad = createSyntheticBeamlets(gridSize)
+    scenarioShifts_voxel = [np.array(shift) for shift in ((1.6, 0., 0.), (-1.6, 0., 0.), (0., 1.2, 0.), (0., -1.2, 0.), (0., 0., 2.), (0., 0., -2.))]
+
+    start_time = time.time()
+    references = [_utils.shiftBeamlets_cpp(beamlets, gridSize, shift.copy(), beamletAngles_rad) for shift in scenarioShifts_voxel]
+    referenceTime = time.time() - start_time
+
+    start_time = time.time()
+    shiftedBeamlets = _utils.shiftBeamlets_csc(beamlets, gridSize, scenarioShifts_voxel, beamletAngles_rad)
+    cscTime = time.time() - start_time
+
+    for reference, shifted in zip(references, shiftedBeamlets):
+        assert reference.nnz == shifted.nnz, "Shifted beamlets do not have the non-zeros of the reference"
+        assert abs(reference - shifted).max() < 1e-5, "Shifted beamlets do not match the reference"
+
+    print('Scenarios:', len(scenarioShifts_voxel), '- non-zeros:', beamlets.nnz)
+    print('C++ engine, one call per scenario:', referenceTime, 's')
+    print('CSC engine, all scenarios at once:', cscTime, 's')
+    print('Speed-up:', referenceTime / cscTime)
+
+
+if __name__ == "__main__":
+    run()
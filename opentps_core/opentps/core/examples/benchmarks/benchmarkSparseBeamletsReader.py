@@ -0,0 +1,77 @@
+import os
+import struct
+import time
+import logging
+
+import numpy as np
+
+from opentps.core.data.images import ROIMask
+from opentps.core.io import mcsquareIO
+
+logger = logging.getLogger(__name__)
+
+
+def createSyntheticSparseBeamlets(filePath, gridSize=(100, 100, 100), nbSpots=300, runLength=40, nbRuns=400, seed=0):
+    """
+    Write a synthetic MCsquare sparse beamlets binary file. Each spot is made of nbRuns runs of runLength contiguous
+    voxels, which mimics the voxel rows crossed by a pencil beam.
+    """
+    rng = np.random.default_rng(seed)
+    nbVoxels = gridSize[0] * gridSize[1] * gridSize[2]
+
+    with open(filePath, 'wb') as fid:
+        for spot in range(nbSpots):
+            firstIndices = np.sort(rng.choice(nbVoxels // runLength, nbRuns, replace=False)) * runLength
+            fid.write(struct.pack('IIIff', nbRuns * runLength, 0, spot, 0., 0.))
+            for firstIndex in firstIndices:
+                fid.write(struct.pack('II', runLength, firstIndex))
+                fid.write(rng.random(runLength, dtype=np.float32).tobytes())
+
+    return nbVoxels
+
+
+def run():
+    output_path = os.path.join(os.getcwd(), 'Output')
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    logger.info('Files will be stored in {}'.format(output_path))
+
+    gridSize = (100, 100, 100)
+    nbSpots = 300
+    binaryFile = os.path.join(output_path, 'Sparse_Dose_benchmark.bin')
+    nbVoxels = createSyntheticSparseBeamlets(binaryFile, gridSize=gridSize, nbSpots=nbSpots)
+
+    roiArray = np.zeros(gridSize, dtype=bool)
+    roiArray[25:75, 25:75, 25:75] = True
+    roi = ROIMask(imageArray=roiArray, name='target')
+
+    # Per-spot logging of the reference reader would dominate the timing
+    logging.getLogger(mcsquareIO.__name__).setLevel(logging.WARNING)
+
+    for testROI in (None, roi):
+        start_time = time.time()
+        reference = mcsquareIO._read_sparse_data_legacy(binaryFile, nbVoxels, nbSpots, testROI)
+        referenceTime = time.time() - start_time
+
+        start_time = time.time()
+        beamlets = mcsquareIO._read_sparse_data(binaryFile, nbVoxels, nbSpots, testROI)
+        vectorizedTime = time.time() - start_time
+
+        start_time = time.time()
+        parallelBeamlets = mcsquareIO._read_sparse_data(binaryFile, nbVoxels, nbSpots, testROI, nbWorkers=os.cpu_count())
+        parallelTime = time.time() - start_time
+
+        assert (reference != beamlets).nnz == 0, "Vectorized reader does not match the reference reader"
+        assert (reference != parallelBeamlets).nnz == 0, "Parallel reader does not match the reference reader"
+
+        print('ROI:', 'none' if testROI is None else testROI.name, '- non-zeros:', beamlets.nnz)
+        print('Reference reader:', referenceTime, 's')
+        print('Vectorized reader:', vectorizedTime, 's')
+        print('Parallel reader ({} threads):'.format(os.cpu_count()), parallelTime, 's')
+        print('Speed-up:', referenceTime / min(vectorizedTime, parallelTime), '\n')
+
+    os.remove(binaryFile)
+
+
+if __name__ == "__main__":
+    run()
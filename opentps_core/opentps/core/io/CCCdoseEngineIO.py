@@ -1,6 +1,9 @@
 import os
 import struct
 import logging
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import scipy.sparse as sp
@@ -162,7 +165,177 @@ def changeOfCoordinates(beamIndexes, size): ### The indexes exported in CCC have
     return formatToOpenTPSformat([j, k, i], size) ### This transpose the axis j = 0, k = 1, i = 2 and order the indexes following the indexation used in OpenTPS 
         
 
-def read_sparse_data(matrixBeamlets_path, header, BeamletMatrix = None):
+def read_sparse_data(matrixBeamlets_path, header, BeamletMatrix = None, roiUnion = None):
+    """
+    Read a sparse beamlet batch file and append its beamlets to BeamletMatrix, as a single CSC matrix.
+
+    Parameters
+    ----------
+    matrixBeamlets_path : str
+        Path of the sparseBeamletMatrix_batch*.bin file
+    header : dict
+        CT header (see read_header)
+    BeamletMatrix : list, optional
+        List of matrices to which the batch is appended
+    roiUnion : np.ndarray, optional
+        Flat boolean mask of the voxels to keep (see mergeContours)
+
+    Returns
+    -------
+    BeamletMatrix : list
+        The list of matrices
+    Nbeamlets : int
+        Number of beamlets in the batch
+    """
+    if BeamletMatrix is None:
+        BeamletMatrix = []
+    batchMatrix = decodeSparseBatch(matrixBeamlets_path, header, roiUnion)
+    BeamletMatrix.append(batchMatrix)
+    return BeamletMatrix, batchMatrix.shape[1]
+
+def decodeSparseBatch(matrixBeamlets_path, header, roiUnion = None):
+    """
+    Decode a sparse beamlet batch file into a CSC matrix with one column per beamlet. The file is memory-mapped, the
+    beamlet headers are walked once and the indexes and values of all beamlets are gathered and remapped in bulk.
+
+    Parameters
+    ----------
+    matrixBeamlets_path : str
+        Path of the sparseBeamletMatrix_batch*.bin file
+    header : dict
+        CT header (see read_header)
+    roiUnion : np.ndarray, optional
+        Flat boolean mask of the voxels to keep (see mergeContours)
+
+    Returns
+    -------
+    csc_matrix
+        Beamlet matrix of shape (NbrVoxels, Nbeamlets)
+    """
+    words = np.memmap(matrixBeamlets_path, dtype='<i4', mode='r') ### Every field of the file is a 4 bytes int or float
+    Nbeamlets = int(words[0])
+    starts, counts = _index_sparse_batch(words, Nbeamlets)
+
+    beamIndexes, beamValues = _gather_sparse_beamlets(words, starts, counts, header['Size'])
+    columns = np.repeat(np.arange(Nbeamlets), counts)
+    del words
+
+    if roiUnion is not None:
+        keep = roiUnion[beamIndexes]
+        beamIndexes, beamValues, columns = beamIndexes[keep], beamValues[keep], columns[keep]
+
+    indptr = np.zeros(Nbeamlets + 1, dtype=np.int64)
+    np.cumsum(np.bincount(columns, minlength=Nbeamlets), out=indptr[1:])
+    BeamletMatrix = csc_matrix((beamValues.astype(np.float32, copy=False), beamIndexes, indptr), shape=(header['NbrVoxels'], Nbeamlets))
+    BeamletMatrix.sum_duplicates() ### Sort the voxels of each beamlet as the COO to CSC conversion did
+    return BeamletMatrix
+
+def _index_sparse_batch(words, Nbeamlets):
+    ### Position (in words) and number of the indexes of each beamlet. Each beamlet has 5 int header fields, the last one is the number of values
+    fields = memoryview(words).cast('B').cast('i')
+    starts = np.empty(Nbeamlets, dtype=np.int64)
+    counts = np.empty(Nbeamlets, dtype=np.int64)
+    pos = 1 ### The first word is the number of beamlets
+    for i in range(Nbeamlets):
+        count = fields[pos + 4]
+        starts[i] = pos + 5
+        counts[i] = count
+        pos += 5 + 2 * count
+    return starts, counts
+
+def _gather_sparse_beamlets(words, starts, counts, size):
+    ### Word positions of the indexes of the beamlets, the values follow the indexes of each beamlet
+    total = int(counts.sum())
+    positions = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(total, dtype=np.int64)
+    beamIndexes = changeOfCoordinates(np.asarray(words[positions]), size)
+    beamValues = words.view('<f4')[positions + np.repeat(counts, counts)]
+    return beamIndexes, beamValues
+
+def accumulateSparseBatchDose(matrixBeamlets_path, header, Mu, dose, lock = None, chunkSize = 2**22):
+    """
+    Accumulate the dose of a sparse beamlet batch file weighted by the beamlet MUs into a dose vector, without building
+    the beamlet matrix. The file is memory-mapped and decoded by chunks of consecutive beamlets, so that the extra
+    memory does not depend on the size of the batch.
+
+    Parameters
+    ----------
+    matrixBeamlets_path : str
+        Path of the sparseBeamletMatrix_batch*.bin file
+    header : dict
+        CT header (see read_header)
+    Mu : np.ndarray
+        MU of each beamlet of the batch
+    dose : np.ndarray
+        Flat dose vector of NbrVoxels voxels (in Fortran order, as the rows of the beamlet matrix), updated in place
+    lock : threading.Lock, optional
+        Lock held while dose is updated, when several batches are accumulated in parallel threads
+    chunkSize : int, optional
+        Approximate number of values decoded at once
+
+    Returns
+    -------
+    int
+        Number of beamlets in the batch
+    """
+    words = np.memmap(matrixBeamlets_path, dtype='<i4', mode='r')
+    Nbeamlets = int(words[0])
+    if len(Mu) != Nbeamlets:
+        raise ValueError('{} MUs given for the {} beamlets of {}'.format(len(Mu), Nbeamlets, matrixBeamlets_path))
+    starts, counts = _index_sparse_batch(words, Nbeamlets)
+    ends = np.cumsum(counts)
+
+    first = 0
+    while first < Nbeamlets:
+        ### At least one beamlet per chunk, and as many following beamlets as fit in chunkSize values
+        last = max(first + 1, int(np.searchsorted(ends, ends[first] - counts[first] + chunkSize, side='right')))
+        beamIndexes, beamValues = _gather_sparse_beamlets(words, starts[first:last], counts[first:last], header['Size'])
+        weightedValues = beamValues * np.repeat(Mu[first:last], counts[first:last]).astype(dose.dtype, copy=False)
+        if lock is None:
+            np.add.at(dose, beamIndexes, weightedValues)
+        else:
+            with lock:
+                np.add.at(dose, beamIndexes, weightedValues)
+        first = last
+    del words
+    return Nbeamlets
+
+def read_sparse_batches(outputDir, header, batchSize, roiUnion = None, nbWorkers = None):
+    """
+    Read the sparse beamlet batch files of a CCC simulation concurrently.
+
+    Parameters
+    ----------
+    outputDir : str
+        Folder of the sparseBeamletMatrix_batch*.bin files
+    header : dict
+        CT header (see read_header)
+    batchSize : int
+        Number of batch files
+    roiUnion : np.ndarray, optional
+        Flat boolean mask of the voxels to keep (see mergeContours)
+    nbWorkers : int, optional
+        Number of batches read in parallel threads. The default is the number of CPUs.
+
+    Returns
+    -------
+    list of csc_matrix
+        Beamlet matrix of each batch
+    """
+    paths = [os.path.join(outputDir,'sparseBeamletMatrix_batch{}.bin'.format(batch)) for batch in range(batchSize)]
+    if nbWorkers is None:
+        nbWorkers = os.cpu_count() or 1
+    nbWorkers = max(1, min(nbWorkers, batchSize))
+
+    def decode(path):
+        logger.info('Read binary file: {}'.format(path))
+        return decodeSparseBatch(path, header, roiUnion)
+
+    if nbWorkers == 1:
+        return [decode(path) for path in paths]
+    with ThreadPoolExecutor(max_workers=nbWorkers) as executor:
+        return list(executor.map(decode, paths))
+
+def _read_sparse_data_legacy(matrixBeamlets_path, header, BeamletMatrix = None): ### Reference implementation (one matrix per beamlet) kept for validation of read_sparse_data
     with open(matrixBeamlets_path, mode='rb') as file: # b is important -> binary
         fileContent = file.read()
     Nbeamlets = struct.unpack("i", fileContent[:4])[0]
@@ -200,7 +373,7 @@ def mergeContours(roi, flatAndFlip = True):
             roiUnion = np.logical_or(roiUnion, roiData)
     return roiUnion
 
-def readBeamlets(CTheaderfile_path, outputDir, batchSize, roi: Optional[Sequence[Union[ROIContour, ROIMask]]] = None): 
+def readBeamlets(CTheaderfile_path, outputDir, batchSize, roi: Optional[Sequence[Union[ROIContour, ROIMask]]] = None, nbWorkers = None): 
     if (not CTheaderfile_path.endswith('.txt')):
         raise NameError('File ', CTheaderfile_path, ' is not a valid sparse matrix header')
 
@@ -208,22 +381,15 @@ def readBeamlets(CTheaderfile_path, outputDir, batchSize, roi: Optional[Sequence
     logger.info('Reading header from: {}'.format(CTheaderfile_path))
     header = read_header(CTheaderfile_path)
 
-    sparseBeamletsDose = None
-    numberOfBeamlets = 0
-    # Read sparse beamlets binary file
-    for batch in range(batchSize):
-        matrixBeamlets_path = os.path.join(outputDir,'sparseBeamletMatrix_batch{}.bin'.format(batch))
-        logger.info('Read binary file: {}'.format(matrixBeamlets_path))
-        sparseBeamletsDose, numberOfBeamletsInBatch = read_sparse_data(matrixBeamlets_path, header, sparseBeamletsDose)
-        numberOfBeamlets+=numberOfBeamletsInBatch
-    
-    sparseBeamletsDose = sp.hstack(sparseBeamletsDose)
-    header["NbrBeamlets"] = numberOfBeamlets
-
+    # The voxels outside the ROI are dropped while decoding
+    roiUnion = None
     if not(roi is None) or (roi is list and not(len(roi)==0)):
         roiUnion = mergeContours(roi)
-        sparseBeamletsDose = sp.csc_matrix.dot(sp.diags(roiUnion.astype(np.int32), format='csc'),
-                                              sparseBeamletsDose)
+
+    # Read sparse beamlets binary files
+    sparseBeamletsDose = read_sparse_batches(outputDir, header, batchSize, roiUnion, nbWorkers)
+    header["NbrBeamlets"] = sum(batch.shape[1] for batch in sparseBeamletsDose)
+    sparseBeamletsDose = sp.hstack(sparseBeamletsDose, format='csc')
         
     beamletDose = SparseBeamlets()
     beamletDose.setUnitaryBeamlets(sparseBeamletsDose)
@@ -235,27 +401,60 @@ def readBeamlets(CTheaderfile_path, outputDir, batchSize, roi: Optional[Sequence
     return beamletDose
 
 
-def readDose(CTheaderfile_path, outputDir, batchSize, Mu): 
+def readDose(CTheaderfile_path, outputDir, batchSize, Mu, nbWorkers = None): 
+    """
+    Compute the dose of a CCC simulation from its sparse beamlet batch files and the beamlet MUs. The weighted beamlet
+    doses are accumulated in the dose volume while the batch files are decoded (see accumulateSparseBatchDose), in
+    parallel threads.
+
+    Parameters
+    ----------
+    CTheaderfile_path : str
+        Path of the CT header file
+    outputDir : str
+        Folder of the sparseBeamletMatrix_batch*.bin files
+    batchSize : int
+        Number of batch files
+    Mu : np.ndarray
+        MU of each beamlet, in the order of the batch files
+    nbWorkers : int, optional
+        Number of batches accumulated in parallel threads. The default is the number of CPUs.
+
+    Returns
+    -------
+    DoseImage
+        The dose
+    """
     if (not CTheaderfile_path.endswith('.txt')):
         raise NameError('File ', CTheaderfile_path, ' is not a valid sparse matrix header')
 
     # Read sparse beamlets header file
     logger.info('Reading header from: {}'.format(CTheaderfile_path))
     header = read_header(CTheaderfile_path)
-    totalDose = None
-    sparseBeamletsDose = None
-    numberOfBeamlets = 0
-    # Read sparse beamlets binary file
-    for batch in range(batchSize):
-        matrixBeamlets_path = os.path.join(outputDir,'sparseBeamletMatrix_batch{}.bin'.format(batch))
-        logger.info('Read binary file: {}'.format(matrixBeamlets_path))
-        sparseBeamletsDose, numberOfBeamletsInBatch = read_sparse_data(matrixBeamlets_path, header)
-        sparseBeamletsDose = sp.hstack(sparseBeamletsDose)
-        if totalDose is None:
-            totalDose = csc_matrix.dot(sparseBeamletsDose, Mu[numberOfBeamlets:numberOfBeamlets+numberOfBeamletsInBatch])
-        else:
-            totalDose += csc_matrix.dot(sparseBeamletsDose, Mu[numberOfBeamlets:numberOfBeamlets+numberOfBeamletsInBatch])
-        numberOfBeamlets+=numberOfBeamletsInBatch
+    Mu = np.asarray(Mu)
+    paths = [os.path.join(outputDir,'sparseBeamletMatrix_batch{}.bin'.format(batch)) for batch in range(batchSize)]
+
+    ### The first word of each batch file is its number of beamlets, which gives the MUs of the batch
+    numberOfBeamlets = [int(np.fromfile(path, dtype='<i4', count=1)[0]) for path in paths]
+    offsets = np.concatenate(([0], np.cumsum(numberOfBeamlets, dtype=np.int64)))
+    if offsets[-1] > len(Mu):
+        raise ValueError('{} MUs given for {} beamlets'.format(len(Mu), offsets[-1]))
+
+    totalDose = np.zeros(header['NbrVoxels'], dtype=np.result_type(np.float32, Mu.dtype))
+    lock = threading.Lock()
+    def accumulate(batch):
+        logger.info('Read binary file: {}'.format(paths[batch]))
+        accumulateSparseBatchDose(paths[batch], header, Mu[offsets[batch]:offsets[batch+1]], totalDose, lock)
+
+    if nbWorkers is None:
+        nbWorkers = os.cpu_count() or 1
+    nbWorkers = max(1, min(nbWorkers, batchSize))
+    if nbWorkers == 1:
+        for batch in range(batchSize):
+            accumulate(batch)
+    else:
+        with ThreadPoolExecutor(max_workers=nbWorkers) as executor:
+            list(executor.map(accumulate, range(batchSize)))
 
     orientation = (1, 0, 0, 0, 1, 0, 0, 0, 1)
     totalDose = np.reshape(totalDose, header["Size"], order='F')
@@ -267,3 +466,54 @@ def readDose(CTheaderfile_path, outputDir, batchSize, Mu):
 
 
     return doseImage
+
+
+class CCCdoseEngineIOTestCase(unittest.TestCase):
+    def testReadSparseData(self):
+        import tempfile
+
+        rng = np.random.default_rng(0)
+        header = {'Size': np.array([6, 5, 4]), 'NbrVoxels': 120}
+        roi = rng.random(120) < 0.5
+        with tempfile.TemporaryDirectory() as directory:
+            for batch, Nbeamlets in enumerate((7, 0, 3)):
+                with open(os.path.join(directory, 'sparseBeamletMatrix_batch{}.bin'.format(batch)), 'wb') as f:
+                    f.write(struct.pack('i', Nbeamlets))
+                    for beamlet in range(Nbeamlets):
+                        indexes = rng.choice(120, size=rng.integers(0, 30), replace=False).astype(np.int32)
+                        f.write(struct.pack('iiiii', beamlet, 0, 0, 0, len(indexes)))
+                        f.write(indexes.tobytes())
+                        f.write(rng.random(len(indexes)).astype(np.float32).tobytes())
+
+            batches = read_sparse_batches(directory, header, 3, nbWorkers=2)
+            self.assertEqual([batch.shape[1] for batch in batches], [7, 0, 3])
+            for batch, batchMatrix in enumerate(batches):
+                path = os.path.join(directory, 'sparseBeamletMatrix_batch{}.bin'.format(batch))
+                legacy, Nbeamlets = _read_sparse_data_legacy(path, header)
+                reference = sp.hstack(legacy, format='csc') if Nbeamlets > 0 else csc_matrix((120, 0), dtype=np.float32)
+                np.testing.assert_array_equal(batchMatrix.toarray(), reference.toarray())
+
+                roiMatrix = read_sparse_data(path, header, roiUnion=roi)[0][0]
+                np.testing.assert_array_equal(roiMatrix.toarray(), reference.toarray() * roi[:, None])
+
+    def testAccumulateSparseBatchDose(self):
+        import tempfile
+
+        rng = np.random.default_rng(1)
+        header = {'Size': np.array([6, 5, 4]), 'NbrVoxels': 120}
+        with tempfile.NamedTemporaryFile(suffix='.bin', delete=False) as f:
+            f.write(struct.pack('i', 9))
+            for beamlet in range(9):
+                indexes = rng.choice(120, size=rng.integers(0, 30), replace=False).astype(np.int32)
+                f.write(struct.pack('iiiii', beamlet, 0, 0, 0, len(indexes)))
+                f.write(indexes.tobytes())
+                f.write(rng.random(len(indexes)).astype(np.float32).tobytes())
+        try:
+            Mu = rng.random(9)
+            reference = decodeSparseBatch(f.name, header).dot(Mu)
+            for chunkSize in (1, 40, 2**22):
+                dose = np.zeros(120)
+                self.assertEqual(accumulateSparseBatchDose(f.name, header, Mu, dose, chunkSize=chunkSize), 9)
+                np.testing.assert_allclose(dose, reference, rtol=1e-12)
+        finally:
+            os.remove(f.name)
@@ -13,7 +13,8 @@ from opentps.core.io.serializedObjectIO import loadDataStructure
 
 logger = logging.getLogger(__name__)
 
-def loadData(patientList:PatientList, dataPath:str, maxDepth=-1, ignoreExistingData:bool=True, importInPatient:Optional[Patient]=None):
+def loadData(patientList:PatientList, dataPath:str, maxDepth=-1, ignoreExistingData:bool=True, importInPatient:Optional[Patient]=None,
+             nbWorkers:int=1):
     """
     Load all data found at the given input path.
 
@@ -37,6 +38,10 @@ def loadData(patientList:PatientList, dataPath:str, maxDepth=-1, ignoreExistingD
         If given, the data will be imported into the given patient.
         Default is None, which implies that the data will be imported into a new patient.
 
+    nbWorkers: int, optional
+        Number of threads reading the Dicom headers and decoding the image slices.
+        Default is 1.
+
     Returns
     -------
     dataList: list of data objects
@@ -44,7 +49,7 @@ def loadData(patientList:PatientList, dataPath:str, maxDepth=-1, ignoreExistingD
     """
     #TODO: implement ignoreExistingData
     
-    dataList = readData(dataPath, maxDepth=maxDepth)
+    dataList = readData(dataPath, maxDepth=maxDepth, nbWorkers=nbWorkers)
 
     patient = None
 
@@ -93,9 +98,11 @@ def loadData(patientList:PatientList, dataPath:str, maxDepth=-1, ignoreExistingD
             logging.warning("WARNING: " + str(data.__class__) + " not loadable yet")
             continue
 
-def readData(inputPaths, maxDepth=-1) -> Sequence[Union[PatientData, Patient]]:
+def readData(inputPaths, maxDepth=-1, nbWorkers:int=1) -> Sequence[Union[PatientData, Patient]]:
     """
     Load all data found at the given input path.
+    Dicom files are first classified from their headers only, which are read once when the files are listed. The
+    slices of each CT and MR series are then decoded by nbWorkers threads into a preallocated volume.
 
     Parameters
     ----------
@@ -106,6 +113,10 @@ def readData(inputPaths, maxDepth=-1) -> Sequence[Union[PatientData, Patient]]:
         Maximum subfolder depth where the function will check for data to be loaded.
         Default is -1, which implies recursive search over infinite subfolder depth.
 
+    nbWorkers: int, optional
+        Number of threads reading the Dicom headers and decoding the image slices.
+        Default is 1.
+
     Returns
     -------
     dataList: list of data objects
@@ -113,15 +124,16 @@ def readData(inputPaths, maxDepth=-1) -> Sequence[Union[PatientData, Patient]]:
 
     """
 
-    fileLists = listAllFiles(inputPaths, maxDepth=maxDepth)
+    dicomHeaders = {}
+    fileLists = listAllFiles(inputPaths, maxDepth=maxDepth, dicomHeaders=dicomHeaders)
     dataList = []
 
     # read Dicom files
     dicomCT = {}
     dicomMRI = {}
     for d, filePath in enumerate(fileLists["Dicom"]):
+        dcm = dicomHeaders[filePath]
         logger.info(f'Loading data {d+1}/{len(fileLists["Dicom"])} Dicom files : {os.path.basename(filePath)}.')
-        dcm = pydicom.dcmread(filePath)
 
         # Dicom field
         if dcm.SOPClassUID == "1.2.840.10008.5.1.4.1.1.66.3" or (hasattr(dcm, 'Modality') and dcm.Modality == "REG"):
@@ -193,14 +205,16 @@ def readData(inputPaths, maxDepth=-1) -> Sequence[Union[PatientData, Patient]]:
     for key in dicomCT:
         logger.debug('in dataLoader readData, for key in dicomCT {}'.format(key))
         logger.debug(dicomCT[key][0])
-        ct = readDicomCT(dicomCT[key][1:])
+        ct = readDicomCT(dicomCT[key][1:], nbWorkers=nbWorkers,
+                         headers=[dicomHeaders[filePath] for filePath in dicomCT[key][1:]])
         dataList.append(ct)
 
     # import Dicom MR images
     for key in dicomMRI:
         logger.debug('in dataLoader readData, for key in dicomMRI {}'.format(key))
         logger.debug(dicomMRI[key][0])
-        mri = readDicomMRI(dicomMRI[key][1:])
+        mri = readDicomMRI(dicomMRI[key][1:], nbWorkers=nbWorkers,
+                           headers=[dicomHeaders[filePath] for filePath in dicomMRI[key][1:]])
         dataList.append(mri)
 
     # read MHD images
@@ -252,7 +266,7 @@ def readSingleData(filePath, dicomCT = {}):
     else:
         filetype = get_file_type(filePath)
         if filetype == 'Dicom':
-            dcm = pydicom.dcmread(filePath)
+            dcm = pydicom.dcmread(filePath, stop_before_pixels=True)
 
             # Dicom field
             if dcm.SOPClassUID == "1.2.840.10008.5.1.4.1.1.66.3" or (hasattr(dcm, 'Modality') and dcm.Modality == "REG"):
@@ -307,36 +321,43 @@ def readSingleData(filePath, dicomCT = {}):
 
 
 def get_file_type(filePath):
+    return _readFileType(filePath)[0]
+
+
+def _readFileType(filePath):
+    """
+    File type of filePath and Dicom header (read without pixel data) if it is a Dicom file
+    """
     # Is Dicom file ?
     dcm = None
     try:
-        dcm = pydicom.dcmread(filePath)
+        dcm = pydicom.dcmread(filePath, stop_before_pixels=True)
     except:
         pass
     if(dcm != None):
-        return 'Dicom'
+        return 'Dicom', dcm
 
     # Is MHD file ?
     with open(filePath, 'rb') as fid:
         data = fid.read(50*1024)  # read 50 kB, which should be more than enough for MHD header
         if data.isascii():
             if("ElementDataFile" in data.decode('ascii')): # recognize key from MHD header
-                return 'MHD'
+                return 'MHD', None
 
     # Is serialized file ?
     if filePath.endswith('.p') or filePath.endswith('.pbz2') or filePath.endswith('.pkl') or filePath.endswith('.pickle'):
-        return "Serialized"
+        return "Serialized", None
 
     # Is txt file ?
     if filePath.endswith('.txt'):
-        return 'txt'
+        return 'txt', None
 
     logging.info("INFO: cannot recognize file format of " + filePath)
-    return None
+    return None, None
 
 
 
-def listAllFiles(inputPaths, maxDepth=-1):
+def listAllFiles(inputPaths, maxDepth=-1, dicomHeaders:Optional[dict]=None):
     """
     List all files of compatible data format from given input paths.
 
@@ -349,6 +370,9 @@ def listAllFiles(inputPaths, maxDepth=-1):
         Maximum subfolder depth where the function will check for files to be listed.
         Default is -1, which implies recursive search over infinite subfolder depth.
 
+    dicomHeaders: dict, optional
+        If given, the headers (without pixel data) read to recognize the Dicom files are stored in it by file path.
+
     Returns
     -------
     fileLists: dictionary
@@ -365,7 +389,7 @@ def listAllFiles(inputPaths, maxDepth=-1):
     # if inputPaths is a list of path, then iteratively call this function with each path of the list
     if(isinstance(inputPaths, list)):
         for path in inputPaths:
-            lists = listAllFiles(path, maxDepth=maxDepth)
+            lists = listAllFiles(path, maxDepth=maxDepth, dicomHeaders=dicomHeaders)
             for key in fileLists:
                 fileLists[key] += lists[key]
 
@@ -386,17 +410,19 @@ def listAllFiles(inputPaths, maxDepth=-1):
         # folders
         if os.path.isdir(filePath):
             if(maxDepth != 0):
-                subfolderFileList = listAllFiles(filePath, maxDepth=maxDepth-1)
+                subfolderFileList = listAllFiles(filePath, maxDepth=maxDepth-1, dicomHeaders=dicomHeaders)
                 for key in fileLists:
                     fileLists[key] += subfolderFileList[key]
 
         # files
         elif os.path.isfile(filePath):
-            filetype = get_file_type(filePath)
+            filetype, dcm = _readFileType(filePath)
             if filetype is None:
                 logging.info("INFO: cannot recognize file format of " + filePath)
             else:
                 fileLists[filetype].append(filePath)
+                if not (dcm is None or dicomHeaders is None):
+                    dicomHeaders[filePath] = dcm
 
     return fileLists
 
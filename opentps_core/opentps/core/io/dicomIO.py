@@ -1,6 +1,10 @@
 import copy
 import datetime
 import os
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
 import pydicom
 import numpy as np
 import logging
@@ -40,8 +44,83 @@ def setFrameOfReferenceUID(value):
     else:
         return value
 
+################### Image slices ###########
+def readDicomSlices(dcmFiles, nbWorkers:int=1, rescale:bool=True, headers=None):
+    """
+    Read the slices of a Dicom image series into a 3D float32 volume.
+    The slices are sorted from their headers, read without pixel data unless they are given. The pixel data of each
+    slice is then decoded by a pool of threads and written directly in a preallocated volume.
+
+    Parameters
+    ----------
+    dcmFiles: list
+        List of paths for Dicom slices of a same series.
+    nbWorkers: int, optional
+        Number of threads decoding the slices, by default 1
+    rescale: bool, optional
+        Whether to apply RescaleSlope and RescaleIntercept to the slices defining them, by default True
+    headers: list, optional
+        Headers of dcmFiles (e.g. read with stop_before_pixels=True by dataLoader.readData), by default they are read
+
+    Returns
+    -------
+    imageData: np.ndarray
+        Volume of shape (Columns, Rows, number of slices)
+    sliceLocation: np.ndarray
+        Sorted slice locations
+    sopInstanceUIDs: list
+        SOPInstanceUID of the sorted slices
+    dcm: pydicom.Dataset
+        Header of the last file of dcmFiles
+    """
+    startTime = time.time()
+
+    with ThreadPoolExecutor(max_workers=max(1, nbWorkers)) as executor:
+        if headers is None:
+            headers = list(executor.map(lambda dcmFile: pydicom.dcmread(dcmFile, stop_before_pixels=True), dcmFiles))
+
+        # sort slices according to their location in order to reconstruct the 3d image
+        sliceLocation = np.array([float(header.ImagePositionPatient[2]) for header in headers], dtype='float')
+        sortIndex = np.argsort(sliceLocation)
+        sliceLocation = sliceLocation[sortIndex]
+        sopInstanceUIDs = [headers[n].SOPInstanceUID for n in sortIndex]
+        dcm = headers[-1]
+
+        def decodeSlice(sliceIndex):
+            sliceDcm = pydicom.dcmread(dcmFiles[sortIndex[sliceIndex]])
+            pixels = sliceDcm.pixel_array
+            if rescale and hasattr(sliceDcm, 'RescaleSlope'):
+                pixels = pixels * sliceDcm.RescaleSlope + sliceDcm.RescaleIntercept
+            return pixels
+
+        # the first slice gives the size of the volume
+        pixels = decodeSlice(0)
+        imageData = np.empty((pixels.shape[1], pixels.shape[0], len(dcmFiles)), dtype=np.float32)
+        imageData[:, :, 0] = pixels.T
+
+        # verify reconstructed volume
+        if imageData.shape[0:2] != (dcm.Columns, dcm.Rows):
+            logging.warning("WARNING: GridSize " + str(imageData.shape[0:2]) + " different from Dicom Columns (" + str(
+                dcm.Columns) + ") and Rows (" + str(dcm.Rows) + ")")
+
+        def decodeSliceInVolume(sliceIndex):
+            imageData[:, :, sliceIndex] = decodeSlice(sliceIndex).T
+
+        list(executor.map(decodeSliceInVolume, range(1, len(dcmFiles))))
+
+    # volume and pixel data (stored, then rescaled in float64) of the slices decoded at once
+    bitsAllocated = int(dcm.BitsAllocated) if hasattr(dcm, 'BitsAllocated') else 16
+    sliceSize = int(dcm.Rows) * int(dcm.Columns)
+    estimatedMemory = imageData.nbytes + min(max(1, nbWorkers), len(dcmFiles)) * sliceSize * (bitsAllocated / 8 + 8)
+    logger.info('Series ' + str(dcm.SeriesInstanceUID) + ': ' + str(len(dcmFiles)) + ' slices read in '
+                + '{:.2f}'.format(time.time() - startTime) + ' s, estimated memory '
+                + '{:.1f}'.format(estimatedMemory / 2 ** 20) + ' MB')
+
+    return imageData, sliceLocation, sopInstanceUIDs, dcm
+
+
 ################### CT Image ###########
-def readDicomCT(dcmFiles):
+def readDicomCT(dcmFiles, nbWorkers:int=1, headers=None):
     """
     Generate a CT image object from a list of dicom CT slices.
 
@@ -49,40 +128,22 @@ def readDicomCT(dcmFiles):
     ----------
     dcmFiles: list
         List of paths for Dicom CT slices to be imported.
+    nbWorkers: int, optional
+        Number of threads decoding the slices, by default 1
+    headers: list, optional
+        Headers of dcmFiles read without pixel data, by default they are read
 
     Returns
     -------
     image: ctImage object
         The function returns the imported CT image
     """
-
-    # read dicom slices
-    images = []
-    sopInstanceUIDs = []
-    sliceLocation = np.zeros(len(dcmFiles), dtype='float')
     dt = datetime.datetime.now()
 
-    for i in range(len(dcmFiles)):
-        dcm = pydicom.dcmread(dcmFiles[i])
-        sliceLocation[i] = float(dcm.ImagePositionPatient[2])
-        images.append(dcm.pixel_array * dcm.RescaleSlope + dcm.RescaleIntercept)
-        sopInstanceUIDs.append(dcm.SOPInstanceUID)
-
-
-    # sort slices according to their location in order to reconstruct the 3d image
-    sortIndex = np.argsort(sliceLocation)
-    sliceLocation = sliceLocation[sortIndex]
-    sopInstanceUIDs = [sopInstanceUIDs[n] for n in sortIndex]
-    images = [images[n] for n in sortIndex]
-    imageData = np.dstack(images).astype("float32").transpose(1, 0, 2)
-
-    # verify reconstructed volume
-    if imageData.shape[0:2] != (dcm.Columns, dcm.Rows):
-        logging.warning("WARNING: GridSize " + str(imageData.shape[0:2]) + " different from Dicom Columns (" + str(
-            dcm.Columns) + ") and Rows (" + str(dcm.Rows) + ")")
+    imageData, sliceLocation, sopInstanceUIDs, dcm = readDicomSlices(dcmFiles, nbWorkers=nbWorkers, headers=headers)
 
     # collect image information
-    meanSliceDistance = (sliceLocation[-1] - sliceLocation[0]) / (len(images) - 1)
+    meanSliceDistance = (sliceLocation[-1] - sliceLocation[0]) / (len(sliceLocation) - 1)
     if (hasattr(dcm, 'SliceThickness') and (
             type(dcm.SliceThickness) == int or type(dcm.SliceThickness) == float) and abs(
             meanSliceDistance - dcm.SliceThickness) > 0.001):
@@ -377,7 +438,7 @@ def writeDicomCT(ct: CTImage, outputFolderPath:str, outputFileName:str=None):
 
 ################### MRI Image ####################
 
-def readDicomMRI(dcmFiles):
+def readDicomMRI(dcmFiles, nbWorkers:int=1, headers=None):
     """
     Generate a MR image object from a list of dicom MR slices.
 
@@ -385,47 +446,22 @@ def readDicomMRI(dcmFiles):
     ----------
     dcmFiles: list
         List of paths for Dicom MR slices to be imported.
+    nbWorkers: int, optional
+        Number of threads decoding the slices, by default 1
+    headers: list, optional
+        Headers of dcmFiles read without pixel data, by default they are read
 
     Returns
     -------
     image: mrImage object
         The function returns the imported MR image
     """
-
-    # read dicom slices
-    images = []
-    sopInstanceUIDs = []
-    sliceLocation = np.zeros(len(dcmFiles), dtype='float')
-    firstdcm = dcmFiles[0]
-    
-    if hasattr(firstdcm,'RescaleSlope') == False:
+    imageData, sliceLocation, sopInstanceUIDs, dcm = readDicomSlices(dcmFiles, nbWorkers=nbWorkers, headers=headers)
+    if not hasattr(dcm, 'RescaleSlope'):
         logging.warning('no RescaleSlope, image could be wrong')
-        for i in range(len(dcmFiles)):
-            dcm = pydicom.dcmread(dcmFiles[i])
-            sliceLocation[i] = float(dcm.ImagePositionPatient[2])
-            images.append(dcm.pixel_array)
-            sopInstanceUIDs.append(dcm.SOPInstanceUID)
-    else :
-        for i in range(len(dcmFiles)):
-            dcm = pydicom.dcmread(dcmFiles[i])
-            sliceLocation[i] = float(dcm.ImagePositionPatient[2])
-            images.append(dcm.pixel_array * dcm.RescaleSlope + dcm.RescaleIntercept)
-            sopInstanceUIDs.append(dcm.SOPInstanceUID)       
-
-    # sort slices according to their location in order to reconstruct the 3d image
-    sortIndex = np.argsort(sliceLocation)
-    sliceLocation = sliceLocation[sortIndex]
-    sopInstanceUIDs = [sopInstanceUIDs[n] for n in sortIndex]
-    images = [images[n] for n in sortIndex]
-    imageData = np.dstack(images).astype("float32").transpose(1, 0, 2)
-
-    # verify reconstructed volume
-    if imageData.shape[0:2] != (dcm.Columns, dcm.Rows):
-        logging.warning("WARNING: GridSize " + str(imageData.shape[0:2]) + " different from Dicom Columns (" + str(
-            dcm.Columns) + ") and Rows (" + str(dcm.Rows) + ")")
 
     # collect image information
-    meanSliceDistance = (sliceLocation[-1] - sliceLocation[0]) / (len(images) - 1)
+    meanSliceDistance = (sliceLocation[-1] - sliceLocation[0]) / (len(sliceLocation) - 1)
     if (hasattr(dcm, 'SliceThickness') and (
             type(dcm.SliceThickness) == int or type(dcm.SliceThickness) == float) and abs(
             meanSliceDistance - dcm.SliceThickness) > 0.001):
@@ -2336,3 +2372,45 @@ def readDicomRigidTransform(dcmFile):
     transform3D.setMatrix4x4(tformMatrix_1)
 
     return transform3D
+
+
+class DicomIOTestCase(unittest.TestCase):
+    def _writeCT(self, folder):
+        rng = np.random.default_rng(0)
+        imageArray = rng.integers(-1000, 2000, (12, 10, 6)).astype(np.float32)
+        ct = CTImage(imageArray=imageArray, name='CT', origin=(-10., 20., -5.), spacing=(1.5, 1.5, 2.),
+                     seriesInstanceUID=pydicom.uid.generate_uid())
+        writeDicomCT(ct, folder)
+        return ct, sorted(os.path.join(folder, file) for file in os.listdir(folder))
+
+    def testReadCT(self):
+        import tempfile
+        from opentps.core.io.dataLoader import readData
+
+        with tempfile.TemporaryDirectory() as folder:
+            ct, dcmFiles = self._writeCT(folder)
+
+            image = readDicomCT(dcmFiles[::-1], nbWorkers=2)
+            np.testing.assert_array_equal(image.imageArray, ct.imageArray)
+            np.testing.assert_allclose(image.origin, ct.origin)
+            np.testing.assert_allclose(image.spacing, ct.spacing)
+
+            images = [data for data in readData(folder, nbWorkers=2) if isinstance(data, CTImage)]
+            self.assertEqual(len(images), 1)
+            np.testing.assert_array_equal(images[0].imageArray, ct.imageArray)
+
+    def testReadMRI(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as folder:
+            ct, dcmFiles = self._writeCT(folder)
+            for dcmFile in dcmFiles:
+                dcm = pydicom.dcmread(dcmFile)
+                dcm.SOPClassUID = "1.2.840.10008.5.1.4.1.1.4"
+                dcm.Modality = "MR"
+                dcm.RescaleSlope = "2"
+                dcm.RescaleIntercept = "1"
+                dcm.save_as(dcmFile)
+
+            image = readDicomMRI(dcmFiles, nbWorkers=2)
+            np.testing.assert_array_equal(image.imageArray, ct.imageArray * 2 + 1)
@@ -5,6 +5,7 @@ import struct
 import time
 import logging
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Sequence, Iterable
 
 import numpy as np
@@ -35,7 +36,8 @@ from opentps.core.data.images import Image3D
 
 logger = logging.getLogger(__name__)
 
-def readBeamlets(file_path, beamletRescaling:Sequence[float], origin, roi: Optional[ROIMask] = None):
+def readBeamlets(file_path, beamletRescaling:Sequence[float], origin, roi: Optional[ROIMask] = None, nbWorkers:int = 1,
+                 memoryBudget:Optional[float] = None):
     """
     Read sparse beamlets from a file and return a beamlet dose image
 
@@ -49,6 +51,10 @@ def readBeamlets(file_path, beamletRescaling:Sequence[float], origin, roi: Optio
         The origin of the dose grid [x,y,z]
     roi : Optional[ROIMask], optional
         The ROI mask, by default None
+    nbWorkers : int, optional
+        Number of threads decoding spot blocks concurrently, by default 1
+    memoryBudget : Optional[float], optional
+        Peak memory (in bytes) allowed for the decoding buffers of the blocks in flight, by default None (unbounded)
 
     Returns
     -------
@@ -67,10 +73,11 @@ def readBeamlets(file_path, beamletRescaling:Sequence[float], origin, roi: Optio
 
     # Read sparse beamlets binary file
     logger.info('Read binary file: {}'.format(file_path))
-    sparseBeamlets = _read_sparse_data(header["Binary_file"], header["NbrVoxels"], header["NbrSpots"], roi)
+    sparseBeamlets = _read_sparse_data(header["Binary_file"], header["NbrVoxels"], header["NbrSpots"], roi,
+                                       nbWorkers=nbWorkers, memoryBudget=memoryBudget)
 
     beamletDose = SparseBeamlets()
-    beamletDose.setUnitaryBeamlets(csc_matrix.dot(sparseBeamlets, csc_matrix(np.diag(beamletRescaling), dtype=np.float32)))
+    beamletDose.setUnitaryBeamlets(csc_matrix.dot(sparseBeamlets, sp.diags(np.array(beamletRescaling, dtype=np.float32), format='csc')))
     beamletDose.doseOrigin = origin
     beamletDose.doseSpacing = header["VoxelSpacing"]
     beamletDose.doseGridSize = header["ImageSize"]
@@ -124,9 +131,282 @@ def _read_sparse_header(file_path):
     return header
 
 
-def _read_sparse_data(Binary_file, NbrVoxels, NbrSpots, roi:Optional[ROIMask]=None) -> csc_matrix:
+def _read_sparse_data(Binary_file, NbrVoxels, NbrSpots, roi:Optional[ROIMask]=None, nbWorkers:int=1,
+                      memoryBudget:Optional[float]=None) -> csc_matrix:
     """
-    Read sparse beamlets matrix from a sparse beamlets binary file
+    Read sparse beamlets matrix from a sparse beamlets binary file.
+    The file is memory-mapped, the run headers are indexed in a single pass and the values are decoded with bulk
+    NumPy operations directly into the CSC arrays, by blocks of consecutive spots.
+
+    Parameters
+    ----------
+    Binary_file : str
+        The path to the sparse beamlets binary file
+    NbrVoxels : int
+        The number of voxels
+    NbrSpots : int
+        The number of spots
+    roi : Optional[ROIMask], optional
+        The ROI mask, by default None
+    nbWorkers : int, optional
+        Number of threads decoding spot blocks concurrently, by default 1
+    memoryBudget : Optional[float], optional
+        Peak memory (in bytes) allowed for the decoding buffers of the blocks in flight, by default None (unbounded)
+
+    Returns
+    -------
+    BeamletMatrix : csc_matrix
+        The sparse beamlets matrix
+    """
+    roiUnion = _sparse_roi_union(roi, NbrVoxels)
+
+    time_start = time.time()
+
+    fileContent = np.memmap(Binary_file, dtype=np.uint8, mode='r')
+    fileContent = fileContent[:len(fileContent) - len(fileContent) % 4]
+    runSpot, runCount, runFirst, runOffset = _index_sparse_data(fileContent, NbrSpots)
+    indptr, indices, data = _decode_sparse_runs(fileContent.view('<f4'), runSpot, runCount, runFirst, runOffset,
+                                                NbrVoxels, NbrSpots, roiUnion, nbWorkers, memoryBudget)
+    del fileContent
+
+    BeamletMatrix = csc_matrix((data, indices, indptr), shape=(NbrVoxels, NbrSpots))
+    BeamletMatrix.sum_duplicates()
+
+    logger.info('Beamlets imported in {} sec'.format(time.time() - time_start))
+
+    _print_memory_usage(BeamletMatrix)
+
+    return BeamletMatrix
+
+
+def _sparse_roi_union(roi, NbrVoxels) -> Optional[np.ndarray]:
+    """
+    Compute the union of the ROI masks in the voxel ordering of the MCsquare sparse format
+
+    Parameters
+    ----------
+    roi : Optional[Union[ROIMask, Sequence[ROIMask]]]
+        The ROI mask(s)
+    NbrVoxels : int
+        The number of voxels
+
+    Returns
+    -------
+    roiUnion : Optional[np.ndarray]
+        Flat boolean mask of size NbrVoxels, or None if no ROI is given
+    """
+    if roi is None:
+        return None
+    if isinstance(roi, ROIMask):
+        roi = [roi]
+    if len(roi) == 0:
+        return None
+
+    logger.info("Beamlets are computed on {}".format([contour.name for contour in roi]))
+    roiUnion = np.zeros(NbrVoxels, dtype=bool)
+    for contour in roi:
+        roiData = np.flip(contour.imageArray, (0, 1))
+        roiUnion |= np.ndarray.flatten(roiData, 'F').astype(bool)
+
+    return roiUnion
+
+
+def _index_sparse_data(buffer, NbrSpots):
+    """
+    Walk the spot and run headers of a sparse beamlets binary buffer once and index all runs of contiguous values
+
+    Parameters
+    ----------
+    buffer : np.ndarray
+        The content of the sparse beamlets binary file as uint8 (e.g. np.memmap)
+    NbrSpots : int
+        The number of spots
+
+    Returns
+    -------
+    runSpot : np.ndarray
+        Spot index of each run
+    runCount : np.ndarray
+        Number of values in each run
+    runFirst : np.ndarray
+        Voxel index of the first value of each run
+    runOffset : np.ndarray
+        Position (in 4-byte words) of the first value of each run in the buffer
+    """
+    words = memoryview(buffer).cast('I')
+
+    runSpot = []
+    runCount = []
+    runFirst = []
+    runOffset = []
+    try:
+        pos = 0
+        for spot in range(NbrSpots):
+            NonZeroVoxels = words[pos]
+            pos += 5  # NonZeroVoxels, BeamID, LayerID, x, y
+
+            ReadVoxels = 0
+            while ReadVoxels < NonZeroVoxels:
+                NbrContinuousValues = words[pos]
+                runSpot.append(spot)
+                runCount.append(NbrContinuousValues)
+                runFirst.append(words[pos + 1])
+                runOffset.append(pos + 2)
+                pos += 2 + NbrContinuousValues
+                ReadVoxels += NbrContinuousValues
+    finally:
+        words.release()
+
+    return np.array(runSpot, dtype=np.int64), np.array(runCount, dtype=np.int64), \
+        np.array(runFirst, dtype=np.int64), np.array(runOffset, dtype=np.int64)
+
+
+_SPARSE_DECODE_CHUNK = 2 ** 24
+_SPARSE_DECODE_BYTES_PER_VALUE = 33  # int64 positions, rows and offsets + float32 value + bool ROI flag
+
+
+def _decode_sparse_runs(values, runSpot, runCount, runFirst, runOffset, NbrVoxels, NbrSpots, roiUnion=None,
+                        nbWorkers=1, memoryBudget=None):
+    """
+    Decode indexed runs of contiguous values into CSC arrays.
+    Consecutive spots are grouped in column blocks which are decoded concurrently, each block being written in its own
+    slice of the preallocated CSC arrays. The number of blocks in flight is bounded by nbWorkers and memoryBudget.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        The content of the sparse beamlets binary file viewed as float32
+    runSpot, runCount, runFirst, runOffset : np.ndarray
+        Run index as returned by _index_sparse_data
+    NbrVoxels : int
+        The number of voxels
+    NbrSpots : int
+        The number of spots
+    roiUnion : Optional[np.ndarray]
+        Flat boolean mask of the voxels to keep, by default None (keep all)
+    nbWorkers : int
+        Number of threads decoding blocks concurrently, by default 1
+    memoryBudget : Optional[float]
+        Peak memory (in bytes) allowed for the decoding buffers of the blocks in flight, by default None (unbounded)
+
+    Returns
+    -------
+    indptr : np.ndarray
+        CSC column pointers
+    indices : np.ndarray
+        CSC row indices
+    data : np.ndarray
+        CSC values (float32)
+    """
+    # Number of values kept in each run, computed from the ROI prefix sum without touching the file
+    if roiUnion is None:
+        runKept = runCount
+    else:
+        roiCumSum = np.zeros(NbrVoxels + 1, dtype=np.int64)
+        np.cumsum(roiUnion, out=roiCumSum[1:])
+        runKept = roiCumSum[runFirst + runCount] - roiCumSum[runFirst]
+
+    nnz = int(runKept.sum())
+    indexDtype = np.int32 if max(nnz, NbrVoxels) < np.iinfo(np.int32).max else np.int64
+
+    indptr = np.zeros(NbrSpots + 1, dtype=indexDtype)
+    np.cumsum(np.bincount(runSpot, weights=runKept, minlength=NbrSpots).astype(np.int64), out=indptr[1:])
+    indices = np.empty(nnz, dtype=indexDtype)
+    data = np.empty(nnz, dtype=np.float32)
+
+    runEnd = np.cumsum(runCount)
+    blocks = _sparse_spot_blocks(runSpot, runEnd, nbWorkers)
+    if not blocks:
+        return indptr, indices, data
+
+    def decodeBlock(block):
+        r0, r1 = block
+        blockStart = runEnd[r0] - runCount[r0]
+        count = runCount[r0:r1]
+        localStart = runEnd[r0:r1] - count - blockStart
+        local = np.arange(runEnd[r1 - 1] - blockStart, dtype=np.int64)
+        rows = np.repeat(runFirst[r0:r1] - localStart, count) + local
+        blockData = values[np.repeat(runOffset[r0:r1] - localStart, count) + local]
+        del local
+
+        if roiUnion is not None:
+            keep = roiUnion[rows]
+            rows = rows[keep]
+            blockData = blockData[keep]
+
+        dataID = indptr[runSpot[r0]]
+        indices[dataID:dataID + len(rows)] = rows
+        data[dataID:dataID + len(rows)] = blockData
+
+    blockBytes = max(runEnd[r1 - 1] - runEnd[r0] + runCount[r0] for r0, r1 in blocks) * _SPARSE_DECODE_BYTES_PER_VALUE
+    nbInFlight = max(1, min(nbWorkers, len(blocks)))
+    if memoryBudget is not None:
+        nbInFlight = max(1, min(nbInFlight, int(memoryBudget // blockBytes)))
+
+    if nbInFlight == 1:
+        for block in blocks:
+            decodeBlock(block)
+    else:
+        logger.info('Decode {} spot blocks with {} threads'.format(len(blocks), nbInFlight))
+        with ThreadPoolExecutor(max_workers=nbInFlight) as executor:
+            for _ in executor.map(decodeBlock, blocks):
+                pass
+
+    return indptr, indices, data
+
+
+def _sparse_spot_blocks(runSpot, runEnd, nbWorkers=1):
+    """
+    Split the runs in blocks of consecutive spots holding at most _SPARSE_DECODE_CHUNK values (a spot is never split),
+    with at least a few blocks per worker
+
+    Parameters
+    ----------
+    runSpot : np.ndarray
+        Spot index of each run
+    runEnd : np.ndarray
+        Cumulative number of values at the end of each run
+    nbWorkers : int
+        Number of workers that will decode the blocks
+
+    Returns
+    -------
+    blocks : list of tuple
+        (first run, last run + 1) of each block
+    """
+    if len(runEnd) == 0:
+        return []
+
+    blockSize = _SPARSE_DECODE_CHUNK
+    if nbWorkers > 1:
+        blockSize = max(1, min(blockSize, int(runEnd[-1]) // (4 * nbWorkers)))
+
+    # Runs starting a new spot are the only valid block boundaries
+    runStartValue = np.concatenate(([0], runEnd[:-1]))
+    spotStartRuns = np.flatnonzero(np.diff(runSpot, prepend=-1))
+    spotStartValues = runStartValue[spotStartRuns]
+
+    blocks = []
+    r0 = 0
+    while r0 < len(runEnd):
+        limit = runStartValue[r0] + blockSize
+        if runEnd[-1] <= limit:
+            r1 = len(runEnd)
+        else:
+            r1 = spotStartRuns[np.searchsorted(spotStartValues, limit, side='right') - 1]
+            if r1 <= r0:  # Single spot larger than the block size
+                nextSpot = np.searchsorted(spotStartRuns, r0, side='right')
+                r1 = spotStartRuns[nextSpot] if nextSpot < len(spotStartRuns) else len(runEnd)
+        blocks.append((int(r0), int(r1)))
+        r0 = r1
+
+    return blocks
+
+
+def _read_sparse_data_legacy(Binary_file, NbrVoxels, NbrSpots, roi:Optional[ROIMask]=None) -> csc_matrix:
+    """
+    Read sparse beamlets matrix from a sparse beamlets binary file, one value at a time.
+    Reference implementation kept for validation and benchmarking of _read_sparse_data.
 
     Parameters
     ----------
@@ -257,7 +537,7 @@ def _print_memory_usage(BeamletMatrix):
     BeamletMatrix : csc_matrix
         The sparse beamlets matrix
     """
-    if BeamletMatrix == []:
+    if BeamletMatrix is None or isinstance(BeamletMatrix, list):
         logger.info("Beamlets not loaded")
 
 
@@ -1094,3 +1374,52 @@ class MCsquareIOTestCase(unittest.TestCase):
         plan.appendBeam(beam)
 
         writePlan(plan, 'plan_test.txt', CTImage(), bdl)
+
+    def testReadSparseData(self):
+        """
+        Test that the vectorized sparse beamlets reader matches the reference reader.
+        """
+        import tempfile
+
+        gridSize = (6, 5, 4)
+        nbVoxels = gridSize[0] * gridSize[1] * gridSize[2]
+        spots = [[(3, [1., 2., 3.]), (10, [4.])], [], [(0, [5., 6.]), (100, [7., 8., 9.])], [(50, [0.5])]]
+
+        roiArray = np.zeros(gridSize, dtype=bool)
+        roiArray[1:4, 0:3, 0:2] = True
+        roi = ROIMask(imageArray=roiArray, name='roi')
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            binaryFile = os.path.join(tmpDir, 'Sparse_Dose.bin')
+            with open(binaryFile, 'wb') as fid:
+                for runs in spots:
+                    fid.write(struct.pack('IIIff', sum(len(values) for _, values in runs), 0, 0, 0., 0.))
+                    for firstIndex, values in runs:
+                        fid.write(struct.pack('II', len(values), firstIndex))
+                        fid.write(np.array(values, dtype='<f4').tobytes())
+
+            for testROI in (None, roi):
+                reference = _read_sparse_data_legacy(binaryFile, nbVoxels, len(spots), testROI)
+                for nbWorkers, memoryBudget in ((1, None), (3, None), (3, 1)):
+                    beamlets = _read_sparse_data(binaryFile, nbVoxels, len(spots), testROI, nbWorkers=nbWorkers,
+                                                 memoryBudget=memoryBudget)
+
+                    self.assertEqual(beamlets.shape, reference.shape)
+                    np.testing.assert_array_equal(beamlets.indptr, reference.indptr)
+                    np.testing.assert_array_equal(beamlets.indices, reference.indices)
+                    np.testing.assert_array_equal(beamlets.data, reference.data)
+
+    def testSparseSpotBlocks(self):
+        """
+        Test that spot blocks cover all runs and never split a spot.
+        """
+        runSpot = np.array([0, 0, 1, 3, 3, 3, 4])
+        runEnd = np.cumsum([5, 5, 30, 1, 1, 1, 2])
+
+        for nbWorkers in (1, 2, 8):
+            blocks = _sparse_spot_blocks(runSpot, runEnd, nbWorkers)
+            self.assertEqual(blocks[0][0], 0)
+            self.assertEqual(blocks[-1][1], len(runSpot))
+            for (_, r1), (r0, _) in zip(blocks[:-1], blocks[1:]):
+                self.assertEqual(r1, r0)
+                self.assertNotEqual(runSpot[r0 - 1], runSpot[r0])
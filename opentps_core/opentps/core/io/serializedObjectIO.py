@@ -205,33 +205,43 @@ def loadRTPlan(file_path, radiationType="Proton"):
     return plan
 
 
-def saveBeamlets(beamlets, file_path):
+def saveBeamlets(beamlets, file_path, compressed=False):
     """
-    Save the beamlets object in a file
+    Save the beamlets object in the native sparse beamlets format (see sparseBeamletsIO). The matrix, the dose grid, the
+    weights and the photon beamlet angles are saved. The patient is not saved: loaded beamlets must be added to a patient
+    again.
 
     Parameters
     ----------
     beamlets : SparseBeamlets
         The beamlets object to save
     file_path : str
-        The path of the file where to save the beamlets object
+        The path of the folder where to save the beamlets object
+    compressed : bool, optional
+        If True, the CSC arrays are compressed. The default is False.
     """
-    beamlets.storeOnFS(file_path)
+    beamlets.storeOnFS(file_path, compressed=compressed)
 
-def loadBeamlets(file_path):
+def loadBeamlets(file_path, lazy=False):
     """
-    Load a beamlets object from a file
+    Load a beamlets object from a file (pickle) or a folder (native sparse beamlets format)
 
     Parameters
     ----------
     file_path : str
         The path of the file to load the beamlets
+    lazy : bool, optional
+        If True and the beamlets are in the native format, the matrix is only read on first access. The default is False.
 
     Returns
     -------
     beamlets:SparseBeamlets
         The beamlets object loaded from the file
     """
+    from opentps.core.io import sparseBeamletsIO
+    if sparseBeamletsIO.isSparseBeamletsFolder(file_path):
+        return sparseBeamletsIO.readSparseBeamlets(file_path, lazy=lazy)
+
     from opentps.core.data._sparseBeamlets import SparseBeamlets
     return loadData(file_path, SparseBeamlets)
 
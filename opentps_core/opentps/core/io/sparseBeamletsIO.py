@@ -0,0 +1,392 @@
+"""
+Native on-disk format for SparseBeamlets.
+
+A beamlet matrix is stored in a folder holding a small JSON header and the CSC arrays. The column pointers are stored in
+a single file and the row indices and values are split in chunks of consecutive columns. The beamlet weights, if any,
+are stored in weights.npy and the beamlet angles of photon beamlets in the header. The patient is not stored. Uncompressed chunks are .npy
+files that are memory-mapped at read time, compressed chunks are .npz files that are decompressed one chunk at a time.
+Selected columns (spots) and rows (voxels) can therefore be read without materializing the full matrix.
+"""
+import json
+import logging
+import os
+import shutil
+import unittest
+from typing import Optional, Sequence, Union
+
+import numpy as np
+from scipy.sparse import csc_matrix
+
+logger = logging.getLogger(__name__)
+
+FORMAT_NAME = 'OpenTPS-SparseBeamlets'
+FORMAT_VERSION = 1
+HEADER_FILE = 'header.json'
+
+_DEFAULT_CHUNK_SIZE = 2 ** 24
+
+
+def isSparseBeamletsFolder(folderPath) -> bool:
+    """
+    Check whether a path is a folder written by writeSparseBeamlets
+
+    Parameters
+    ----------
+    folderPath : str
+        Path to test
+
+    Returns
+    -------
+    bool
+        True if the path holds a native sparse beamlets header
+    """
+    return os.path.isfile(os.path.join(folderPath, HEADER_FILE))
+
+
+def writeSparseBeamlets(beamlets, folderPath, compressed=False, chunkSize=_DEFAULT_CHUNK_SIZE):
+    """
+    Write a SparseBeamlets object in the native format. The matrix, the dose grid, the weights and the photon beamlet
+    angles are written, the patient is not.
+
+    Parameters
+    ----------
+    beamlets : SparseBeamlets
+        Beamlets to write. The matrix must be loaded in memory.
+    folderPath : str
+        Output folder. An existing folder is replaced only if it was written by writeSparseBeamlets, an existing file
+        is replaced.
+    compressed : bool, optional
+        If True, the chunks are compressed (not memory-mappable), by default False
+    chunkSize : int, optional
+        Approximate number of non-zero values per chunk, by default 2**24
+
+    Raises
+    ------
+    FileExistsError
+        If folderPath is an existing folder that was not written by writeSparseBeamlets
+    """
+    if os.path.isdir(folderPath) and not isSparseBeamletsFolder(folderPath):
+        raise FileExistsError('{} is an existing folder that does not hold sparse beamlets'.format(folderPath))
+
+    matrix = csc_matrix(beamlets.toSparseMatrix())
+
+    if os.path.isdir(folderPath):
+        shutil.rmtree(folderPath)
+    elif os.path.isfile(folderPath):
+        os.remove(folderPath)
+    os.makedirs(folderPath)
+
+    indptr = matrix.indptr.astype(np.int64)
+    chunkColumns = _chunkColumns(indptr, chunkSize)
+
+    np.save(os.path.join(folderPath, 'indptr.npy'), indptr)
+    for chunkID, (c0, c1) in enumerate(zip(chunkColumns[:-1], chunkColumns[1:])):
+        indices = matrix.indices[indptr[c0]:indptr[c1]]
+        data = matrix.data[indptr[c0]:indptr[c1]]
+        if compressed:
+            np.savez_compressed(os.path.join(folderPath, 'chunk_{}.npz'.format(chunkID)), indices=indices, data=data)
+        else:
+            np.save(os.path.join(folderPath, 'indices_{}.npy'.format(chunkID)), indices)
+            np.save(os.path.join(folderPath, 'data_{}.npy'.format(chunkID)), data)
+
+    if beamlets._weights is not None:
+        np.save(os.path.join(folderPath, 'weights.npy'), np.asarray(beamlets._weights))
+    beamletAngles = getattr(beamlets, 'beamletAngles_rad', None)
+
+    header = {
+        'format': FORMAT_NAME,
+        'version': FORMAT_VERSION,
+        'shape': [int(n) for n in matrix.shape],
+        'nnz': int(matrix.nnz),
+        'dtype': np.dtype(matrix.dtype).str,
+        'indexDtype': np.dtype(matrix.indices.dtype).str,
+        'compressed': bool(compressed),
+        'chunkColumns': [int(c) for c in chunkColumns],
+        'doseOrigin': _toList(beamlets.doseOrigin),
+        'doseSpacing': _toList(beamlets.doseSpacing),
+        'doseGridSize': _toList(beamlets.doseGridSize),
+        'doseOrientation': _toList(beamlets.doseOrientation),
+        'name': beamlets.name,
+        'seriesInstanceUID': str(beamlets.seriesInstanceUID),
+        'weights': beamlets._weights is not None,
+        'beamletAngles_rad': None if beamletAngles is None else np.asarray(beamletAngles, dtype=float).tolist(),
+    }
+    with open(os.path.join(folderPath, HEADER_FILE), 'w') as fid:
+        json.dump(header, fid, indent=2)
+
+    logger.info('Sparse beamlets ({} non-zeros) written in {}'.format(matrix.nnz, folderPath))
+
+
+def readSparseBeamletsHeader(folderPath) -> dict:
+    """
+    Read the header of a sparse beamlets folder
+
+    Parameters
+    ----------
+    folderPath : str
+        Folder written by writeSparseBeamlets
+
+    Returns
+    -------
+    header : dict
+        Header content
+    """
+    with open(os.path.join(folderPath, HEADER_FILE), 'r') as fid:
+        header = json.load(fid)
+
+    if header.get('format') != FORMAT_NAME:
+        raise ValueError('{} is not a sparse beamlets folder'.format(folderPath))
+    if header['version'] > FORMAT_VERSION:
+        raise ValueError('Sparse beamlets format version {} is not supported'.format(header['version']))
+
+    return header
+
+
+def readSparseBeamlets(folderPath, lazy=True):
+    """
+    Read a SparseBeamlets object from the native format
+
+    Parameters
+    ----------
+    folderPath : str
+        Folder written by writeSparseBeamlets
+    lazy : bool, optional
+        If True, only the header is read and the matrix is loaded on first access, by default True
+
+    Returns
+    -------
+    beamlets : SparseBeamlets
+        The beamlets
+    """
+    from opentps.core.data._sparseBeamlets import SparseBeamlets
+
+    header = readSparseBeamletsHeader(folderPath)
+
+    beamlets = SparseBeamlets()
+    beamlets.name = header['name']
+    beamlets.seriesInstanceUID = header['seriesInstanceUID']
+    beamlets.doseOrigin = tuple(header['doseOrigin'])
+    beamlets.doseSpacing = tuple(header['doseSpacing'])
+    beamlets.doseGridSize = tuple(header['doseGridSize'])
+    beamlets.doseOrientation = tuple(header['doseOrientation'])
+    beamlets._savedBeamletFile = folderPath
+    if header.get('weights', False):
+        beamlets._weights = np.load(os.path.join(folderPath, 'weights.npy'))
+    if header.get('beamletAngles_rad') is not None:
+        beamlets.beamletAngles_rad = np.array(header['beamletAngles_rad'])
+
+    if not lazy:
+        beamlets.setUnitaryBeamlets(readSparseMatrix(folderPath))
+
+    return beamlets
+
+
+def readSparseMatrix(folderPath, columns:Optional[Union[Sequence[int], slice, np.ndarray]]=None,
+                     rows:Optional[Union[Sequence[int], np.ndarray]]=None) -> csc_matrix:
+    """
+    Read the beamlet matrix, or a sub-matrix, from the native format.
+    Only the chunks holding the selected columns are read.
+
+    Parameters
+    ----------
+    folderPath : str
+        Folder written by writeSparseBeamlets
+    columns : Optional[Union[Sequence[int], slice, np.ndarray]], optional
+        Indices (or slice) of the columns (spots) to read, by default None (all columns)
+    rows : Optional[Union[Sequence[int], np.ndarray]], optional
+        Indices of the rows (voxels) to keep or flat boolean mask of size nbVoxels, by default None (all rows).
+        Rows of the returned matrix follow the order of the given indices.
+
+    Returns
+    -------
+    matrix : csc_matrix
+        Sparse matrix of shape (len(rows), len(columns))
+    """
+    header = readSparseBeamletsHeader(folderPath)
+    nbRows, nbColumns = header['shape']
+    indptr = np.load(os.path.join(folderPath, 'indptr.npy'))
+    chunkColumns = np.array(header['chunkColumns'], dtype=np.int64)
+
+    if columns is None:
+        columns = np.arange(nbColumns, dtype=np.int64)
+    elif isinstance(columns, slice):
+        columns = np.arange(nbColumns, dtype=np.int64)[columns]
+    else:
+        columns = np.array(columns, dtype=np.int64).reshape(-1)
+        columns[columns < 0] += nbColumns
+
+    rowMap = None
+    if rows is not None:
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        rowMap = np.full(nbRows, -1, dtype=np.int64)
+        rowMap[rows] = np.arange(len(rows))
+        nbRows = len(rows)
+
+    counts = indptr[columns + 1] - indptr[columns]
+    columnChunk = np.searchsorted(chunkColumns, columns, side='right') - 1
+
+    indices = np.empty(int(counts.sum()), dtype=np.dtype(header['indexDtype']))
+    data = np.empty(len(indices), dtype=np.dtype(header['dtype']))
+    outputStart = np.concatenate(([0], np.cumsum(counts)))
+
+    for chunkID in np.unique(columnChunk):
+        selected = np.flatnonzero(columnChunk == chunkID)
+        chunkIndices, chunkData = _loadChunk(folderPath, header, chunkID)
+
+        chunkStart = indptr[chunkColumns[chunkID]]
+        positions = _expandRanges(indptr[columns[selected]] - chunkStart, counts[selected])
+        outputPositions = _expandRanges(outputStart[selected], counts[selected])
+        indices[outputPositions] = chunkIndices[positions]
+        data[outputPositions] = chunkData[positions]
+        del chunkIndices, chunkData
+
+    newIndptr = outputStart
+
+    if rowMap is not None:
+        newRows = rowMap[indices]
+        keep = newRows >= 0
+        keptCumSum = np.concatenate(([0], np.cumsum(keep)))
+        newIndptr = keptCumSum[outputStart]
+        indices = newRows[keep].astype(indices.dtype)
+        data = data[keep]
+
+    matrix = csc_matrix((data, indices, newIndptr), shape=(nbRows, len(columns)))
+    if rowMap is not None:
+        matrix.sort_indices()
+
+    return matrix
+
+
+def _loadChunk(folderPath, header, chunkID):
+    if header['compressed']:
+        with np.load(os.path.join(folderPath, 'chunk_{}.npz'.format(chunkID))) as chunk:
+            return chunk['indices'], chunk['data']
+
+    indices = np.load(os.path.join(folderPath, 'indices_{}.npy'.format(chunkID)), mmap_mode='r')
+    data = np.load(os.path.join(folderPath, 'data_{}.npy'.format(chunkID)), mmap_mode='r')
+    return indices, data
+
+
+def _chunkColumns(indptr, chunkSize):
+    """
+    Column boundaries of chunks holding about chunkSize non-zero values each
+    """
+    nbColumns = len(indptr) - 1
+    chunkColumns = [0]
+    while chunkColumns[-1] < nbColumns:
+        c0 = chunkColumns[-1]
+        c1 = int(np.searchsorted(indptr, indptr[c0] + chunkSize, side='right')) - 1
+        chunkColumns.append(min(max(c1, c0 + 1), nbColumns))
+    return np.array(chunkColumns, dtype=np.int64)
+
+
+def _expandRanges(starts, counts):
+    """
+    Concatenate the ranges [starts[i], starts[i] + counts[i])
+    """
+    total = int(counts.sum())
+    offsets = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+    return offsets + np.arange(total, dtype=np.int64)
+
+
+def _toList(value):
+    return [float(v) if isinstance(v, (float, np.floating)) else int(v) if isinstance(v, (int, np.integer)) else v
+            for v in value]
+
+
+class SparseBeamletsIOTestCase(unittest.TestCase):
+    """
+    Test case for the native sparse beamlets format.
+    """
+    def testWriteRead(self):
+        """
+        Test full and partial reads of uncompressed and compressed beamlets.
+        """
+        import tempfile
+        import scipy.sparse as sp
+
+        from opentps.core.data._sparseBeamlets import SparseBeamlets
+
+        matrix = sp.random(500, 40, density=0.05, format='csc', dtype=np.float32, random_state=0)
+        columns = [39, 2, 17, 2]
+        rows = np.zeros(matrix.shape[0], dtype=bool)
+        rows[100:300] = True
+
+        for compressed in (False, True):
+            with tempfile.TemporaryDirectory() as tmpDir:
+                folderPath = os.path.join(tmpDir, 'beamlets.blm')
+                beamlets = SparseBeamlets()
+                beamlets.setUnitaryBeamlets(matrix.copy())
+                beamlets.doseGridSize = (5, 10, 10)
+                writeSparseBeamlets(beamlets, folderPath, compressed=compressed, chunkSize=100)
+
+                self.assertGreater(len(readSparseBeamletsHeader(folderPath)['chunkColumns']), 2)
+                self.assertEqual((readSparseMatrix(folderPath) != matrix).nnz, 0)
+
+                subMatrix = readSparseMatrix(folderPath, columns=columns, rows=rows)
+                expected = matrix[np.flatnonzero(rows)][:, columns]
+                self.assertEqual(subMatrix.shape, expected.shape)
+                self.assertEqual((subMatrix != expected).nnz, 0)
+
+                lazyBeamlets = readSparseBeamlets(folderPath, lazy=True)
+                self.assertEqual(lazyBeamlets.doseGridSize, (5, 10, 10))
+                self.assertEqual((lazyBeamlets.toSparseSubMatrix(spots=slice(5, 10)) != matrix[:, 5:10]).nnz, 0)
+                self.assertIsNone(lazyBeamlets._sparseBeamlets)
+                self.assertEqual((lazyBeamlets.toSparseMatrix() != matrix).nnz, 0)
+
+    def testOverwrite(self):
+        """
+        Test that only folders written by writeSparseBeamlets are replaced.
+        """
+        import tempfile
+        import scipy.sparse as sp
+
+        from opentps.core.data._sparseBeamlets import SparseBeamlets
+
+        beamlets = SparseBeamlets()
+        beamlets.setUnitaryBeamlets(sp.random(50, 4, density=0.1, format='csc', random_state=0))
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            folderPath = os.path.join(tmpDir, 'beamlets.blm')
+            writeSparseBeamlets(beamlets, folderPath)
+            writeSparseBeamlets(beamlets, folderPath)
+            self.assertEqual((readSparseMatrix(folderPath) != beamlets.toSparseMatrix()).nnz, 0)
+
+            userFile = os.path.join(tmpDir, 'data.txt')
+            with open(userFile, 'w') as fid:
+                fid.write('data')
+            with self.assertRaises(FileExistsError):
+                writeSparseBeamlets(beamlets, tmpDir)
+            self.assertTrue(os.path.isfile(userFile))
+
+    def testWeightsAndAngles(self):
+        """
+        Test that the weights and the photon beamlet angles are written and read with the matrix.
+        """
+        import tempfile
+        import scipy.sparse as sp
+
+        from opentps.core.data._sparseBeamlets import SparseBeamlets
+
+        beamlets = SparseBeamlets()
+        beamlets.setUnitaryBeamlets(sp.random(50, 4, density=0.1, format='csc', random_state=0))
+        beamlets.doseGridSize = (5, 5, 2)
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            folderPath = os.path.join(tmpDir, 'beamlets.blm')
+            writeSparseBeamlets(beamlets, folderPath)
+            readBeamlets = readSparseBeamlets(folderPath)
+            self.assertIsNone(readBeamlets._weights)
+            self.assertFalse(hasattr(readBeamlets, 'beamletAngles_rad'))
+
+            beamlets._weights = np.array([1., 2., 0., 4.], dtype=np.float32)
+            beamlets.beamletAngles_rad = [0., np.pi / 2, np.pi / 2, np.pi]
+            writeSparseBeamlets(beamlets, folderPath, compressed=True)
+            readBeamlets = readSparseBeamlets(folderPath, lazy=False)
+            np.testing.assert_array_equal(readBeamlets._weights, beamlets._weights)
+            self.assertEqual(readBeamlets._weights.dtype, np.float32)
+            np.testing.assert_array_equal(readBeamlets.beamletAngles_rad, beamlets.beamletAngles_rad)
+            np.testing.assert_array_equal(readBeamlets.toDoseImage().imageArray.ravel(),
+                                          beamlets.toDoseImage().imageArray.ravel())
@@ -1,9 +1,11 @@
-import os
-import numpy as np
 import ctypes
-import scipy.interpolate
-import platform
 import logging
+import time
+
+import numpy as np
+import scipy.interpolate
+
+from opentps.core.processing.C_libraries import nativeBackend
 
 logger = logging.getLogger(__name__)
 #logger.setLevel(logging.WARNING)
@@ -12,13 +14,16 @@ try:
     import cupy
     import cupyx
     # cupy.cuda.Device(0).use()
+    cupyAvailable = True
 except:
+    cupyAvailable = False
     logger.warning('cupy not found.')
 
 
-def interpolateTrilinear(image, gridSize, interpolatedPoints, fillValue=0, tryGPU=True):
+def interpolateTrilinear(image, gridSize, interpolatedPoints, fillValue=0, tryGPU=True, numThreads=None):
   """
     Interpolate a 3D image using trilinear interpolation.
+    The C library is loaded once. Float32 C-contiguous inputs are passed to it without copy.
 
     Parameters
     ----------
@@ -32,59 +37,50 @@ def interpolateTrilinear(image, gridSize, interpolatedPoints, fillValue=0, tryGP
         Value to be used for points outside the image. The default is 0.
     tryGPU : bool, optional
         Try to use GPU for interpolation. The default is True.
+    numThreads : int, optional
+        Number of OpenMP threads of the C implementation. The default is None (OpenMP default).
 
     Returns
     -------
     interpolatedImage : numpy.ndarray
         Interpolated image.
   """
+  startTime = time.perf_counter()
 
-  interpolatedImage = None
-
-  if image.size > 1e5 and tryGPU:
-    if interpolatedImage is None:
-      try:
-        interpolatedImage = cupy.asnumpy(cupyx.scipy.ndimage.map_coordinates(cupy.asarray(image), cupy.asarray(interpolatedPoints.T), order=1, mode='constant', cval=fillValue))
-      except:
-        logger.info('cupy 3D interpolation not enabled. The C implementation is tried instead')
-
-  if interpolatedImage is None:
+  if image.size > 1e5 and tryGPU and cupyAvailable:
     try:
-      # import C library
-      if(platform.system() == "Linux"): libInterp3 = ctypes.cdll.LoadLibrary(os.path.join(os.path.dirname(__file__),
-                                                                                          "libInterp3.so"))
-      elif(platform.system() == "Windows"): libInterp3 = ctypes.cdll.LoadLibrary(os.path.join(os.path.dirname(__file__),
-                                                                                              "libInterp3.dll"))
-      elif (platform.system() == "Darwin"): libInterp3 = ctypes.cdll.LoadLibrary(os.path.join(os.path.dirname(__file__),
-                                                                                              "libInterp3MAC.so"))
-      else: print("Error: not compatible with " + platform.system() + " system.")
-      float_array = np.ctypeslib.ndpointer(dtype=np.float32)
-      int_array = np.ctypeslib.ndpointer(dtype=np.int32)
-      libInterp3.Trilinear_Interpolation.argtypes = [float_array, int_array, float_array, ctypes.c_int, ctypes.c_float, float_array]
-      libInterp3.Trilinear_Interpolation.restype = ctypes.c_void_p
-
-      # prepare inputs for C library
-      Img = np.array(image, dtype=np.float32, order='C')
-      Size = np.array(gridSize, dtype=np.int32, order='C')
-      Points = np.array(interpolatedPoints, dtype=np.float32, order='C')
-      NumPoints = interpolatedPoints.shape[0]
-      interpolatedImage = np.zeros(NumPoints, dtype=np.float32, order='C')
-
-      # call C function
-      libInterp3.Trilinear_Interpolation(Img, Size, Points, NumPoints, fillValue, interpolatedImage)
-
-    except:
-      # print('accelerated 3D interpolation not enabled. The python implementation is used instead')
-      logger.info('accelerated 3D interpolation not enabled. The python implementation is used instead')
-      # print('accelerated 3D interpolation not enabled. The python implementation is used instead')
-
-
-  if interpolatedImage is None:
+      interpolatedImage = cupy.asnumpy(cupyx.scipy.ndimage.map_coordinates(cupy.asarray(image), cupy.asarray(interpolatedPoints.T), order=1, mode='constant', cval=fillValue))
+      nativeBackend.reportCall('interpolateTrilinear', nativeBackend.CUPY, time.perf_counter() - startTime)
+      return interpolatedImage
+    except Exception as error:
+      logger.info('cupy 3D interpolation failed (' + str(error) + '). The C implementation is tried instead')
+
+  trilinearInterpolation = nativeBackend.getFunction('libInterp3', 'Trilinear_Interpolation',
+                                                     [nativeBackend.floatArray, nativeBackend.intArray,
+                                                      nativeBackend.floatArray, ctypes.c_int, ctypes.c_float,
+                                                      nativeBackend.floatArray])
+
+  if trilinearInterpolation is not None:
+    # prepare inputs for C library
+    Img = nativeBackend.asFloat32(image)
+    Size = np.array(gridSize, dtype=np.int32)
+    Points = nativeBackend.asFloat32(interpolatedPoints)
+    NumPoints = Points.shape[0]
+    interpolatedImage = np.zeros(NumPoints, dtype=np.float32)
+
+    # call C function
+    with nativeBackend.openMPThreads('libInterp3', numThreads):
+      trilinearInterpolation(Img, Size, Points, NumPoints, fillValue, interpolatedImage)
+    backend = nativeBackend.NATIVE
+
+  else:
     # voxel coordinates of the original image
     x = np.arange(gridSize[0])
     y = np.arange(gridSize[1])
     z = np.arange(gridSize[2])
 
     interpolatedImage = scipy.interpolate.interpn((x, y, z), image, interpolatedPoints, method='linear', fill_value=fillValue, bounds_error=False)
+    backend = nativeBackend.PYTHON
 
+  nativeBackend.reportCall('interpolateTrilinear', backend, time.perf_counter() - startTime)
   return interpolatedImage
@@ -0,0 +1,301 @@
+"""
+NumPy implementation of the kernels of libRayTracing.c, used when the C library cannot be loaded.
+
+Each function has the signature of its C counterpart (flattened float32 arrays modified in place). All the rays are
+traced together: every iteration moves each remaining ray to its next voxel boundary, with the float32 arithmetic and
+the stopping rules of the C kernels. Rays are removed from the computation as soon as they stop.
+"""
+
+import unittest
+
+import numpy as np
+
+_RAYS_PER_CHUNK = 2 ** 18
+
+
+def _distanceToNextVoxel(positions, direction, offset, spacing):
+    # fabs(((floor((x-Offset)/PixelSpacing) + (u>0)) * PixelSpacing + Offset - x)/u), evaluated in double and stored
+    # in float as in the C kernels
+    voxelCoordinates = np.floor((positions - offset) / spacing).astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dist = np.abs(((voxelCoordinates + (direction > 0)) * spacing.astype(np.float64) + offset.astype(np.float64)
+                       - positions) / direction.astype(np.float64)).astype(np.float32)
+    return np.fmin(np.fmin(dist[:, 0], dist[:, 1]), dist[:, 2])
+
+
+def _step(positions, direction, offset, spacing):
+    return (_distanceToNextVoxel(positions, direction, offset, spacing).astype(np.float64) + 1e-3).astype(np.float32)
+
+
+def _voxelIndex(positions, offset, spacing, gridSize):
+    voxel = np.floor((positions - offset) / spacing).astype(np.int64)
+    return voxel, voxel[:, 2] + gridSize[2] * (voxel[:, 1] + gridSize[1] * voxel[:, 0])
+
+
+def _outsideImage(positions, direction, lowerBorder, upperBorder):
+    return np.any(((positions < lowerBorder) & (direction < 0)) | ((positions > upperBorder) & (direction > 0)), axis=1)
+
+
+def _prepare(Offset, PixelSpacing, GridSize):
+    offset = np.asarray(Offset, dtype=np.float32).reshape(3)
+    spacing = np.asarray(PixelSpacing, dtype=np.float32).reshape(3)
+    gridSize = np.asarray(GridSize, dtype=np.int64).reshape(3)
+    return offset, spacing, gridSize
+
+
+def raytrace_WET(SPR, ROI_mask, WET, Offset, PixelSpacing, GridSize, beam_direction):
+    """
+    Compute in WET the water equivalent thickness from each voxel of ROI_mask to the border of the SPR image,
+    against beam_direction.
+
+    Parameters
+    ----------
+    SPR : numpy.ndarray
+        float32 SPR image (flattened in C order or 3D).
+    ROI_mask : numpy.ndarray
+        Voxels for which the WET is computed.
+    WET : numpy.ndarray
+        float32 output array, same size as SPR.
+    Offset, PixelSpacing, GridSize, beam_direction : numpy.ndarray
+        Image geometry and beam direction.
+    """
+    offset, spacing, gridSize = _prepare(Offset, PixelSpacing, GridSize)
+    SPR = np.ravel(SPR)
+    WET = WET.reshape(-1)
+    direction = -np.asarray(beam_direction, dtype=np.float32).reshape(3)
+    lowerBorder = offset
+    upperBorder = offset + (gridSize - 1).astype(np.float32) * spacing
+
+    rays = np.flatnonzero(np.ravel(ROI_mask))
+    for start in range(0, len(rays), _RAYS_PER_CHUNK):
+        chunk = rays[start:start + _RAYS_PER_CHUNK]
+        voxel = np.stack(np.unravel_index(chunk, tuple(gridSize)), axis=1)
+        voxelCoordinates = offset + voxel.astype(np.float32) * spacing
+        positions = (voxelCoordinates.astype(np.float64) + 0.5 * spacing.astype(np.float64)).astype(np.float32)
+        wet = np.zeros(len(chunk), dtype=np.float32)
+        active = np.arange(len(chunk))
+
+        while len(active):
+            inside = ~_outsideImage(positions, direction, lowerBorder, upperBorder)
+            active = active[inside]
+            positions = positions[inside]
+            if not len(active):
+                break
+
+            step = _step(positions, direction, offset, spacing)
+            _, index = _voxelIndex(positions, offset, spacing, gridSize)
+            wet[active] += SPR[index] * step
+            positions = positions + step[:, None] * direction
+
+        WET[chunk] = wet
+
+
+def compute_position_from_range(SPR, Offset, PixelSpacing, GridSize, positions, directions, ranges, NumSpots):
+    """
+    Move each spot position along its direction until the water equivalent path length reaches its range.
+    Voxels outside the image have a SPR of 0.001.
+
+    Parameters
+    ----------
+    SPR : numpy.ndarray
+        float32 SPR image (flattened in C order or 3D).
+    Offset, PixelSpacing, GridSize : numpy.ndarray
+        Image geometry.
+    positions : numpy.ndarray
+        float32 array of the NumSpots x 3 spot positions, updated in place.
+    directions : numpy.ndarray
+        NumSpots x 3 spot directions.
+    ranges : numpy.ndarray
+        Ranges in water of the spots.
+    NumSpots : int
+        Number of spots.
+    """
+    offset, spacing, gridSize = _prepare(Offset, PixelSpacing, GridSize)
+    SPR = np.ravel(SPR)
+    output = positions.reshape(NumSpots, 3)
+    directions = np.asarray(directions, dtype=np.float32).reshape(NumSpots, 3)
+    ranges = np.asarray(ranges, dtype=np.float32).reshape(NumSpots)
+    lowerBorder = offset
+    upperBorder = offset + gridSize.astype(np.float32) * spacing
+
+    current = output.copy()
+    wet = np.zeros(NumSpots, dtype=np.float32)
+    active = np.arange(NumSpots)
+    while len(active):
+        position = current[active]
+        direction = directions[active]
+        remaining = (wet[active] < ranges[active]) & ~_outsideImage(position, direction, lowerBorder, upperBorder)
+        output[active[~remaining]] = position[~remaining]
+        active = active[remaining]
+        position = position[remaining]
+        direction = direction[remaining]
+        if not len(active):
+            break
+
+        step = _step(position, direction, offset, spacing)
+        voxel, index = _voxelIndex(position, offset, spacing, gridSize)
+        inGrid = np.all((voxel >= 0) & (voxel < gridSize), axis=1)
+        voxelSPR = np.full(len(active), 0.001, dtype=np.float32)
+        voxelSPR[inGrid] = SPR[index[inGrid]]
+        wet[active] += voxelSPR * step
+        current[active] = position + step[:, None] * direction
+
+
+def transport_spots_to_target(SPR, Target_mask, Offset, PixelSpacing, GridSize, positions, WETs, direction, NumSpots):
+    """
+    Move each spot position along direction until it reaches the target, and accumulate its water equivalent path
+    length in WETs (-1 if the spot leaves the image).
+
+    Parameters
+    ----------
+    SPR : numpy.ndarray
+        float32 SPR image (flattened in C order or 3D).
+    Target_mask : numpy.ndarray
+        Target mask.
+    Offset, PixelSpacing, GridSize : numpy.ndarray
+        Image geometry.
+    positions : numpy.ndarray
+        float32 array of the NumSpots x 3 spot positions, updated in place.
+    WETs : numpy.ndarray
+        float32 array of the NumSpots WETs, updated in place.
+    direction : numpy.ndarray
+        Beam direction.
+    NumSpots : int
+        Number of spots.
+    """
+    offset, spacing, gridSize = _prepare(Offset, PixelSpacing, GridSize)
+    SPR = np.ravel(SPR)
+    targetMask = np.ravel(Target_mask)
+    numVoxels = int(np.prod(gridSize))
+    output = positions.reshape(NumSpots, 3)
+    direction = np.asarray(direction, dtype=np.float32).reshape(3)
+    lowerBorder = offset
+    upperBorder = offset + gridSize.astype(np.float32) * spacing
+
+    current = output.copy()
+    active = np.arange(NumSpots)
+    while len(active):
+        position = current[active]
+        outside = _outsideImage(position, direction, lowerBorder, upperBorder)
+        WETs[active[outside]] = -1
+
+        _, index = _voxelIndex(position, offset, spacing, gridSize)
+        inImage = (index > 0) & (index < numVoxels)
+        inTarget = np.zeros(len(active), dtype=bool)
+        inTarget[inImage] = targetMask[index[inImage]]
+
+        stopped = outside | inTarget
+        output[active[stopped]] = position[stopped]
+        active = active[~stopped]
+        position = position[~stopped]
+        index = index[~stopped]
+        inImage = inImage[~stopped]
+        if not len(active):
+            break
+
+        step = _step(position, direction, offset, spacing)
+        voxelSPR = np.full(len(active), 0.001, dtype=np.float32)
+        voxelSPR[inImage] = SPR[index[inImage]]
+        WETs[active] += voxelSPR * step
+        current[active] = position + step[:, None] * direction
+
+
+def transport_spots_inside_target(SPR, Target_mask, Offset, PixelSpacing, GridSize, positions, WETs, Layers, direction,
+                                  NumSpots, max_number_layers, minWET, LayerSpacing):
+    """
+    Move each spot position along direction through the target, and store in Layers the WET of the energy layers
+    reached inside the target.
+
+    Parameters
+    ----------
+    SPR : numpy.ndarray
+        float32 SPR image (flattened in C order or 3D).
+    Target_mask : numpy.ndarray
+        Target mask.
+    Offset, PixelSpacing, GridSize : numpy.ndarray
+        Image geometry.
+    positions : numpy.ndarray
+        float32 array of the NumSpots x 3 spot positions, updated in place.
+    WETs : numpy.ndarray
+        float32 array of the NumSpots WETs, updated in place.
+    Layers : numpy.ndarray
+        float32 array of NumSpots x max_number_layers layer WETs, initialized to -1 and updated in place.
+    direction : numpy.ndarray
+        Beam direction.
+    NumSpots : int
+        Number of spots.
+    max_number_layers : int
+        Maximum number of layers per spot.
+    minWET : float
+        WET of the first layer.
+    LayerSpacing : float
+        WET between layers.
+    """
+    offset, spacing, gridSize = _prepare(Offset, PixelSpacing, GridSize)
+    SPR = np.ravel(SPR)
+    targetMask = np.ravel(Target_mask)
+    numVoxels = int(np.prod(gridSize))
+    output = positions.reshape(NumSpots, 3)
+    Layers = Layers.reshape(NumSpots, max_number_layers)
+    direction = np.asarray(direction, dtype=np.float32).reshape(3)
+    minWET = np.float32(minWET)
+    LayerSpacing = np.float32(LayerSpacing)
+    lowerBorder = offset
+    upperBorder = offset + gridSize.astype(np.float32) * spacing
+
+    numLayer = np.ceil((WETs.astype(np.float32) - minWET).astype(np.float64) / np.float64(LayerSpacing)).astype(np.int64)
+    layerWET = minWET + numLayer.astype(np.float32) * LayerSpacing
+    count = np.zeros(NumSpots, dtype=np.int64)
+
+    current = output.copy()
+    active = np.arange(NumSpots)
+    while len(active):
+        position = current[active]
+        _, index = _voxelIndex(position, offset, spacing, gridSize)
+        stopped = _outsideImage(position, direction, lowerBorder, upperBorder) | (index < 0) | (index >= numVoxels)
+        output[active[stopped]] = position[stopped]
+        active = active[~stopped]
+        position = position[~stopped]
+        index = index[~stopped]
+        if not len(active):
+            break
+
+        reached = WETs[active] >= layerWET[active]
+        recorded = active[reached & targetMask[index] & (count[active] < max_number_layers)]
+        Layers[recorded, count[recorded]] = layerWET[recorded]
+        count[recorded] += 1
+        reached = active[reached]
+        numLayer[reached] += 1
+        layerWET[reached] = minWET + numLayer[reached].astype(np.float32) * LayerSpacing
+
+        step = np.fmin(_step(position, direction, offset, spacing), LayerSpacing)
+        WETs[active] += SPR[index] * step
+        current[active] = position + step[:, None] * direction
+
+
+class LibRayTracingNumpyTestCase(unittest.TestCase):
+    def testRaytraceWET(self):
+        SPR = np.full((10, 6, 4), 2., dtype=np.float32)
+        WET = np.zeros(SPR.size, dtype=np.float32)
+        ROI_mask = np.zeros(SPR.shape, dtype=bool)
+        ROI_mask[3, 2, 1] = True
+
+        offset = np.zeros(3, dtype=np.float32)
+        spacing = np.ones(3, dtype=np.float32)
+        raytrace_WET(SPR, ROI_mask, WET, offset, spacing, np.array(SPR.shape, dtype=np.int32),
+                     np.array([1., 0., 0.], dtype=np.float32))
+
+        WET = WET.reshape(SPR.shape)
+        self.assertEqual(np.count_nonzero(WET), 1)
+        # steps of 0.5 + 1e-3 mm to cross the first voxel boundary, then of 1 mm until x < 0
+        self.assertAlmostEqual(WET[3, 2, 1], 2. * (0.501 + 3.), places=4)
+
+    def testComputePositionFromRange(self):
+        SPR = np.ones((20, 5, 5), dtype=np.float32)
+        positions = np.array([0.5, 2.5, 2.5, 0.5, 2.5, 2.5], dtype=np.float32)
+        directions = np.array([1., 0., 0., 1., 0., 0.], dtype=np.float32)
+        ranges = np.array([5., 50.], dtype=np.float32)
+        compute_position_from_range(SPR, np.zeros(3), np.ones(3), np.array(SPR.shape), positions, directions, ranges, 2)
+
+        self.assertAlmostEqual(positions[0], 6.001, places=4)
+        self.assertGreater(positions[3], 20.)
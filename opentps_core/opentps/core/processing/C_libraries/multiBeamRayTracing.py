@@ -0,0 +1,298 @@
+__all__ = ['MultiBeamRayTracer', 'RayTracingCache', 'beamDirection']
+
+import copy
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+import unittest
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Sequence
+
+import numpy as np
+
+from opentps.core.processing.C_libraries import nativeBackend
+from opentps.core.processing.C_libraries import libRayTracing_wrapper as wrapper
+
+logger = logging.getLogger(__name__)
+
+
+def beamDirection(gantryAngle:float, couchAngle:float=0.) -> np.ndarray:
+    """
+    Direction of a proton beam in the Dicom CT coordinate system.
+
+    Parameters
+    ----------
+    gantryAngle : float
+        Gantry angle in degree
+    couchAngle : float
+        Couch angle in degree
+
+    Returns
+    -------
+    direction : np.ndarray
+        Unit vector along the beam direction
+    """
+    gantryAngle = math.radians(gantryAngle)
+    couchAngle = math.radians(couchAngle)
+
+    # BEV to 3D coordinates, then rotations for the gantry angle (around Z) and the couch angle (around Y)
+    u, v, w = 1e-10, 1.0, 1e-10
+    u, v = u * math.cos(gantryAngle) - v * math.sin(gantryAngle), u * math.sin(gantryAngle) + v * math.cos(gantryAngle)
+    u, w = u * math.cos(couchAngle) + w * math.sin(couchAngle), -u * math.sin(couchAngle) + w * math.cos(couchAngle)
+    return np.array([u, v, w])
+
+
+class RayTracingCache:
+    """
+    Least recently used cache of ray tracing results (WET maps and spot transports), addressed by the hash of the SPR
+    image, of the masks and spots, and by the beam direction. A same cache can be shared by several MultiBeamRayTracer.
+
+    Attributes
+    ----------
+    maxBytes: float
+        Maximum memory (in bytes) used by the cached arrays (None for no limit)
+    statistics: dict
+        Number of hits, misses and evictions
+    """
+    def __init__(self, maxBytes:Optional[float]=2**30):
+        self.maxBytes = maxBytes
+
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self._statistics = {}
+        self.resetStatistics()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def statistics(self) -> dict:
+        return dict(self._statistics)
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def resetStatistics(self):
+        """
+        Reset the hit, miss and eviction counters.
+        """
+        self._statistics = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, key:tuple):
+        """
+        Get a copy of a cached result, None if the key is not in cache.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._statistics['misses'] += 1
+                return None
+            self._statistics['hits'] += 1
+            self._entries.move_to_end(key)
+
+        return copy.deepcopy(entry[0])
+
+    def put(self, key:tuple, result):
+        """
+        Store a copy of a result (array or tuple of arrays) and evict the least recently used results exceeding maxBytes.
+        """
+        result = copy.deepcopy(result)
+        nbytes = sum(array.nbytes for array in (result if isinstance(result, tuple) else (result, )))
+
+        with self._lock:
+            if key in self._entries:
+                self._nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (result, nbytes)
+            self._nbytes += nbytes
+
+            while self._entries and self.maxBytes is not None and self._nbytes > self.maxBytes:
+                _, (_, evictedBytes) = self._entries.popitem(last=False)
+                self._nbytes -= evictedBytes
+                self._statistics['evictions'] += 1
+
+    def clear(self):
+        """
+        Remove all results from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+
+class MultiBeamRayTracer:
+    """
+    Ray tracing of several beams on a same SPR image.
+
+    The SPR image is converted once to the format of the ray tracing kernels, the beams are traced in parallel threads
+    (the kernels release the GIL) and the results are cached by SPR content and beam direction.
+
+    Parameters
+    ----------
+    rspImage : RSPImage
+        The SPR image.
+    numWorkers : int
+        Number of beams traced in parallel. The default is the number of CPUs.
+    cache : RayTracingCache
+        Cache of the results. If None, a cache is created for this ray tracer.
+    """
+    def __init__(self, rspImage, numWorkers:Optional[int]=None, cache:Optional[RayTracingCache]=None):
+        self.numWorkers = numWorkers if numWorkers is not None else (os.cpu_count() or 1)
+        self.cache = cache if cache is not None else RayTracingCache()
+
+        self._image = wrapper._prepareImage(rspImage)
+        self._imageKey = _hashArrays(*self._image)
+
+    def computeWETs(self, beamDirections:Sequence, roi=None) -> list:
+        """
+        Compute the water equivalent thickness of each voxel of roi for each beam direction.
+
+        Parameters
+        ----------
+        beamDirections : list
+            Beam direction vectors (see beamDirection() to get them from the gantry and couch angles).
+        roi : ROIMask
+            Voxels for which the WET is computed. If None, the WET is computed for all voxels.
+
+        Returns
+        -------
+        WETs : list of np.ndarray
+            WET map of each beam.
+        """
+        shape = tuple(self._image[3])
+        roiMask = np.ones(shape, dtype=bool) if roi is None else np.ascontiguousarray(roi.imageArray, dtype=bool)
+        roiKey = _hashArrays(roiMask)
+
+        def compute(direction, numThreads):
+            key = ('WET', self._imageKey, roiKey, _directionKey(direction))
+            WET = self.cache.get(key)
+            if WET is None:
+                WET, _ = wrapper._raytraceWET(self._image, roiMask, direction, numThreads)
+                self.cache.put(key, WET)
+            return WET
+
+        return self._map('WET_raytracing', compute, list(beamDirections))
+
+    def transportSpotsToTarget(self, targetMask, spotGrids:Sequence[dict], beamDirections:Sequence):
+        """
+        Transport the spots of each beam until they reach the target. See libRayTracing_wrapper.transport_spots_to_target.
+
+        Parameters
+        ----------
+        targetMask : ROIMask
+            The target mask.
+        spotGrids : list of dict
+            Spot grid of each beam, updated in place.
+        beamDirections : list
+            Beam direction vectors.
+        """
+        targetArray = np.ascontiguousarray(targetMask.imageArray, dtype=bool).ravel()
+        targetKey = _hashArrays(targetArray)
+
+        def compute(spotGrid, direction, numThreads):
+            positions = wrapper._spotPositions(spotGrid)
+            key = ('toTarget', self._imageKey, targetKey, _directionKey(direction), _hashArrays(positions))
+            result = self.cache.get(key)
+            if result is None:
+                WETs, _ = wrapper._transportSpotsToTarget(self._image, targetArray, positions, direction, numThreads)
+                result = (positions, WETs)
+                self.cache.put(key, result)
+
+            positions, WETs = result
+            spotGrid["WET"] = WETs.tolist()
+            wrapper._setSpotPositions(spotGrid, positions)
+
+        self._map('transport_spots_to_target', compute, list(spotGrids), list(beamDirections))
+
+    def transportSpotsInsideTarget(self, targetMask, spotGrids:Sequence[dict], beamDirections:Sequence,
+                                   minWETs:Sequence[float], layerSpacing:float):
+        """
+        Transport the spots of each beam inside the target and compute their energy layers. See
+        libRayTracing_wrapper.transport_spots_inside_target.
+
+        Parameters
+        ----------
+        targetMask : ROIMask
+            The target mask.
+        spotGrids : list of dict
+            Spot grid of each beam. The energy layers are appended to spotGrid["EnergyLayers"].
+        beamDirections : list
+            Beam direction vectors.
+        minWETs : list of float
+            Minimum WET of each beam.
+        layerSpacing : float
+            WET between energy layers.
+        """
+        targetArray = np.ascontiguousarray(targetMask.imageArray, dtype=bool).ravel()
+        targetKey = _hashArrays(targetArray)
+
+        def compute(spotGrid, direction, minWET, numThreads):
+            positions = wrapper._spotPositions(spotGrid)
+            WETs = np.array(spotGrid["WET"], dtype=np.float32, order='C')
+            key = ('insideTarget', self._imageKey, targetKey, _directionKey(direction), _hashArrays(positions, WETs),
+                   float(minWET), float(layerSpacing))
+            Layers = self.cache.get(key)
+            if Layers is None:
+                Layers, _ = wrapper._transportSpotsInsideTarget(self._image, targetArray, positions, WETs, direction,
+                                                                minWET, layerSpacing, numThreads)
+                self.cache.put(key, Layers)
+
+            wrapper._appendEnergyLayers(spotGrid, Layers)
+
+        self._map('transport_spots_inside_target', compute, list(spotGrids), list(beamDirections), list(minWETs))
+
+    def _map(self, functionName, function, *beamArguments):
+        startTime = time.perf_counter()
+        numBeams = len(beamArguments[0])
+        numWorkers = max(1, min(self.numWorkers, numBeams))
+        # share the CPUs between the beams traced in parallel
+        numThreads = max(1, (os.cpu_count() or 1) // numWorkers) if numWorkers > 1 else None
+
+        if numWorkers == 1:
+            results = [function(*arguments, numThreads) for arguments in zip(*beamArguments)]
+        else:
+            with ThreadPoolExecutor(max_workers=numWorkers) as executor:
+                results = list(executor.map(function, *beamArguments, [numThreads] * numBeams))
+
+        backend = nativeBackend.NATIVE if nativeBackend.loadLibrary('libRayTracing') is not None else nativeBackend.NUMPY
+        nativeBackend.reportCall(functionName, backend, time.perf_counter() - startTime)
+        logger.debug(functionName + ' of ' + str(numBeams) + ' beams in ' + str(time.perf_counter() - startTime) + ' s')
+        return results
+
+
+def _hashArrays(*arrays) -> str:
+    hasher = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        hasher.update((array.dtype.str + str(array.shape)).encode())
+        hasher.update(array.data)
+    return hasher.hexdigest()
+
+
+def _directionKey(direction) -> bytes:
+    return np.array(direction, dtype=np.float32).reshape(3).tobytes()
+
+
+class MultiBeamRayTracerTestCase(unittest.TestCase):
+    def testComputeWETs(self):
+        from opentps.core.data.images import RSPImage, ROIMask
+        from opentps.core.processing.C_libraries.libRayTracing_wrapper import WET_raytracing
+
+        rng = np.random.default_rng(0)
+        rsp = RSPImage(imageArray=rng.uniform(0.5, 1.5, (12, 10, 8)), spacing=(2., 2., 3.), origin=(-12., -10., 0.))
+        roi = ROIMask(imageArray=rng.random((12, 10, 8)) < 0.3, spacing=rsp.spacing, origin=rsp.origin)
+        directions = [beamDirection(angle, couch) for angle, couch in ((0., 0.), (45., 0.), (90., 30.))]
+
+        rayTracer = MultiBeamRayTracer(rsp, numWorkers=2)
+        WETs = rayTracer.computeWETs(directions, roi)
+        for direction, WET in zip(directions, WETs):
+            np.testing.assert_array_equal(WET, WET_raytracing(rsp, direction, roi))
+
+        WETs[0][...] = 0.
+        np.testing.assert_array_equal(rayTracer.computeWETs(directions[:1], roi)[0], WET_raytracing(rsp, directions[0], roi))
+        self.assertEqual(rayTracer.cache.statistics, {'hits': 1, 'misses': 3, 'evictions': 0})
@@ -0,0 +1,178 @@
+import ctypes
+import logging
+import os
+import platform
+import threading
+import unittest
+from contextlib import contextmanager
+from typing import Callable, Optional, Sequence
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+NATIVE = 'native'
+CUPY = 'cupy'
+NUMPY = 'numpy'
+PYTHON = 'python'
+
+floatArray = np.ctypeslib.ndpointer(dtype=np.float32, flags='C_CONTIGUOUS')
+intArray = np.ctypeslib.ndpointer(dtype=np.int32, flags='C_CONTIGUOUS')
+boolArray = np.ctypeslib.ndpointer(dtype=bool, flags='C_CONTIGUOUS')
+
+_libraryFileNames = {'Linux': '{}.so', 'Windows': '{}.dll', 'Darwin': '{}MAC.so'}
+_libraries = {}
+_functions = {}
+_lock = threading.Lock()
+_metricsHooks = []
+
+
+def loadLibrary(libraryName:str) -> Optional[ctypes.CDLL]:
+    """
+    Load a C library of the C_libraries folder. The library is loaded at the first call only.
+
+    Parameters
+    ----------
+    libraryName : str
+        Name of the library without extension, e.g. 'libInterp3'.
+
+    Returns
+    -------
+    ctypes.CDLL
+        The loaded library, None if it is not available on this system.
+    """
+    with _lock:
+        if libraryName not in _libraries:
+            library = None
+            fileName = _libraryFileNames.get(platform.system())
+            if fileName is None:
+                logger.error("Not compatible with " + platform.system() + " system.")
+            else:
+                try:
+                    library = ctypes.CDLL(os.path.join(os.path.dirname(__file__), fileName.format(libraryName)))
+                except OSError as error:
+                    logger.warning(libraryName + ' could not be loaded, the python implementation is used instead: '
+                                   + str(error))
+            _libraries[libraryName] = library
+
+        return _libraries[libraryName]
+
+
+def getFunction(libraryName:str, functionName:str, argtypes:Sequence, restype=ctypes.c_void_p) -> Optional[Callable]:
+    """
+    Get a function of a C library with its signature declared. Libraries and signatures are cached.
+
+    Parameters
+    ----------
+    libraryName : str
+        Name of the library without extension.
+    functionName : str
+        Name of the C function.
+    argtypes : list
+        ctypes types of the arguments.
+    restype : ctypes type
+        ctypes type of the returned value.
+
+    Returns
+    -------
+    Callable
+        The C function, None if the library or the function is not available.
+    """
+    key = (libraryName, functionName)
+    if key not in _functions:
+        library = loadLibrary(libraryName)
+        function = None
+        if library is not None:
+            try:
+                function = getattr(library, functionName)
+                function.argtypes = argtypes
+                function.restype = restype
+            except AttributeError:
+                logger.warning(functionName + ' not found in ' + libraryName + ', the python implementation is used instead')
+                function = None
+        _functions[key] = function
+
+    return _functions[key]
+
+
+def asFloat32(array) -> np.ndarray:
+    """
+    Return array as a float32 C-contiguous array, without copy if it already is one.
+    """
+    return np.ascontiguousarray(array, dtype=np.float32)
+
+
+@contextmanager
+def openMPThreads(libraryName:str, numThreads:Optional[int]=None):
+    """
+    Context manager setting the number of OpenMP threads used by the kernels of a C library called from the current
+    thread. The previous number of threads is restored on exit.
+
+    Parameters
+    ----------
+    libraryName : str
+        Name of the library without extension.
+    numThreads : int
+        Number of OpenMP threads. If None, the OpenMP default is used.
+    """
+    library = loadLibrary(libraryName) if numThreads is not None else None
+    setNumThreads = getattr(library, 'omp_set_num_threads', None) if library is not None else None
+    if setNumThreads is None:
+        if library is not None:
+            logger.warning('The number of OpenMP threads of ' + libraryName + ' cannot be set on this system')
+        yield
+        return
+
+    previousNumThreads = library.omp_get_max_threads()
+    setNumThreads(max(1, int(numThreads)))
+    try:
+        yield
+    finally:
+        setNumThreads(previousNumThreads)
+
+
+def addMetricsHook(hook:Callable[[str, str, float], None]):
+    """
+    Register a function called after each call of an accelerated routine, with the routine name, the backend that
+    served the call (NATIVE, CUPY, NUMPY or PYTHON) and the duration of the call in seconds.
+    """
+    _metricsHooks.append(hook)
+
+
+def removeMetricsHook(hook:Callable[[str, str, float], None]):
+    """
+    Unregister a function registered with addMetricsHook.
+    """
+    _metricsHooks.remove(hook)
+
+
+def reportCall(functionName:str, backend:str, duration:float):
+    """
+    Report to the metrics hooks the backend that served a call.
+    """
+    for hook in list(_metricsHooks):
+        hook(functionName, backend, duration)
+
+
+class NativeBackendTestCase(unittest.TestCase):
+    def testInterpolateTrilinear(self):
+        from opentps.core.processing.C_libraries import nativeBackend
+        from opentps.core.processing.C_libraries.libInterp3_wrapper import interpolateTrilinear
+
+        calls = []
+        hook = lambda functionName, backend, duration: calls.append((functionName, backend))
+        nativeBackend.addMetricsHook(hook)
+        try:
+            image = np.arange(60, dtype=np.float32).reshape((3, 4, 5))
+            points = np.array([[0., 0., 0.], [1.5, 2., 3.5], [-1., 0., 0.]])
+            for numThreads in (None, 1):
+                interpolated = interpolateTrilinear(image, image.shape, points, fillValue=-1, tryGPU=False,
+                                                    numThreads=numThreads)
+                np.testing.assert_allclose(interpolated, [0., 1.5 * 20 + 2. * 5 + 3.5, -1.])
+        finally:
+            nativeBackend.removeMetricsHook(hook)
+
+        backend = NATIVE if nativeBackend.loadLibrary('libInterp3') is not None else PYTHON
+        self.assertEqual(calls, [('interpolateTrilinear', backend)] * 2)
+        self.assertIs(nativeBackend.getFunction('libInterp3', 'Trilinear_Interpolation', []),
+                      nativeBackend.getFunction('libInterp3', 'Trilinear_Interpolation', []))
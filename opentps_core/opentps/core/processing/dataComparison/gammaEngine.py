@@ -0,0 +1,263 @@
+"""
+Native gamma index computation, independent of pymedphys.
+
+The evaluation dose is searched around each reference voxel with a precomputed stencil of offsets lying on a
+Cartesian grid of step distance_mm_threshold / interp_fraction. The stencil is sorted by distance and split in rings
+of one step. Offsets are expressed in voxel units of the reference grid, with precomputed trilinear weights, so the
+evaluation dose at all offsets of a ring is gathered for many voxels at once. A voxel stops being searched as soon as
+the next ring cannot give a lower gamma.
+"""
+import itertools
+import logging
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from opentps.core.data.images._image3D import Image3D
+from opentps.core.processing.imageProcessing import resampler3D
+
+logger = logging.getLogger(__name__)
+
+_RINGS_PER_BLOCK = 8
+
+
+def computeGammaIndex(referenceImage:Image3D, evaluationImage:Image3D, dose_percent_threshold:float,
+                      distance_mm_threshold:float, lower_percent_dose_cutoff:float=20, interp_fraction:int=10,
+                      max_gamma:float=None, local_gamma:bool=False, global_normalisation:float=None,
+                      skip_once_passed:bool=False, nbProcesses:int=1, chunkSize:int=2**22) -> Image3D:
+    """
+    Compute the gamma index between two images. The parameters and the output follow pymedphys.gamma
+    (https://github.com/pymedphys/pymedphys).
+
+    Parameters
+    ----------
+    referenceImage : Image3D
+        The reference dose. Each reference voxel above the dose cutoff becomes the centre of a gamma ellipsoid.
+    evaluationImage : Image3D
+        The evaluation dose, searched at increasing distances from each reference voxel. It is resampled on the grid
+        of the reference image if the grids differ.
+    dose_percent_threshold : float
+        The percent dose threshold
+    distance_mm_threshold : float
+        The gamma distance threshold in mm
+    lower_percent_dose_cutoff : float, optional
+        The percent lower dose cutoff below which gamma is not calculated. Only applied to the reference dose.
+    interp_fraction : int, optional
+        The fraction in which the distance threshold is divided to define the search step, by default 10
+    max_gamma : float, optional
+        The maximum gamma searched for. Larger gamma values are set to max_gamma. By default, the search continues
+        until the gamma of every voxel is found.
+    local_gamma : bool, optional
+        Use local instead of global normalisation, by default False
+    global_normalisation : float, optional
+        The dose normalisation value of the percent inputs. Defaults to the maximum of the reference dose.
+    skip_once_passed : bool, optional
+        Stop searching a voxel as soon as its gamma is below 1, by default False
+    nbProcesses : int, optional
+        Number of processes among which the reference grid is split in slabs, by default 1
+    chunkSize : int, optional
+        Maximum number of evaluation dose samples gathered at once, by default 2**22
+
+    Returns
+    -------
+    gamma: Image3D or DoseImage
+        Gamma values with the grid of the reference image. NaN below the dose cutoff and where the evaluation dose is
+        not defined.
+    """
+    if max_gamma is None:
+        max_gamma = np.inf
+
+    referenceDose = np.asarray(referenceImage.imageArray, dtype=np.float64)
+    if evaluationImage.hasSameGrid(referenceImage):
+        evaluationDose = np.asarray(evaluationImage.imageArray, dtype=np.float64)
+    else:
+        evaluationDose = resampler3D.resampleImage3DOnImage3D(evaluationImage, referenceImage, fillValue=np.nan,
+                                                              inPlace=False).imageArray.astype(np.float64)
+
+    if global_normalisation is None:
+        global_normalisation = np.nanmax(referenceDose)
+    doseThreshold = dose_percent_threshold / 100.
+    spacing = np.asarray(referenceImage.spacing, dtype=np.float64)
+    stepSize = distance_mm_threshold / interp_fraction
+
+    voxels = np.argwhere(referenceDose >= lower_percent_dose_cutoff / 100. * global_normalisation)
+    referenceValues = referenceDose[tuple(voxels.T)]
+    normalisation = referenceValues if local_gamma else np.full(len(voxels), float(global_normalisation))
+
+    # Gamma at distance 0 bounds the gamma of each voxel, hence the search distance
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gamma0 = np.abs(evaluationDose[tuple(voxels.T)] - referenceValues) / normalisation / doseThreshold
+    finiteGamma0 = gamma0[np.isfinite(gamma0)]
+    maxDistance = distance_mm_threshold * min(max_gamma, finiteGamma0.max() if len(finiteGamma0) else 0.)
+    margin = np.ceil((maxDistance + stepSize) / spacing).astype(int) + 1
+
+    paddedDose = np.pad(evaluationDose, [(m, m) for m in margin], mode='constant', constant_values=np.nan)
+    voxels = voxels + margin
+
+    parameters = dict(spacing=spacing, stepSize=stepSize, distanceThreshold=distance_mm_threshold,
+                      doseThreshold=doseThreshold, maxDistance=maxDistance, skipOncePassed=skip_once_passed,
+                      chunkSize=chunkSize)
+
+    if nbProcesses > 1 and len(voxels) > 0:
+        slabs = np.array_split(np.arange(len(voxels)), nbProcesses)
+        tasks = []
+        for slab in slabs:
+            if len(slab) == 0:
+                continue
+            i0 = voxels[slab, 0].min() - margin[0]
+            i1 = voxels[slab, 0].max() + margin[0] + 1
+            tasks.append((paddedDose[i0:i1], voxels[slab] - [i0, 0, 0], referenceValues[slab], normalisation[slab],
+                          parameters))
+        with ProcessPoolExecutor(max_workers=nbProcesses) as executor:
+            gammaSquared = np.concatenate(list(executor.map(_gammaTile, tasks)))
+    else:
+        gammaSquared = _gammaTile((paddedDose, voxels, referenceValues, normalisation, parameters))
+
+    gamma = np.full(referenceDose.shape, np.nan)
+    values = np.sqrt(gammaSquared)
+    values[np.isinf(values)] = np.nan
+    with np.errstate(invalid='ignore'):
+        values[values > max_gamma] = max_gamma
+    gamma[tuple((voxels - margin).T)] = values
+
+    return referenceImage.__class__.fromImage3D(referenceImage, imageArray=gamma, name="gamma")
+
+
+def _gammaTile(task):
+    """
+    Squared gamma of the given voxels of a padded evaluation dose
+    """
+    paddedDose, voxels, referenceValues, normalisation, parameters = task
+    distanceThreshold2 = parameters['distanceThreshold'] ** 2
+    doseThreshold2 = parameters['doseThreshold'] ** 2
+    stepSize = parameters['stepSize']
+    maxDistance = parameters['maxDistance']
+
+    strides = np.array([paddedDose.shape[1] * paddedDose.shape[2], paddedDose.shape[2], 1], dtype=np.int64)
+    evaluationDose = paddedDose.reshape(-1)
+    flatIndex = voxels.astype(np.int64) @ strides
+
+    gammaSquared = np.full(len(voxels), np.inf)
+    active = np.arange(len(voxels))
+    firstRing = 0
+    while len(active) > 0 and firstRing * stepSize <= maxDistance:
+        lastRing = firstRing + _RINGS_PER_BLOCK
+        for ring, groups in _stencilRings(firstRing, lastRing, stepSize, parameters['spacing'], strides, maxDistance):
+            for group in groups:
+                ringGamma = _minGammaSquared(evaluationDose, flatIndex[active], referenceValues[active],
+                                             normalisation[active], group, doseThreshold2, distanceThreshold2,
+                                             parameters['chunkSize'])
+                gammaSquared[active] = np.fmin(gammaSquared[active], ringGamma)
+
+            # The next ring is at least (ring + 1) * stepSize away
+            searching = gammaSquared[active] > ((ring + 1) * stepSize) ** 2 / distanceThreshold2
+            if parameters['skipOncePassed']:
+                searching &= gammaSquared[active] >= 1
+            active = active[searching]
+            if len(active) == 0:
+                break
+        firstRing = lastRing
+
+    return gammaSquared
+
+
+def _minGammaSquared(evaluationDose, flatIndex, referenceValues, normalisation, group, doseThreshold2,
+                     distanceThreshold2, chunkSize):
+    """
+    Minimum squared gamma over the offsets of a stencil group, NaN where no evaluation dose is defined
+    """
+    baseShifts, cornerShifts, weights, distances2 = group
+    distanceTerm = (distances2 / distanceThreshold2)[:, None]
+    result = np.empty(len(flatIndex))
+    step = max(1, chunkSize // (len(baseShifts) * len(cornerShifts)))
+    for a0 in range(0, len(flatIndex), step):
+        a1 = a0 + step
+        index = flatIndex[None, a0:a1] + baseShifts[:, None]
+        values = weights[:, 0, None] * evaluationDose[index + cornerShifts[0]]
+        for c in range(1, len(cornerShifts)):
+            values += weights[:, c, None] * evaluationDose[index + cornerShifts[c]]
+        values -= referenceValues[None, a0:a1]
+        values /= normalisation[None, a0:a1]
+        values *= values
+        values /= doseThreshold2
+        values += distanceTerm
+        result[a0:a1] = np.fmin.reduce(values, axis=0)
+    return result
+
+
+def _stencilRings(firstRing, lastRing, stepSize, spacing, strides, maxDistance):
+    """
+    Offsets of the search stencil in rings [firstRing, lastRing). Ring i holds the offsets at a distance in
+    [i * stepSize, (i + 1) * stepSize). The offsets of a ring are grouped by the axes on which they fall between
+    voxels, each group being given as (base flat shifts, corner flat shifts, trilinear weights, squared distances).
+    """
+    axis = np.arange(-lastRing, lastRing + 1)
+    offsets = np.stack(np.meshgrid(axis, axis, axis, indexing='ij'), axis=-1).reshape(-1, 3)
+    squaredNorms = (offsets * offsets).sum(axis=1)
+    rings = np.floor(np.sqrt(squaredNorms)).astype(np.int64)
+    rings[(rings + 1) ** 2 <= squaredNorms] += 1
+    rings[rings ** 2 > squaredNorms] -= 1
+    distances2 = squaredNorms * stepSize ** 2
+    keep = (rings >= firstRing) & (rings < lastRing) & (distances2 <= maxDistance ** 2)
+    offsets, rings, distances2 = offsets[keep], rings[keep], distances2[keep]
+
+    order = np.argsort(squaredNorms[keep], kind='stable')
+    offsets, rings, distances2 = offsets[order], rings[order], distances2[order]
+
+    voxelOffsets = offsets * stepSize / spacing
+    baseOffsets = np.floor(voxelOffsets)
+    fractions = voxelOffsets - baseOffsets
+    roundedUp = fractions > 1 - 1e-9
+    baseOffsets[roundedUp] += 1
+    fractions[roundedUp | (fractions < 1e-9)] = 0
+    patterns = (fractions > 0) @ np.array([1, 2, 4])
+    baseShifts = baseOffsets.astype(np.int64) @ strides
+
+    for ring in range(firstRing, lastRing):
+        inRing = rings == ring
+        if not np.any(inRing):
+            continue
+        groups = []
+        for pattern in np.unique(patterns[inRing]):
+            selected = np.flatnonzero(inRing & (patterns == pattern))
+            interpolatedAxes = [a for a in range(3) if pattern & (1 << a)]
+            corners = np.array(list(itertools.product((0, 1), repeat=len(interpolatedAxes))),
+                               dtype=np.int64).reshape(2 ** len(interpolatedAxes), len(interpolatedAxes))
+            cornerShifts = corners @ strides[interpolatedAxes]
+            weights = np.ones((len(selected), len(corners)))
+            for c, corner in enumerate(corners):
+                for a, up in zip(interpolatedAxes, corner):
+                    weights[:, c] *= fractions[selected, a] if up else 1 - fractions[selected, a]
+            groups.append((baseShifts[selected], cornerShifts, weights, distances2[selected]))
+        yield ring, groups
+
+
+class GammaEngineTestCase(unittest.TestCase):
+    """
+    Test case for the native gamma index.
+    """
+    def testShiftedDose(self):
+        """
+        Test the gamma of a dose against a shifted and scaled copy of itself.
+        """
+        from opentps.core.data.images._doseImage import DoseImage
+
+        x, y, z = np.meshgrid(np.arange(30), np.arange(30), np.arange(20), indexing='ij')
+        reference = 50 * np.exp(-((x - 15) ** 2 + (y - 15) ** 2 + (z - 10) ** 2) / 50)
+        referenceImage = DoseImage(imageArray=reference, spacing=(2, 2, 2))
+
+        # Identical doses give zero gamma
+        gamma = computeGammaIndex(referenceImage, referenceImage, 3, 3).imageArray
+        self.assertEqual(np.nanmax(gamma), 0)
+        self.assertTrue(np.all(np.isnan(gamma[reference < 10])))
+
+        # A 1 mm shift passes everywhere with 3 mm, a 2 % scaling passes with 3 %
+        shifted = DoseImage(imageArray=reference, spacing=(2, 2, 2), origin=(1, 0, 0))
+        gamma = computeGammaIndex(referenceImage, shifted, 3, 3, max_gamma=2).imageArray
+        self.assertLess(np.nanmax(gamma[2:-2]), 1)
+        scaled = DoseImage(imageArray=reference * 1.02, spacing=(2, 2, 2))
+        gamma = computeGammaIndex(referenceImage, scaled, 3, 3).imageArray
+        # Gamma cannot exceed the dose difference at distance 0
+        self.assertLessEqual(np.nanmax(gamma), 2 / 3 + 1e-9)
+        self.assertGreater(np.nanmin(gamma), 0)
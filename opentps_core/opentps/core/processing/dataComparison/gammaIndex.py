@@ -1,8 +1,16 @@
-import pymedphys
+import logging
 import numpy as np
 from typing import Sequence, Tuple
 from opentps.core.data.images._image3D import Image3D
 
+logger = logging.getLogger(__name__)
+
+try:
+    import pymedphys
+    pymedphys_available = True
+except ImportError:
+    pymedphys_available = False
+
 def _orientation_is_head_first(orientation_vector, is_decubitus):
     """
     From pymedphys (https://github.com/pymedphys/pymedphys)
@@ -162,12 +170,17 @@ def xyz_axes_from_dataset(
 def gammaIndex(referenceImage:Image3D, evaluationImage:Image3D,     
                dose_percent_threshold, distance_mm_threshold, lower_percent_dose_cutoff=20,
                interp_fraction=10, max_gamma=None, local_gamma=False, global_normalisation=None,
-               skip_once_passed=False, random_subset=None, ram_available=int(2**30 * 4)):
+               skip_once_passed=False, random_subset=None, ram_available=int(2**30 * 4), engine='pymedphys',
+               nbProcesses=1):
     """
     Compute the gamma index between two images using pymedphys library (https://github.com/pymedphys/pymedphys).
     This function is essentially a wrapper on function `pymedphys.gamma` using when using OpenTPS data.
     As such, most of the parameters are the same.
 
+    With engine='native', the gamma index is computed by gammaEngine.computeGammaIndex, which is much faster and
+    does not require pymedphys. random_subset and ram_available are then ignored. The native engine is also used if
+    pymedphys is not installed.
+
     pymedphys DOCSTRING:
     Compare two dose grids with the gamma index.
 
@@ -219,6 +232,10 @@ def gammaIndex(referenceImage:Image3D, evaluationImage:Image3D,
     ram_available : int, optional
         The number of bytes of RAM available for use by this function. Defaults
         to 4GB.
+    engine : str, optional
+        'pymedphys' or 'native'. Defaults to 'pymedphys'.
+    nbProcesses : int, optional
+        Number of processes used by the native engine. Defaults to 1.
 
     Returns
     -------
@@ -226,6 +243,20 @@ def gammaIndex(referenceImage:Image3D, evaluationImage:Image3D,
         Contains the array of gamma values the same shape as that
         given by the reference image.
     """
+    if engine == 'pymedphys' and not pymedphys_available:
+        logger.warning('pymedphys is not installed, the native gamma engine is used')
+        engine = 'native'
+
+    if engine == 'native':
+        from opentps.core.processing.dataComparison.gammaEngine import computeGammaIndex
+        return computeGammaIndex(referenceImage, evaluationImage, dose_percent_threshold, distance_mm_threshold,
+                                 lower_percent_dose_cutoff=lower_percent_dose_cutoff, interp_fraction=interp_fraction,
+                                 max_gamma=max_gamma, local_gamma=local_gamma,
+                                 global_normalisation=global_normalisation, skip_once_passed=skip_once_passed,
+                                 nbProcesses=nbProcesses)
+    elif engine != 'pymedphys':
+        raise ValueError('Unknown gamma engine: ' + str(engine))
+
     x,y,z = xyz_axes_from_dataset(referenceImage)
     axes_reference = (z, y, x)
     x,y,z = xyz_axes_from_dataset(evaluationImage)
@@ -1,5 +1,6 @@
 import numpy as np
 from opentps.core.data.dynamicData._dynamic3DSequence import Dynamic3DSequence
+from opentps.core.data.dynamicData._lazyDynamic3DSequence import LazyDynamic3DSequence
 from opentps.core.processing.deformableDataAugmentationToolBox.weightMaps import generateDeformationFromTrackers
 from opentps.core.processing.deformableDataAugmentationToolBox.modelManipFunctions import *
 
@@ -50,17 +51,7 @@ def generateDynSeqFromBreathingSignalsAndModel(model, signalList, ROIList, signa
 
         print('Deform image', signalIdxUsed[0] + breathingSignalSampleIndex)
         ## translate the phase infos into phase and amplitude lists
-        phaseList = []
-        amplitudeList = []
-        for ROIndex in range(len(phaseValueByROIList)):
-
-            phase = phaseValueByROIList[ROIndex][breathingSignalSampleIndex]
-            if phase[0] == 'I':
-                phaseList.append((phase[1]+phase[2])/10)
-                amplitudeList.append(1)
-            elif phase[0] == 'E':
-                phaseList.append(phase[1]/10)
-                amplitudeList.append(phase[2])
+        phaseList, amplitudeList = getPhaseAndAmplitudeLists(phaseValueByROIList, breathingSignalSampleIndex)
 
         if len(ROIList) > 1:
             ## generate the deformation field combining the fields for each points and phase info
@@ -77,6 +68,60 @@ def generateDynSeqFromBreathingSignalsAndModel(model, signalList, ROIList, signa
 
     return dynseq
 
+## -------------------------------------------------------------------------------
+def generateLazyDynSeqFromBreathingSignalsAndModel(model, signalList, ROIList, signalIdxUsed=[0, 0], dimensionUsed='Z', outputType=np.float32, tryGPU=True,
+                                                   cacheSize=8, prefetch=0, memmapPath=None):
+
+    """
+    Generate a lazy dynamic 3D sequence from a model, in which each given ROI follows its breathing signal. Only the
+    phases and amplitudes are computed here, the images are generated when they are accessed.
+
+    Parameters
+    ----------
+    model : Dynamic3DModel
+        The dynamic 3D model that will be used to create the images of the resulting sequence
+    signalList : list
+        list of breathing signals as 1D numpy arrays
+    ROIList : list
+        list of points as [X, Y, Z] or (X, Y, Z) --> does not work with ROI's as masks or struct
+    dimensionUsed : str
+        X, Y, Z or norm, the dimension used to compare the breathing signals with the model deformation values
+    outputType : pixel data type (np.float32, np.uint16, etc)
+    cacheSize : int
+        maximum number of images kept in memory
+    prefetch : int
+        number of images following the accessed image that are generated in a background thread
+    memmapPath : str
+        path of a memory-mapped file in which the generated images are stored. If None, the images evicted from the
+        cache are generated again.
+
+    Returns
+    -------
+    dynseq (LazyDynamic3DSequence): a new sequence generating its images on demand
+
+    """
+
+    if len(signalList) != len(ROIList):
+        print('Numbers of signals and ROI do not match')
+        return
+
+    if signalIdxUsed == [0, 0]:
+        signalIdxUsed = [0, signalList[0].shape[0]]
+
+    phaseValueByROIList = []
+    for ROIndex, ROI in enumerate(ROIList):
+        phaseValueByROIList.append(getPhaseValueList(ROI, model, signalList[ROIndex], signalIdxUsed, dimensionUsed=dimensionUsed, tryGPU=tryGPU))
+
+    phaseLists = []
+    amplitudeLists = []
+    for breathingSignalSampleIndex in range(len(phaseValueByROIList[0])):
+        phaseList, amplitudeList = getPhaseAndAmplitudeLists(phaseValueByROIList, breathingSignalSampleIndex)
+        phaseLists.append(phaseList)
+        amplitudeLists.append(amplitudeList)
+
+    return LazyDynamic3DSequence(model, phaseLists, amplitudeLists, ROIList=ROIList, name='BreathingSigGenerated',
+                                 outputType=outputType, tryGPU=tryGPU, cacheSize=cacheSize, prefetch=prefetch, memmapPath=memmapPath)
+
 ## -------------------------------------------------------------------------------
 def generateDeformationListFromBreathingSignalsAndModel(model, signalList, ROIList, signalIdxUsed=[0, 0], dimensionUsed='Z', outputType=np.float32, tryGPU=True):
 
@@ -125,17 +170,7 @@ def generateDeformationListFromBreathingSignalsAndModel(model, signalList, ROILi
     for breathingSignalSampleIndex in range(len(phaseValueByROIList[0])):
 
         ## translate the phase infos into phase and amplitude lists
-        phaseList = []
-        amplitudeList = []
-        for ROIndex in range(len(phaseValueByROIList)):
-
-            phase = phaseValueByROIList[ROIndex][breathingSignalSampleIndex]
-            if phase[0] == 'I':
-                phaseList.append((phase[1]+phase[2])/10)
-                amplitudeList.append(1)
-            elif phase[0] == 'E':
-                phaseList.append(phase[1]/10)
-                amplitudeList.append(phase[2])
+        phaseList, amplitudeList = getPhaseAndAmplitudeLists(phaseValueByROIList, breathingSignalSampleIndex)
 
         if len(ROIList) > 1:
             ## generate the deformation field combining the fields for each points and phase info
@@ -148,6 +183,38 @@ def generateDeformationListFromBreathingSignalsAndModel(model, signalList, ROILi
 
     return deformationList
 
+def getPhaseAndAmplitudeLists(phaseValueByROIList, breathingSignalSampleIndex):
+    """
+    Translate the phase values of the ROIs at a breathing signal sample into the phases and amplitudes of the model
+
+    Parameters
+    ----------
+    phaseValueByROIList : list
+        phase value lists of each ROI (see getPhaseValueList)
+    breathingSignalSampleIndex : int
+        index of the sample in the phase value lists
+
+    Returns
+    -------
+    phaseList (list)
+        phase of each ROI
+    amplitudeList (list)
+        amplitude of each ROI
+    """
+    phaseList = []
+    amplitudeList = []
+    for ROIndex in range(len(phaseValueByROIList)):
+
+        phase = phaseValueByROIList[ROIndex][breathingSignalSampleIndex]
+        if phase[0] == 'I':
+            phaseList.append((phase[1]+phase[2])/10)
+            amplitudeList.append(1)
+        elif phase[0] == 'E':
+            phaseList.append(phase[1]/10)
+            amplitudeList.append(phase[2])
+
+    return phaseList, amplitudeList
+
 def getPhaseValueList(ROI, model, signal, signalIdxUsed, dimensionUsed='Z', tryGPU=True):
     """
     Get the phase value list for a given ROI and a given model
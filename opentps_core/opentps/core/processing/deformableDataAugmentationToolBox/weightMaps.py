@@ -2,12 +2,21 @@ import numpy as np
 
 import matplotlib.pyplot as plt
 from scipy.interpolate import LinearNDInterpolator
-import copy
+from scipy.spatial import Delaunay
 import logging
+import threading
+import unittest
+from collections import OrderedDict
 from opentps.core.data.images._image3D import Image3D
 
 logger = logging.getLogger(__name__)
 
+# weight maps of the last point sets and image grids
+_weightMapCache = OrderedDict()
+_weightMapCacheLock = threading.Lock()
+_weightMapCacheStatistics = {'hits': 0, 'misses': 0}
+_WEIGHT_MAP_CACHE_SIZE = 4
+
 def createExternalPoints(imgSize, numberOfPointsPerEdge = 0):
     """
     Create a list of points that are outside the image, to be used for the weight maps
@@ -91,6 +100,10 @@ def createWeightMaps(absoluteInternalPoints, imageGridSize, imageOrigin, pixelSp
     Create a list of weight maps, one for each internal point. Each weight map is a 3D array of the same size as the image, with values between 0 and 1.
     The value 1 is at the position of the internal point, and the value 0 is at the position of the external points.
 
+    The maps are linear interpolations on the Delaunay triangulation of the external and internal points. The
+    triangulation and the barycentric coordinates of the voxels are computed once for all maps, and the maps are cached
+    for the point set and image grid (see clearWeightMapCache).
+
     parameters
     ----------
     absoluteInternalPoints : list
@@ -108,43 +121,65 @@ def createWeightMaps(absoluteInternalPoints, imageGridSize, imageOrigin, pixelSp
         list of weight maps
     """
     ## get points coordinates in voxels (no need to get them in int, it will not be used to access image values)
-    internalPoints = copy.deepcopy(absoluteInternalPoints)
-    for pointIndex in range(len(internalPoints)):
-        for i in range(3):
-            internalPoints[pointIndex][i] = (internalPoints[pointIndex][i] - imageOrigin[i]) / pixelSpacing[i]
-
-    X = np.linspace(0, imageGridSize[0] - 1, imageGridSize[0])
-    Y = np.linspace(0, imageGridSize[1] - 1, imageGridSize[1])
-    Z = np.linspace(0, imageGridSize[2] - 1, imageGridSize[2])
+    internalPoints = (np.array(absoluteInternalPoints, dtype=float).reshape((-1, 3)) - np.array(imageOrigin, dtype=float)) / np.array(pixelSpacing, dtype=float)
+    gridSize = tuple(int(n) for n in imageGridSize)
+    key = (internalPoints.tobytes(), gridSize)
+
+    with _weightMapCacheLock:
+        weightMaps = _weightMapCache.get(key)
+        if weightMaps is not None:
+            _weightMapCache.move_to_end(key)
+            _weightMapCacheStatistics['hits'] += 1
+        else:
+            _weightMapCacheStatistics['misses'] += 1
 
-    X, Y, Z = np.meshgrid(X, Y, Z, indexing='ij')  # 3D grid for interpolation
+    if weightMaps is None:
+        weightMaps = _interpolateWeightMaps(internalPoints, gridSize)
+        with _weightMapCacheLock:
+            _weightMapCache[key] = weightMaps
+            while len(_weightMapCache) > _WEIGHT_MAP_CACHE_SIZE:
+                _weightMapCache.popitem(last=False)
 
-    externalPoints = createExternalPoints(imageGridSize, numberOfPointsPerEdge=5)
+    return [weightMap.copy() for weightMap in weightMaps]
 
-    # showPoints(externalPoints)
 
-    pointList = externalPoints + internalPoints
-    externalValues = np.ones(len(externalPoints))/len(internalPoints)
+def clearWeightMapCache():
+    """
+    Remove the weight maps from the cache and reset its hit and miss counters.
+    """
+    with _weightMapCacheLock:
+        _weightMapCache.clear()
+        _weightMapCacheStatistics.update({'hits': 0, 'misses': 0})
 
-    weightMapList = []
 
-    for pointIndex in range(len(internalPoints)):
+def getWeightMapCacheStatistics():
+    """
+    Get the number of hits and misses of the weight map cache.
 
-        # startTime = time.time()
+    returns
+    -------
+    statistics : dict
+        number of hits and misses
+    """
+    with _weightMapCacheLock:
+        return dict(_weightMapCacheStatistics)
 
-        internalValues = np.zeros(len(internalPoints))
-        internalValues[pointIndex] = 1
-        values = np.concatenate((externalValues, internalValues))
 
-        interp = LinearNDInterpolator(pointList, values) # this could be replaced by cupy if GPU acceleration is necessary
-        weightMap = interp(X, Y, Z)
+def _interpolateWeightMaps(internalPoints, gridSize):
+    externalPoints = np.array(createExternalPoints(gridSize, numberOfPointsPerEdge=5), dtype=float)
+    pointList = np.concatenate((externalPoints, internalPoints))
 
-        # stopTime = time.time()
-        # print(pointIndex, 'weight map creation duration', stopTime-startTime)
+    # value of each point in each map: 1/n at the external points, 1 at the internal point of the map
+    values = np.zeros((len(pointList), len(internalPoints)))
+    values[:len(externalPoints)] = 1 / len(internalPoints)
+    values[len(externalPoints):] = np.eye(len(internalPoints))
 
-        weightMapList.append(weightMap)
+    # a single triangulation, and a single evaluation of the barycentric coordinates of the voxels for all maps
+    interp = LinearNDInterpolator(Delaunay(pointList), values) # this could be replaced by cupy if GPU acceleration is necessary
+    X, Y, Z = np.meshgrid(*[np.arange(n, dtype=float) for n in gridSize], indexing='ij')
+    weightMaps = interp(X, Y, Z)
 
-    return weightMapList
+    return [np.ascontiguousarray(weightMaps[..., pointIndex]) for pointIndex in range(len(internalPoints))]
 
 
 def getWeightMapsAsImage3DList(internalPoints, ref3DImage):
@@ -294,3 +329,26 @@ def generateDeformationFromTrackersAndWeightMaps(midpModel, phases, amplitudes,
 
     return field
 
+
+
+class WeightMapsTestCase(unittest.TestCase):
+    def testCreateWeightMaps(self):
+        clearWeightMapCache()
+        gridSize, origin, spacing = (9, 8, 7), (-10., 0., 5.), (2., 2.5, 3.)
+        internalPoints = [[-2., 9., 14.], [4., 6., 20.], [0., 12., 11.]]
+        weightMaps = createWeightMaps(internalPoints, gridSize, origin, spacing)
+
+        # reference: one interpolator per internal point
+        voxelPoints = [[(point[i] - origin[i]) / spacing[i] for i in range(3)] for point in internalPoints]
+        externalPoints = createExternalPoints(gridSize, numberOfPointsPerEdge=5)
+        X, Y, Z = np.meshgrid(*[np.arange(n, dtype=float) for n in gridSize], indexing='ij')
+        for pointIndex, weightMap in enumerate(weightMaps):
+            internalValues = np.zeros(len(internalPoints))
+            internalValues[pointIndex] = 1
+            values = np.concatenate((np.ones(len(externalPoints)) / len(internalPoints), internalValues))
+            np.testing.assert_allclose(weightMap, LinearNDInterpolator(externalPoints + voxelPoints, values)(X, Y, Z), atol=1e-10)
+
+        weightMaps[0][:] = 0
+        np.testing.assert_array_equal(createWeightMaps(internalPoints, gridSize, origin, spacing)[1], weightMaps[1])
+        self.assertEqual(getWeightMapCacheStatistics(), {'hits': 1, 'misses': 1})
+        self.assertGreater(createWeightMaps(internalPoints, gridSize, origin, spacing)[0].max(), 0.9)
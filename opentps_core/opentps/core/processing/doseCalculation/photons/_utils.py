@@ -8,11 +8,14 @@ import scipy.sparse as sp
 from scipy.sparse import csc_matrix
 from opentps.core.data.images import DoseImage
 import ctypes
+import functools
 import os
 import psutil
-import os
+import unittest
 from opentps.core.data.plan import PhotonPlan
 
+_FLOAT_TOLERANCE = 1e-7 ### Values of the interpolated beamlets kept by shiftBeamlets.cpp
+
 
 def correctShift(setup, angle):
     """
@@ -147,6 +150,17 @@ def find_change_indices(arr):
     change_indices = np.where(changes)[0] + 1
     return change_indices.tolist()
 
+@functools.lru_cache(maxsize=None)
+def _isCudaAvailable():
+    try:
+        import pycuda.driver as cuda
+        import pycuda.autoinit
+        cuda.init()
+        return cuda.Device.count() > 0
+    except Exception as e:
+        logger.info(f"CUDA is not available: {e}")
+        return False
+
 def shiftBeamlets(sparseBeamlets, gridSize,  scenarioShift_voxel, beamletAngles_rad):
     """
     Shift the beamlets in the dose influence matrix for a given setup error. This would be equivalent to recalculating the dose distribution for a given setup error. 
@@ -164,43 +178,130 @@ def shiftBeamlets(sparseBeamlets, gridSize,  scenarioShift_voxel, beamletAngles_
     sp.csc_matrix
         Sparse matrix of the shifted beamlets
     """   
-    paralelize = False
-    try:
-        import pycuda.driver as cuda
-        import pycuda.autoinit
-        cuda.init()
-        device_count = cuda.Device.count()
-        if device_count>0:
-            paralelize = True
-    except Exception as e:
-        print(f"CUDA is not available: {e}")
-    
-    if paralelize:
-        return shiftBeamlets_cu(sparseBeamlets, gridSize,  scenarioShift_voxel, beamletAngles_rad)
-    return shiftBeamlets_cpp(sparseBeamlets, gridSize,  scenarioShift_voxel, beamletAngles_rad)
+    return shiftBeamletsScenarios(sparseBeamlets, gridSize, [scenarioShift_voxel], beamletAngles_rad)[0]
 
+def shiftBeamletsScenarios(sparseBeamlets, gridSize, scenarioShifts_voxel, beamletAngles_rad):
+    """
+    Shift the beamlets in the dose influence matrix for several setup errors. On CPU, all the scenarios are computed
+    from a single pass over the nominal matrix (see shiftBeamlets_csc).
+    ----------
+    sparseBeamlets : sp.csc_matrix
+        Sparse matrix of the beamlets
+    gridSize : np.array
+        Size of the grid
+    scenarioShifts_voxel : sequence of np.array
+        Setup error of each scenario in voxels
+    beamletAngles_rad : np.array
+        Angles of the beamlets in radians
+    Returns
+    -------
+    list of sp.csc_matrix
+        Sparse matrix of the shifted beamlets of each scenario
+    """
+    if _isCudaAvailable():
+        return [shiftBeamlets_cu(sparseBeamlets, gridSize, np.array(scenarioShift_voxel, dtype=float), beamletAngles_rad) for scenarioShift_voxel in scenarioShifts_voxel]
+    return shiftBeamlets_csc(sparseBeamlets, gridSize, scenarioShifts_voxel, beamletAngles_rad)
 
-def shiftBeamlets_cpp(sparseBeamlets, gridSize,  scenarioShift_voxel, beamletAngles_rad):
+def shiftBeamlets_csc(sparseBeamlets, gridSize, scenarioShifts_voxel, beamletAngles_rad):
     """
-    Shift the beamlets in the dose influence matrix for a given setup error.
-    This would be equivalent to recalculating the dose distribution for a given setup error.
-    This function is executed in c++ to gain speed and parallelize the process over different threads.
+    Shift the beamlets in the dose influence matrix for several setup errors, working directly on the CSC arrays of the
+    matrix. The values of the neighbours of each nonzero along each axis are looked up once and shared by all the
+    scenarios, then each scenario is computed with vectorized operations over all the nonzeros and converted to CSC at
+    once. The interpolation is the one of shiftBeamlets_cpp.
     ----------
     sparseBeamlets : sp.csc_matrix
         Sparse matrix of the beamlets
     gridSize : np.array
         Size of the grid
-    scenarioShift_voxel : np.array
-        Setup error in voxels
+    scenarioShifts_voxel : sequence of np.array
+        Setup error of each scenario in voxels
     beamletAngles_rad : np.array
         Angles of the beamlets in radians
     Returns
     -------
-    sp.csc_matrix
-        Sparse matrix of the shifted beamlets
-    """   
+    list of sp.csc_matrix
+        Sparse matrix of the shifted beamlets of each scenario
+    """
+    sparseBeamlets = sp.csc_matrix(sparseBeamlets)
+    if not sparseBeamlets.has_sorted_indices:
+        sparseBeamlets = sparseBeamlets.sorted_indices()
+    nbOfVoxels, nbOfBeamlets = sparseBeamlets.shape
+    strides = np.array([1, gridSize[0], gridSize[0] * gridSize[1]], dtype=np.int64) ### Fortran order
+    indexes = sparseBeamlets.indices.astype(np.int64)
+    values = sparseBeamlets.data.astype(np.float32, copy=False)
+    columns = np.repeat(np.arange(nbOfBeamlets), np.diff(sparseBeamlets.indptr))
+    keys = columns * nbOfVoxels + indexes ### Sorted, since the indexes of each column are sorted
+    angles = np.array(beamletAngles_rad, dtype=np.float32).astype(np.float64)
+    cosAngles, sinAngles = np.cos(angles), np.sin(angles)
+
+    neighbours = {}
+    def neighbourValues(axis, direction):
+        ### Value of the next voxel of each nonzero along an axis in the same beamlet, 0 if the beamlet does not have it
+        if (axis, direction) not in neighbours:
+            offset = direction * strides[axis]
+            position = np.minimum(np.searchsorted(keys, keys + offset), max(len(keys) - 1, 0))
+            found = (keys[position] == keys + offset) & (indexes + offset >= 0) & (indexes + offset < nbOfVoxels)
+            neighbours[(axis, direction)] = np.where(found, values[position], np.float32(0))
+        return neighbours[(axis, direction)]
+
+    BeamletMatrices = []
+    for scenarioShift_voxel in scenarioShifts_voxel:
+        setUpShift = np.array(scenarioShift_voxel, dtype=np.float32)
+        setUpShift[1:] *= -1 ### To have the setup error in LPS. Check because some signs problem
+        setUpShift = setUpShift.astype(np.float64)
+
+        ### Shift of each beamlet, see correctShift, rounded half away from zero to the third digit
+        projection = setUpShift[0] * cosAngles - setUpShift[1] * sinAngles
+        correctedShift = np.stack([projection * cosAngles, projection * sinAngles, np.full(nbOfBeamlets, setUpShift[2])], axis=1)
+        correctedShift = np.copysign(np.floor(np.abs(correctedShift) * 1000 + 0.5), correctedShift) / 1000
+        truncatedShift = np.trunc(correctedShift)
+        shiftTruncated = truncatedShift.astype(np.int64) @ strides
+        shiftSmallVoxel = correctedShift - truncatedShift
+        shiftSmallVoxelAbsSum = np.abs(shiftSmallVoxel).astype(np.float32).sum(axis=1)
+        interpolated = shiftSmallVoxelAbsSum != 0
+
+        ### Beamlets shifted by whole voxels
+        selection = np.flatnonzero(~interpolated[columns])
+        rows, cols, data = [indexes[selection] + shiftTruncated[columns[selection]]], [columns[selection]], [values[selection]]
+
+        ### Beamlets interpolated along each axis with a fractional shift, weighted by the fraction of the axis
+        for axis in range(3):
+            fraction = shiftSmallVoxel[:, axis]
+            selection = np.flatnonzero(fraction[columns] != 0)
+            if len(selection) == 0:
+                continue
+            col = columns[selection]
+            positive = (fraction > 0)[col]
+            shiftValue = np.mod(fraction, 1).astype(np.float32)[col]
+            weight = (np.abs(fraction) / shiftSmallVoxelAbsSum.astype(np.float64)).astype(np.float32)[col]
+            previous, following = neighbourValues(axis, -1)[selection], neighbourValues(axis, 1)[selection]
+            value0 = np.where(positive, previous, following)
+            value1 = values[selection]
+            value2 = np.where(positive, following, previous)
+
+            lower = ((value1 - value0) * (1 - shiftValue) + value0) * np.where(value0 != 0, np.float32(0.5), np.float32(1)) * weight
+            upper = ((value2 - value1) * (1 - shiftValue) + value1) * np.where(value2 != 0, np.float32(0.5), np.float32(1)) * weight
+            lowerRows = indexes[selection] + shiftTruncated[col]
+            rows += [lowerRows, lowerRows + np.where(positive, strides[axis], -strides[axis])]
+            cols += [col, col]
+            data += [lower, upper]
+
+        rows, cols, data = np.concatenate(rows), np.concatenate(cols), np.concatenate(data)
+        inside = (rows >= 0) & (rows < nbOfVoxels)
+        BeamletMatrix = sp.coo_matrix((data[inside], (rows[inside], cols[inside])), shape=(nbOfVoxels, nbOfBeamlets), dtype=np.float32).tocsc()
+
+        ### Interpolated voxels under FLOAT_TOLERANCE are dropped as in shiftBeamlets_cpp
+        entryColumns = np.repeat(np.arange(nbOfBeamlets), np.diff(BeamletMatrix.indptr))
+        BeamletMatrix.data[np.where(interpolated[entryColumns], BeamletMatrix.data <= _FLOAT_TOLERANCE, BeamletMatrix.data == 0)] = 0
+        BeamletMatrix.eliminate_zeros()
+        BeamletMatrices.append(BeamletMatrix)
+    return BeamletMatrices
+
+
+@functools.lru_cache(maxsize=None)
+def _loadShiftBeamletsLibrary():
     lib = ctypes.cdll.LoadLibrary(os.path.join(os.path.dirname(os.path.abspath(__file__)), "shiftBeamlets.so"))
-    
+
     # Define the argument types and return types for the C++ function
     lib.shiftBeamlets.argtypes = [
         np.ctypeslib.ndpointer(dtype=np.float32, ndim=1, flags='C_CONTIGUOUS'),
@@ -214,6 +315,28 @@ def shiftBeamlets_cpp(sparseBeamlets, gridSize,  scenarioShift_voxel, beamletAng
         ctypes.c_int,
         ctypes.c_int
     ]
+    return lib
+
+def shiftBeamlets_cpp(sparseBeamlets, gridSize,  scenarioShift_voxel, beamletAngles_rad):
+    """
+    Shift the beamlets in the dose influence matrix for a given setup error.
+    This would be equivalent to recalculating the dose distribution for a given setup error.
+    This function is executed in c++ to gain speed and parallelize the process over different threads.
+    ----------
+    sparseBeamlets : sp.csc_matrix
+        Sparse matrix of the beamlets
+    gridSize : np.array
+        Size of the grid
+    scenarioShift_voxel : np.array
+        Setup error in voxels
+    beamletAngles_rad : np.array
+        Angles of the beamlets in radians
+    Returns
+    -------
+    sp.csc_matrix
+        Sparse matrix of the shifted beamlets
+    """   
+    lib = _loadShiftBeamletsLibrary()
     numThreads = psutil.cpu_count()
     scenarioShift_voxel[2]*=-1 ### To have the setup error in LPS. Check because some signs problem
     scenarioShift_voxel[1]*=-1 ### To have the setup error in LPS. Check because some signs problem
@@ -225,7 +348,7 @@ def shiftBeamlets_cpp(sparseBeamlets, gridSize,  scenarioShift_voxel, beamletAng
     nonZeroValues = np.array(sparseBeamlets[nonZeroIndexes], dtype= np.float32)[0]
     nonZeroIndexes_beamlet = np.array(nonZeroIndexes[0], dtype= np.int32)
     indexes_beamlet = np.array(nonZeroIndexes[1], dtype= np.int32)
-    arg = np.argsort(indexes_beamlet)
+    arg = np.argsort(indexes_beamlet, kind="stable") ### The voxels of each beamlet must stay sorted for the binary search of shiftBeamlets.cpp
     
     indexes_beamlet = indexes_beamlet[arg]
     nonZeroIndexes_beamlet = nonZeroIndexes_beamlet[arg]
@@ -292,4 +415,21 @@ def adjustDoseToScenario(scenario, nominal, plan: PhotonPlan): ### Shift beamlet
         return dose
     dose.imageArray = doseArray
 
-    return dose
\ No newline at end of file
+    return dose
+
+
+class ShiftBeamletsTestCase(unittest.TestCase):
+    def testShiftBeamletsCSC(self):
+        gridSize = np.array([8, 7, 6])
+        beamlet = np.zeros(gridSize, dtype=np.float32)
+        beamlet[2:5, 3:5, 1:4] = np.arange(1, 19, dtype=np.float32).reshape((3, 2, 3))
+        beamlets = sp.csc_matrix(np.stack([beamlet.ravel(order='F'), 2 * beamlet.ravel(order='F')], axis=1))
+
+        # whole voxel shifts along z (with the LPS sign change) and a 0.25 voxel shift along x
+        shifted, interpolated = shiftBeamlets_csc(beamlets, gridSize, [np.array([0., 0., -2.]), np.array([0.25, 0., 0.])], np.zeros(2))
+        np.testing.assert_array_equal(shifted.toarray()[:, 0].reshape(gridSize, order='F'), np.roll(beamlet, 2, axis=2))
+        np.testing.assert_array_equal(shifted.toarray()[:, 1], 2 * shifted.toarray()[:, 0])
+
+        expected = 0.75 * beamlet
+        expected[1:] += 0.25 * beamlet[:-1]
+        np.testing.assert_allclose(interpolated.toarray()[:, 0].reshape(gridSize, order='F'), expected, rtol=1e-6)
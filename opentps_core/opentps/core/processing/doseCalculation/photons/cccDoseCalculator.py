@@ -25,7 +25,8 @@ from opentps.core.data.images import ROIMask
 from opentps.core.data import ROIContour
 from opentps.core.data.plan._photonPlan import PhotonPlan
 import opentps.core.io.CCCdoseEngineIO as CCCdoseEngineIO
-from opentps.core.processing.doseCalculation.photons._utils import shiftBeamlets, adjustDoseToScenario
+from opentps.core.processing.doseCalculation.photons._utils import shiftBeamlets, shiftBeamletsScenarios, adjustDoseToScenario
+from opentps.core.processing.doseCalculation.photons.cccScenarioScheduler import CCCScenarioScheduler
 from opentps.core.data.plan._robustnessPhoton import RobustScenario
 from scipy.ndimage import gaussian_filter
 
@@ -35,6 +36,9 @@ __all__ = ['CCCDoseCalculator']
 
 logger = logging.getLogger(__name__)
 
+# approximate number of bytes used per CT voxel by one CCC process (density, TERMA and dose grids)
+_CCC_BYTES_PER_VOXEL = 32
+
 
 class CCCDoseCalculator(AbstractDoseCalculator):
     """
@@ -63,13 +67,17 @@ class CCCDoseCalculator(AbstractDoseCalculator):
         Subprocess killed (if subprocess is used)
     overwriteOutsideROI : bool
         if true, set to air all the region in the CT outside the ROI
+    cpuBudget : int
+        maximum number of CCC processes running at once when the robust scenarios are simulated (None for the number of CPUs)
+    memoryBudget : float
+        maximum memory (in bytes) used by the CCC processes running at once when the robust scenarios are simulated (None for the available memory)
     self.WorkSpaceDir : str
         Path to the directory where the opentps code was cloned
     self.ROFolder : str
         Name of the folder where robust scenarios are stored
         
     """
-    def __init__(self, batchSize = 1):
+    def __init__(self, batchSize = 1, cpuBudget = None, memoryBudget = None):
 
         self._ctCalibration: Optional[AbstractCTCalibration] = None
         self._ct: Optional[Image3D] = None
@@ -81,6 +89,9 @@ class CCCDoseCalculator(AbstractDoseCalculator):
 
         self._subprocess = []
         self._subprocessKilled = True
+        self._scenarioScheduler = None
+        self.cpuBudget = cpuBudget
+        self.memoryBudget = memoryBudget
 
         self.overwriteOutsideROI = None  
 
@@ -173,10 +184,13 @@ class CCCDoseCalculator(AbstractDoseCalculator):
         if not folder.is_dir():
             os.makedirs(folder)
     
-    def writeExecuteCCCfile(self):
+    def writeExecuteCCCfile(self, kernelFilePath = None, geometryFilePath = None, beamDirectory = None):
+        kernelFilePath = self._kernelsFilePath if kernelFilePath is None else kernelFilePath
+        geometryFilePath = self._geometryFilePath if geometryFilePath is None else geometryFilePath
+        beamDirectory = self._beamDirectory if beamDirectory is None else beamDirectory
         for batch in range(self.batchSize):
             f = open(os.path.join(self._executableDir, 'CCC_simulation_batch{}'.format(batch)),'w')
-            f.write('{executablePath} {kernelFilePath} {geometryFilePath} {beamPath} {outputPath}'.format(executablePath = self._CCCexecutablePath, kernelFilePath = self._kernelsFilePath, geometryFilePath = self._geometryFilePath, beamPath = os.path.join(self._beamDirectory,'pencilBeamSpecs_batch{}.txt'.format(batch)), outputPath = os.path.join(self.outputDir,'sparseBeamletMatrix_batch{}.bin'.format(batch))))
+            f.write('{executablePath} {kernelFilePath} {geometryFilePath} {beamPath} {outputPath}'.format(executablePath = self._CCCexecutablePath, kernelFilePath = kernelFilePath, geometryFilePath = geometryFilePath, beamPath = os.path.join(beamDirectory,'pencilBeamSpecs_batch{}.txt'.format(batch)), outputPath = os.path.join(self.outputDir,'sparseBeamletMatrix_batch{}.bin'.format(batch))))
             f.close()
 
 
@@ -211,6 +225,17 @@ class CCCDoseCalculator(AbstractDoseCalculator):
             self._subprocess = []
 
 
+    def kill(self):
+        """
+        Kill the running CCC simulations.
+        """
+        self._subprocessKilled = True
+        for process in self._subprocess:
+            process.kill()
+        self._subprocess = []
+        if self._scenarioScheduler is not None:
+            self._scenarioScheduler.kill()
+
     def _importBeamlets(self):
         beamletDose = CCCdoseEngineIO.readBeamlets(os.path.join(self._ctDirName, 'CT_HeaderFile.txt'), self.outputDir, self.batchSize, self._roi)
         return beamletDose
@@ -281,7 +306,9 @@ class CCCDoseCalculator(AbstractDoseCalculator):
         self._startCCC()
 
         beamletDose = self._importBeamlets()
+        return self._setBeamletsWeights(beamletDose, plan)
 
+    def _setBeamletsWeights(self, beamletDose, plan):
         nbOfBeamlets = beamletDose._sparseBeamlets.shape[1]
         assert(nbOfBeamlets==len(self._plan.beamlets))
         beamletDose.beamletAngles_rad = self._plan.beamletsAngle_rad
@@ -337,12 +364,26 @@ class CCCDoseCalculator(AbstractDoseCalculator):
         else:
             plan.planDesign.robustness.nominal = plan.planDesign.beamlets 
             
+        shiftedBeamlets = [None] * len(scenarios)
+        if robustMode == "Shift":
+            ### All the scenarios are shifted in a single pass over the nominal beamlets
+            t0 = time.time()
+            scenarioShifts_voxel = [np.array(scenario.sse) / self._ct.spacing for scenario in scenarios]
+            shiftedBeamlets = shiftBeamletsScenarios(nominal._sparseBeamlets, nominal.doseGridSize, scenarioShifts_voxel, self._plan.beamletsAngle_rad)
+            logger.info('The beamlets of the {} scenarios were shifted in {:.2f}'.format(len(scenarios), time.time()-t0))
+
+        if robustMode == "Simulation":
+            scenariosDoses = self._simulateRobustScenarioBeamlets(scenarios, origin, storePath)
+            self._ct.origin = origin
+            return nominal, scenariosDoses
+
         scenariosDoses = []
         for s, scenario in enumerate(scenarios):
             logger.info('Calculating Scenario {}'.format(s+1))
             logger.info(scenario)
             self.ROFolder = 'Scenario_{}'.format(s)
-            scenario = self.calculateRobustBeamlets(scenario, origin, nominal, mode = robustMode)
+            scenario = self.calculateRobustBeamlets(scenario, origin, nominal, mode = robustMode, shiftedBeamlets = shiftedBeamlets[s])
+            shiftedBeamlets[s] = None
             if not (storePath is None):
                 outputBeamletFile = os.path.join(storePath,
                                                     "BeamletMatrix_" + plan.seriesInstanceUID + "_Scenario_" + str(
@@ -353,7 +394,59 @@ class CCCDoseCalculator(AbstractDoseCalculator):
 
         return nominal, scenariosDoses
 
-    def calculateRobustBeamlets(self, scenario: RobustScenario, origin: Sequence[float], nominal:SparseBeamlets = None, mode = "Simulation"):
+    def _simulateRobustScenarioBeamlets(self, scenarios, origin, storePath = None):
+        """
+        Simulate the beamlets of the scenarios with several CCC simulations running at once (see CCCScenarioScheduler),
+        bounded by cpuBudget and memoryBudget. The density CT, the kernel file list and the beam files are written once
+        in the 'Shared' folder, and each scenario folder only has the CT header with its shifted origin, its geometry
+        file and its execution scripts. The beamlets of each scenario are imported (and stored in storePath) as soon as
+        its simulation finishes.
+        """
+        self.ROFolder = 'Shared'
+        self._ct.origin = origin
+        self._cleanDir(self._beamDirectory)
+        self._writeFilesToSimuDir()
+        kernelFilePath = self._kernelsFilePath
+        densityPath = os.path.join(self._ctDirName, 'CT.bin')
+        beamDirectory = self._beamDirectory
+        isocenter = self._plan.beams[0].isocenterPosition_mm
+
+        executableDirs = []
+        for s, scenario in enumerate(scenarios):
+            self.ROFolder = 'Scenario_{}'.format(s)
+            self._cleanDir(self.outputDir)
+            self._cleanDir(self._executableDir)
+            scenarioOrigin = origin + scenario.sse
+            CCCdoseEngineIO.writeCTHeaderFile(self._ct.imageArray.shape, self._ct.spacing / 10, (scenarioOrigin - isocenter) / 10, scenarioOrigin / 10, self._ctDirName) ### The image dimension in the Dose Engine should be in cm
+            geometryFilePath = os.path.join(self._CCCSimuDir, 'geometryFilePath.txt')
+            with open(geometryFilePath, 'w') as f:
+                f.write('geometry_header\n'+os.path.join(self._ctDirName, 'CT_HeaderFile.txt\n'))
+                f.write('geometry_density\n'+densityPath+'\n')
+            self.writeExecuteCCCfile(kernelFilePath, geometryFilePath, beamDirectory)
+            executableDirs.append(self._executableDir)
+
+        self._scenarioScheduler = CCCScenarioScheduler(self.batchSize, self.cpuBudget, self.memoryBudget, _CCC_BYTES_PER_VOXEL * self._ct.imageArray.size)
+        scenariosDoses = [None] * len(scenarios)
+        try:
+            for s in self._scenarioScheduler.run(executableDirs):
+                logger.info('Scenario {} simulated'.format(s+1))
+                logger.info(scenarios[s])
+                scenarios[s].sre = None if scenarios[s].sre == [0,0,0] else scenarios[s].sre
+                self.ROFolder = 'Scenario_{}'.format(s)
+                beamletsScenario = self._setBeamletsWeights(self._importBeamlets(), self._plan)
+                beamletsScenario.doseOrigin = origin
+                if not (storePath is None):
+                    outputBeamletFile = os.path.join(storePath,
+                                                        "BeamletMatrix_" + self._plan.seriesInstanceUID + "_Scenario_" + str(
+                                                            s + 1) + "-" + str(self._plan.planDesign.robustness.numScenarios) + ".blm")
+                    beamletsScenario.storeOnFS(outputBeamletFile)
+                scenariosDoses[s] = beamletsScenario
+        finally:
+            self._scenarioScheduler = None
+
+        return scenariosDoses
+
+    def calculateRobustBeamlets(self, scenario: RobustScenario, origin: Sequence[float], nominal:SparseBeamlets = None, mode = "Simulation", shiftedBeamlets = None):
         """
         Compute the beamlets for a given scenario
 
@@ -368,6 +461,8 @@ class CCCDoseCalculator(AbstractDoseCalculator):
         mode: str ['Shift', 'Simulation']
             It selects the type of robust scenarios to calculate. 'Shift' calculates the scenarios by shifting the beamlets, 
             'Simulation' calculates the scenarios by simulating the beamlets again per every scenario.
+        shiftedBeamlets: sp.csc_matrix
+            Nominal beamlets already shifted for the scenario (see shiftBeamletsScenarios). If None, they are shifted here.
         Returns
         -------
         beamletsScenario:SparseBeamlets
@@ -389,7 +484,10 @@ class CCCDoseCalculator(AbstractDoseCalculator):
             nbOfBeamlets = nominal._sparseBeamlets.shape[1]
             assert(nbOfBeamlets==len(self._plan.beamlets))
 
-            BeamletMatrix = shiftBeamlets(nominal._sparseBeamlets, nominal.doseGridSize, scenarioShift_voxel, self._plan.beamletsAngle_rad) ### Implement the convolutions in case of sre in GPU look at shiftBeamlets
+            if shiftedBeamlets is None:
+                BeamletMatrix = shiftBeamlets(nominal._sparseBeamlets, nominal.doseGridSize, scenarioShift_voxel, self._plan.beamletsAngle_rad) ### Implement the convolutions in case of sre in GPU look at shiftBeamlets
+            else:
+                BeamletMatrix = shiftedBeamlets
             beamletsScenario = SparseBeamlets()
             beamletsScenario.setUnitaryBeamlets(BeamletMatrix)
             beamletsScenario.doseOrigin = nominal.doseOrigin
@@ -0,0 +1,164 @@
+__all__ = ['CCCScenarioScheduler']
+
+import logging
+import os
+import platform
+import signal
+import subprocess
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional, Sequence
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+
+class CCCScenarioScheduler:
+    """
+    Run the Collapse Cone Convolution simulations of several scenarios concurrently. Each simulation is a folder of
+    execution scripts CCC_simulation_batch0 ... CCC_simulation_batch{batchSize-1} (see
+    CCCDoseCalculator.writeExecuteCCCfile) whose processes run together.
+
+    The number of simulations running at once is bounded by a CPU budget (number of CCC processes) and a memory
+    budget. The simulations are reported as they finish, and the processes still running are killed when the caller
+    stops iterating, raises an exception or calls kill.
+
+    Attributes
+    ----------
+    batchSize : int
+        Number of CCC processes of each simulation
+    cpuBudget : int
+        Maximum number of CCC processes running at once (None for the number of CPUs)
+    memoryBudget : float
+        Maximum memory (in bytes) used by the CCC processes running at once (None for the available memory)
+    bytesPerProcess : float
+        Estimated memory (in bytes) used by one CCC process (0 to ignore the memory budget)
+    """
+    def __init__(self, batchSize:int=1, cpuBudget:Optional[int]=None, memoryBudget:Optional[float]=None, bytesPerProcess:float=0):
+        self.batchSize = batchSize
+        self.cpuBudget = cpuBudget
+        self.memoryBudget = memoryBudget
+        self.bytesPerProcess = bytesPerProcess
+
+        self._processes = set()
+        self._lock = threading.Lock()
+        self._killed = False
+
+    def numberOfWorkers(self, nbSimulations:int) -> int:
+        """
+        Number of simulations run at once.
+        """
+        cpuBudget = self.cpuBudget if self.cpuBudget is not None else (os.cpu_count() or 1)
+        nbWorkers = cpuBudget // self.batchSize
+
+        if self.bytesPerProcess > 0:
+            memoryBudget = self.memoryBudget if self.memoryBudget is not None else psutil.virtual_memory().available
+            nbWorkers = min(nbWorkers, int(memoryBudget // (self.bytesPerProcess * self.batchSize)))
+
+        return max(1, min(nbWorkers, nbSimulations))
+
+    def run(self, executableDirs:Sequence[str]):
+        """
+        Run the simulations and yield the index of each simulation in executableDirs as it finishes.
+
+        Parameters
+        ----------
+        executableDirs : sequence of str
+            Folder of the execution scripts of each simulation
+        """
+        if platform.system() != "Linux":
+            raise NotImplementedError('Concurrent CCC simulations are only available on Linux')
+
+        self._killed = False
+        nbWorkers = self.numberOfWorkers(len(executableDirs))
+        logger.info('Running {} CCC simulations, {} at once'.format(len(executableDirs), nbWorkers))
+
+        executor = ThreadPoolExecutor(max_workers=nbWorkers)
+        nbFinished = 0
+        try:
+            futures = {executor.submit(self._simulate, executableDir): index for index, executableDir in enumerate(executableDirs)}
+            for future in as_completed(futures):
+                future.result()
+                nbFinished += 1
+                yield futures[future]
+        finally:
+            if nbFinished < len(executableDirs):
+                self.kill()
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def kill(self):
+        """
+        Kill the running simulations and cancel the ones that did not start.
+        """
+        with self._lock:
+            self._killed = True
+            for process in self._processes:
+                try:
+                    # the process group also contains the CCC executable started by the shell
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+    def _simulate(self, executableDir):
+        startTime = time.time()
+        with self._lock:
+            if self._killed:
+                raise Exception('Collapse Cone Convolution subprocess killed by caller.')
+            processes = [subprocess.Popen(["sh", 'CCC_simulation_batch{}'.format(batch)], cwd=executableDir, start_new_session=True)
+                         for batch in range(self.batchSize)]
+            self._processes.update(processes)
+
+        try:
+            for process in processes:
+                process.wait()
+        finally:
+            with self._lock:
+                self._processes.difference_update(processes)
+
+        if self._killed:
+            raise Exception('Collapse Cone Convolution subprocess killed by caller.')
+        logger.info('CCC simulation of {} done in {:.2f} s'.format(executableDir, time.time() - startTime))
+
+
+class CCCScenarioSchedulerTestCase(unittest.TestCase):
+    def _writeScripts(self, directory, nbSimulations, command):
+        executableDirs = []
+        for index in range(nbSimulations):
+            executableDir = os.path.join(directory, 'Scenario_{}'.format(index))
+            os.makedirs(executableDir)
+            for batch in range(2):
+                with open(os.path.join(executableDir, 'CCC_simulation_batch{}'.format(batch)), 'w') as f:
+                    f.write(command.format(batch=batch))
+            executableDirs.append(executableDir)
+        return executableDirs
+
+    @unittest.skipUnless(platform.system() == "Linux", "CCC simulations run on Linux")
+    def testRun(self):
+        import tempfile
+
+        scheduler = CCCScenarioScheduler(batchSize=2, cpuBudget=4, memoryBudget=5e9, bytesPerProcess=1e9)
+        self.assertEqual(scheduler.numberOfWorkers(5), 2)
+        self.assertEqual(scheduler.numberOfWorkers(1), 1)
+
+        with tempfile.TemporaryDirectory() as directory:
+            executableDirs = self._writeScripts(directory, 3, 'echo {batch} > output_batch{batch}.txt')
+            self.assertEqual(sorted(scheduler.run(executableDirs)), [0, 1, 2])
+            for executableDir in executableDirs:
+                self.assertTrue(os.path.isfile(os.path.join(executableDir, 'output_batch1.txt')))
+
+    @unittest.skipUnless(platform.system() == "Linux", "CCC simulations run on Linux")
+    def testKill(self):
+        import tempfile
+
+        scheduler = CCCScenarioScheduler(batchSize=2, cpuBudget=2)
+        with tempfile.TemporaryDirectory() as directory:
+            executableDirs = self._writeScripts(directory, 3, 'sleep 30')
+            threading.Timer(0.5, scheduler.kill).start()
+            startTime = time.time()
+            with self.assertRaises(Exception):
+                list(scheduler.run(executableDirs))
+            self.assertLess(time.time() - startTime, 10)
+            self.assertEqual(len(scheduler._processes), 0)
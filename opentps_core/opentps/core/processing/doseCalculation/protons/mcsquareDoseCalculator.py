@@ -7,6 +7,7 @@ import sys
 import platform
 import shutil
 import subprocess
+import unittest
 from pathlib import Path
 from typing import Optional, Sequence, Union, Tuple
 import matplotlib.pyplot as plt
@@ -18,9 +19,11 @@ from opentps.core.data import SparseBeamlets
 from opentps.core.processing.planEvaluation.robustnessEvaluation import RobustnessEvalProton
 from opentps.core.processing.doseCalculation.abstractDoseInfluenceCalculator import AbstractDoseInfluenceCalculator
 from opentps.core.processing.doseCalculation.protons.abstractMCDoseCalculator import AbstractMCDoseCalculator
+from opentps.core.processing.doseCalculation.protons.mcsquareSimulationCache import MCsquareSimulationCache
 from opentps.core.processing.imageProcessing import resampler3D
 from opentps.core.utils.programSettings import ProgramSettings
 from opentps.core.data.CTCalibrations._abstractCTCalibration import AbstractCTCalibration
+from opentps.core.data.CTCalibrations.MCsquareCalibration._mcsquareCTCalibration import MCsquareCTCalibration
 from opentps.core.data.images import CTImage
 from opentps.core.data.images import DoseImage
 from opentps.core.data.images import LETImage
@@ -80,12 +83,22 @@ class MCsquareDoseCalculator(AbstractMCDoseCalculator, AbstractDoseInfluenceCalc
         Subprocess if used
     _subprocessKilled : bool
         Subprocess killed (if subprocess is used)
+    _stopEvent : threading.Event
+        If set, MCsquare is not started, or is killed as soon as it starts (None to ignore, see MCsquareJobRunner)
     _sparseLETFilePath : str
         Sparse LET file path
     _sparseDoseFilePath : str
         Sparse dose file path
     _sparseDoseScenarioToRead : int
         Sparse dose scenario to read
+    beamletImportWorkers : int
+        Number of threads decoding the sparse beamlets files at import
+    beamletImportMemoryBudget : float
+        Peak memory (in bytes) allowed for the beamlet blocks decoded concurrently at import (None for no limit)
+    simulationCache : MCsquareSimulationCache
+        Cache of the doses and beamlets computed by computeDose and computeBeamlets (None to disable caching)
+    numThreads : int
+        Number of threads used by MCsquare (0 for the number of CPUs)
     """
     def __init__(self):
         AbstractMCDoseCalculator.__init__(self)
@@ -116,15 +129,20 @@ class MCsquareDoseCalculator(AbstractMCDoseCalculator, AbstractDoseInfluenceCalc
 
         self._subprocess = None
         self._subprocessKilled = True
+        self._stopEvent = None
 
         self.overwriteOutsideROI = None  # Previously cropCTContour but this name was confusing
 
-        self._sparseLETFilePath = os.path.join(self._workDir, "Sparse_LET.txt")
-        self._doseFilePath = os .path.join(self._workDir, "Dose.mhd")
-        self._letFilePath = os.path.join(self._workDir, "LET.mhd")
+        self._resetOutputFilePaths()
 
         self._sparseDoseScenarioToRead = None
 
+        self._beamletImportWorkers = os.cpu_count() or 1
+        self._beamletImportMemoryBudget = None
+
+        self._simulationCache = None
+        self._numThreads = 0
+
     @property
     def _sparseDoseFilePath(self):
         if (self._plan.planDesign is None) or self._plan.planDesign.robustness.selectionStrategy==self._plan.planDesign.robustness.Strategies.DISABLED:
@@ -265,6 +283,30 @@ class MCsquareDoseCalculator(AbstractMCDoseCalculator, AbstractDoseInfluenceCalc
                 self.scoringGridSize = np.floor(self._ct.gridSize*self._ct.spacing/self._scoringVoxelSpacing).astype(int)
                 self._adapt_gridSize_to_new_spacing = False
 
+    @property
+    def beamletImportWorkers(self) -> int:
+        return self._beamletImportWorkers
+
+    @beamletImportWorkers.setter
+    def beamletImportWorkers(self, nbWorkers: int):
+        self._beamletImportWorkers = max(1, int(nbWorkers))
+
+    @property
+    def beamletImportMemoryBudget(self) -> Optional[float]:
+        return self._beamletImportMemoryBudget
+
+    @beamletImportMemoryBudget.setter
+    def beamletImportMemoryBudget(self, budget: Optional[float]):
+        self._beamletImportMemoryBudget = budget
+
+    @property
+    def simulationCache(self) -> Optional[MCsquareSimulationCache]:
+        return self._simulationCache
+
+    @simulationCache.setter
+    def simulationCache(self, cache: Optional[MCsquareSimulationCache]):
+        self._simulationCache = cache
+
     @property
     def simulationDirectory(self) -> str:
         return str(self._simulationDirectory)
@@ -272,6 +314,15 @@ class MCsquareDoseCalculator(AbstractMCDoseCalculator, AbstractDoseInfluenceCalc
     @simulationDirectory.setter
     def simulationDirectory(self, path):
         self._simulationDirectory = path
+        self._resetOutputFilePaths()
+
+    @property
+    def numThreads(self) -> int:
+        return self._numThreads
+
+    @numThreads.setter
+    def numThreads(self, nbThreads: int):
+        self._numThreads = max(0, int(nbThreads))
 
     def kill(self):
         if not (self._subprocess is None):
@@ -304,11 +355,21 @@ class MCsquareDoseCalculator(AbstractMCDoseCalculator, AbstractDoseInfluenceCalc
         self._roi = roi
         self._config = self._doseComputationConfig
 
+        cacheKey = self._simulationCacheKey('dose')
+        if cacheKey is not None:
+            mhdDose = self._simulationCache.get(cacheKey)
+            if mhdDose is not None:
+                logger.info("MCsquare dose found in simulation cache")
+                mhdDose.patient = self._ct.patient
+                return mhdDose
+
         self._writeFilesToSimuDir()
         self._cleanDir(self._workDir)
         self._startMCsquare()
 
         mhdDose = self._importDose(plan)
+        if cacheKey is not None:
+            self._simulationCache.put(cacheKey, mhdDose)
         return mhdDose
 
     def computeDoseAndLET(self, ct: CTImage, plan: ProtonPlan, roi: Optional[Sequence[ROIContour]] = None) -> Tuple[DoseImage, LETImage]:
@@ -454,6 +515,27 @@ class MCsquareDoseCalculator(AbstractMCDoseCalculator, AbstractDoseInfluenceCalc
             Beamlets dose with same grid size and spacing as the CT image
         """
         logger.info("Prepare MCsquare Beamlet calculation")
+        self._prepareBeamletsSimulation(ct, plan, roi)
+
+        # The error scenarios of a robust simulation are read from the simulation folder afterwards, so that the nominal
+        # beamlets are only cached with them (see computeRobustScenarioBeamlets)
+        cacheKey = None if self._config["Robustness_Mode"] else self._simulationCacheKey('beamlets')
+        if cacheKey is not None:
+            beamletDose = self._simulationCache.get(cacheKey)
+            if beamletDose is not None:
+                logger.info("MCsquare beamlets found in simulation cache")
+                return beamletDose
+
+        beamletDose = self._simulateBeamlets()
+
+        if cacheKey is not None:
+            self._simulationCache.put(cacheKey, beamletDose)
+        return beamletDose
+
+    def _prepareBeamletsSimulation(self, ct, plan, roi):
+        """
+        Set the CT, a copy of the plan with unit MUs, the ROIs and the beamlet configuration of a beamlet simulation
+        """
         self.ct = ct
         self._plan = copy.deepcopy(plan)
         self._plan.spotMUs = np.ones(self._plan.spotMUs.shape)
@@ -467,9 +549,13 @@ class MCsquareDoseCalculator(AbstractMCDoseCalculator, AbstractDoseInfluenceCalc
             planDesign.targetMask = roi
             planDesign.scoringVoxelSpacing = self.scoringVoxelSpacing
             self._plan.planDesign = planDesign
-            
+
         self._config = self._beamletComputationConfig
 
+    def _simulateBeamlets(self) -> SparseBeamlets:
+        """
+        Run the beamlet simulation prepared by _prepareBeamletsSimulation and import the nominal beamlets
+        """
         self._writeFilesToSimuDir()
         self._cleanDir(self._workDir)
 
@@ -478,7 +564,6 @@ class MCsquareDoseCalculator(AbstractMCDoseCalculator, AbstractDoseInfluenceCalc
         else:
             self._startMCsquare()
             beamletDose = self._importBeamlets()
-
         return beamletDose
 
     def _computeBeamletsLinux(self):
@@ -600,32 +685,66 @@ class MCsquareDoseCalculator(AbstractMCDoseCalculator, AbstractDoseInfluenceCalc
         scenarios:Sequence[SparseBeamlets]
             Error scenarios beamlets dose with same grid size and spacing as the CT image
         """
-        nominal = self.computeBeamlets(ct, plan, roi)
-        if not (storePath is None):
-            outputBeamletFile = os.path.join(storePath, "BeamletMatrix_" + plan.seriesInstanceUID + "_Nominal.blm")
-            nominal.storeOnFS(outputBeamletFile)
+        logger.info("Prepare MCsquare robust Beamlet calculation")
+        self._prepareBeamletsSimulation(ct, plan, roi)
+        numScenarios = self._plan.planDesign.robustness.numScenarios
 
-        scenarios = []
-        for s in range(self._plan.planDesign.robustness.numScenarios):
-            self._sparseDoseScenarioToRead = s
+        # (scenario, phase) of each imported scenario
+        scenarioIDs = []
+        for s in range(numScenarios):
             if self._plan.planDesign.robustness.Mode4D == self._plan.planDesign.robustness.Mode4D.MCsquareSystematic:
-                for p in range(self._nbPhase):
-                    self._phase = p+1
-                    scenario = self._importBeamlets()
-                    if not (storePath is None):
-                        outputBeamletFile = os.path.join(storePath,
-                                                        "BeamletMatrix_" + plan.seriesInstanceUID + "_Scenario_" + str(
-                                                            s + 1) + "-" + str(self._plan.planDesign.robustness.numScenarios) + "_Phase" + str(self._phase) + ".blm")
-                        scenario.storeOnFS(outputBeamletFile)
-                    scenarios.append(scenario)
-            else : 
-                scenario = self._importBeamlets()
+                scenarioIDs += [(s, p+1) for p in range(self._nbPhase)]
+            else:
+                scenarioIDs.append((s, None))
+
+        def store(beamlets, scenarioID=None):
+            if scenarioID is None:
+                fileName = "BeamletMatrix_" + plan.seriesInstanceUID + "_Nominal.blm"
+            else:
+                s, phase = scenarioID
+                fileName = "BeamletMatrix_" + plan.seriesInstanceUID + "_Scenario_" + str(s + 1) + "-" + str(numScenarios) \
+                           + ("" if phase is None else "_Phase" + str(phase)) + ".blm"
+            beamlets.storeOnFS(os.path.join(storePath, fileName))
+
+        # The nominal and scenario beamlets are cached together: the scenarios are only in the simulation folder after
+        # the simulation
+        cacheKey = self._simulationCacheKey('robustBeamlets')
+        if cacheKey is not None:
+            cached = self._simulationCache.get(cacheKey)
+            if cached is not None:
+                logger.info("MCsquare robust beamlets found in simulation cache")
+                nominal, scenarios = cached
                 if not (storePath is None):
-                    outputBeamletFile = os.path.join(storePath,
-                                                 "BeamletMatrix_" + plan.seriesInstanceUID + "_Scenario_" + str(
-                                                     s + 1) + "-" + str(self._plan.planDesign.robustness.numScenarios) + ".blm")
-                    scenario.storeOnFS(outputBeamletFile)
-                scenarios.append(scenario)
+                    store(nominal)
+                    for scenarioID, scenario in zip(scenarioIDs, scenarios):
+                        store(scenario, scenarioID)
+                return nominal, scenarios
+
+        # Without cache, each beamlet matrix is stored (and unloaded) as soon as it is imported
+        storeNow = cacheKey is None and not (storePath is None)
+
+        self._sparseDoseScenarioToRead = None
+        nominal = self._simulateBeamlets()
+        if storeNow:
+            store(nominal)
+
+        scenarios = []
+        for scenarioID in scenarioIDs:
+            self._sparseDoseScenarioToRead, phase = scenarioID
+            if not (phase is None):
+                self._phase = phase
+            scenario = self._importBeamlets()
+            if storeNow:
+                store(scenario, scenarioID)
+            scenarios.append(scenario)
+        self._sparseDoseScenarioToRead = None
+
+        if cacheKey is not None:
+            self._simulationCache.put(cacheKey, (nominal, scenarios))
+            if not (storePath is None):
+                store(nominal)
+                for scenarioID, scenario in zip(scenarioIDs, scenarios):
+                    store(scenario, scenarioID)
 
         return nominal, scenarios
 
@@ -693,6 +812,74 @@ class MCsquareDoseCalculator(AbstractMCDoseCalculator, AbstractDoseInfluenceCalc
             logger.info('Range shifter with ID ' + str([range_shifters_added[i].ID for i in range(len(range_shifters_added))]) + ' in plan not in BDL but will be add. Please note: it is up to the user to check that the range shifter is compatible with the real machine.')
         self._beamModel.rangeShifters.extend(range_shifters_added)
 
+    def _simulationCacheKey(self, simulationType:str) -> Optional[str]:
+        """
+        Hash the inputs of the simulation to run into a key of the simulation cache
+
+        Parameters
+        ----------
+        simulationType : str
+            'dose', 'beamlets' or 'robustBeamlets'
+
+        Returns
+        -------
+        key : str
+            Cache key, None if caching is disabled or if the simulation has outputs other than the dose (LET)
+        """
+        if self._simulationCache is None or self._computeLETDistribution:
+            return None
+
+        # The range shifters of the plan that computeDose adds to the BDL are hashed with it, so that the key does not
+        # change once they are added
+        beamModel = self._beamModel
+        if self._plan.rangeShifter:
+            beamModel = copy.copy(self._beamModel)
+            beamModel.rangeShifters = self._beamModel.rangeShifters + \
+                                      [rs for rs in self._plan.rangeShifter if rs not in self._beamModel.rangeShifters]
+
+        plan = [self._plan.scanMode, self._plan.numberOfFractionsPlanned]
+        for beam in self._plan:
+            rangeShifters = beam.rangeShifter if isinstance(beam.rangeShifter, list) else [beam.rangeShifter]
+            plan.append([beam.gantryAngle, beam.couchAngle, np.asarray(beam.isocenterPosition, dtype=float),
+                         [None if rs is None else rs.ID for rs in rangeShifters]])
+            for layer in beam:
+                rsSettings = layer.rangeShifterSettings
+                plan.append([layer.nominalEnergy, np.asarray(layer.spotXY, dtype=float),
+                             np.asarray(layer.spotMUs, dtype=float), np.asarray(layer.spotTimings, dtype=float),
+                             None if rsSettings is None else [rsSettings.rangeShifterSetting,
+                                                              rsSettings.isocenterToRangeShifterDistance,
+                                                              rsSettings.rangeShifterWaterEquivalentThickness]])
+
+        rois = []
+        if simulationType in ('beamlets', 'robustBeamlets') and self._roi:
+            for roi in (self._roi if isinstance(self._roi, Sequence) else [self._roi]):
+                if isinstance(roi, ROIContour):
+                    rois.append(roi.polygonMesh)
+                else:
+                    rois.append([roi.imageArray, np.asarray(roi.origin, dtype=float), np.asarray(roi.spacing, dtype=float)])
+
+        overwriteOutsideROI = None
+        if self.overwriteOutsideROI is not None:
+            overwriteOutsideROI = self.overwriteOutsideROI.getBinaryMask(self._ct.origin, self._ct.gridSize,
+                                                                         self._ct.spacing).imageArray
+
+        # The text tables of a MCsquare calibration include the material compositions and are much faster to hash than
+        # the pickled stopping powers of all elements
+        ctCalibration = self._ctCalibration
+        if isinstance(ctCalibration, MCsquareCTCalibration):
+            ctCalibration = [str(ctCalibration), ctCalibration.materialsPath]
+
+        # The files of the simulation folder and the number of threads do not change the result, so that calculators
+        # running in different folders (see MCsquareJobRunner) share the cached results
+        simuDir = self._mcsquareSimuDir
+        config = {key: value for key, value in self._config.config.items()
+                  if key != "Num_Threads" and not (isinstance(value, str) and value.startswith(simuDir))}
+
+        return MCsquareSimulationCache.computeKey(simulationType, self._ct.imageArray,
+                                                  np.asarray(self._ct.origin, dtype=float),
+                                                  np.asarray(self._ct.spacing, dtype=float), overwriteOutsideROI,
+                                                  ctCalibration, beamModel, plan, rois, config)
+
     def _writeFilesToSimuDir(self):
         """
         Write all files needed for MCsquare simulation in the simulation directory
@@ -715,6 +902,8 @@ class MCsquareDoseCalculator(AbstractMCDoseCalculator, AbstractDoseInfluenceCalc
         """
         if not (self._subprocess is None):
             raise Exception("MCsquare already running")
+        if self._stopEvent is not None and self._stopEvent.is_set():
+            raise Exception('MCsquare subprocess killed by caller.')
 
         self._subprocessKilled = False
         logger.info("Start MCsquare simulation")
@@ -723,6 +912,10 @@ class MCsquareDoseCalculator(AbstractMCDoseCalculator, AbstractDoseInfluenceCalc
                 self._subprocess = subprocess.Popen(["sh", "MCsquare"], cwd=self._mcsquareSimuDir)
             else:
                 self._subprocess = subprocess.Popen(["sh", "MCsquare_opti"], cwd=self._mcsquareSimuDir)
+            if self._stopEvent is not None and self._stopEvent.is_set():
+                # stopped while the subprocess was starting
+                self._subprocessKilled = True
+                self._subprocess.kill()
             self._subprocess.wait()
             if self._subprocessKilled:
                 self._subprocessKilled = False
@@ -736,6 +929,10 @@ class MCsquareDoseCalculator(AbstractMCDoseCalculator, AbstractDoseInfluenceCalc
             else:
                 self._subprocess = subprocess.Popen(os.path.join(self._mcsquareSimuDir, "MCsquare_opti_win.bat"),
                                                     cwd=self._mcsquareSimuDir)
+            if self._stopEvent is not None and self._stopEvent.is_set():
+                # stopped while the subprocess was starting
+                self._subprocessKilled = True
+                self._subprocess.kill()
             self._subprocess.wait()
             if self._subprocessKilled:
                 self._subprocessKilled = False
@@ -800,7 +997,8 @@ class MCsquareDoseCalculator(AbstractMCDoseCalculator, AbstractDoseInfluenceCalc
             Beamlet dose computed by MCsquare
         """
         self._resampleROI()
-        beamletDose = mcsquareIO.readBeamlets(self._sparseDoseFilePath, self._beamletRescaling(), self.scoringOrigin, self._roi)
+        beamletDose = mcsquareIO.readBeamlets(self._sparseDoseFilePath, self._beamletRescaling(), self.scoringOrigin, self._roi,
+                                              nbWorkers=self._beamletImportWorkers, memoryBudget=self._beamletImportMemoryBudget)
         return beamletDose
 
     def _importBeamletsLET(self):
@@ -813,7 +1011,8 @@ class MCsquareDoseCalculator(AbstractMCDoseCalculator, AbstractDoseInfluenceCalc
             Beamlet LET computed by MCsquare
         """
         self._resampleROI()
-        beamletDose = mcsquareIO.readBeamlets(self._sparseLETFilePath, self._beamletRescaling(), self.scoringOrigin, self._roi)
+        beamletDose = mcsquareIO.readBeamlets(self._sparseLETFilePath, self._beamletRescaling(), self.scoringOrigin, self._roi,
+                                              nbWorkers=self._beamletImportWorkers, memoryBudget=self._beamletImportMemoryBudget)
         return beamletDose
 
     def _beamletRescaling(self) -> Sequence[float]:
@@ -878,6 +1077,12 @@ class MCsquareDoseCalculator(AbstractMCDoseCalculator, AbstractDoseInfluenceCalc
     @simulationFolderName.setter
     def simulationFolderName(self, name):
         self._simulationFolderName = name
+        self._resetOutputFilePaths()
+
+    def _resetOutputFilePaths(self):
+        self._sparseLETFilePath = os.path.join(self._workDir, "Sparse_LET.txt")
+        self._doseFilePath = os.path.join(self._workDir, "Dose.mhd")
+        self._letFilePath = os.path.join(self._workDir, "LET.mhd")
 
     @property
     def _workDir(self):
@@ -1122,6 +1327,7 @@ class MCsquareDoseCalculator(AbstractMCDoseCalculator, AbstractDoseInfluenceCalc
     def _generalMCsquareConfig(self) -> MCsquareConfig:
         config = MCsquareConfig()
 
+        config["Num_Threads"] = self._numThreads
         config["Num_Primaries"] = self._nbPrimaries
         config["Stat_uncertainty"] = self._statUncertainty
         config["WorkDir"] = self._mcsquareSimuDir
@@ -1227,3 +1433,106 @@ class MCsquareDoseCalculator(AbstractMCDoseCalculator, AbstractDoseInfluenceCalc
 
         if not folder.is_dir():
             os.mkdir(folder)
+
+
+class MCsquareDoseCalculatorTestCase(unittest.TestCase):
+    class _ScenarioCalculator(MCsquareDoseCalculator):
+        # Import beamlets identifying the run and the scenario instead of running MCsquare
+        nbRuns = 0
+
+        def _writeFilesToSimuDir(self):
+            pass
+
+        def _startMCsquare(self, opti=False):
+            self.nbRuns += 1
+
+        def _importBeamlets(self):
+            scenario = -1 if self._sparseDoseScenarioToRead is None else self._sparseDoseScenarioToRead
+            beamlets = SparseBeamlets()
+            beamlets.setUnitaryBeamlets(csc_matrix(np.full((8, 2), 100. * self.nbRuns + scenario, dtype=np.float32)))
+            return beamlets
+
+    def _createCalculator(self, directory):
+        from opentps.core.io.scannerReader import readScanner
+        from opentps.core.processing.doseCalculation.doseCalculationConfig import DoseCalculationConfig
+
+        calculator = self._ScenarioCalculator()
+        calculator.simulationDirectory = directory
+        calculator.ctCalibration = readScanner(DoseCalculationConfig().scannerFolder)
+        calculator.beamModel = mcsquareIO.readBDL(DoseCalculationConfig().bdlFile)
+        calculator.nbPrimaries = 1e4
+        calculator.simulationCache = MCsquareSimulationCache()
+        return calculator
+
+    def _createPlan(self, ct):
+        from opentps.core.data.plan import PlanProtonBeam, PlanProtonLayer
+
+        plan = ProtonPlan()
+        plan.planDesign = ProtonPlanDesign()
+        plan.planDesign.ct = ct
+        plan.planDesign.robustness.selectionStrategy = plan.planDesign.robustness.Strategies.REDUCED_SET
+        beam = PlanProtonBeam()
+        layer = PlanProtonLayer(100.)
+        layer.appendSpot([0., 10.], [0., 0.], [1., 1.])
+        beam.appendLayer(layer)
+        plan.appendBeam(beam)
+        return plan
+
+    def testRobustBeamletsCache(self):
+        import tempfile
+
+        ct = CTImage(imageArray=np.zeros((4, 4, 4)), spacing=(2., 2., 2.))
+        plan = self._createPlan(ct)
+
+        with tempfile.TemporaryDirectory() as directory:
+            calculator = self._createCalculator(directory)
+            nominal, scenarios = calculator.computeRobustScenarioBeamlets(ct, plan)
+            cachedNominal, cachedScenarios = calculator.computeRobustScenarioBeamlets(ct, plan)
+
+            self.assertEqual(calculator.nbRuns, 1)
+            self.assertGreater(len(scenarios), 0)
+            self.assertEqual(len(cachedScenarios), len(scenarios))
+            self.assertEqual(cachedNominal.toSparseMatrix()[0, 0], 99.)
+            for s, scenario in enumerate(cachedScenarios):
+                self.assertEqual(scenario.toSparseMatrix()[0, 0], 100. + s)
+
+            # the beamlets are cropped to the ROI at import: another ROI is another simulation
+            from opentps.core.data.images import ROIMask
+
+            roiA = ROIMask(imageArray=np.zeros((4, 4, 4), dtype=bool), spacing=(2., 2., 2.))
+            roiA.imageArray[1:3, 1:3, 1:3] = True
+            roiB = ROIMask(imageArray=np.zeros((4, 4, 4), dtype=bool), spacing=(2., 2., 2.))
+            roiB.imageArray[0:2, 0:2, 0:2] = True
+            calculator.computeRobustScenarioBeamlets(ct, plan, [roiA])
+            self.assertEqual(calculator.nbRuns, 2)
+            calculator.computeRobustScenarioBeamlets(ct, plan, [roiA])
+            self.assertEqual(calculator.nbRuns, 2)
+            calculator.computeRobustScenarioBeamlets(ct, plan, [roiB])
+            self.assertEqual(calculator.nbRuns, 3)
+
+            # the scenarios of a robust simulation are not in the folder after a nominal cache hit: simulate again
+            calculator.computeBeamlets(ct, plan)
+            self.assertEqual(calculator.nbRuns, 4)
+
+    def testCacheKeyRangeShifter(self):
+        import tempfile
+
+        from opentps.core.data.plan._rangeShifter import RangeShifter
+
+        ct = CTImage(imageArray=np.zeros((4, 4, 4)), spacing=(2., 2., 2.))
+        plan = self._createPlan(ct)
+        plan[0].rangeShifter = RangeShifter()
+        plan.rangeShifter = [plan[0].rangeShifter]
+
+        with tempfile.TemporaryDirectory() as directory:
+            calculator = self._createCalculator(directory)
+            calculator.ct = ct
+            calculator._plan = plan
+            calculator._config = calculator._doseComputationConfig
+            nbRangeShifters = len(calculator.beamModel.rangeShifters)
+
+            key = calculator._simulationCacheKey('dose')
+            self.assertEqual(len(calculator.beamModel.rangeShifters), nbRangeShifters)
+            calculator._writeRangeShifters()
+            self.assertEqual(len(calculator.beamModel.rangeShifters), nbRangeShifters + 1)
+            self.assertEqual(calculator._simulationCacheKey('dose'), key)
@@ -0,0 +1,238 @@
+__all__ = ['MCsquareJobRunner']
+
+import copy
+import logging
+import os
+import shutil
+import threading
+import time
+import unittest
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+
+class MCsquareJobRunner:
+    """
+    Run several MCsquare dose calculations concurrently. Each job is a CT and a plan, simulated by a copy of a template
+    MCsquareDoseCalculator (or of the calculator given with the job), which holds the MCsquare configuration (beam model,
+    CT calibration, number of primaries, scoring grid, ...).
+
+    Each job runs in its own simulation folder {simulationFolderName}_job{index} and its MCsquare instance uses
+    threadsPerInstance threads, so that nbInstances jobs share the CPUs of the node. The doses are returned as futures and
+    the simulation folders created by the runner are removed when the jobs are done.
+
+    When an exception leaves the with block of the runner (for example the exception of a failed job raised by its
+    future), the running MCsquare instances are killed and the jobs that did not start are cancelled.
+
+    Attributes
+    ----------
+    calculator : MCsquareDoseCalculator
+        Template dose calculator of the jobs
+    nbInstances : int
+        Maximum number of MCsquare instances running at once
+    threadsPerInstance : int
+        Number of threads of each MCsquare instance (None to split the CPUs between the instances)
+    cleanUp : bool
+        Remove the simulation folder of each job when it is done, unless the folder existed before the job
+    """
+    def __init__(self, calculator, nbInstances:int=1, threadsPerInstance:Optional[int]=None, cleanUp:bool=True):
+        self.calculator = calculator
+        self.nbInstances = max(1, int(nbInstances))
+        self.threadsPerInstance = threadsPerInstance
+        self.cleanUp = cleanUp
+
+        self._executor = ThreadPoolExecutor(max_workers=self.nbInstances)
+        self._futures = []
+        self._running = set()
+        self._nbJobs = 0
+        self._lock = threading.Lock()
+        # shared with the calculators of the jobs, which do not start MCsquare once it is set
+        self._stopEvent = threading.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.shutdown(wait=True, kill=excType is not None)
+
+    @property
+    def numberOfThreads(self) -> int:
+        """
+        Number of threads of each MCsquare instance.
+        """
+        if self.threadsPerInstance is not None:
+            return max(1, int(self.threadsPerInstance))
+        return max(1, (os.cpu_count() or 1) // self.nbInstances)
+
+    def submit(self, ct, plan, calculator=None, roi=None) -> Future:
+        """
+        Submit a dose calculation.
+
+        Parameters
+        ----------
+        ct : CTImage
+            CT image of the patient
+        plan : ProtonPlan
+            RT plan
+        calculator : MCsquareDoseCalculator, optional
+            Dose calculator holding the configuration of this job (None for the template calculator)
+        roi : Optional[Sequence[ROIContour]], optional
+            ROI contours, by default None
+
+        Returns
+        -------
+        future : Future
+            Future of the DoseImage
+        """
+        with self._lock:
+            if self._stopEvent.is_set():
+                raise Exception('MCsquare job runner killed by caller.')
+            index = self._nbJobs
+            self._nbJobs += 1
+            future = self._executor.submit(self._run, index, ct, plan, self.calculator if calculator is None else calculator, roi)
+            self._futures.append(future)
+        return future
+
+    def submitJobs(self, jobs:Sequence) -> Sequence[Future]:
+        """
+        Submit several dose calculations.
+
+        Parameters
+        ----------
+        jobs : sequence of tuple
+            (ct, plan) or (ct, plan, calculator) of each job
+
+        Returns
+        -------
+        futures : list of Future
+            Future of the DoseImage of each job, in the order of jobs
+        """
+        return [self.submit(*job) for job in jobs]
+
+    def kill(self):
+        """
+        Kill the running MCsquare instances and cancel the jobs that did not start.
+        """
+        with self._lock:
+            self._stopEvent.set()
+            for future in self._futures:
+                future.cancel()
+            for calculator in self._running:
+                calculator.kill()
+
+    def shutdown(self, wait:bool=True, kill:bool=False):
+        """
+        Stop accepting jobs and release the threads once the submitted jobs are done.
+
+        Parameters
+        ----------
+        wait : bool
+            Wait for the submitted jobs
+        kill : bool
+            Kill the running jobs and cancel the others first
+        """
+        if kill:
+            self.kill()
+        self._executor.shutdown(wait=wait)
+
+    def _run(self, index, ct, plan, template, roi):
+        folderName = template.simulationFolderName + '_job{}'.format(index)
+        simuDir = os.path.join(template.simulationDirectory, folderName)
+        # the folder is created when the folder name of the calculator is set
+        removeSimuDir = self.cleanUp and not os.path.exists(simuDir)
+
+        calculator = copy.copy(template)
+        calculator._subprocess = None
+        calculator._stopEvent = self._stopEvent
+        # Range shifters of the plan are added to the beam model by computeDose
+        calculator.beamModel = copy.deepcopy(template.beamModel)
+        calculator.simulationFolderName = folderName
+        calculator.numThreads = self.numberOfThreads
+
+        startTime = time.time()
+        with self._lock:
+            if self._stopEvent.is_set():
+                if removeSimuDir:
+                    shutil.rmtree(simuDir, ignore_errors=True)
+                raise Exception('MCsquare subprocess killed by caller.')
+            self._running.add(calculator)
+
+        try:
+            dose = calculator.computeDose(ct, plan, roi)
+        finally:
+            with self._lock:
+                self._running.discard(calculator)
+            if removeSimuDir:
+                shutil.rmtree(simuDir, ignore_errors=True)
+
+        logger.info('MCsquare job {} done in {:.2f} s'.format(index, time.time() - startTime))
+        return dose
+
+
+class MCsquareJobRunnerTestCase(unittest.TestCase):
+    def testRun(self):
+        import tempfile
+
+        from opentps.core.processing.doseCalculation.protons.mcsquareDoseCalculator import MCsquareDoseCalculator
+
+        class WorkDirCalculator(MCsquareDoseCalculator):
+            # Report the simulation folder and the number of threads instead of running MCsquare
+            def computeDose(self, ct, plan, roi=None):
+                time.sleep(0.1)
+                with open(self._doseFilePath, 'w') as f:
+                    f.write(str(ct))
+                return ct, plan, self._mcsquareSimuDir, self.numThreads
+
+        with tempfile.TemporaryDirectory() as directory:
+            calculator = WorkDirCalculator()
+            calculator.simulationDirectory = directory
+
+            with MCsquareJobRunner(calculator, nbInstances=2, threadsPerInstance=3) as runner:
+                futures = runner.submitJobs([(phase, 'plan') for phase in range(4)])
+                results = [future.result() for future in futures]
+
+            self.assertEqual([result[0] for result in results], [0, 1, 2, 3])
+            self.assertEqual(len({result[2] for result in results}), 4)
+            self.assertTrue(all(result[3] == 3 for result in results))
+            self.assertTrue(all(not os.path.exists(result[2]) for result in results))
+            self.assertEqual(calculator.numThreads, 0)
+
+        self.assertEqual(MCsquareJobRunner(calculator, nbInstances=2).numberOfThreads, max(1, (os.cpu_count() or 1) // 2))
+
+    def testKillOnFailure(self):
+        import tempfile
+
+        from opentps.core.processing.doseCalculation.protons.mcsquareDoseCalculator import MCsquareDoseCalculator
+
+        class FailingCalculator(MCsquareDoseCalculator):
+            # Phase 0 fails, the other phases run a long MCsquare
+            def computeDose(self, ct, plan, roi=None):
+                if ct == 0:
+                    raise ValueError('phase 0 failed')
+                with open(os.path.join(self._mcsquareSimuDir, 'MCsquare'), 'w') as f:
+                    f.write('exec sleep 60\n')
+                self._startMCsquare()
+                return ct
+
+        with tempfile.TemporaryDirectory() as directory:
+            calculator = FailingCalculator()
+            calculator.simulationDirectory = directory
+            # a folder of the user named as a job folder is kept
+            userDir = os.path.join(directory, calculator.simulationFolderName + '_job1')
+            os.makedirs(userDir)
+
+            startTime = time.time()
+            with self.assertRaises(ValueError):
+                with MCsquareJobRunner(calculator, nbInstances=2, threadsPerInstance=1) as runner:
+                    futures = runner.submitJobs([(phase, 'plan') for phase in range(4)])
+                    for future in futures:
+                        future.result()
+
+            self.assertLess(time.time() - startTime, 30)
+            self.assertTrue(all(future.done() for future in futures))
+            self.assertTrue(futures[2].cancelled() or futures[3].cancelled())
+            self.assertIsNotNone(futures[1].exception())
+            self.assertTrue(os.path.isdir(userDir))
+            self.assertEqual([folder for folder in os.listdir(directory) if '_job' in folder], [os.path.basename(userDir)])
@@ -0,0 +1,252 @@
+__all__ = ['MCsquareSimulationCache']
+
+import copy
+import hashlib
+import logging
+import pickle
+import threading
+import unittest
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+from scipy.sparse import issparse
+
+logger = logging.getLogger(__name__)
+
+
+class MCsquareSimulationCache:
+    """
+    Least recently used cache of MCsquare simulation results (DoseImage, SparseBeamlets), addressed by a hash of all
+    simulation inputs.
+
+    The dose calculator computes the key from the CT, the CT calibration, the BDL, the plan, the scoring ROIs and the
+    MCsquare configuration (number of primaries, statistical uncertainty, scoring grid, ...). A repeated simulation with
+    identical inputs returns a copy of the stored result without running MCsquare. A same cache can be shared by
+    several dose calculators.
+
+    Attributes
+    ----------
+    maxEntries: int
+        Maximum number of results kept in cache (None for no limit)
+    maxBytes: float
+        Maximum memory (in bytes) used by the arrays of the cached results (None for no limit)
+    statistics: dict
+        Number of hits, misses, evictions and invalidations
+    """
+    def __init__(self, maxEntries:Optional[int]=8, maxBytes:Optional[float]=None):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._statistics = {}
+        self.resetStatistics()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_entries'] = OrderedDict()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key:str) -> bool:
+        return key in self._entries
+
+    @property
+    def statistics(self) -> dict:
+        return dict(self._statistics)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(nbytes for _, nbytes in self._entries.values())
+
+    def keys(self) -> list:
+        """
+        Keys of the cached results, from the least to the most recently used.
+        """
+        return list(self._entries.keys())
+
+    def resetStatistics(self):
+        """
+        Reset the hit, miss, eviction and invalidation counters.
+        """
+        self._statistics = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    @staticmethod
+    def computeKey(*inputs) -> str:
+        """
+        Hash the simulation inputs into a cache key.
+
+        Parameters
+        ----------
+        inputs:
+            numpy arrays, scipy sparse matrices, numbers, strings, None, lists, tuples and dicts of those. Other objects
+            are pickled.
+
+        Returns
+        -------
+        key: str
+            Hexadecimal digest of the inputs
+        """
+        hasher = hashlib.sha256()
+        _updateHash(hasher, inputs)
+        return hasher.hexdigest()
+
+    def get(self, key:str):
+        """
+        Get a copy of a cached result.
+
+        Parameters
+        ----------
+        key: str
+            Key computed by computeKey()
+
+        Returns
+        -------
+        result: DoseImage, SparseBeamlets or tuple of those
+            Copy of the result, None if the key is not in cache
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._statistics['misses'] += 1
+                return None
+            self._statistics['hits'] += 1
+            self._entries.move_to_end(key)
+
+        return copy.deepcopy(entry[0])
+
+    def put(self, key:str, result):
+        """
+        Store a copy of a simulation result and evict the least recently used results exceeding maxEntries or maxBytes.
+
+        Parameters
+        ----------
+        key: str
+            Key computed by computeKey()
+        result: DoseImage, SparseBeamlets or tuple of those
+            Simulation result
+        """
+        result = copy.deepcopy(result)
+        nbytes = _nbytes(result)
+
+        with self._lock:
+            self._entries[key] = (result, nbytes)
+            self._entries.move_to_end(key)
+
+            totalBytes = self.nbytes
+            while len(self._entries) > 1 and ((self.maxEntries is not None and len(self._entries) > self.maxEntries)
+                                              or (self.maxBytes is not None and totalBytes > self.maxBytes)):
+                evictedKey, (_, evictedBytes) = self._entries.popitem(last=False)
+                totalBytes -= evictedBytes
+                self._statistics['evictions'] += 1
+                logger.debug('Evict MCsquare simulation ' + evictedKey + ' from cache')
+
+            if self.maxBytes is not None and totalBytes > self.maxBytes:
+                del self._entries[key]
+                self._statistics['evictions'] += 1
+                logger.warning('MCsquare simulation result of ' + str(nbytes) + ' bytes exceeds cache size limit')
+
+    def invalidate(self, key:Optional[str]=None):
+        """
+        Remove a result from the cache.
+
+        Parameters
+        ----------
+        key: str
+            Key of the result to remove. If None, all results are removed.
+        """
+        with self._lock:
+            if key is None:
+                self._statistics['invalidations'] += len(self._entries)
+                self._entries.clear()
+            elif self._entries.pop(key, None) is not None:
+                self._statistics['invalidations'] += 1
+
+
+def _updateHash(hasher, value):
+    if value is None or isinstance(value, (bool, int, float, str, np.generic)):
+        hasher.update((type(value).__name__ + ':' + repr(value) + ';').encode())
+    elif isinstance(value, np.ndarray):
+        hasher.update(('ndarray:' + value.dtype.str + ':' + str(value.shape) + ';').encode())
+        hasher.update(np.ascontiguousarray(value).data)
+    elif issparse(value):
+        value = value.tocsc()
+        hasher.update(('sparse:' + str(value.shape) + ';').encode())
+        for array in (value.data, value.indices, value.indptr):
+            _updateHash(hasher, array)
+    elif isinstance(value, (list, tuple)):
+        hasher.update((type(value).__name__ + ':' + str(len(value)) + ';').encode())
+        for item in value:
+            _updateHash(hasher, item)
+    elif isinstance(value, dict):
+        hasher.update(('dict:' + str(len(value)) + ';').encode())
+        for itemKey in sorted(value.keys(), key=str):
+            _updateHash(hasher, itemKey)
+            _updateHash(hasher, value[itemKey])
+    else:
+        hasher.update(('pickle:' + type(value).__name__ + ';').encode())
+        hasher.update(pickle.dumps(value, protocol=4))
+
+
+def _nbytes(result) -> int:
+    if isinstance(result, (list, tuple)):
+        return sum(_nbytes(item) for item in result)
+
+    nbytes = 0
+    for value in vars(result).values():
+        if isinstance(value, np.ndarray):
+            nbytes += value.nbytes
+        elif issparse(value):
+            nbytes += value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+    return nbytes
+
+
+class MCsquareSimulationCacheTestCase(unittest.TestCase):
+    def testComputeKey(self):
+        array = np.arange(24, dtype=np.float32).reshape((2, 3, 4))
+        key = MCsquareSimulationCache.computeKey(array, [1., 2.], {'Num_Primaries': 1e7}, None)
+
+        self.assertEqual(key, MCsquareSimulationCache.computeKey(array.copy(), [1., 2.], {'Num_Primaries': 1e7}, None))
+        self.assertNotEqual(key, MCsquareSimulationCache.computeKey(array.astype(float), [1., 2.], {'Num_Primaries': 1e7}, None))
+        self.assertNotEqual(key, MCsquareSimulationCache.computeKey(array.reshape((3, 2, 4)), [1., 2.], {'Num_Primaries': 1e7}, None))
+        self.assertNotEqual(key, MCsquareSimulationCache.computeKey(array, (1., 2.), {'Num_Primaries': 1e7}, None))
+        self.assertNotEqual(key, MCsquareSimulationCache.computeKey(array, [1., 2.], {'Num_Primaries': 1e6}, None))
+
+    def testLRU(self):
+        from opentps.core.data.images import DoseImage
+
+        cache = MCsquareSimulationCache(maxEntries=2)
+        doses = [DoseImage(imageArray=np.full((4, 4, 4), float(i))) for i in range(3)]
+        for i, dose in enumerate(doses[:2]):
+            cache.put(str(i), dose)
+
+        cached = cache.get('0')
+        np.testing.assert_array_equal(cached.imageArray, doses[0].imageArray)
+        cached.imageArray[0, 0, 0] = -1.
+        self.assertEqual(cache.get('0').imageArray[0, 0, 0], 0.)
+
+        cache.put('2', doses[2])
+        self.assertEqual(cache.keys(), ['0', '2'])
+        self.assertIsNone(cache.get('1'))
+        self.assertEqual(cache.statistics, {'hits': 2, 'misses': 1, 'evictions': 1, 'invalidations': 0})
+
+        cache.maxEntries = None
+        cache.maxBytes = 2.5 * doses[0].imageArray.nbytes
+        for i, dose in enumerate(doses):
+            cache.put(str(i), dose)
+        self.assertEqual(cache.keys(), ['1', '2'])
+        self.assertLessEqual(cache.nbytes, cache.maxBytes)
+
+        cache.invalidate('1')
+        self.assertEqual(cache.keys(), ['2'])
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.statistics['invalidations'], 2)
@@ -0,0 +1,237 @@
+"""
+Exponentiation of velocity fields by scaling and squaring.
+
+Each squaring step composes the field with itself: field(x) <- field(x) + field(x + field(x)). The sample coordinates
+x + field(x) are computed once per step in buffers allocated once for a given grid, and the three components of the field
+are interpolated at these coordinates with the libInterp3 trilinear interpolation. Without the C library, the three
+components are gathered together and share the same trilinear weights.
+"""
+import ctypes
+import logging
+import math
+import time
+import unittest
+
+import numpy as np
+import scipy.ndimage
+
+from opentps.core.processing.C_libraries import nativeBackend
+
+logger = logging.getLogger(__name__)
+
+
+def numberOfSquarings(fieldArray:np.ndarray, spacing) -> int:
+    """
+    Number of squaring steps used to exponentiate a field, from its maximum norm in voxels.
+
+    Parameters
+    ----------
+    fieldArray : numpy array
+        Vector field of shape (X, Y, Z, 3), in mm.
+    spacing : sequence of float
+        Voxel spacing of the field.
+
+    Returns
+    -------
+    int
+        Number of squaring steps.
+    """
+    norm = np.square(fieldArray[:, :, :, 0] / spacing[0]) + np.square(fieldArray[:, :, :, 1] / spacing[1]) + np.square(fieldArray[:, :, :, 2] / spacing[2])
+    N = math.ceil(2 + math.log2(np.maximum(1.0, np.amax(np.sqrt(norm)))) / 2) + 1
+    return max(N, 1)
+
+
+class ScalingAndSquaring:
+    """
+    Scaling and squaring exponentiation of vector fields defined on a same voxel grid. The work buffers are allocated
+    once and reused by the successive calls to exponentiate.
+
+    Parameters
+    ----------
+    gridSize : sequence of int
+        Voxel grid size of the fields.
+    spacing : sequence of float
+        Voxel spacing of the fields.
+    """
+    def __init__(self, gridSize, spacing):
+        self.gridSize = tuple(int(n) for n in gridSize)
+        self.spacing = np.array(spacing, dtype=np.float32)
+
+        numVoxels = int(np.prod(self.gridSize))
+        self._points = np.empty(self.gridSize + (3,), dtype=np.float32)
+        self._warped = np.empty(self.gridSize + (3,), dtype=np.float32)
+        self._component = np.empty(self.gridSize, dtype=np.float32)
+        self._interpolated = np.empty(numVoxels, dtype=np.float32)
+        self._numpyBuffers = None
+
+        # voxel indices along each axis
+        self._grid = [np.arange(n, dtype=np.float32).reshape([-1 if a == axis else 1 for a in range(3)]) for axis, n in enumerate(self.gridSize)]
+
+    def exponentiate(self, fieldArray:np.ndarray, out:np.ndarray=None, tolerance:float=None) -> np.ndarray:
+        """
+        Exponentiate a vector field (e.g. to convert a velocity field into a displacement field).
+
+        Parameters
+        ----------
+        fieldArray : numpy array
+            Vector field of shape (X, Y, Z, 3), in mm.
+        out : numpy array
+            float32 C-contiguous array of shape (X, Y, Z, 3) receiving the result. It may be fieldArray itself. If None,
+            a new array is allocated.
+        tolerance : float
+            If not None, the squarings stop once the largest correction of a step (norm of field(x + field(x)) -
+            field(x), in voxels) is below tolerance, and the field is scaled by the remaining powers of 2 instead.
+            This is exact for uniform fields.
+
+        Returns
+        -------
+        numpy array
+            The exponentiated field.
+        """
+        if tuple(fieldArray.shape) != self.gridSize + (3,):
+            raise ValueError('Field shape ' + str(fieldArray.shape) + ' does not match the grid size ' + str(self.gridSize))
+
+        N = numberOfSquarings(fieldArray, self.spacing)
+
+        if out is None:
+            out = np.empty(self.gridSize + (3,), dtype=np.float32)
+        elif out.dtype != np.float32 or not out.flags.c_contiguous or tuple(out.shape) != self.gridSize + (3,):
+            raise ValueError('out must be a float32 C-contiguous array of shape ' + str(self.gridSize + (3,)))
+        np.multiply(fieldArray, np.float32(2 ** (-N)), out=out, casting='unsafe')
+
+        for r in range(N):
+            self._interpolate(out)
+            self._warped -= out
+            if tolerance is not None and r < N - 1 and self._maxNorm(self._warped) < tolerance:
+                out *= np.float32(2 ** (N - r))
+                logger.debug('Field exponentiation stopped after ' + str(r + 1) + ' of ' + str(N) + ' squarings')
+                break
+            out += out
+            out += self._warped
+
+        return out
+
+    def _interpolate(self, field):
+        # trilinear interpolation of the three components of field at x + field(x), clamped to the grid
+        startTime = time.perf_counter()
+        points = self._points
+        for axis in range(3):
+            coordinate = points[:, :, :, axis]
+            np.divide(field[:, :, :, axis], self.spacing[axis], out=coordinate)
+            coordinate += self._grid[axis]
+            np.clip(coordinate, 0, self.gridSize[axis] - 1, out=coordinate)
+
+        trilinearInterpolation = nativeBackend.getFunction('libInterp3', 'Trilinear_Interpolation',
+                                                           [nativeBackend.floatArray, nativeBackend.intArray,
+                                                            nativeBackend.floatArray, ctypes.c_int, ctypes.c_float,
+                                                            nativeBackend.floatArray])
+        # the C interpolation needs 2 voxels along each axis
+        if trilinearInterpolation is not None and min(self.gridSize) > 1:
+            size = np.array(self.gridSize, dtype=np.int32)
+            flatPoints = points.reshape((-1, 3))
+            for axis in range(3):
+                np.copyto(self._component, field[:, :, :, axis])
+                trilinearInterpolation(self._component, size, flatPoints, flatPoints.shape[0], 0., self._interpolated)
+                self._warped[:, :, :, axis] = self._interpolated.reshape(self.gridSize)
+            backend = nativeBackend.NATIVE
+        else:
+            self._interpolateNumpy(field)
+            backend = nativeBackend.NUMPY
+
+        nativeBackend.reportCall('ScalingAndSquaring._interpolate', backend, time.perf_counter() - startTime)
+
+    def _interpolateNumpy(self, field):
+        # the three components are gathered together and share the trilinear weights
+        numVoxels = field.size // 3
+        if self._numpyBuffers is None:
+            self._numpyBuffers = (np.empty(self.gridSize, dtype=np.float32), np.empty(self.gridSize, dtype=np.intp),
+                                  np.empty(numVoxels, dtype=np.intp),
+                                  [np.empty((numVoxels, 1), dtype=np.float32) for _ in range(3)],
+                                  [np.empty((numVoxels, 3), dtype=np.float32) for _ in range(5)])
+        lower, index, cornerIndex, weights, corners = self._numpyBuffers
+
+        strides = (self.gridSize[1] * self.gridSize[2], self.gridSize[2], 1)
+        # flat index offset of the next voxel along each axis (0 for axes of size 1)
+        offsets = [strides[axis] if n > 1 else 0 for axis, n in enumerate(self.gridSize)]
+
+        index.fill(0)
+        for axis in range(3):
+            coordinate = self._points[:, :, :, axis]
+            # lower voxel index, at most the before last voxel so that the upper voxel exists
+            np.floor(coordinate, out=lower)
+            np.minimum(lower, max(self.gridSize[axis] - 2, 0), out=lower)
+            np.subtract(coordinate, lower, out=weights[axis].reshape(self.gridSize))
+            index += lower.astype(np.intp) * strides[axis]
+
+        # interpolation along z of the 4 pairs of corners, then along y and x
+        flatField = field.reshape((-1, 3))
+        index = index.reshape(-1)
+        for cx in range(2):
+            for cy in range(2):
+                corner = corners[2 * cx + cy]
+                np.add(index, cx * offsets[0] + cy * offsets[1], out=cornerIndex)
+                np.take(flatField, cornerIndex, axis=0, out=corner)
+                cornerIndex += offsets[2]
+                upper = np.take(flatField, cornerIndex, axis=0, out=corners[4])
+                upper -= corner
+                upper *= weights[2]
+                corner += upper
+        for cx in range(2):
+            corner, upper = corners[2 * cx], corners[2 * cx + 1]
+            upper -= corner
+            upper *= weights[1]
+            corner += upper
+        corners[2] -= corners[0]
+        corners[2] *= weights[0]
+        np.add(corners[0], corners[2], out=self._warped.reshape((-1, 3)))
+
+    def _maxNorm(self, fieldArray):
+        voxels = fieldArray / self.spacing
+        return float(np.sqrt(np.amax(np.einsum('...i,...i->...', voxels, voxels))))
+
+
+class ScalingAndSquaringTestCase(unittest.TestCase):
+    def testExponentiate(self):
+        rng = np.random.default_rng(0)
+        gridSize, spacing = (12, 9, 7), (2., 1.5, 3.)
+        field = rng.normal(0., 2., gridSize + (3,)).astype(np.float32)
+
+        # reference: component by component interpolation with scipy
+        N = numberOfSquarings(field, spacing)
+        reference = field * np.float32(2 ** (-N))
+        grid = np.meshgrid(*[np.arange(n) for n in gridSize], indexing='ij')
+        for r in range(N):
+            coordinates = [np.clip(grid[a] + reference[..., a] / spacing[a], 0, gridSize[a] - 1) for a in range(3)]
+            warped = [scipy.ndimage.map_coordinates(reference[..., a], coordinates, order=1) for a in range(3)]
+            reference = reference + np.stack(warped, axis=-1)
+
+        exponentiation = ScalingAndSquaring(gridSize, spacing)
+        np.testing.assert_allclose(exponentiation.exponentiate(field), reference, atol=1e-4)
+
+        inPlace = field.copy()
+        exponentiation.exponentiate(inPlace, out=inPlace)
+        np.testing.assert_allclose(inPlace, reference, atol=1e-4)
+
+        uniform = np.tile(np.float32([3., -2., 1.]), gridSize + (1,))
+        np.testing.assert_allclose(exponentiation.exponentiate(uniform, tolerance=1e-3), uniform, atol=1e-5)
+
+    def testNumpyInterpolation(self):
+        rng = np.random.default_rng(1)
+        gridSize = (10, 4, 6)
+        field = rng.normal(0., 3., gridSize + (3,)).astype(np.float32)
+
+        exponentiation = ScalingAndSquaring(gridSize, (1., 2., 1.5))
+        exponentiation._interpolate(field)
+        warped = exponentiation._warped.copy()
+        exponentiation._interpolateNumpy(field)
+        np.testing.assert_allclose(exponentiation._warped, warped, atol=1e-5)
+
+        # single slice along y, interpolated in 2D
+        field = np.ascontiguousarray(field[:, :1])
+        flat = ScalingAndSquaring(field.shape[:3], (1., 2., 1.5))
+        flat._interpolate(field)
+        grid = np.meshgrid(np.arange(10), np.arange(6), indexing='ij')
+        coordinates = [np.clip(grid[0] + field[:, 0, :, 0], 0, 9), np.clip(grid[1] + field[:, 0, :, 2] / 1.5, 0, 5)]
+        for axis in range(3):
+            warped = scipy.ndimage.map_coordinates(field[:, 0, :, axis], coordinates, order=1)
+            np.testing.assert_allclose(flat._warped[:, 0, :, axis], warped, atol=1e-5)
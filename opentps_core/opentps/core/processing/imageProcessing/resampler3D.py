@@ -272,11 +272,13 @@ def resampleOpenMP(data, inputOrigin, inputSpacing, inputGridSize, outputOrigin,
 
     """
     Resample 3D data according to new voxel grid using linear interpolation.
+    The grids being axis-aligned, the trilinear interpolation is applied as separable 1D interpolations along each axis,
+    by slabs, without computing the coordinates of every output voxel.
 
     Parameters
     ----------
     data : numpy array
-        data to be resampled.
+        data to be resampled (3D, or 4D with the vector components along the last axis).
     inputOrigin : list
         origin of the input data voxel grid.
     inputSpacing : list
@@ -293,6 +295,8 @@ def resampleOpenMP(data, inputOrigin, inputSpacing, inputGridSize, outputOrigin,
         interpolation value for locations outside the input voxel grid.
     outputType : numpy data type
         type of the output.
+    tryGPU : bool
+        try to use the GPU for the anti-aliasing filter.
 
     Returns
     -------
@@ -330,21 +334,71 @@ def resampleOpenMP(data, inputOrigin, inputSpacing, inputGridSize, outputOrigin,
     interpY[interpY > inputGridSize[1] - 1] = np.round(interpY[interpY > inputGridSize[1] - 1] * 1e3) / 1e3
     interpZ[interpZ > inputGridSize[2] - 1] = np.round(interpZ[interpZ > inputGridSize[2] - 1] * 1e3) / 1e3
 
-    xi = np.array(np.meshgrid(interpX, interpY, interpZ))
-    xi = np.rollaxis(xi, 0, 4)
-    xi = xi.reshape((xi.size // 3, 3))
+    data = _interpolateSeparable(data, (interpX, interpY, interpZ), fillValue=fillValue)
 
-    if vectorDimension > 1:
-        field = np.zeros((*outputGridSize, vectorDimension))
-        for i in range(vectorDimension):
-            fieldTemp = interpolateTrilinear(data[:, :, :, i], inputGridSize, xi, fillValue=fillValue, tryGPU=tryGPU)
-            field[:, :, :, i] = fieldTemp.reshape((outputGridSize[1], outputGridSize[0], outputGridSize[2])).transpose(1, 0, 2)
-        data = field
-    else:
-        data = interpolateTrilinear(data, inputGridSize, xi, fillValue=fillValue, tryGPU=tryGPU)
-        data = data.reshape((outputGridSize[1], outputGridSize[0], outputGridSize[2])).transpose(1, 0, 2)
+    return data.astype(outputType, copy=False)
+
+def _interpolateSeparable(data, interpolatedCoordinates, fillValue=0, chunkSize=2**22):
+    """
+    Linear interpolation of 3D data (or of a 3D vector field) on an axis-aligned grid, applied as three successive 1D
+    interpolations. The output is computed by slabs along the first axis, so that only the input, the output and one
+    slab of intermediate values are in memory. The float32 arithmetic of the trilinear C interpolation is reproduced:
+    points whose floor index is outside the input grid take fillValue.
 
-    return data.astype(outputType)
+    Parameters
+    ----------
+    data : numpy array
+        3D data, or 4D data with the vector components along the last axis.
+    interpolatedCoordinates : sequence of 3 numpy arrays
+        voxel coordinates, in the input grid, of the output grid along each axis.
+    fillValue : scalar
+        interpolation value for locations outside the input voxel grid.
+    chunkSize : int
+        maximum number of intermediate values computed at once.
+
+    Returns
+    -------
+    numpy array
+        Interpolated data in float32.
+    """
+    indices = []
+    weights = []
+    valid = []
+    for axis, coordinates in enumerate(interpolatedCoordinates):
+        coordinates = np.asarray(coordinates, dtype=np.float32)
+        index = np.floor(coordinates).astype(np.int64)
+        valid.append((index >= 0) & (index < data.shape[axis]))
+        index = np.clip(index, 0, max(data.shape[axis] - 2, 0))
+        weight = (coordinates - index.astype(np.float32)) if data.shape[axis] > 1 else np.zeros_like(coordinates)
+        shape = [1] * data.ndim
+        shape[axis] = -1
+        indices.append((index, np.minimum(index + 1, data.shape[axis] - 1)))
+        weights.append(weight.reshape(shape))
+
+    outputShape = tuple(len(coordinates) for coordinates in interpolatedCoordinates) + data.shape[3:]
+    output = np.empty(outputShape, dtype=np.float32)
+
+    def interpolateAxis(values, axis, index, weight):
+        lower = np.take(values, index[0], axis=axis).astype(np.float32, copy=False)
+        upper = np.take(values, index[1], axis=axis).astype(np.float32, copy=False)
+        upper -= lower
+        upper *= weight
+        upper += lower
+        return upper
+
+    sliceSize = max(1, int(np.prod(data.shape[1:])), int(np.prod(outputShape[1:])))
+    slabSize = max(1, chunkSize // sliceSize)
+    for start in range(0, outputShape[0], slabSize):
+        stop = min(start + slabSize, outputShape[0])
+        slab = interpolateAxis(data, 0, (indices[0][0][start:stop], indices[0][1][start:stop]), weights[0][start:stop])
+        slab = interpolateAxis(slab, 1, indices[1], weights[1])
+        output[start:stop] = interpolateAxis(slab, 2, indices[2], weights[2])
+
+    output[~valid[0]] = fillValue
+    output[:, ~valid[1]] = fillValue
+    output[:, :, ~valid[2]] = fillValue
+
+    return output
 
 ## --------------------------------------------------------------------------------------
 def warp(data,field,spacing,fillValue=0,outputType=None, tryGPU=True):
@@ -11,6 +11,7 @@ from opentps.core.data.plan._rtPlan import RTPlan
 from opentps.core.data.images._ctImage import CTImage
 from opentps.core.io import mcsquareIO
 from opentps.core.processing.doseCalculation.protons.mcsquareDoseCalculator import MCsquareDoseCalculator
+from opentps.core.processing.doseCalculation.protons.mcsquareJobRunner import MCsquareJobRunner
 from opentps.core.utils.programSettings import ProgramSettings
 from pydicom.uid import generate_uid
 from opentps.core.data._rtStruct import ROIContour
@@ -50,11 +51,14 @@ class PlanDeliverySimulation():
         Whether or not to save the doses in the object
     deliveryModel : BeamDeliveryTimings
         Class for computing the delivery timings of the spots in the plan
+    nbMCsquareInstances : int
+        Number of MCsquare simulations of the phases running at once
     """
     def __init__(self, plan:RTPlan, CT4D: Optional[Dynamic3DSequence]= None, 
     model3D: Optional[Dynamic3DModel]= None, deliverySimulationFolderName: Optional[str] = None,
     overwriteOutsideROI: Optional[ROIContour] = None, MCsquareSimulationPath: Optional[str] = None,
-    saveDosesToFile:bool =True, saveDosesInObject:bool =False, deliveryModel = SimpleBeamDeliveryTimings):
+    saveDosesToFile:bool =True, saveDosesInObject:bool =False, deliveryModel = SimpleBeamDeliveryTimings,
+    nbMCsquareInstances:int =1):
         self.plan = plan
         self.CT4D = CT4D
         self.model3D = model3D
@@ -77,6 +81,7 @@ class PlanDeliverySimulation():
         self.saveDosesToFile=saveDosesToFile
         self.saveDosesInObject=saveDosesInObject
         self.deliveryModel = deliveryModel
+        self.nbMCsquareInstances = nbMCsquareInstances
 
     def simulate4DDose(self):
         """
@@ -96,17 +101,17 @@ class PlanDeliverySimulation():
         # Initialize reference dose on the MidP image
         dose_MidP = DoseImage().createEmptyDoseWithSameMetaData(self.model3D.midp)
         dose_MidP.name = "accumulated_4DD"
-        for p in range(len(self.CT4D)):
-            # Import CT
-            CT = self.CT4D.dyn3DImageList[p]
-            # MCsquare simulation
-            dose = self.mc2.computeDose(CT, self.plan)
-            dose.name = f"partial_4DD_p{p:03d}"
-            if self.saveDosesInObject: self.computedDoses.append(dose)
-            if self.saveDosesToFile: writeRTDose(dose, fx_dir, f"{dose.name}.dcm")
-            # Accumulate dose on MidP CT
-            df = self.model3D.deformationList[p]
-            dose_MidP._imageArray += df.deformImage(dose)._imageArray
+        # MCsquare simulations of all phases
+        with MCsquareJobRunner(self.mc2, self.nbMCsquareInstances) as runner:
+            futures = runner.submitJobs([(CT, self.plan) for CT in self.CT4D.dyn3DImageList])
+            for p, future in enumerate(futures):
+                dose = future.result()
+                dose.name = f"partial_4DD_p{p:03d}"
+                if self.saveDosesInObject: self.computedDoses.append(dose)
+                if self.saveDosesToFile: writeRTDose(dose, fx_dir, f"{dose.name}.dcm")
+                # Accumulate dose on MidP CT
+                df = self.model3D.deformationList[p]
+                dose_MidP._imageArray += df.deformImage(dose)._imageArray
         dose_MidP._imageArray /= len(self.CT4D)
 
         if self.saveDosesInObject: self.computedDoses.append(dose_MidP)
@@ -161,20 +166,18 @@ class PlanDeliverySimulation():
         dose_MidP = DoseImage().createEmptyDoseWithSameMetaData(self.model3D.midp)
         dose_MidP.name = f"accumulated_4DDD_starting_p{start_phase:03d}"
         
-        for p in range(len(self.CT4D)):
-            # Import CT
-            CT = self.CT4D.dyn3DImageList[p]
-            current_plan = plan_4DCT[plan_names[p]]
-
-            # Create MCsquare simulation
-            dose = self.mc2.computeDose(CT, current_plan)
-            dose.name = f"partial_4DDD_p{p:03d}"
-            if save_partial_doses:
-                # if self.saveDosesInObject: self.computedDoses.append(dose)
-                if self.saveDosesToFile: writeRTDose(dose, path_dose, f"{dose.name}.dcm")
-            # Accumulate dose on MidP CT
-            df = self.model3D.deformationList[p]
-            dose_MidP._imageArray += df.deformImage(dose)._imageArray
+        # MCsquare simulations of all phases
+        with MCsquareJobRunner(self.mc2, self.nbMCsquareInstances) as runner:
+            futures = runner.submitJobs([(self.CT4D.dyn3DImageList[p], plan_4DCT[plan_names[p]]) for p in range(len(self.CT4D))])
+            for p, future in enumerate(futures):
+                dose = future.result()
+                dose.name = f"partial_4DDD_p{p:03d}"
+                if save_partial_doses:
+                    # if self.saveDosesInObject: self.computedDoses.append(dose)
+                    if self.saveDosesToFile: writeRTDose(dose, path_dose, f"{dose.name}.dcm")
+                # Accumulate dose on MidP CT
+                df = self.model3D.deformationList[p]
+                dose_MidP._imageArray += df.deformImage(dose)._imageArray
 
         if self.saveDosesInObject: self.computedDoses.append(dose_MidP)
         if self.saveDosesToFile:
@@ -52,6 +52,8 @@ class RobustnessEval:
         It can be "Nominal", "Voxel wise minimum" or "Voxel wise maximum".
     doseDistribution : list[DoseImage]
         The dose distributions.
+    dvhEngine : DVHEngine
+        The engine computing the DVHs. It caches the ROI voxels of each dose grid.
     """
 
     # TODO: Add analysisStrategy class : DOSIMETRIC or ERROR SPACE
@@ -81,6 +83,9 @@ class RobustnessEval:
         self.doseDistributionType = ""
         self.doseDistribution = []
 
+        from opentps.core.data._dvhEngine import DVHEngine
+        self.dvhEngine = DVHEngine()
+
         #4D Mode
         self.Mode4D = self.Mode4D.DISABLED
         self.CreateReffrom4DCT = False
@@ -103,12 +108,9 @@ class RobustnessEval:
         contours : list[ROIContour]
             The list of contours.
         """
-        from opentps.core.data._dvh import DVH
         self.nominal.dose = dose
         self.nominal.dvh.clear()
-        for contour in contours:
-            myDVH = DVH(contour, self.nominal.dose)
-            self.nominal.dvh.append(myDVH)
+        self.nominal.dvh.extend(self.dvhEngine.computeDVHs(contours, [self.nominal.dose])[0])
         self.nominal.dose.imageArray = self.nominal.dose.imageArray.astype(np.float32)
 
     def addScenario(self, dose: DoseImage, contours: Union[ROIContour, ROIMask]):
@@ -122,18 +124,16 @@ class RobustnessEval:
         contours : list[ROIContour]
             The list of contours.
         """
-        from opentps.core.data._dvh import DVH
         scenario = RobustnessScenario()
         scenario.dose = dose
         scenario.sse = self.setupSystematicError
         scenario.sre = self.setupRandomError
         # Need to set patient to None for memory, est-ce que ca va poser probleme ?
         scenario.dose.patient = None
-        scenario.dvh.clear()     
+        scenario.dvh.clear()
         for contour in contours:
             contour.patient = None
-            myDVH = DVH(contour, scenario.dose)
-            scenario.dvh.append(myDVH)
+        scenario.dvh.extend(self.dvhEngine.computeDVHs(contours, [scenario.dose])[0])
         scenario.dose.imageArray = scenario.dose.imageArray.astype(
             np.float16)  # can be reduced to float16 because all metrics are already computed and it's only used for display
 
@@ -186,16 +186,12 @@ class RobustnessEval:
         contours : list[ROIContour]
             The list of contours.
         """
-        from opentps.core.data._dvh import DVH
+        dvhs = self.dvhEngine.computeDVHs(contours, [self.nominal.dose] + [scenario.dose for scenario in self.scenarios])
         self.nominal.dvh.clear()
-        for contour in contours:
-            myDVH = DVH(contour, self.nominal.dose)
-            self.nominal.dvh.append(myDVH)
-        for scenario in self.scenarios:
+        self.nominal.dvh.extend(dvhs[0])
+        for scenario, scenarioDVHs in zip(self.scenarios, dvhs[1:]):
             scenario.dvh.clear()
-            for contour in contours:
-                myDVH = DVH(contour, scenario.dose)
-                scenario.dvh.append(myDVH)
+            scenario.dvh.extend(scenarioDVHs)
 
     def computeTargetMSE(self, dose):
         """
@@ -514,18 +510,16 @@ class RobustnessEvalPhoton(RobustnessEval,RobustnessPhoton):
         contours : list[ROIContour]
             The list of contours.
         """
-        from opentps.core.data._dvh import DVH
         scenario = RobustnessScenario()
         scenario.dose = dose
         scenario.sse = self.scenariosConfig[scenarioIdx].sse
         scenario.sre = self.scenariosConfig[scenarioIdx].sre
         # Need to set patient to None for memory, est-ce que ca va poser probleme ?
         scenario.dose.patient = None
-        scenario.dvh.clear()     
+        scenario.dvh.clear()
         for contour in contours:
             contour.patient = None
-            myDVH = DVH(contour, scenario.dose)
-            scenario.dvh.append(myDVH)
+        scenario.dvh.extend(self.dvhEngine.computeDVHs(contours, [scenario.dose])[0])
         scenario.dose.imageArray = scenario.dose.imageArray.astype(
             np.float16)  # can be reduced to float16 because all metrics are already computed and it's only used for display
 
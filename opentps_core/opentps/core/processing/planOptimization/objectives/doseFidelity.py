@@ -44,12 +44,27 @@ class DoseFidelity(BaseFunc):
         If true, the GPU is used for the computation of the fidelity function and gradient.
     MKL_acceleration : bool (default: False)
         If true, the MKL is used for the computation of the fidelity function and gradient.
+    roiRows : np.ndarray
+        Voxels kept in the nominal beamlet matrix (union of the objective masks)
+    robustRoiRows : np.ndarray
+        Voxels kept in the scenario beamlet matrices (union of the robust objective masks)
     """
-    def __init__(self, plan, xSquare=True,GPU_acceleration=False,MKL_acceleration=False):
+    def __init__(self, plan, xSquare=True,GPU_acceleration=False,MKL_acceleration=False, roiRows=None, robustRoiRows=None):
         super(DoseFidelity, self).__init__()
         self.list = plan.planDesign.objectives.fidObjList
         self.xSquare = xSquare
-        self.beamlets = plan.planDesign.beamlets.toSparseMatrix()
+
+        # Only the voxels of the objectives are needed during the optimization
+        if roiRows is None:
+            roiRows = plan.planDesign.objectives.getRoiRows()
+        if robustRoiRows is None:
+            robustRoiRows = plan.planDesign.objectives.getRoiRows(robust=True)
+        self.roiRows = roiRows
+        self.robustRoiRows = robustRoiRows
+        for objective in self.list:
+            objective._updateRoiIndex(self.roiRows, self.robustRoiRows)
+
+        self.beamlets = sp.csc_matrix(plan.planDesign.beamlets.toSparseMatrix())[self.roiRows, :]
         self.GPU_acceleration = GPU_acceleration
         self.MKL_acceleration = MKL_acceleration
         if GPU_acceleration:
@@ -57,8 +72,8 @@ class DoseFidelity(BaseFunc):
             self.beamlets_gpu = cpx.scipy.sparse.csc_matrix(self.beamlets.astype(np.float32))
 
         if plan.planDesign.robustness.scenarios:
-            self.scenariosBL = [plan.planDesign.robustness.scenarios[s].toSparseMatrix() for s in
-                                range(len(plan.planDesign.robustness.scenarios))]
+            self.scenariosBL = [sp.csc_matrix(plan.planDesign.robustness.scenarios[s].toSparseMatrix())[self.robustRoiRows, :]
+                                for s in range(len(plan.planDesign.robustness.scenarios))]
         else:
             self.scenariosBL = []
 
@@ -110,81 +125,82 @@ class DoseFidelity(BaseFunc):
         else:
             doseTotal = sp.csc_matrix.dot(self.beamlets, weights)
         for objective in self.list:
+            maskVec = objective.roiIndex
             if objective.metric == objective.Metrics.DMAX:
                 if self.GPU_acceleration:
-                    f = np.mean(np.maximum(0, doseTotal[objective.maskVec].get() - objective.limitValue) ** 2)
+                    f = np.mean(np.maximum(0, doseTotal[maskVec].get() - objective.limitValue) ** 2)
                 else:
-                    f = np.mean(np.maximum(0, doseTotal[objective.maskVec] - objective.limitValue) ** 2)
+                    f = np.mean(np.maximum(0, doseTotal[maskVec] - objective.limitValue) ** 2)
             elif objective.metric == objective.Metrics.DMEAN:
                 if self.GPU_acceleration:
-                    f = np.maximum(0, np.mean(doseTotal[objective.maskVec].get(),
+                    f = np.maximum(0, np.mean(doseTotal[maskVec].get(),
                                               dtype=np.float32) - objective.limitValue) ** 2
                 else:
                     f = np.maximum(0,
-                                   np.mean(doseTotal[objective.maskVec], dtype=np.float32) - objective.limitValue) ** 2
+                                   np.mean(doseTotal[maskVec], dtype=np.float32) - objective.limitValue) ** 2
             elif objective.metric == objective.Metrics.DMIN:
                 if self.GPU_acceleration:
-                    f = np.mean(np.minimum(0, doseTotal[objective.maskVec].get() - objective.limitValue) ** 2)
+                    f = np.mean(np.minimum(0, doseTotal[maskVec].get() - objective.limitValue) ** 2)
                 else:
-                    f = np.mean(np.minimum(0, doseTotal[objective.maskVec] - objective.limitValue) ** 2)
+                    f = np.mean(np.minimum(0, doseTotal[maskVec] - objective.limitValue) ** 2)
             elif objective.metric == objective.Metrics.DUNIFORM:
                 if self.GPU_acceleration:
-                    f = np.mean((doseTotal[objective.maskVec].get() - objective.limitValue) ** 2)
+                    f = np.mean((doseTotal[maskVec].get() - objective.limitValue) ** 2)
                 else:
-                    f = np.mean((doseTotal[objective.maskVec] - objective.limitValue) ** 2)
+                    f = np.mean((doseTotal[maskVec] - objective.limitValue) ** 2)
             elif objective.metric == objective.Metrics.DFALLOFF:
                 if self.GPU_acceleration:
-                    f = np.mean(np.maximum(0, doseTotal[objective.maskVec].get() - objective.voxelwiseLimitValue) ** 2)
+                    f = np.mean(np.maximum(0, doseTotal[maskVec].get() - objective.voxelwiseLimitValue) ** 2)
                 else:
-                    f = np.mean(np.maximum(0, doseTotal[objective.maskVec] - objective.voxelwiseLimitValue) ** 2)
+                    f = np.mean(np.maximum(0, doseTotal[maskVec] - objective.voxelwiseLimitValue) ** 2)
             elif objective.metric == objective.Metrics.DVHMIN:
                 if self.GPU_acceleration:
-                    deviation = doseTotal[objective.maskVec].get() - objective.limitValue
-                    DAV = self._calcInverseDVH(objective.volume, doseTotal[objective.maskVec]).get()
-                    deviation[(doseTotal[objective.maskVec].get() > objective.limitValue) | (doseTotal[objective.maskVec].get() < DAV)] = 0
+                    deviation = doseTotal[maskVec].get() - objective.limitValue
+                    DAV = self._calcInverseDVH(objective.volume, doseTotal[maskVec]).get()
+                    deviation[(doseTotal[maskVec].get() > objective.limitValue) | (doseTotal[maskVec].get() < DAV)] = 0
                     f = np.mean(deviation**2)
                 else:
-                    deviation = doseTotal[objective.maskVec] - objective.limitValue
-                    DAV = self._calcInverseDVH(objective.volume, doseTotal[objective.maskVec])
-                    deviation[(doseTotal[objective.maskVec] > objective.limitValue) | (doseTotal[objective.maskVec] < DAV)] = 0
+                    deviation = doseTotal[maskVec] - objective.limitValue
+                    DAV = self._calcInverseDVH(objective.volume, doseTotal[maskVec])
+                    deviation[(doseTotal[maskVec] > objective.limitValue) | (doseTotal[maskVec] < DAV)] = 0
                     f = np.mean(deviation**2)   
             elif objective.metric == objective.Metrics.DVHMAX:
                 if self.GPU_acceleration:
-                    deviation = doseTotal[objective.maskVec].get() - objective.limitValue
-                    DAV = self._calcInverseDVH(objective.volume, doseTotal[objective.maskVec]).get()
-                    deviation[(doseTotal[objective.maskVec].get() < objective.limitValue) | (doseTotal[objective.maskVec].get() > DAV)] = 0
+                    deviation = doseTotal[maskVec].get() - objective.limitValue
+                    DAV = self._calcInverseDVH(objective.volume, doseTotal[maskVec]).get()
+                    deviation[(doseTotal[maskVec].get() < objective.limitValue) | (doseTotal[maskVec].get() > DAV)] = 0
                     f = np.mean(deviation**2)
                 else:
-                    deviation = doseTotal[objective.maskVec] - objective.limitValue
-                    DAV = self._calcInverseDVH(objective.volume, doseTotal[objective.maskVec])
-                    deviation[(doseTotal[objective.maskVec] < objective.limitValue) | (doseTotal[objective.maskVec] > DAV)] = 0
+                    deviation = doseTotal[maskVec] - objective.limitValue
+                    DAV = self._calcInverseDVH(objective.volume, doseTotal[maskVec])
+                    deviation[(doseTotal[maskVec] < objective.limitValue) | (doseTotal[maskVec] > DAV)] = 0
                     f = np.mean(deviation**2)
             elif objective.metric == objective.Metrics.EUDMAX:
                 if self.GPU_acceleration:
-                    DVH_a = np.mean(doseTotal[objective.maskVec].get() ** objective.EUDa) ** (1/objective.EUDa)
+                    DVH_a = np.mean(doseTotal[maskVec].get() ** objective.EUDa) ** (1/objective.EUDa)
                     f = max(0, DVH_a - objective.limitValue) ** 2
                 else:
-                    DVH_a = np.mean(doseTotal[objective.maskVec] ** objective.EUDa) ** (1/objective.EUDa)
+                    DVH_a = np.mean(doseTotal[maskVec] ** objective.EUDa) ** (1/objective.EUDa)
                     f = max(0, DVH_a - objective.limitValue) ** 2
             elif objective.metric == objective.Metrics.EUDMIN:
                 if self.GPU_acceleration:
-                    DVH_a = np.mean(doseTotal[objective.maskVec].get() ** objective.EUDa) ** (1/objective.EUDa)
+                    DVH_a = np.mean(doseTotal[maskVec].get() ** objective.EUDa) ** (1/objective.EUDa)
                     f = min(0, DVH_a - objective.limitValue) ** 2
                 else:
-                    DVH_a = np.mean(doseTotal[objective.maskVec] ** objective.EUDa) ** (1/objective.EUDa)
+                    DVH_a = np.mean(doseTotal[maskVec] ** objective.EUDa) ** (1/objective.EUDa)
                     f = min(0, DVH_a - objective.limitValue) ** 2
             elif objective.metric == objective.Metrics.EUDUNIFORM:
                 if self.GPU_acceleration:
-                    DVH_a = np.mean(doseTotal[objective.maskVec].get() ** objective.EUDa) ** (1/objective.EUDa)
+                    DVH_a = np.mean(doseTotal[maskVec].get() ** objective.EUDa) ** (1/objective.EUDa)
                     f = (DVH_a - objective.limitValue) ** 2
                 else:
-                    DVH_a = np.mean(doseTotal[objective.maskVec] ** objective.EUDa) ** (1/objective.EUDa)
+                    DVH_a = np.mean(doseTotal[maskVec] ** objective.EUDa) ** (1/objective.EUDa)
                     f = (DVH_a - objective.limitValue) ** 2   
             elif objective.metric == objective.Metrics.DFALLOFF:
                 if self.GPU_acceleration:
-                    f = np.mean(np.maximum(0, doseTotal[objective.maskVec].get() - objective.voxelwiseLimitValue) ** 2)
+                    f = np.mean(np.maximum(0, doseTotal[maskVec].get() - objective.voxelwiseLimitValue) ** 2)
                 else:
-                    f = np.mean(np.maximum(0, doseTotal[objective.maskVec] - objective.voxelwiseLimitValue) ** 2)
+                    f = np.mean(np.maximum(0, doseTotal[maskVec] - objective.voxelwiseLimitValue) ** 2)
             else:
                 raise Exception(objective.metric + ' is not supported as an objective metric')
             if not objective.robust:
@@ -232,39 +248,40 @@ class DoseFidelity(BaseFunc):
             for objective in self.list:
                 if not objective.robust:
                     continue
+                maskVec = objective.robustRoiIndex
 
                 if objective.metric == objective.Metrics.DMAX:
-                    f = np.mean(np.maximum(0, doseTotal[objective.maskVec] - objective.limitValue) ** 2)
+                    f = np.mean(np.maximum(0, doseTotal[maskVec] - objective.limitValue) ** 2)
                 elif objective.metric == objective.Metrics.DMEAN:
                     f = np.maximum(0,
-                                   np.mean(doseTotal[objective.maskVec], dtype=np.float32) - objective.limitValue) ** 2
+                                   np.mean(doseTotal[maskVec], dtype=np.float32) - objective.limitValue) ** 2
                 elif objective.metric == objective.Metrics.DMIN:
-                    f = np.mean(np.minimum(0, doseTotal[objective.maskVec] - objective.limitValue) ** 2)
+                    f = np.mean(np.minimum(0, doseTotal[maskVec] - objective.limitValue) ** 2)
                 elif objective.metric == objective.Metrics.DUNIFORM:
-                    f = np.mean((doseTotal[objective.maskVec] - objective.limitValue) ** 2)
+                    f = np.mean((doseTotal[maskVec] - objective.limitValue) ** 2)
                 elif objective.metric == objective.Metrics.DFALLOFF:
-                    f = np.mean(np.maximum(0, doseTotal[objective.maskVec] - objective.voxelwiseLimitValue) ** 2)
+                    f = np.mean(np.maximum(0, doseTotal[maskVec] - objective.voxelwiseLimitValue) ** 2)
                 elif objective.metric == objective.Metrics.DVHMIN:
-                    deviation = doseTotal[objective.maskVec] - objective.limitValue
-                    DAV = self._calcInverseDVH(objective.volume, doseTotal[objective.maskVec])
-                    deviation[(doseTotal[objective.maskVec] > objective.limitValue) | (doseTotal[objective.maskVec] < DAV)] = 0
+                    deviation = doseTotal[maskVec] - objective.limitValue
+                    DAV = self._calcInverseDVH(objective.volume, doseTotal[maskVec])
+                    deviation[(doseTotal[maskVec] > objective.limitValue) | (doseTotal[maskVec] < DAV)] = 0
                     f = np.mean(deviation**2)
                 elif objective.metric == objective.Metrics.DVHMAX:
-                    deviation = doseTotal[objective.maskVec] - objective.limitValue
-                    DAV = self._calcInverseDVH(objective.volume, doseTotal[objective.maskVec])
-                    deviation[(doseTotal[objective.maskVec] < objective.limitValue) | (doseTotal[objective.maskVec] > DAV)] = 0
+                    deviation = doseTotal[maskVec] - objective.limitValue
+                    DAV = self._calcInverseDVH(objective.volume, doseTotal[maskVec])
+                    deviation[(doseTotal[maskVec] < objective.limitValue) | (doseTotal[maskVec] > DAV)] = 0
                     f = np.mean(deviation**2)
                 elif objective.metric == objective.Metrics.EUDMAX:
-                    DVH_a = np.mean(doseTotal[objective.maskVec] ** objective.EUDa) ** (1/objective.EUDa)
+                    DVH_a = np.mean(doseTotal[maskVec] ** objective.EUDa) ** (1/objective.EUDa)
                     f = max(0, DVH_a - objective.limitValue) ** 2
                 elif objective.metric == objective.Metrics.EUDMIN:
-                    DVH_a = np.mean(doseTotal[objective.maskVec] ** objective.EUDa) ** (1/objective.EUDa)
+                    DVH_a = np.mean(doseTotal[maskVec] ** objective.EUDa) ** (1/objective.EUDa)
                     f = min(0, DVH_a - objective.limitValue) ** 2
                 elif objective.metric == objective.Metrics.EUDUNIFORM:
-                    DVH_a = np.mean(doseTotal[objective.maskVec] ** objective.EUDa) ** (1/objective.EUDa)
+                    DVH_a = np.mean(doseTotal[maskVec] ** objective.EUDa) ** (1/objective.EUDa)
                     f = (DVH_a - objective.limitValue) ** 2
                 elif objective.metric == objective.Metrics.DFALLOFF:
-                    f = np.mean(np.maximum(0, doseTotal[objective.maskVec] - objective.voxelwiseLimitValue) ** 2)
+                    f = np.mean(np.maximum(0, doseTotal[maskVec] - objective.voxelwiseLimitValue) ** 2)
                 else:
                     raise Exception(objective.metric + ' is not supported as an objective metric')
 
@@ -364,17 +381,19 @@ class DoseFidelity(BaseFunc):
             if worstCase != -1 and objective.robust:
                 doseTotal = doseScenario
                 doseBL = doseScenarioBL
+                maskVec = objective.robustRoiIndex
             else:
                 doseTotal = doseNominal
                 doseBL = doseNominalBL
+                maskVec = objective.roiIndex
 
             if objective.metric == objective.Metrics.DMAX:
                 if self.GPU_acceleration:
-                    maskVec_gpu = cp.asarray(objective.maskVec)
+                    maskVec_gpu = cp.asarray(maskVec)
                     limitValue_gpu = cp.asarray(objective.limitValue)
                     f = cp.maximum(0, doseTotal[maskVec_gpu] - limitValue_gpu.astype(cp.float32))
                 else:
-                    f = np.maximum(0, doseTotal[objective.maskVec] - objective.limitValue)
+                    f = np.maximum(0, doseTotal[maskVec] - objective.limitValue)
 
                 if self.GPU_acceleration:
                     f = cpx.scipy.sparse.diags(f, format='csc')
@@ -382,20 +401,20 @@ class DoseFidelity(BaseFunc):
                     dfTot += objective.weight * (cpx.scipy.sparse.csr_matrix.mean(df, axis=0)).get()
                 elif self.MKL_acceleration:
                     f = sp.diags(f.astype(np.float32), format='csc')
-                    df = sparse_dot_mkl.dot_product_mkl(f, doseBL[objective.maskVec, :])
+                    df = sparse_dot_mkl.dot_product_mkl(f, doseBL[maskVec, :])
                     dfTot += objective.weight * sp.csr_matrix.mean(df, axis=0)
                 else:
-                    df = sp.csr_matrix.multiply(doseBL[:, objective.maskVec], f)
+                    df = sp.csr_matrix.multiply(doseBL[:, maskVec], f)
                     dfTot += objective.weight * sp.csr_matrix.mean(df, axis=1)
 
             elif objective.metric == objective.Metrics.DMEAN:
                 if self.GPU_acceleration:
-                    maskVec_gpu = cp.asarray(objective.maskVec)
+                    maskVec_gpu = cp.asarray(maskVec)
                     limitValue_gpu = cp.asarray(objective.limitValue)
                     f = cp.maximum(0, cp.mean(doseTotal[maskVec_gpu], dtype=cp.float32) - limitValue_gpu.astype(
                         cp.float32))
                 else:
-                    f = np.maximum(0, np.mean(doseTotal[objective.maskVec],
+                    f = np.maximum(0, np.mean(doseTotal[maskVec],
                                               dtype=np.float32) - objective.limitValue)
 
                 if self.GPU_acceleration:
@@ -408,20 +427,20 @@ class DoseFidelity(BaseFunc):
                             f))  # inconsistent behaviour when multiplied by scalar ?cupy/_compressed
                         dfTot += objective.weight * (cpx.scipy.sparse.csr_matrix.mean(df, axis=1)).get().T
                 elif self.MKL_acceleration:
-                    df = sp.csr_matrix.multiply(doseBL[objective.maskVec, :], f)
+                    df = sp.csr_matrix.multiply(doseBL[maskVec, :], f)
                     dfTot += objective.weight * sp.csr_matrix.mean(df, axis=0)
                 else:
-                    df = sp.csr_matrix.multiply(doseBL[:, objective.maskVec], f)
+                    df = sp.csr_matrix.multiply(doseBL[:, maskVec], f)
                     dfTot += objective.weight * sp.csr_matrix.mean(df, axis=1)
 
             elif objective.metric == objective.Metrics.DMIN:
                 if self.GPU_acceleration:
-                    maskVec_gpu = cp.asarray(objective.maskVec)
+                    maskVec_gpu = cp.asarray(maskVec)
                     limitValue_gpu = cp.asarray(objective.limitValue)
                     f = cp.minimum(0, doseTotal[maskVec_gpu] - limitValue_gpu.astype(cp.float32))
 
                 else:
-                    f = np.minimum(0, doseTotal[objective.maskVec] - objective.limitValue)
+                    f = np.minimum(0, doseTotal[maskVec] - objective.limitValue)
 
                 if self.GPU_acceleration:
                     f = cpx.scipy.sparse.diags(f, format='csc')
@@ -429,20 +448,20 @@ class DoseFidelity(BaseFunc):
                     dfTot += objective.weight * (cpx.scipy.sparse.csr_matrix.mean(df, axis=0)).get()
                 elif self.MKL_acceleration:
                     f = sp.diags(f.astype(np.float32), format='csc')
-                    df = sparse_dot_mkl.dot_product_mkl(f, doseBL[objective.maskVec, :])
+                    df = sparse_dot_mkl.dot_product_mkl(f, doseBL[maskVec, :])
                     dfTot += objective.weight * sp.csr_matrix.mean(df, axis=0)
                 else:
-                    df = sp.csr_matrix.multiply(doseBL[:, objective.maskVec], f)
+                    df = sp.csr_matrix.multiply(doseBL[:, maskVec], f)
                     dfTot += objective.weight * sp.csr_matrix.mean(df, axis=1)
 
             elif objective.metric == objective.Metrics.DUNIFORM:
                 if self.GPU_acceleration:
-                    maskVec_gpu = cp.asarray(objective.maskVec)
+                    maskVec_gpu = cp.asarray(maskVec)
                     limitValue_gpu = cp.asarray(objective.limitValue)
                     f = doseTotal[maskVec_gpu] - limitValue_gpu.astype(cp.float32)
 
                 else:
-                    f = doseTotal[objective.maskVec] - objective.limitValue
+                    f = doseTotal[maskVec] - objective.limitValue
 
                 if self.GPU_acceleration:
                     f = cpx.scipy.sparse.diags(f, format='csc')
@@ -450,20 +469,20 @@ class DoseFidelity(BaseFunc):
                     dfTot += objective.weight * (cpx.scipy.sparse.csr_matrix.mean(df, axis=0)).get()
                 elif self.MKL_acceleration:
                     f = sp.diags(f.astype(np.float32), format='csc')
-                    df = sparse_dot_mkl.dot_product_mkl(f, doseBL[objective.maskVec, :])
+                    df = sparse_dot_mkl.dot_product_mkl(f, doseBL[maskVec, :])
                     dfTot += objective.weight * sp.csr_matrix.mean(df, axis=0)
                 else:
-                    df = sp.csr_matrix.multiply(doseBL[:, objective.maskVec], f)
+                    df = sp.csr_matrix.multiply(doseBL[:, maskVec], f)
                     dfTot += objective.weight * sp.csr_matrix.mean(df, axis=1)
 
             elif objective.metric == objective.Metrics.DFALLOFF:
                 if self.GPU_acceleration:
-                    maskVec_gpu = cp.asarray(objective.maskVec)
+                    maskVec_gpu = cp.asarray(maskVec)
                     limitValue_gpu = cp.asarray(objective.voxelwiseLimitValue).astype(cp.float32)
                     f = cp.maximum(0, doseTotal[maskVec_gpu] - limitValue_gpu)
 
                 else:
-                    f = np.maximum(0, doseTotal[objective.maskVec] - objective.voxelwiseLimitValue)
+                    f = np.maximum(0, doseTotal[maskVec] - objective.voxelwiseLimitValue)
 
                 if self.GPU_acceleration:
                     f = cpx.scipy.sparse.diags(f, format='csc')
@@ -471,22 +490,22 @@ class DoseFidelity(BaseFunc):
                     dfTot += objective.weight * (cpx.scipy.sparse.csr_matrix.mean(df, axis=0)).get()
                 elif self.MKL_acceleration:
                     f = sp.diags(f.astype(np.float32), format='csc')
-                    df = sparse_dot_mkl.dot_product_mkl(f, doseBL[objective.maskVec, :])
+                    df = sparse_dot_mkl.dot_product_mkl(f, doseBL[maskVec, :])
                     dfTot += objective.weight * sp.csr_matrix.mean(df, axis=0)
                 else:
-                    df = sp.csr_matrix.multiply(doseBL[:, objective.maskVec], f)
+                    df = sp.csr_matrix.multiply(doseBL[:, maskVec], f)
                     dfTot += objective.weight * sp.csr_matrix.mean(df, axis=1)
 
             elif objective.metric == objective.Metrics.DVHMIN:
-                d_ref = self._calcInverseDVH(objective.volume, doseTotal[objective.maskVec])
+                d_ref = self._calcInverseDVH(objective.volume, doseTotal[maskVec])
                 if self.GPU_acceleration:
-                    maskVec_gpu = cp.asarray(objective.maskVec)
+                    maskVec_gpu = cp.asarray(maskVec)
                     limitValue_gpu = cp.asarray(objective.limitValue)
                     f = cp.minimum(0, doseTotal[maskVec_gpu] - limitValue_gpu.astype(cp.float32))
                     f[doseTotal[maskVec_gpu] < d_ref] = 0
                 else:
-                    f = np.minimum(0, doseTotal[objective.maskVec] - objective.limitValue)
-                    f[doseTotal[objective.maskVec] < d_ref] = 0
+                    f = np.minimum(0, doseTotal[maskVec] - objective.limitValue)
+                    f[doseTotal[maskVec] < d_ref] = 0
 
 
                 if self.GPU_acceleration:
@@ -495,45 +514,45 @@ class DoseFidelity(BaseFunc):
                     dfTot += objective.weight * (cpx.scipy.sparse.csr_matrix.mean(df, axis=0)).get()
                 elif self.MKL_acceleration:
                     f = sp.diags(f.astype(np.float32), format='csc')
-                    df = sparse_dot_mkl.dot_product_mkl(f, doseBL[objective.maskVec, :])
+                    df = sparse_dot_mkl.dot_product_mkl(f, doseBL[maskVec, :])
                     dfTot += objective.weight * sp.csr_matrix.mean(df, axis=0)
                 else:
-                    df = sp.csr_matrix.multiply(doseBL[:, objective.maskVec], f)
+                    df = sp.csr_matrix.multiply(doseBL[:, maskVec], f)
                     dfTot += objective.weight * sp.csr_matrix.mean(df, axis=1)
 
             elif objective.metric == objective.Metrics.DVHMAX:
-                d_ref = self._calcInverseDVH(objective.volume, doseTotal[objective.maskVec])
+                d_ref = self._calcInverseDVH(objective.volume, doseTotal[maskVec])
                 if self.GPU_acceleration:
-                    maskVec_gpu = cp.asarray(objective.maskVec)
+                    maskVec_gpu = cp.asarray(maskVec)
                     limitValue_gpu = cp.asarray(objective.limitValue)
                     f = cp.maximum(0, doseTotal[maskVec_gpu] - limitValue_gpu.astype(cp.float32))
                     f[doseTotal[maskVec_gpu] > d_ref] = 0
                 else:
-                    f = np.maximum(0, doseTotal[objective.maskVec] - objective.limitValue)
-                    f[doseTotal[objective.maskVec] > d_ref] = 0
+                    f = np.maximum(0, doseTotal[maskVec] - objective.limitValue)
+                    f[doseTotal[maskVec] > d_ref] = 0
                 if self.GPU_acceleration:
                     f = cpx.scipy.sparse.diags(f, format='csc')
                     df = cp.sparse.csc_matrix.dot(f, doseBL[maskVec_gpu, :])
                     dfTot += objective.weight * (cpx.scipy.sparse.csr_matrix.mean(df, axis=0)).get()
                 elif self.MKL_acceleration:
                     f = sp.diags(f.astype(np.float32), format='csc')
-                    df = sparse_dot_mkl.dot_product_mkl(f, doseBL[objective.maskVec, :])
+                    df = sparse_dot_mkl.dot_product_mkl(f, doseBL[maskVec, :])
                     dfTot += objective.weight * sp.csr_matrix.mean(df, axis=0)
                 else:
-                    df = sp.csr_matrix.multiply(doseBL[:, objective.maskVec], f)
+                    df = sp.csr_matrix.multiply(doseBL[:, maskVec], f)
                     dfTot += objective.weight * sp.csr_matrix.mean(df, axis=1)
             elif objective.metric == objective.Metrics.EUDMAX:
                 if self.GPU_acceleration:
-                    maskVec_gpu = cp.asarray(objective.maskVec)
+                    maskVec_gpu = cp.asarray(maskVec)
                     limitValue_gpu = cp.asarray(objective.limitValue)
                     EUDa_gpu = cp.asarray(objective.EUDa)
                     power_dose = doseTotal[maskVec_gpu] ** EUDa_gpu
                     EUD_a = cp.mean(power_dose) ** (1/EUDa_gpu)
-                    f = (1 / len(maskVec_gpu)) ** ((1 - EUDa_gpu)/ EUDa_gpu) * cp.sum(power_dose) ** ((1 - EUDa_gpu) / EUDa_gpu) * doseTotal[maskVec_gpu] ** (EUDa_gpu - 1) * cp.maximum(0, EUD_a - limitValue_gpu)
+                    f = (1 / len(objective.maskVec)) ** ((1 - EUDa_gpu)/ EUDa_gpu) * cp.sum(power_dose) ** ((1 - EUDa_gpu) / EUDa_gpu) * doseTotal[maskVec_gpu] ** (EUDa_gpu - 1) * cp.maximum(0, EUD_a - limitValue_gpu)
                 else:
-                    power_dose = doseTotal[objective.maskVec] ** objective.EUDa
+                    power_dose = doseTotal[maskVec] ** objective.EUDa
                     EUD_a = np.mean(power_dose) ** (1/objective.EUDa)
-                    f = (1 / len(objective.maskVec)) ** ((1 - objective.EUDa)/ objective.EUDa) * np.sum(power_dose) ** ((1 - objective.EUDa) / objective.EUDa) * doseTotal[objective.maskVec] ** (objective.EUDa - 1) * max(0, EUD_a - objective.limitValue)
+                    f = (1 / len(objective.maskVec)) ** ((1 - objective.EUDa)/ objective.EUDa) * np.sum(power_dose) ** ((1 - objective.EUDa) / objective.EUDa) * doseTotal[maskVec] ** (objective.EUDa - 1) * max(0, EUD_a - objective.limitValue)
 
                 if self.GPU_acceleration:
                     f = cpx.scipy.sparse.diags(f, format='csc')
@@ -541,23 +560,23 @@ class DoseFidelity(BaseFunc):
                     dfTot += objective.weight * (cpx.scipy.sparse.csr_matrix.mean(df, axis=0)).get()
                 elif self.MKL_acceleration:
                     f = sp.diags(f.astype(np.float32), format='csc')
-                    df = sparse_dot_mkl.dot_product_mkl(f, doseBL[objective.maskVec, :])
+                    df = sparse_dot_mkl.dot_product_mkl(f, doseBL[maskVec, :])
                     dfTot += objective.weight * sp.csr_matrix.mean(df, axis=0)
                 else:
-                    df = sp.csr_matrix.multiply(doseBL[:, objective.maskVec], f)
+                    df = sp.csr_matrix.multiply(doseBL[:, maskVec], f)
                     dfTot += objective.weight * sp.csr_matrix.mean(df, axis=1)
             elif objective.metric == objective.Metrics.EUDMIN:
                 if self.GPU_acceleration:
-                    maskVec_gpu = cp.asarray(objective.maskVec)
+                    maskVec_gpu = cp.asarray(maskVec)
                     limitValue_gpu = cp.asarray(objective.limitValue)
                     EUDa_gpu = cp.asarray(objective.EUDa)
                     power_dose = doseTotal[maskVec_gpu] ** EUDa_gpu
                     EUD_a = cp.mean(power_dose) ** (1/EUDa_gpu)
-                    f = (1 / len(maskVec_gpu)) ** ((1 - EUDa_gpu)/ EUDa_gpu) * cp.sum(power_dose) ** ((1 - EUDa_gpu) / EUDa_gpu) * doseTotal[maskVec_gpu] ** (EUDa_gpu - 1) * cp.minimum(0, EUD_a - limitValue_gpu)
+                    f = (1 / len(objective.maskVec)) ** ((1 - EUDa_gpu)/ EUDa_gpu) * cp.sum(power_dose) ** ((1 - EUDa_gpu) / EUDa_gpu) * doseTotal[maskVec_gpu] ** (EUDa_gpu - 1) * cp.minimum(0, EUD_a - limitValue_gpu)
                 else:
-                    power_dose = doseTotal[objective.maskVec] ** objective.EUDa
+                    power_dose = doseTotal[maskVec] ** objective.EUDa
                     EUD_a = np.mean(power_dose) ** (1/objective.EUDa)
-                    f = (1 / len(objective.maskVec)) ** ((1 - objective.EUDa)/ objective.EUDa) * np.sum(power_dose) ** ((1 - objective.EUDa) / objective.EUDa) * doseTotal[objective.maskVec] ** (objective.EUDa - 1) * min(0,EUD_a - objective.limitValue)
+                    f = (1 / len(objective.maskVec)) ** ((1 - objective.EUDa)/ objective.EUDa) * np.sum(power_dose) ** ((1 - objective.EUDa) / objective.EUDa) * doseTotal[maskVec] ** (objective.EUDa - 1) * min(0,EUD_a - objective.limitValue)
 
                 if self.GPU_acceleration:
                     f = cpx.scipy.sparse.diags(f, format='csc')
@@ -565,23 +584,23 @@ class DoseFidelity(BaseFunc):
                     dfTot += objective.weight * (cpx.scipy.sparse.csr_matrix.mean(df, axis=0)).get()
                 elif self.MKL_acceleration:
                     f = sp.diags(f.astype(np.float32), format='csc')
-                    df = sparse_dot_mkl.dot_product_mkl(f, doseBL[objective.maskVec, :])
+                    df = sparse_dot_mkl.dot_product_mkl(f, doseBL[maskVec, :])
                     dfTot += objective.weight * sp.csr_matrix.mean(df, axis=0)
                 else:
-                    df = sp.csr_matrix.multiply(doseBL[:, objective.maskVec], f)
+                    df = sp.csr_matrix.multiply(doseBL[:, maskVec], f)
                     dfTot += objective.weight * sp.csr_matrix.mean(df, axis=1)
             elif objective.metric == objective.Metrics.EUDUNIFORM:
                 if self.GPU_acceleration:
-                    maskVec_gpu = cp.asarray(objective.maskVec)
+                    maskVec_gpu = cp.asarray(maskVec)
                     limitValue_gpu = cp.asarray(objective.limitValue)
                     EUDa_gpu = cp.asarray(objective.EUDa)
                     power_dose = doseTotal[maskVec_gpu] ** EUDa_gpu
                     EUD_a = cp.mean(power_dose) ** (1/EUDa_gpu)
-                    f = (1 / len(maskVec_gpu)) ** ((1 - EUDa_gpu)/ EUDa_gpu) * cp.sum(power_dose) ** ((1 - EUDa_gpu) / EUDa_gpu) * doseTotal[maskVec_gpu] ** (EUDa_gpu - 1) * (EUD_a - limitValue_gpu)
+                    f = (1 / len(objective.maskVec)) ** ((1 - EUDa_gpu)/ EUDa_gpu) * cp.sum(power_dose) ** ((1 - EUDa_gpu) / EUDa_gpu) * doseTotal[maskVec_gpu] ** (EUDa_gpu - 1) * (EUD_a - limitValue_gpu)
                 else:
-                    power_dose = doseTotal[objective.maskVec] ** objective.EUDa
+                    power_dose = doseTotal[maskVec] ** objective.EUDa
                     EUD_a = np.mean(power_dose) ** (1/objective.EUDa)
-                    f = (1 / len(objective.maskVec)) ** ((1 - objective.EUDa)/ objective.EUDa) * np.sum(power_dose) ** ((1 - objective.EUDa) / objective.EUDa) * doseTotal[objective.maskVec] ** (objective.EUDa - 1) * (EUD_a - objective.limitValue)
+                    f = (1 / len(objective.maskVec)) ** ((1 - objective.EUDa)/ objective.EUDa) * np.sum(power_dose) ** ((1 - objective.EUDa) / objective.EUDa) * doseTotal[maskVec] ** (objective.EUDa - 1) * (EUD_a - objective.limitValue)
 
                 if self.GPU_acceleration:
                     f = cpx.scipy.sparse.diags(f, format='csc')
@@ -589,10 +608,10 @@ class DoseFidelity(BaseFunc):
                     dfTot += objective.weight * (cpx.scipy.sparse.csr_matrix.mean(df, axis=0)).get()
                 elif self.MKL_acceleration:
                     f = sp.diags(f.astype(np.float32), format='csc')
-                    df = sparse_dot_mkl.dot_product_mkl(f, doseBL[objective.maskVec, :])
+                    df = sparse_dot_mkl.dot_product_mkl(f, doseBL[maskVec, :])
                     dfTot += objective.weight * sp.csr_matrix.mean(df, axis=0)
                 else:
-                    df = sp.csr_matrix.multiply(doseBL[:, objective.maskVec], f)
+                    df = sp.csr_matrix.multiply(doseBL[:, maskVec], f)
                     dfTot += objective.weight * sp.csr_matrix.mean(df, axis=1)
                     
             else:
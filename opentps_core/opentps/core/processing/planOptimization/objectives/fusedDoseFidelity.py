@@ -0,0 +1,479 @@
+import logging
+import os
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+
+import numpy as np
+
+from opentps.core.processing.planOptimization.objectives.doseFidelity import DoseFidelity
+
+logger = logging.getLogger(__name__)
+
+try:
+    import sparse_dot_mkl
+    sdm_available = True
+except:
+    sdm_available = False
+
+try:
+    import cupy as cp
+    import cupyx as cpx
+    cupy_available = True
+except:
+    cupy_available = False
+
+
+# Objectives of a group are evaluated together with segmented reductions
+_VOXELWISE, _DVH, _MEAN, _EUD = range(4)
+
+
+def _metricGroup(objective):
+    Metrics = objective.Metrics
+    if objective.metric in (Metrics.DMIN, Metrics.DMAX, Metrics.DUNIFORM, Metrics.DFALLOFF):
+        return _VOXELWISE
+    elif objective.metric in (Metrics.DVHMIN, Metrics.DVHMAX):
+        return _DVH
+    elif objective.metric == Metrics.DMEAN:
+        return _MEAN
+    elif objective.metric in (Metrics.EUDMIN, Metrics.EUDMAX, Metrics.EUDUNIFORM):
+        return _EUD
+    raise Exception(str(objective.metric) + ' is not supported as an objective metric')
+
+
+def _metricBounds(objective):
+    """
+    Bounds applied to the deviation from the limit value: (0, inf) penalizes overdosage, (-inf, 0) underdosage
+    """
+    Metrics = objective.Metrics
+    if objective.metric in (Metrics.DMAX, Metrics.DFALLOFF, Metrics.DVHMAX, Metrics.DMEAN, Metrics.EUDMAX):
+        return 0., np.inf
+    elif objective.metric in (Metrics.DMIN, Metrics.DVHMIN, Metrics.EUDMIN):
+        return -np.inf, 0.
+    return -np.inf, np.inf
+
+
+class FidelityTerms:
+    """
+    Compiled evaluation of a list of fidelity objectives on a ROI-restricted dose vector.
+    The voxels of all objectives are concatenated once. Objectives sharing a metric type are grouped and evaluated
+    with segmented reductions, which gives the objective values and the voxel residuals of the gradient in one pass.
+
+    Attributes
+    ----------
+    objectives : list
+        Objectives, sorted by metric group
+    robust : np.ndarray
+        True for the robust objectives (same order as objectives)
+    xp : module
+        Array module (numpy or cupy) holding the data
+    """
+    def __init__(self, objectives, indexAttribute='roiIndex', xp=np):
+        self.xp = xp
+        groups = [_metricGroup(objective) for objective in objectives]
+        order = np.argsort(groups, kind='stable')
+        self.objectives = [objectives[i] for i in order]
+        groups = np.array(groups, dtype=np.int64)[order]
+        self.robust = np.array([objective.robust for objective in self.objectives], dtype=bool)
+
+        indices = [np.asarray(getattr(objective, indexAttribute), dtype=np.int64) for objective in self.objectives]
+        counts = np.array([len(index) for index in indices], dtype=np.int64)
+        starts = np.concatenate(([0], np.cumsum(counts)))
+        segments = np.repeat(np.arange(len(self.objectives)), counts)
+
+        limits = []
+        for objective, count in zip(self.objectives, counts):
+            if objective.metric == objective.Metrics.DFALLOFF:
+                limits.append(np.asarray(objective.voxelwiseLimitValue, dtype=np.float32))
+            else:
+                limits.append(np.full(count, objective.limitValue, dtype=np.float32))
+
+        bounds = np.array([_metricBounds(objective) for objective in self.objectives], dtype=np.float64).reshape(-1, 2)
+        EUDa = np.array([objective.EUDa if objective.EUDa is not None else 1. for objective in self.objectives],
+                        dtype=np.float64)
+
+        # DVH: voxels of each objective and position of the dose at the objective volume in their sorted dose
+        self._dvhBlocks = []
+        dvhSigns = []
+        for objective, start, count, group in zip(self.objectives, starts, counts, groups):
+            if group != _DVH:
+                continue
+            self._dvhBlocks.append((int(start), int(start + count), min(int((1 - objective.volume) * count), max(count - 1, 0))))
+            dvhSigns.append(1. if objective.metric == objective.Metrics.DVHMAX else -1.)
+
+        # (first objective, last objective, first voxel, last voxel) of each group
+        self._groups = []
+        self._segmentStarts = []
+        for group in range(4):
+            objectiveIDs = np.flatnonzero(groups == group)
+            if len(objectiveIDs) == 0:
+                self._groups.append(None)
+                self._segmentStarts.append(None)
+            else:
+                o0, o1 = int(objectiveIDs[0]), int(objectiveIDs[-1]) + 1
+                self._groups.append((o0, o1, int(starts[o0]), int(starts[o1])))
+                nonEmpty = counts[o0:o1] > 0
+                self._segmentStarts.append((xp.asarray(starts[o0:o1][nonEmpty] - starts[o0]), xp.asarray(nonEmpty)))
+
+        self._index = xp.asarray(np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64))
+        self._segments = xp.asarray(segments)
+        self._limits = xp.asarray(np.concatenate(limits) if limits else np.zeros(0, dtype=np.float32))
+        self._lower = xp.asarray(bounds[:, 0].astype(np.float32)[segments])
+        self._upper = xp.asarray(bounds[:, 1].astype(np.float32)[segments])
+        self._counts = xp.asarray(counts.astype(np.float64))
+        self._weights = xp.asarray(np.array([objective.weight for objective in self.objectives], dtype=np.float64))
+        self._objectiveLimits = xp.asarray(np.array([objective.limitValue if objective.limitValue is not None else 0.
+                                                     for objective in self.objectives], dtype=np.float64))
+        self._objectiveLower = xp.asarray(bounds[:, 0])
+        self._objectiveUpper = xp.asarray(bounds[:, 1])
+        self._EUDa = xp.asarray(EUDa)
+        self._voxelEUDa = xp.asarray(EUDa.astype(np.float32)[segments])
+        self._gridSizes = xp.asarray(np.array([len(objective.maskVec) for objective in self.objectives], dtype=np.float64))
+        self._dvhSigns = xp.asarray(np.array(dvhSigns, dtype=np.float32))
+
+    def __len__(self):
+        return len(self.objectives)
+
+    def evaluate(self, dose, residual=False):
+        """
+        Evaluate the objectives
+
+        Parameters
+        ----------
+        dose : array
+            ROI-restricted dose vector, or array of shape (nbScenarios, nbVoxels) to evaluate several scenarios
+            sharing the same voxels at once (on the device of the terms)
+        residual : bool
+            If True, the voxel contributions to the gradient are returned as well
+
+        Returns
+        -------
+        values : array
+            Weighted value of each objective (one row per scenario for a 2D dose)
+        contributions : array (only if residual is True)
+            Weighted derivative of the objectives with respect to the dose of each voxel of the concatenated masks
+        """
+        xp = self.xp
+        doses = dose[None, :] if dose.ndim == 1 else dose
+        nbDoses = doses.shape[0]
+        doseROI = doses[:, self._index]
+        values = xp.zeros((nbDoses, len(self.objectives)), dtype=np.float64)
+        contributions = xp.zeros(doseROI.shape, dtype=np.float32) if residual else None
+
+        for group, bounds in enumerate(self._groups):
+            if bounds is None:
+                continue
+            o0, o1, v0, v1 = bounds
+            d = doseROI[:, v0:v1]
+            segments = self._segments[v0:v1] - o0
+            counts = self._counts[o0:o1]
+            segmentStarts, nonEmpty = self._segmentStarts[group]
+
+            def segmentSum(weights):
+                # the voxels of an objective are contiguous: sum them for all doses at once
+                sums = xp.zeros((nbDoses, o1 - o0), dtype=np.float64)
+                if len(segmentStarts) > 0:
+                    sums[:, nonEmpty] = xp.add.reduceat(weights, segmentStarts, axis=1, dtype=np.float64)
+                return sums
+
+            if group in (_VOXELWISE, _DVH):
+                deviation = xp.minimum(xp.maximum(d - self._limits[v0:v1], self._lower[v0:v1]), self._upper[v0:v1])
+                if group == _DVH:
+                    dav = xp.stack([xp.partition(doseROI[:, s0:s1], kth, axis=1)[:, kth] if s1 > s0
+                                    else xp.zeros(nbDoses, dtype=doseROI.dtype) for s0, s1, kth in self._dvhBlocks], axis=1)
+                    deviation[self._dvhSigns[segments] * (d - dav[:, segments]) > 0] = 0
+                values[:, o0:o1] = segmentSum(deviation * deviation) / counts
+                if residual:
+                    contributions[:, v0:v1] = deviation * (self._weights[o0:o1] / counts)[segments]
+
+            elif group == _MEAN:
+                mean = segmentSum(d) / counts
+                deviation = xp.minimum(xp.maximum(mean - self._objectiveLimits[o0:o1], self._objectiveLower[o0:o1]),
+                                       self._objectiveUpper[o0:o1])
+                values[:, o0:o1] = deviation ** 2
+                if residual:
+                    contributions[:, v0:v1] = (deviation * self._weights[o0:o1] / counts)[:, segments]
+
+            else:
+                a = self._EUDa[o0:o1]
+                powerSum = segmentSum(d ** self._voxelEUDa[v0:v1])
+                EUD = (powerSum / counts) ** (1 / a)
+                deviation = xp.minimum(xp.maximum(EUD - self._objectiveLimits[o0:o1], self._objectiveLower[o0:o1]),
+                                       self._objectiveUpper[o0:o1])
+                values[:, o0:o1] = deviation ** 2
+                if residual:
+                    factor = (1 / self._gridSizes[o0:o1]) ** ((1 - a) / a) * powerSum ** ((1 - a) / a) * deviation \
+                             * self._weights[o0:o1] / counts
+                    contributions[:, v0:v1] = d ** (self._voxelEUDa[v0:v1] - 1) * factor[:, segments]
+
+        values *= self._weights
+        if dose.ndim == 1:
+            values = values[0]
+            contributions = contributions[0] if residual else None
+        if residual:
+            return values, contributions
+        return values
+
+    def residual(self, contributions, size, selection=None):
+        """
+        Accumulate the voxel contributions in a dose-sized residual vector
+
+        Parameters
+        ----------
+        contributions : array
+            Contributions returned by evaluate
+        size : int
+            Length of the dose vector
+        selection : np.ndarray
+            Objectives to include (same order as objectives), by default all
+
+        Returns
+        -------
+        residual : array
+            Residual vector r such that the gradient with respect to the weights is B^T r
+        """
+        xp = self.xp
+        if selection is not None:
+            contributions = contributions * xp.asarray(selection.astype(np.float32))[self._segments]
+        return xp.bincount(self._index, weights=contributions, minlength=size).astype(np.float32)
+
+
+class FusedDoseFidelity(DoseFidelity):
+    """
+    Dose fidelity objective evaluated with a compiled FidelityTerms engine. Inherits from DoseFidelity.
+    The objective value and the gradient residuals are computed in the same pass over the dose and the gradient needs a
+    single product B^T r per beamlet matrix. On GPU, the intermediate arrays stay on the device.
+    The error scenarios share the same voxels: their doses are computed in parallel in a single
+    (nbScenarios, nbVoxels) array and all scenarios are evaluated at once.
+
+    Attributes
+    ----------
+    nominalTerms : FidelityTerms
+        All objectives evaluated on the nominal dose
+    scenarioTerms : FidelityTerms
+        Robust objectives evaluated on the scenario doses
+    nbWorkers : int
+        Number of threads computing the scenario doses (CPU only), by default the number of CPUs
+    """
+    def __init__(self, plan, xSquare=True, GPU_acceleration=False, MKL_acceleration=False, roiRows=None,
+                 robustRoiRows=None, nbWorkers=None):
+        super(FusedDoseFidelity, self).__init__(plan, xSquare, GPU_acceleration, MKL_acceleration, roiRows=roiRows,
+                                                robustRoiRows=robustRoiRows)
+        self.xp = cp if self.GPU_acceleration else np
+        self.nbWorkers = nbWorkers if nbWorkers is not None else (os.cpu_count() or 1)
+
+        self.nominalTerms = FidelityTerms(self.list, 'roiIndex', self.xp)
+        self.scenarioTerms = FidelityTerms([objective for objective in self.list if objective.robust],
+                                           'robustRoiIndex', self.xp)
+        self.robust = len(self.scenarioTerms) > 0 and len(self.scenariosBL) > 0
+
+        self.scenariosBL_gpu = []
+        if self.GPU_acceleration and self.robust:
+            self.scenariosBL_gpu = [cpx.scipy.sparse.csc_matrix(scenarioBL.astype(np.float32))
+                                    for scenarioBL in self.scenariosBL]
+
+        self._lastEvaluation = None
+
+    def unload_blGPU(self):
+        self.scenariosBL_gpu = []
+        super(FusedDoseFidelity, self).unload_blGPU()
+
+    def computeFidelityFunction(self, x, returnWorstCase=False):
+        """
+        Computes the fidelity function.
+
+        Parameters
+        ----------
+        x : array
+            Weights
+        returnWorstCase : bool
+            If true, the worst case scenario is returned. If false, the nominal scenario is returned.
+
+        Returns
+        -------
+        fTot : float
+            Fidelity function value
+        worstCase : int (only if robust objectives are present)
+            Worst case scenario index (-1 for nominal)
+        """
+        fTot, worstCase = self._evaluate(x)[1:3]
+        if not returnWorstCase:
+            return fTot
+        return fTot, worstCase
+
+    def computeFidelityGradient(self, x):
+        """
+        Computes the fidelity gradient.
+
+        Parameters
+        ----------
+        x : array
+            Weights
+
+        Returns
+        -------
+        dfTot : array
+            Fidelity gradient
+        """
+        xp = self.xp
+        _, _, worstCase, contributions, worstDose = self._evaluate(x)
+
+        if worstCase == -1:
+            residual = self.nominalTerms.residual(contributions, self.beamlets.shape[0])
+        else:
+            residual = self.nominalTerms.residual(contributions, self.beamlets.shape[0],
+                                                  selection=~self.nominalTerms.robust)
+        dfTot = self._backProject(-1, residual)
+
+        if worstCase != -1:
+            _, scenarioContributions = self.scenarioTerms.evaluate(worstDose, residual=True)
+            residual = self.scenarioTerms.residual(scenarioContributions, self.scenariosBL[worstCase].shape[0])
+            dfTot = dfTot + self._backProject(worstCase, residual)
+
+        if self.xSquare:
+            dfTot = 4 * xp.asarray(x.astype(np.float32)) * dfTot
+        else:
+            dfTot = 2 * dfTot
+
+        if self.GPU_acceleration:
+            dfTot = dfTot.get()
+        return np.asarray(dfTot).astype(np.float64)
+
+    def _evaluate(self, x):
+        """
+        Evaluate all scenarios at x. The result of the last evaluation is kept since solvers usually request the value
+        and the gradient at the same point.
+        """
+        if self._lastEvaluation is not None and np.array_equal(x, self._lastEvaluation[0]):
+            return self._lastEvaluation
+
+        xp = self.xp
+        if self.xSquare:
+            weights = xp.asarray(np.square(x).astype(np.float32))
+        else:
+            weights = xp.asarray(x.astype(np.float32))
+
+        values, contributions = self.nominalTerms.evaluate(self._dose(-1, weights), residual=True)
+        robust = xp.asarray(self.nominalTerms.robust)
+        fTot = float(xp.sum(values[~robust]))
+
+        worstCase = -1
+        worstDose = None
+        if self.robust:
+            scenarioDoses = self._scenarioDoses(weights)
+            scenarioValues = xp.concatenate((xp.sum(values[robust])[None],
+                                             xp.sum(self.scenarioTerms.evaluate(scenarioDoses), axis=1)))
+            if self.GPU_acceleration:
+                scenarioValues = scenarioValues.get()
+            worstCase = int(np.argmax(scenarioValues)) - 1  # -1 for nominal
+            fTot += float(scenarioValues[worstCase + 1])
+            if worstCase != -1:
+                worstDose = scenarioDoses[worstCase]
+            self.savedWorstCase = (copy(x), worstCase)
+
+        self._lastEvaluation = (np.array(x, copy=True), fTot, worstCase, contributions, worstDose)
+        return self._lastEvaluation
+
+    def _scenarioDoses(self, weights):
+        """
+        Doses of all error scenarios, one row per scenario
+        """
+        doses = self.xp.empty((len(self.scenariosBL), len(self.robustRoiRows)), dtype=np.float32)
+
+        def computeDose(s):
+            doses[s] = self._dose(s, weights)
+
+        # Sparse products release the GIL. MKL is already multi-threaded.
+        if self.GPU_acceleration or self.MKL_acceleration or self.nbWorkers <= 1 or len(self.scenariosBL) <= 1:
+            for s in range(len(self.scenariosBL)):
+                computeDose(s)
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.nbWorkers, len(self.scenariosBL))) as executor:
+                list(executor.map(computeDose, range(len(self.scenariosBL))))
+
+        return doses
+
+    def _dose(self, scenario, weights):
+        if self.GPU_acceleration:
+            matrix = self.beamlets_gpu if scenario == -1 else self.scenariosBL_gpu[scenario]
+            return matrix.dot(weights)
+
+        matrix = self.beamlets if scenario == -1 else self.scenariosBL[scenario]
+        if self.MKL_acceleration:
+            return sparse_dot_mkl.dot_product_mkl(matrix, weights)
+        return matrix.dot(weights)
+
+    def _backProject(self, scenario, residual):
+        if self.GPU_acceleration:
+            matrix = self.beamlets_gpu if scenario == -1 else self.scenariosBL_gpu[scenario]
+            return matrix.T.dot(residual)
+
+        matrix = self.beamlets if scenario == -1 else self.scenariosBL[scenario]
+        if self.MKL_acceleration:
+            return sparse_dot_mkl.dot_product_mkl(matrix.T, residual)
+        return matrix.T.dot(residual)
+
+
+class FusedDoseFidelityTestCase(unittest.TestCase):
+    def _createPlan(self, nbScenarios=0, nbVoxels=2000, nbSpots=30):
+        import scipy.sparse as sp
+
+        from opentps.core.data import SparseBeamlets
+        from opentps.core.data.plan import ProtonPlan, ProtonPlanDesign, FidObjective
+
+        def randomBeamlets(seed):
+            beamlets = SparseBeamlets()
+            beamlets.setUnitaryBeamlets(sp.random(nbVoxels, nbSpots, density=0.05, format='csc', dtype=np.float32,
+                                                  random_state=seed))
+            return beamlets
+
+        plan = ProtonPlan()
+        plan.planDesign = ProtonPlanDesign()
+        plan.planDesign.beamlets = randomBeamlets(0)
+        plan.planDesign.robustness.scenarios = [randomBeamlets(s + 1) for s in range(nbScenarios)]
+
+        rng = np.random.default_rng(0)
+        for i, metric in enumerate(list(FidObjective.Metrics) * 2):
+            objective = FidObjective(metric=metric, limitValue=rng.uniform(0.05, 0.2), weight=rng.uniform(1, 10))
+            objective.robust = nbScenarios > 0 and i % 3 == 0
+            objective.volume = 0.5
+            objective.EUDa = 3.
+            start = rng.integers(0, nbVoxels // 2)
+            objective.maskVec = np.zeros(nbVoxels, dtype=bool)
+            objective.maskVec[start:start + rng.integers(20, 200)] = True
+            objective.voxelwiseLimitValue = rng.uniform(0.05, 0.2, objective.maskVec.sum()).astype(np.float32)
+            plan.planDesign.objectives.fidObjList.append(objective)
+
+        return plan
+
+    def testEquivalence(self):
+        plan = self._createPlan()
+        x = np.random.default_rng(1).uniform(0.5, 1.5, plan.planDesign.beamlets.shape[1])
+
+        reference = DoseFidelity(plan)
+        fused = FusedDoseFidelity(plan)
+
+        referenceGradient = reference.computeFidelityGradient(x)
+        self.assertAlmostEqual(fused.computeFidelityFunction(x) / reference.computeFidelityFunction(x), 1., places=4)
+        np.testing.assert_allclose(fused.computeFidelityGradient(x), referenceGradient, rtol=1e-3,
+                                   atol=1e-4 * np.abs(referenceGradient).max())
+
+    def testScenarioDoses(self):
+        plan = self._createPlan(nbScenarios=5)
+        x = np.random.default_rng(1).uniform(0.5, 1.5, plan.planDesign.beamlets.shape[1])
+        weights = np.square(x).astype(np.float32)
+
+        sequential = FusedDoseFidelity(plan, nbWorkers=1)
+        threaded = FusedDoseFidelity(plan, nbWorkers=4)
+        self.assertTrue(threaded.robust)
+
+        doses = threaded._scenarioDoses(weights)
+        self.assertEqual(doses.shape, (5, len(threaded.robustRoiRows)))
+        np.testing.assert_array_equal(doses, sequential._scenarioDoses(weights))
+        np.testing.assert_array_equal(doses[2], threaded._dose(2, weights))
+
+        reference = DoseFidelity(plan)
+        referenceValue, referenceWorstCase = reference.computeFidelityFunction(x, returnWorstCase=True)
+        value, worstCase = threaded.computeFidelityFunction(x, returnWorstCase=True)
+        self.assertEqual(worstCase, referenceWorstCase)
+        self.assertAlmostEqual(value / referenceValue, 1., places=4)
@@ -10,6 +10,7 @@ from opentps.core.data.plan._planProtonLayer import PlanProtonLayer
 from opentps.core.data.plan._rtPlan import RTPlan
 from opentps.core.processing.C_libraries.libRayTracing_wrapper import transport_spots_to_target, \
     transport_spots_inside_target
+from opentps.core.processing.C_libraries.multiBeamRayTracing import MultiBeamRayTracer, RayTracingCache, beamDirection
 from opentps.core.processing.rangeEnergy import energyToRange, rangeToEnergy
 
 logger = logging.getLogger(__name__)
@@ -43,32 +44,37 @@ class BeamInitializer:
         """
         Initialize the beam with spots and layers.
         """
+        spotGrid, direction = self._spotGridAtImageBorder()
 
+        # transport each spot until it reaches the target
+        transport_spots_to_target(self.rspImage, self.targetMask, spotGrid, direction)
+        minWET = self._removeSpotsOutsideTarget(spotGrid)
+
+        # raytracing of remaining spots to define energy layers
+        transport_spots_inside_target(self.rspImage, self.targetMask, spotGrid, direction, minWET, self.layerSpacing)
+        self._createLayers(spotGrid)
+
+    def _spotGridAtImageBorder(self):
         # generate hexagonal spot grid around isocenter
         spotGrid = self._defineHexagSpotGridAroundIsocenter()
-        numSpots = len(spotGrid["x"])
 
         # compute direction vector
-        u, v, w = 1e-10, 1.0, 1e-10  # BEV to 3D coordinates
-        [u, v, w] = self._rotateVector([u, v, w], math.radians(self.beam.gantryAngle), 'z')  # rotation for gantry angle
-        [u, v, w] = self._rotateVector([u, v, w], math.radians(self.beam.couchAngle), 'y')  # rotation for couch angle
+        u, v, w = beamDirection(self.beam.gantryAngle, self.beam.couchAngle)
 
         # prepare raytracing: translate initial positions at the CT image border
-        for s in range(numSpots):
-            translation = np.array([1.0, 1.0, 1.0])
-            translation[0] = (spotGrid["x"][s] - self.imgBordersX[int(u < 0)]) / u
-            translation[1] = (spotGrid["y"][s] - self.imgBordersY[int(v < 0)]) / v
-            translation[2] = (spotGrid["z"][s] - self.imgBordersZ[int(w < 0)]) / w
-            translation = translation.min()
-            spotGrid["x"][s] = spotGrid["x"][s] - translation * u
-            spotGrid["y"][s] = spotGrid["y"][s] - translation * v
-            spotGrid["z"][s] = spotGrid["z"][s] - translation * w
+        translation = np.stack([(np.array(spotGrid["x"]) - self.imgBordersX[int(u < 0)]) / u,
+                                (np.array(spotGrid["y"]) - self.imgBordersY[int(v < 0)]) / v,
+                                (np.array(spotGrid["z"]) - self.imgBordersZ[int(w < 0)]) / w]).min(axis=0)
+        spotGrid["x"] = (np.array(spotGrid["x"]) - translation * u).tolist()
+        spotGrid["y"] = (np.array(spotGrid["y"]) - translation * v).tolist()
+        spotGrid["z"] = (np.array(spotGrid["z"]) - translation * w).tolist()
 
-        # transport each spot until it reaches the target
-        transport_spots_to_target(self.rspImage, self.targetMask, spotGrid, [u, v, w])
+        return spotGrid, [u, v, w]
 
-        # remove spots that didn't reach the target
+    def _removeSpotsOutsideTarget(self, spotGrid):
+        # remove spots that didn't reach the target and return the minimum WET of the remaining spots
         minWET = 9999999
+        numSpots = len(spotGrid["x"])
         for s in range(numSpots - 1, -1, -1):
             if spotGrid["WET"][s] < 0:
                 spotGrid["BEVx"].pop(s)
@@ -82,10 +88,9 @@ class BeamInitializer:
                     s] += self.beam.rangeShifter.WET
                 if spotGrid["WET"][s] < minWET: minWET = spotGrid["WET"][s]
                 if self.layersToSpacingAlignment: minWET = round(minWET / self.layerSpacing) * self.layerSpacing
+        return minWET
 
-        # raytracing of remaining spots to define energy layers
-        transport_spots_inside_target(self.rspImage, self.targetMask, spotGrid, [u, v, w], minWET, self.layerSpacing)
-
+    def _createLayers(self, spotGrid):
         # process valid spots
         numSpots = len(spotGrid["x"])
         for s in range(numSpots):
@@ -138,31 +143,28 @@ class BeamInitializer:
         numSpotX = math.ceil(FOV / self.spotSpacing)
         numSpotY = math.ceil(FOV / (self.spotSpacing * math.cos(math.pi / 6)))
 
-        spotGrid = {"BEVx": [], "BEVy": [], "x": [], "y": [], "z": [], "WET": [], "EnergyLayers": []}
-
-        for i in range(numSpotX):
-            for j in range(numSpotY):
-                spot = {}
-
-                # coordinates in Beam-eye-view
-                spotGrid["BEVx"].append((i - round(numSpotX / 2) + (j % 2) * 0.5) * self.spotSpacing)
-                spotGrid["BEVy"].append((j - round(numSpotY / 2)) * self.spotSpacing * math.cos(math.pi / 6))
+        # coordinates in Beam-eye-view
+        i, j = np.meshgrid(np.arange(numSpotX), np.arange(numSpotY), indexing='ij')
+        BEVx = ((i - round(numSpotX / 2) + (j % 2) * 0.5) * self.spotSpacing).ravel()
+        BEVy = ((j - round(numSpotY / 2)) * self.spotSpacing * math.cos(math.pi / 6)).ravel()
 
-                # 3D coordinates
-                x, y, z = spotGrid["BEVx"][-1], 0, spotGrid["BEVy"][-1]
+        # 3D coordinates
+        x, y, z = BEVx, np.zeros(BEVx.shape), BEVy
 
-                # rotation for gantry angle (around Z axis)
-                [x, y, z] = self._rotateVector([x, y, z], math.radians(self.beam.gantryAngle), 'z')
+        # rotation for gantry angle (around Z axis)
+        [x, y, z] = self._rotateVector([x, y, z], math.radians(self.beam.gantryAngle), 'z')
 
-                # rotation for couch angle (around Y axis)
-                [x, y, z] = self._rotateVector([x, y, z], math.radians(self.beam.couchAngle), 'y')
+        # rotation for couch angle (around Y axis)
+        [x, y, z] = self._rotateVector([x, y, z], math.radians(self.beam.couchAngle), 'y')
 
-                # Dicom CT coordinates
-                spotGrid["x"].append(x + self.beam.isocenterPosition[0])
-                spotGrid["y"].append(y + self.beam.isocenterPosition[1])
-                spotGrid["z"].append(z + self.beam.isocenterPosition[2])
+        # Dicom CT coordinates
+        spotGrid = {"BEVx": BEVx.tolist(), "BEVy": BEVy.tolist(),
+                    "x": (x + self.beam.isocenterPosition[0]).tolist(),
+                    "y": (y + self.beam.isocenterPosition[1]).tolist(),
+                    "z": (z + self.beam.isocenterPosition[2]).tolist(),
+                    "WET": [], "EnergyLayers": []}
         return spotGrid
-    
+
     def _defineSquareSpotGridAroundIsocenter(self):
         FOV = 400  # max field size on IBA P+ is 30x40 cm
         numSpotX = math.ceil(FOV / self.spotSpacing)
@@ -216,6 +218,7 @@ class PlanInitializer:
         self.ct: CTImage = None
         self.plan: RTPlan = None
         self.targetMask: ROIMask = None
+        self.rayTracingCache = RayTracingCache()
 
         self._beamInitializer = BeamInitializer()
 
@@ -248,8 +251,28 @@ class PlanInitializer:
         self._beamInitializer.imgBordersY = imgBordersY
         self._beamInitializer.imgBordersZ = imgBordersZ
 
-        for beam in self.plan:
+        # the spots of all beams are transported together on the same RSP image
+        beams = list(self.plan)
+        spotGrids = []
+        directions = []
+        for beam in beams:
             beam.removeLayer(beam.layers)
 
             self._beamInitializer.beam = beam
-            self._beamInitializer.initializeBeam()
+            spotGrid, direction = self._beamInitializer._spotGridAtImageBorder()
+            spotGrids.append(spotGrid)
+            directions.append(direction)
+
+        rayTracer = MultiBeamRayTracer(rspImage, cache=self.rayTracingCache)
+        rayTracer.transportSpotsToTarget(roiDilated, spotGrids, directions)
+
+        minWETs = []
+        for beam, spotGrid in zip(beams, spotGrids):
+            self._beamInitializer.beam = beam
+            minWETs.append(self._beamInitializer._removeSpotsOutsideTarget(spotGrid))
+
+        rayTracer.transportSpotsInsideTarget(roiDilated, spotGrids, directions, minWETs, layerSpacing)
+
+        for beam, spotGrid in zip(beams, spotGrids):
+            self._beamInitializer.beam = beam
+            self._beamInitializer._createLayers(spotGrid)
@@ -1,11 +1,13 @@
 import logging
 import math
+import unittest
 from typing import Iterable
 
 import numpy as np
 import scipy.sparse as sp
 
 from opentps.core.processing.planOptimization.objectives.doseFidelity import DoseFidelity
+from opentps.core.processing.planOptimization.objectives.fusedDoseFidelity import FusedDoseFidelity
 
 try:
     import sparse_dot_mkl
@@ -53,6 +55,14 @@ try:
 except:
     cupy_available = False
 
+def _expandRows(matrix:csc_matrix, rows:np.ndarray, nbRows:int) -> csc_matrix:
+    """
+    Put the rows of a ROI-restricted matrix back at their place in a matrix of nbRows rows (without copying the values)
+    """
+    return csc_matrix((matrix.data, rows[matrix.indices].astype(matrix.indices.dtype), matrix.indptr),
+                      shape=(nbRows, matrix.shape[1]))
+
+
 class PlanOptimizer:
     """
     This class is used to optimize a plan.
@@ -79,6 +89,9 @@ class PlanOptimizer:
         - 'MKL-n' : use the MKL library for the optimization with n threads.
         - 'MKL-n-DEBUG' : use the MKL library for the optimization with n threads and the debug mode.
         - 'MKL-DEBUG' : use the MKL library for the optimization with the debug mode.
+    fusedObjectives : bool
+        If True, the objectives are evaluated with the fused engine (FusedDoseFidelity) instead of DoseFidelity. False
+        by default.
 
     """
     def __init__(self, plan:RTPlan, hardwareAcceleration:str=None, **kwargs):
@@ -95,6 +108,7 @@ class PlanOptimizer:
         # beamlet matrix
         self.GPU_acceleration = False
         self.MKL_acceleration = False
+        self.fusedObjectives = False
         if hardwareAcceleration is not None:
             if hardwareAcceleration == 'GPU':
                 self.use_GPU_acceleration()
@@ -216,47 +230,23 @@ class PlanOptimizer:
         """
         self.plan.planDesign.setScoringParameters()
 
-        # crop on ROI
-        if self.plan.planDesign.ROI_cropping == True:
-            roiObjectives = np.zeros(len(self.plan.planDesign.objectives.fidObjList[0].maskVec)).astype(bool)
-            roiRobustObjectives = np.zeros(len(self.plan.planDesign.objectives.fidObjList[0].maskVec)).astype(bool)
-        else : 
-            roiObjectives = np.ones(len(self.plan.planDesign.objectives.fidObjList[0].maskVec)).astype(bool)
-            roiRobustObjectives = np.ones(len(self.plan.planDesign.objectives.fidObjList[0].maskVec)).astype(bool)
-
-        robust = False
-        for objective in self.plan.planDesign.objectives.fidObjList:
-            if objective.robust:
-                robust = True
-                roiRobustObjectives = np.logical_or(roiRobustObjectives, objective.maskVec)
-            else:
-                roiObjectives = np.logical_or(roiObjectives, objective.maskVec)
-        roiObjectives = np.logical_or(roiObjectives, roiRobustObjectives)
+        # The optimization only uses the voxels of the objectives
+        self._roiRows = self.plan.planDesign.objectives.getRoiRows()
+        self._robustRoiRows = self.plan.planDesign.objectives.getRoiRows(robust=True)
 
-        if self.MKL_acceleration :
-            logger.info("Using MKL to create sparse beamlet matrix")
-            beamletMatrix = sparse_dot_mkl.dot_product_mkl(
-                sp.diags(roiObjectives.astype(np.float32), format='csc'), self.plan.planDesign.beamlets.toSparseMatrix())
-        else:
-            beamletMatrix = sp.csc_matrix.dot(sp.diags(roiObjectives.astype(np.float32), format='csc'),
-                                              self.plan.planDesign.beamlets.toSparseMatrix())
-
-        self.plan.planDesign.beamlets.setUnitaryBeamlets(beamletMatrix)
-
-        if robust:
-            for s in range(len(self.plan.planDesign.robustness.scenarios)):
-                if self.MKL_acceleration:
-                    print("Using MKL to create sparse beamlet matrix")
-                    beamletMatrix = sparse_dot_mkl.dot_product_mkl(
-                        sp.diags(roiRobustObjectives.astype(np.float32), format='csc'),
-                        self.plan.planDesign.robustness.scenarios[s].toSparseMatrix())
-                else:
-                    beamletMatrix = sp.csc_matrix.dot(
-                        sp.diags(roiRobustObjectives.astype(np.float32), format='csc'),
-                        self.plan.planDesign.robustness.scenarios[s].toSparseMatrix())
-                self.plan.planDesign.robustness.scenarios[s].setUnitaryBeamlets(beamletMatrix)
+        fidelityClass = FusedDoseFidelity if self.fusedObjectives else DoseFidelity
+        objectiveFunction = fidelityClass(self.plan, self.xSquared, self.GPU_acceleration, self.MKL_acceleration,
+                                          roiRows=self._roiRows, robustRoiRows=self._robustRoiRows)
+
+        # crop on ROI: the full grid matrices share the arrays of the ROI-restricted ones
+        if self.plan.planDesign.ROI_cropping == True:
+            beamlets = self.plan.planDesign.beamlets
+            beamlets.setUnitaryBeamlets(_expandRows(objectiveFunction.beamlets, self._roiRows, beamlets.shape[0]))
+            if len(self._robustRoiRows) > 0:
+                for s, scenario in enumerate(self.plan.planDesign.robustness.scenarios):
+                    scenario.setUnitaryBeamlets(_expandRows(objectiveFunction.scenariosBL[s], self._robustRoiRows,
+                                                            scenario.shape[0]))
 
-        objectiveFunction = DoseFidelity(self.plan, self.xSquared,self.GPU_acceleration,self.MKL_acceleration)
         self.functions.append(objectiveFunction)
 
     def computeDose(self):
@@ -576,7 +566,9 @@ class BoundConstraintsOptimizer(PlanOptimizer):
 
             self.functions = [] # to avoid a beamlet copy with different size
             self.plan.planDesign.beamlets.setUnitaryBeamlets(self.plan.planDesign.beamlets._sparseBeamlets[:, ind_to_keep])
-            objectiveFunction = DoseFidelity(self.plan, self.xSquared)
+            fidelityClass = FusedDoseFidelity if self.fusedObjectives else DoseFidelity
+            objectiveFunction = fidelityClass(self.plan, self.xSquared, roiRows=self._roiRows,
+                                              robustRoiRows=self._robustRoiRows)
             self.functions.append(objectiveFunction)
 
             # second optimization with lower bound = self.bounds[0]
@@ -633,4 +625,80 @@ class ARCPTPlanOptimizer(PlanOptimizer):
                 self.solver = sparcling.SPArCling()
         else:
             logger.error(
-                'Method {} is not implemented. Pick among ["FISTA","LS","MIP","SPArcling"]'.format(self.method))
\ No newline at end of file
+                'Method {} is not implemented. Pick among ["FISTA","LS","MIP","SPArcling"]'.format(self.method))
+
+
+class PlanOptimizerTestCase(unittest.TestCase):
+    def _createPlan(self):
+        from opentps.core.data import SparseBeamlets
+        from opentps.core.data.images import CTImage, ROIMask
+        from opentps.core.data.plan import ProtonPlanDesign, FidObjective
+
+        gridSize = (8, 8, 8)
+        nbVoxels = int(np.prod(gridSize))
+
+        def randomBeamlets(seed):
+            beamlets = SparseBeamlets()
+            beamlets.setUnitaryBeamlets(sp.random(nbVoxels, 12, density=0.3, format='csc', dtype=np.float32,
+                                                  random_state=seed))
+            beamlets.doseGridSize = gridSize
+            return beamlets
+
+        ct = CTImage(imageArray=np.zeros(gridSize), spacing=(2., 2., 2.))
+        target = ROIMask(imageArray=np.zeros(gridSize, dtype=bool), spacing=ct.spacing, name='target')
+        target.imageArray[2:5, 2:5, 2:5] = True
+        oar = ROIMask(imageArray=np.zeros(gridSize, dtype=bool), spacing=ct.spacing, name='oar')
+        oar.imageArray[5:7, 3:6, 1:4] = True
+
+        plan = ProtonPlan()
+        plan.planDesign = ProtonPlanDesign()
+        plan.planDesign.ct = ct
+        plan.planDesign.beamlets = randomBeamlets(0)
+        plan.planDesign.robustness.scenarios = [randomBeamlets(s + 1) for s in range(3)]
+        plan.planDesign.objectives.addFidObjective(target, FidObjective.Metrics.DMIN, 1., 10., robust=True)
+        plan.planDesign.objectives.addFidObjective(target, FidObjective.Metrics.DMAX, 1.05, 10.)
+        plan.planDesign.objectives.addFidObjective(oar, FidObjective.Metrics.DMEAN, 0.2, 1.)
+        return plan
+
+    def testRoiRows(self):
+        from opentps.core.processing.planOptimization.objectives.doseFidelity import DoseFidelity
+
+        plan = self._createPlan()
+        nominal = plan.planDesign.beamlets.toSparseMatrix().copy()
+        scenarios = [scenario.toSparseMatrix().copy() for scenario in plan.planDesign.robustness.scenarios]
+        nbVoxels = nominal.shape[0]
+        x0 = np.full(nominal.shape[1], 0.5)
+
+        optimizer = PlanOptimizer(plan)
+        optimizer.initializeFidObjectiveFunction()
+        restricted = optimizer.functions[0]
+        rows = optimizer._roiRows
+        robustRows = optimizer._robustRoiRows
+        self.assertLess(len(rows), nbVoxels)
+        self.assertLess(len(robustRows), len(rows))
+
+        # the full grid matrices are the ROI-cropped ones
+        self.assertEqual((_expandRows(restricted.beamlets, rows, nbVoxels)[rows] != nominal[rows]).nnz, 0)
+        outside = np.setdiff1d(np.arange(nbVoxels), rows)
+        self.assertEqual(plan.planDesign.beamlets.toSparseMatrix()[outside].nnz, 0)
+        self.assertEqual((plan.planDesign.beamlets.toSparseMatrix()[rows] != nominal[rows]).nnz, 0)
+        for scenario, matrix in zip(plan.planDesign.robustness.scenarios, scenarios):
+            self.assertEqual(scenario.toSparseMatrix().shape, matrix.shape)
+            self.assertEqual((scenario.toSparseMatrix()[robustRows] != matrix[robustRows]).nnz, 0)
+
+        restrictedValue = restricted.computeFidelityFunction(x0)
+        restrictedGradient = restricted.computeFidelityGradient(x0)
+        restrictedX = optimizer.solver.solve([restricted], x0)['sol']
+
+        # same optimization on the full matrices
+        plan.planDesign.beamlets.setUnitaryBeamlets(nominal)
+        for scenario, matrix in zip(plan.planDesign.robustness.scenarios, scenarios):
+            scenario.setUnitaryBeamlets(matrix)
+        full = DoseFidelity(plan, roiRows=np.arange(nbVoxels), robustRoiRows=np.arange(nbVoxels))
+        self.assertEqual(full.beamlets.shape, nominal.shape)
+
+        self.assertAlmostEqual(full.computeFidelityFunction(x0) / restrictedValue, 1., places=6)
+        np.testing.assert_allclose(full.computeFidelityGradient(x0), restrictedGradient, rtol=1e-5, atol=1e-7)
+        fullX = optimizer.solver.solve([full], x0)['sol']
+        np.testing.assert_allclose(nominal.dot(np.square(fullX))[rows], nominal.dot(np.square(restrictedX))[rows],
+                                   rtol=1e-4)
@@ -1,15 +1,23 @@
 import numpy as np
 from pydicom.uid import generate_uid
 import logging
+import multiprocessing as mp
+import unittest
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from multiprocessing.shared_memory import SharedMemory
 
-from opentps.core.processing.registration.registrationMorphons import RegistrationMorphons
+from opentps.core.processing.registration.registrationMorphons import RegistrationMorphons, MorphonsSession
 from opentps.core.data.images._deformation3D import Deformation3D
 
 
 logger = logging.getLogger(__name__)
 
+# approximate number of bytes used per voxel of the finest Morphons grid (complex filter responses of the fixed and
+# deformed images, equation system, velocity and certainty)
+_MORPHONS_BYTES_PER_VOXEL = 500
 
-def compute(CT4D, refIndex=0, baseResolution=2.5, nbProcesses=-1, tryGPU=True):
+
+def compute(CT4D, refIndex=0, baseResolution=2.5, nbProcesses=-1, tryGPU=True, nbWorkers=1, memoryBudget=None):
 
     """
     Compute mid-position image and corresponding deformations from a 4D image.
@@ -24,6 +32,12 @@ def compute(CT4D, refIndex=0, baseResolution=2.5, nbProcesses=-1, tryGPU=True):
         spacing of the highest registration resolution (i.e. spacing of the output deformation fields)
     nbProcesses : int
         number of processes to be used in Morphons registration (-1 = maximum number of processes)
+    nbWorkers : int
+        number of phases registered in parallel processes (-1 = number of CPUs). The phase images are passed to the
+        processes through shared memory.
+    memoryBudget : float
+        maximum memory (in bytes) used by the registrations running in parallel. It limits the number of workers.
+        If None, the number of workers is not limited.
 
     Returns
     -------
@@ -32,46 +46,169 @@ def compute(CT4D, refIndex=0, baseResolution=2.5, nbProcesses=-1, tryGPU=True):
     list
         List of deformations between MidP image and each phase of the 4D image
     """
+    images = CT4D.dyn3DImageList
+    nbWorkers = _numberOfWorkers(images[refIndex], len(images) - 1, baseResolution, nbWorkers, memoryBudget)
 
     averageField = Deformation3D()
 
     # perform registrations
-    motionFieldList = []
-
-    for i in range(len(CT4D.dyn3DImageList)):
-
-        if i == refIndex:
-            emptyField = Deformation3D()
-            motionFieldList.append(emptyField)
-        else:
-            logger.info('\nRegistering phase' + str(refIndex) + ' to phase' + str(i) + '...')
-            reg = RegistrationMorphons(CT4D.dyn3DImageList[i], CT4D.dyn3DImageList[refIndex], baseResolution=baseResolution, nbProcesses=nbProcesses, tryGPU=tryGPU)
-            motionFieldList.append(reg.compute())
-            if (max(averageField.gridSize) == 0):
-                averageField.initFromImage(motionFieldList[i])
-            averageField.setVelocityArray(averageField.velocity.imageArray + motionFieldList[i].velocity.imageArray)
+    motionFieldList = [None] * len(images)
+    motionFieldList[refIndex] = Deformation3D()
+
+    if nbWorkers > 1:
+        # several Morphons registrations run at once, they share the CPUs
+        if nbProcesses < 0:
+            nbProcesses = max(1, mp.cpu_count() // nbWorkers)
+        logger.info('Registering ' + str(len(images) - 1) + ' phases to phase' + str(refIndex) + ' with ' + str(nbWorkers) + ' workers...')
+
+        sharedImages = [_SharedImage(image) for image in images]
+        try:
+            with ProcessPoolExecutor(max_workers=nbWorkers) as executor:
+                futures = [executor.submit(_registerPhase, sharedImages[i], sharedImages[refIndex], i, baseResolution, nbProcesses, tryGPU)
+                           for i in range(len(images)) if i != refIndex]
+
+                for future in as_completed(futures):
+                    i, motionField = future.result()
+                    logger.info('Phase' + str(refIndex) + ' registered to phase' + str(i))
+                    motionFieldList[i] = motionField
+        finally:
+            for sharedImage in sharedImages:
+                sharedImage.unlink()
+
+        # the velocity fields are summed in phase order so that the result does not depend on the order of completion
+        for i in range(len(images)):
+            if i != refIndex:
+                _accumulateVelocity(averageField, motionFieldList[i])
+    else:
+        # the phases are the fixed images and are registered once, while the reference phase is the moving image of all
+        # registrations, so only the reference phase resampled at each scale is cached
+        with MorphonsSession(nbProcesses=nbProcesses, cacheFixed=False) as session:
+            for i in range(len(images)):
+                if i == refIndex:
+                    continue
+                logger.info('\nRegistering phase' + str(refIndex) + ' to phase' + str(i) + '...')
+                reg = RegistrationMorphons(images[i], images[refIndex], baseResolution=baseResolution, nbProcesses=nbProcesses, tryGPU=tryGPU, session=session)
+                motionFieldList[i] = reg.compute()
+                _accumulateVelocity(averageField, motionFieldList[i])
 
     motionFieldList[refIndex].initFromImage(averageField)
     averageField.setVelocityArray(averageField.velocity.imageArray / len(motionFieldList))
 
     # compute fields to midp
-    for i in range(len(CT4D.dyn3DImageList)):
-        motionFieldList[i].name = 'def ' + CT4D.dyn3DImageList[i].name
+    for i in range(len(images)):
+        motionFieldList[i].name = 'def ' + images[i].name
         motionFieldList[i].setVelocityArray(averageField.velocity.imageArray - motionFieldList[i].velocity.imageArray)
 
     # deform images
-    def3DImageList = []
-    for i in range(len(CT4D.dyn3DImageList)):
-        def3DImageList.append(motionFieldList[i].deformImage(CT4D.dyn3DImageList[i], fillValue='closest', tryGPU=tryGPU)._imageArray)
+    deformPhase = lambda i: motionFieldList[i].deformImage(images[i], fillValue='closest', tryGPU=tryGPU)._imageArray
+    if nbWorkers > 1:
+        with ThreadPoolExecutor(max_workers=nbWorkers) as executor:
+            def3DImageList = list(executor.map(deformPhase, range(len(images))))
+    else:
+        def3DImageList = [deformPhase(i) for i in range(len(images))]
 
     # invert fields (to have them from midp to phases)
-    for i in range(len(CT4D.dyn3DImageList)):
+    for i in range(len(images)):
         motionFieldList[i].displacement = None
         motionFieldList[i].setVelocityArray(-motionFieldList[i].velocity.imageArray)
 
     # compute MidP
-    midp = CT4D.dyn3DImageList[0].copy()
+    midp = images[0].copy()
     midp.UID = generate_uid()
     midp._imageArray = np.median(def3DImageList, axis=0)
-    
+
     return midp, motionFieldList
+
+
+def _accumulateVelocity(averageField, motionField):
+    if (max(averageField.gridSize) == 0):
+        averageField.initFromImage(motionField)
+    averageField.setVelocityArray(averageField.velocity.imageArray + motionField.velocity.imageArray)
+
+
+def _numberOfWorkers(image, nbRegistrations, baseResolution, nbWorkers, memoryBudget):
+    if nbWorkers < 0:
+        nbWorkers = mp.cpu_count()
+    nbWorkers = max(1, min(nbWorkers, nbRegistrations))
+
+    if memoryBudget is not None and nbWorkers > 1:
+        registrationGridSize = np.array(image.gridSize) * np.array(image.spacing) / baseResolution
+        registrationMemory = _MORPHONS_BYTES_PER_VOXEL * np.prod(registrationGridSize) + 4 * image.imageArray.nbytes
+        nbWorkers = max(1, min(nbWorkers, int(memoryBudget // registrationMemory)))
+        logger.info('Estimated memory per registration: ' + str(round(registrationMemory / 2**20)) + ' MB - ' + str(nbWorkers) + ' workers')
+
+    return nbWorkers
+
+
+class _SharedImage:
+    """
+    Image whose array is stored in a shared memory block. Only the name of the block is pickled to the workers.
+    """
+    def __init__(self, image):
+        self.imageClass = image.__class__
+        self.name = image.name
+        self.origin = image.origin
+        self.spacing = image.spacing
+        self.shape = image.imageArray.shape
+        self.dtype = image.imageArray.dtype
+
+        self._sharedMemory = SharedMemory(create=True, size=max(1, image.imageArray.nbytes))
+        np.ndarray(self.shape, dtype=self.dtype, buffer=self._sharedMemory.buf)[:] = image.imageArray
+        self.sharedMemoryName = self._sharedMemory.name
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_sharedMemory']
+        return state
+
+    def open(self):
+        """
+        Attach the shared memory block and return the image referencing it with the block. The image must be deleted
+        before closing the block.
+        """
+        sharedMemory = SharedMemory(name=self.sharedMemoryName)
+        imageArray = np.ndarray(self.shape, dtype=self.dtype, buffer=sharedMemory.buf)
+        return self.imageClass(imageArray=imageArray, name=self.name, origin=self.origin, spacing=self.spacing), sharedMemory
+
+    def unlink(self):
+        self._sharedMemory.close()
+        self._sharedMemory.unlink()
+
+
+def _registerPhase(phase, reference, phaseIndex, baseResolution, nbProcesses, tryGPU):
+    fixed, fixedMemory = phase.open()
+    moving, movingMemory = reference.open()
+    reg = RegistrationMorphons(fixed, moving, baseResolution=baseResolution, nbProcesses=nbProcesses, tryGPU=tryGPU)
+    del fixed, moving
+    try:
+        motionField = reg.compute()
+    finally:
+        del reg
+        for sharedMemory in (fixedMemory, movingMemory):
+            try:
+                sharedMemory.close()
+            except BufferError:
+                # the images are still referenced by the traceback of a failed registration
+                pass
+
+    return phaseIndex, motionField
+
+
+class MidPositionTestCase(unittest.TestCase):
+    def testParallelRegistrations(self):
+        from opentps.core.data.images import CTImage
+        from opentps.core.data.dynamicData._dynamic3DSequence import Dynamic3DSequence
+
+        # sphere moving along z
+        x, y, z = np.meshgrid(*[np.arange(24)] * 3, indexing='ij')
+        images = [CTImage(imageArray=np.where((x - 12) ** 2 + (y - 12) ** 2 + (z - 10 - 2 * p) ** 2 < 36, 0., -1000.),
+                          spacing=(2.5, 2.5, 2.5), name='phase' + str(p)) for p in range(3)]
+        CT4D = Dynamic3DSequence(dyn3DImageList=images)
+
+        midp, fields = compute(CT4D, baseResolution=2.5, tryGPU=False, nbWorkers=1)
+        parallelMidp, parallelFields = compute(CT4D, baseResolution=2.5, tryGPU=False, nbWorkers=2)
+
+        self.assertGreater(np.abs(fields[1].velocity.imageArray).max(), 0)
+        np.testing.assert_array_equal(parallelMidp.imageArray, midp.imageArray)
+        for field, parallelField in zip(fields, parallelFields):
+            np.testing.assert_array_equal(parallelField.velocity.imageArray, field.velocity.imageArray)
@@ -0,0 +1,155 @@
+"""
+Block FFT convolution of an image with the six complex Morphons kernels.
+
+The image is split in blocks that are convolved by overlap-save: each block is extended by half the kernel size on
+each side, transformed once with a real FFT, and multiplied by the spectra of the real and imaginary parts of the six
+kernels in a single batch. The inverse transforms of the twelve products give the filter responses of the block.
+Kernel spectra are cached for each block shape, and the FFTs run on several threads.
+"""
+import hashlib
+import logging
+import os
+import threading
+import unittest
+from collections import OrderedDict
+
+import numpy as np
+import scipy.fft
+import scipy.signal
+
+logger = logging.getLogger(__name__)
+
+FFTCONVOLVE = 'fftconvolve'
+BLOCK_FFT = 'blockFFT'
+
+# images with less voxels are filtered with scipy.signal.fftconvolve. On one thread, the block FFT was faster at all
+# measured sizes (about 4x from 4^3 to 8^3, 2.5x at 16^3 and 1.6x from 32^3, see benchmarkMorphonsConvolution): the six
+# fftconvolve calls transform the image twelve times, the block FFT once.
+_BLOCK_FFT_MIN_VOXELS = 8 ** 3
+
+_spectraCache = OrderedDict()
+_spectraCacheLock = threading.Lock()
+_SPECTRA_CACHE_SIZE = 8
+
+
+def selectBackend(shape) -> str:
+    """
+    Convolution backend used for an image of the given shape when the backend is 'auto'.
+    """
+    return BLOCK_FFT if np.prod(shape) >= _BLOCK_FFT_MIN_VOXELS else FFTCONVOLVE
+
+
+def convolveKernels(imageArray:np.ndarray, kernels, conjugate:bool=False, maxFFTLength:int=64, workers:int=None) -> list:
+    """
+    Convolve a real 3D image with complex kernels, with the output of scipy.signal.fftconvolve(mode='same') applied
+    separately on the real and imaginary parts of each kernel.
+
+    Parameters
+    ----------
+    imageArray : np.ndarray
+        Real 3D image.
+    kernels : sequence of np.ndarray
+        Complex 3D kernels with odd sizes, all of the same shape.
+    conjugate : bool
+        If True, the imaginary part of the responses is subtracted (convolution with the complex conjugate kernels).
+    maxFFTLength : int
+        Maximum FFT length of the blocks along each axis.
+    workers : int
+        Number of threads of the FFTs. The default is the number of CPUs.
+
+    Returns
+    -------
+    list of np.ndarray
+        Complex response of each kernel, with the shape of the image.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    imageArray = np.asarray(imageArray)
+    realType = np.result_type(imageArray.dtype, np.real(kernels[0]).dtype, np.float32)
+    complexType = np.result_type(realType, np.complex64)
+
+    shape = np.array(imageArray.shape)
+    kernelShape = np.array(kernels[0].shape)
+    halfKernel = kernelShape // 2
+    fftShape = tuple(_fftLength(int(n), 2 * int(h), maxFFTLength) for n, h in zip(shape, halfKernel))
+    blockShape = np.minimum(shape, np.array(fftShape) - 2 * halfKernel)
+    spectra = _kernelSpectra(kernels, fftShape, realType)
+
+    # zero padding of half the kernel size around the image, and up to a whole number of blocks
+    numBlocks = -(-shape // blockShape)
+    padded = np.zeros(numBlocks * blockShape + 2 * halfKernel, dtype=realType)
+    padded[tuple(slice(h, h + n) for h, n in zip(halfKernel, shape))] = imageArray
+
+    responses = np.zeros((len(kernels),) + tuple(shape), dtype=complexType)
+    sign = -1 if conjugate else 1
+    axes = (1, 2, 3)
+    for index in np.ndindex(*numBlocks):
+        start = np.array(index) * blockShape
+        stop = np.minimum(start + blockShape, shape)
+        tile = padded[tuple(slice(a, b + 2 * h) for a, b, h in zip(start, start + blockShape, halfKernel))]
+
+        # circular convolution: the values are exact from index 2 * halfKernel on, which is the 'same' output
+        blockSpectrum = scipy.fft.rfftn(tile, s=fftShape, workers=workers)
+        blockResponses = scipy.fft.irfftn(spectra * blockSpectrum, s=fftShape, axes=axes, workers=workers)
+        valid = (slice(None),) + tuple(slice(2 * h, 2 * h + b - a) for a, b, h in zip(start, stop, halfKernel))
+        blockResponses = blockResponses[valid]
+
+        output = (slice(None),) + tuple(slice(a, b) for a, b in zip(start, stop))
+        responses[output].real = blockResponses[0::2]
+        responses[output].imag = sign * blockResponses[1::2]
+
+    return list(responses)
+
+
+def _fftLength(size, overlap, maxFFTLength):
+    # FFT length minimizing the total length of the transforms of the blocks covering size voxels along an axis
+    bestLength, bestCost = None, np.inf
+    length = scipy.fft.next_fast_len(min(size, 8) + overlap, real=True)
+    while bestLength is None or length <= maxFFTLength:
+        blockSize = min(length - overlap, size)
+        cost = -(-size // blockSize) * length * np.log2(length)
+        if cost < bestCost:
+            bestLength, bestCost = length, cost
+        if blockSize == size:
+            break
+        length = scipy.fft.next_fast_len(length + 1, real=True)
+    return bestLength
+
+
+def _kernelSpectra(kernels, fftShape, realType):
+    # spectra of the real and imaginary parts of the kernels, interleaved
+    hasher = hashlib.sha1()
+    for kernel in kernels:
+        hasher.update(np.ascontiguousarray(kernel).data)
+    key = (hasher.hexdigest(), fftShape, np.dtype(realType).str)
+
+    with _spectraCacheLock:
+        spectra = _spectraCache.get(key)
+        if spectra is not None:
+            _spectraCache.move_to_end(key)
+            return spectra
+
+    parts = np.stack([part for kernel in kernels for part in (np.real(kernel), np.imag(kernel))]).astype(realType)
+    spectra = scipy.fft.rfftn(parts, s=fftShape, axes=(1, 2, 3))
+
+    with _spectraCacheLock:
+        _spectraCache[key] = spectra
+        while len(_spectraCache) > _SPECTRA_CACHE_SIZE:
+            _spectraCache.popitem(last=False)
+    return spectra
+
+
+class MorphonsConvolutionTestCase(unittest.TestCase):
+    def testConvolveKernels(self):
+        rng = np.random.default_rng(0)
+        image = rng.normal(size=(30, 17, 23)).astype(np.float32)
+        kernels = [(rng.normal(size=(9, 9, 9)) + 1j * rng.normal(size=(9, 9, 9))).astype(np.complex64) for _ in range(2)]
+
+        for conjugate in (False, True):
+            responses = convolveKernels(image, kernels, conjugate=conjugate, maxFFTLength=20)
+            for kernel, response in zip(kernels, responses):
+                real = scipy.signal.fftconvolve(image, np.real(kernel), mode='same')
+                imag = scipy.signal.fftconvolve(image, np.imag(kernel), mode='same')
+                self.assertEqual(response.shape, image.shape)
+                np.testing.assert_allclose(response.real, real, atol=1e-3)
+                np.testing.assert_allclose(response.imag, -imag if conjugate else imag, atol=1e-3)
@@ -1,9 +1,13 @@
 import os
+import time
+import hashlib
 import numpy as np
 import scipy.signal
 import logging
 import multiprocessing as mp
-from functools import partial
+import unittest
+from collections import OrderedDict
+from functools import partial, lru_cache
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +22,7 @@ from opentps.core.data.images._vectorField3D import VectorField3D
 from opentps.core.processing.registration.registration import Registration
 import opentps.core.processing.imageProcessing.filter3D as imageFilter3D
 import opentps.core.processing.registration.morphonsCupy as morphonsCupy
+import opentps.core.processing.registration.morphonsConvolution as morphonsConvolution
 
 
 
@@ -33,7 +38,36 @@ def morphonsComplexConvD(im, k):
     return scipy.signal.fftconvolve(im, np.real(k), mode='same') - scipy.signal.fftconvolve(im, np.imag(k), mode='same') * 1j
 
 
-def applyMorphonsKernels(image, k, is_fixed=1, tryGPU=True):
+def applyMorphonsKernels(image, k, is_fixed=1, tryGPU=True, backend='auto', workers=None):
+    """
+    Convolve an image with the six complex Morphons kernels.
+
+    Parameters
+    ----------
+    image : Image3D
+        Image to filter.
+    k : sequence of numpy arrays
+        The Morphons kernels.
+    is_fixed : int
+        1 for the fixed image, 0 for the deformed image (complex conjugate kernels).
+    tryGPU : bool
+        Try to use GPU for the convolutions.
+    backend : str
+        CPU convolution backend: 'fftconvolve' (scipy.signal.fftconvolve on the whole image), 'blockFFT' (block FFT
+        convolution of morphonsConvolution) or 'auto' (selected from the image size).
+    workers : int
+        Number of threads of the block FFTs (None = number of CPUs).
+
+    Returns
+    -------
+    list of numpy arrays
+        The six complex filter responses.
+    """
+    if backend == 'auto':
+        backend = morphonsConvolution.selectBackend(image._imageArray.shape)
+    if backend not in (morphonsConvolution.FFTCONVOLVE, morphonsConvolution.BLOCK_FFT):
+        raise ValueError('Unknown Morphons convolution backend: ' + str(backend))
+
     output = []
     if image._imageArray.size > 1e5 and tryGPU:
         try:
@@ -47,6 +81,9 @@ def applyMorphonsKernels(image, k, is_fixed=1, tryGPU=True):
         except:
             logger.warning('cupy not used for morphons kernel convolution.')
 
+    if len(output) == 0 and backend == morphonsConvolution.BLOCK_FFT:
+        output = morphonsConvolution.convolveKernels(image._imageArray, k, conjugate=not is_fixed, workers=workers)
+
     if(len(output)==0):
         for n in range(6):
             if (is_fixed):
@@ -57,6 +94,252 @@ def applyMorphonsKernels(image, k, is_fixed=1, tryGPU=True):
     return output
 
 
+@lru_cache(maxsize=1)
+def loadMorphonsKernels():
+    """
+    Read the six complex Morphons quadrature kernels (9x9x9) of the Morphons_kernels folder. The files are read at the
+    first call only.
+
+    Returns
+    -------
+    tuple of numpy arrays
+        The read-only kernels.
+    """
+    morphonsPath = os.path.join(os.path.dirname(__file__), 'Morphons_kernels')
+    k = []
+    for n in range(1, 7):
+        kernel = np.reshape(
+            np.float32(np.fromfile(os.path.join(morphonsPath, "kernel" + str(n) + "_real.bin"), dtype="float64")) + np.float32(
+                np.fromfile(os.path.join(morphonsPath, "kernel" + str(n) + "_imag.bin"), dtype="float64")) * 1j, (9, 9, 9))
+        kernel.flags.writeable = False
+        k.append(kernel)
+    return tuple(k)
+
+
+class MorphonsSession:
+    """
+    Resources shared by successive Morphons registrations: the Morphons kernels, a persistent pool of processes for the
+    filter responses, and a cache of the fixed image resampled at each scale with its filter responses and of the moving
+    image resampled at each scale. Registering several moving images to a same fixed image then filters the fixed image
+    once per scale, and registering several fixed images to a same moving image resamples the moving image once per scale.
+    The least recently used images are removed from the cache when it exceeds maxBytes.
+
+    The session can be used as a context manager, which terminates the pool on exit.
+
+    Attributes
+    ----------
+    nbProcesses : int
+        Number of processes of the pool (-1 = number of CPUs, at most 6).
+    maxBytes : float
+        Maximum memory (in bytes) used by the cached images and filter responses (None for no limit, 0 to disable the
+        cache).
+    cacheFixed : bool
+        Cache the fixed images and their filter responses. It can be disabled when each fixed image is registered once.
+    convolutionBackend : str
+        CPU convolution backend of the filter responses ('fftconvolve', 'blockFFT' or 'auto', see applyMorphonsKernels).
+        The block FFTs run on nbProcesses threads, while the fftconvolve backend uses the pool of processes.
+    statistics : dict
+        Number of hits and misses of the image cache.
+    scaleTimes : list
+        Computation time (in seconds) of each scale of the last registration.
+    """
+    def __init__(self, nbProcesses=-1, maxBytes=2**31, convolutionBackend='auto', cacheFixed=True):
+        if nbProcesses < 0:
+            nbProcesses = min(mp.cpu_count(), 6)
+        self.nbProcesses = nbProcesses
+        self.maxBytes = maxBytes
+        self.cacheFixed = cacheFixed
+        self.convolutionBackend = convolutionBackend
+        self.kernels = loadMorphonsKernels()
+        self.scaleTimes = []
+
+        self._pool = None
+        self._poolSize = 0
+        self._imageCache = OrderedDict()
+        self._cachedBytes = 0
+        self._statistics = {}
+        self.resetStatistics()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def statistics(self) -> dict:
+        return dict(self._statistics)
+
+    def resetStatistics(self):
+        """
+        Reset the hit and miss counters.
+        """
+        self._statistics = {'hits': 0, 'misses': 0}
+
+    def close(self):
+        """
+        Terminate the pool of processes and clear the cache.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self._poolSize = 0
+        self.clearCache()
+
+    def clearCache(self):
+        """
+        Remove all images from the cache.
+        """
+        self._imageCache.clear()
+        self._cachedBytes = 0
+
+    @property
+    def cachedBytes(self) -> int:
+        return self._cachedBytes
+
+    def filterResponses(self, image, is_fixed=1, tryGPU=True, nbProcesses=None):
+        """
+        Convolve an image with the six Morphons kernels.
+
+        Parameters
+        ----------
+        image : Image3D
+            Image to filter.
+        is_fixed : int
+            1 for the fixed image, 0 for the deformed image (complex conjugate kernels).
+        tryGPU : bool
+            Try to use GPU for the convolutions.
+        nbProcesses : int
+            Number of processes (or threads of the block FFTs) of the convolutions. If None or negative, the nbProcesses
+            of the session is used. The pool of processes is recreated when its size changes.
+
+        Returns
+        -------
+        list of numpy arrays
+            The six complex filter responses.
+        """
+        if nbProcesses is None or nbProcesses < 0:
+            nbProcesses = self.nbProcesses
+        backend = self.convolutionBackend
+        if backend == 'auto':
+            backend = morphonsConvolution.selectBackend(image._imageArray.shape)
+
+        if nbProcesses > 1 and backend == morphonsConvolution.FFTCONVOLVE:
+            if self._pool is not None and self._poolSize != nbProcesses:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+            if self._pool is None:
+                self._pool = mp.Pool(nbProcesses)
+                self._poolSize = nbProcesses
+            pconv = partial(morphonsComplexConvS if is_fixed else morphonsComplexConvD, image._imageArray)
+            return self._pool.map(pconv, self.kernels)
+
+        return applyMorphonsKernels(image, self.kernels, is_fixed=is_fixed, tryGPU=tryGPU, backend=backend,
+                                    workers=max(1, nbProcesses))
+
+    def fixedResponses(self, fixed, fixedKey, spacing, gridSize, tryGPU=True, nbProcesses=None):
+        """
+        Resample the fixed image at a scale and compute its filter responses, or get them from the cache.
+
+        Parameters
+        ----------
+        fixed : Image3D
+            Fixed image.
+        fixedKey : str
+            Identifier of the fixed image content. If None, the cache is not used.
+        spacing : numpy array
+            Voxel spacing of the scale.
+        gridSize : numpy array
+            Grid size of the scale.
+        tryGPU : bool
+            Try to use GPU.
+        nbProcesses : int
+            Number of processes of the filter responses (None for the nbProcesses of the session).
+
+        Returns
+        -------
+        Image3D
+            The resampled fixed image, which must not be modified.
+        list of numpy arrays
+            Its six complex filter responses.
+        """
+        key = ('fixed', fixedKey, tuple(np.round(spacing, 6)), tuple(int(n) for n in gridSize))
+        entry = self._getCached(key) if fixedKey is not None else None
+        if entry is not None:
+            return entry
+        fixedResampled = fixed.copy()
+        fixedResampled.resample(spacing, gridSize, fixed.origin, tryGPU=tryGPU)
+        qFixed = self.filterResponses(fixedResampled, is_fixed=1, tryGPU=tryGPU, nbProcesses=nbProcesses)
+
+        if fixedKey is not None:
+            self._store(key, (fixedResampled, qFixed), fixedResampled.imageArray.nbytes + sum(q.nbytes for q in qFixed))
+        return fixedResampled, qFixed
+
+    def resampledImage(self, image, imageKey, spacing, gridSize, origin, tryGPU=True):
+        """
+        Resample an image on a grid, or get it from the cache.
+
+        Parameters
+        ----------
+        image : Image3D
+            Image to resample.
+        imageKey : str
+            Identifier of the image content. If None, the cache is not used.
+        spacing : numpy array
+            Voxel spacing of the grid.
+        gridSize : numpy array
+            Size of the grid.
+        origin : numpy array
+            Origin of the grid.
+        tryGPU : bool
+            Try to use GPU.
+
+        Returns
+        -------
+        Image3D
+            The resampled image, which must not be modified.
+        """
+        key = ('resampled', imageKey, tuple(np.round(spacing, 6)), tuple(int(n) for n in gridSize), tuple(np.round(origin, 6)))
+        entry = self._getCached(key) if imageKey is not None else None
+        if entry is not None:
+            return entry[0]
+        resampled = image.copy()
+        resampled.resample(spacing, gridSize, origin, tryGPU=tryGPU)
+
+        if imageKey is not None:
+            self._store(key, (resampled,), resampled.imageArray.nbytes)
+        return resampled
+
+    def _getCached(self, key):
+        entry = self._imageCache.get(key)
+        if entry is None:
+            self._statistics['misses'] += 1
+            return None
+        self._statistics['hits'] += 1
+        self._imageCache.move_to_end(key)
+        return entry[0]
+
+    def _store(self, key, value, nbytes):
+        if self.maxBytes is not None and nbytes > self.maxBytes:
+            return
+        self._imageCache[key] = (value, nbytes)
+        self._cachedBytes += nbytes
+        while self.maxBytes is not None and self._cachedBytes > self.maxBytes:
+            _, (_, evictedBytes) = self._imageCache.popitem(last=False)
+            self._cachedBytes -= evictedBytes
+
+
+def _imageKey(image, tryGPU):
+    hasher = hashlib.sha256()
+    imageArray = np.ascontiguousarray(image.imageArray)
+    hasher.update((imageArray.dtype.str + str(imageArray.shape) + str(list(image.origin)) + str(list(image.spacing))
+                   + str(tryGPU)).encode())
+    hasher.update(imageArray.data)
+    return hasher.hexdigest()
+
+
 class RegistrationMorphons(Registration):
     """
     Class for performing registration using morphons kernels. inherited from Registration class.
@@ -70,17 +353,22 @@ class RegistrationMorphons(Registration):
     baseResolution : float
         Base resolution for registration.
     nbProcesses : int
-        Number of processes to use for registration.
+        Number of processes to use for registration (-1 = nbProcesses of the session, or number of CPUs (at most 6)
+        without session).
     tryGPU : bool
         Try to use GPU for registration.
+    session : MorphonsSession
+        Kernels, pool of processes and image cache shared with other registrations. If None, they are created for this
+        registration only.
 
     """
-    def __init__(self, fixed, moving, baseResolution=2.5, nbProcesses=-1, tryGPU=True):
+    def __init__(self, fixed, moving, baseResolution=2.5, nbProcesses=-1, tryGPU=True, session=None):
 
         Registration.__init__(self, fixed, moving)
         self.baseResolution = baseResolution
         self.nbProcesses = nbProcesses
         self.tryGPU = tryGPU
+        self.session = session
 
     def compute(self):
 
@@ -104,11 +392,18 @@ class RegistrationMorphons(Registration):
             except:
                 logger.info('Failed to use full CuPy implementation. Try CPU instead.')
 
-        if self.nbProcesses < 0:
-            self.nbProcesses = min(mp.cpu_count(), 6)
+        session = self.session if self.session is not None else MorphonsSession(nbProcesses=self.nbProcesses)
+        try:
+            return self._computeCPU(session)
+        finally:
+            if self.session is None:
+                session.close()
 
-        if self.nbProcesses > 1:
-            pool = mp.Pool(self.nbProcesses)
+    def _computeCPU(self, session):
+        useCache = self.session is not None and self.session.maxBytes != 0
+        fixedKey = _imageKey(self.fixed, self.tryGPU) if useCache and self.session.cacheFixed else None
+        movingKey = _imageKey(self.moving, self.tryGPU) if useCache else None
+        session.scaleTimes = []
 
         eps = np.finfo("float64").eps
         eps32 = np.finfo("float32").eps
@@ -117,30 +412,10 @@ class RegistrationMorphons(Registration):
         qDirections = [[0, 0.5257, 0.8507], [0, -0.5257, 0.8507], [0.5257, 0.8507, 0], [-0.5257, 0.8507, 0],
                        [0.8507, 0, 0.5257], [0.8507, 0, -0.5257]]
 
-        morphonsPath = os.path.join(os.path.dirname(__file__), 'Morphons_kernels')
-        k = []
-        k.append(np.reshape(
-            np.float32(np.fromfile(os.path.join(morphonsPath, "kernel1_real.bin"), dtype="float64")) + np.float32(
-                np.fromfile(os.path.join(morphonsPath, "kernel1_imag.bin"), dtype="float64")) * 1j, (9, 9, 9)))
-        k.append(np.reshape(
-            np.float32(np.fromfile(os.path.join(morphonsPath, "kernel2_real.bin"), dtype="float64")) + np.float32(
-                np.fromfile(os.path.join(morphonsPath, "kernel2_imag.bin"), dtype="float64")) * 1j, (9, 9, 9)))
-        k.append(np.reshape(
-            np.float32(np.fromfile(os.path.join(morphonsPath, "kernel3_real.bin"), dtype="float64")) + np.float32(
-                np.fromfile(os.path.join(morphonsPath, "kernel3_imag.bin"), dtype="float64")) * 1j, (9, 9, 9)))
-        k.append(np.reshape(
-            np.float32(np.fromfile(os.path.join(morphonsPath, "kernel4_real.bin"), dtype="float64")) + np.float32(
-                np.fromfile(os.path.join(morphonsPath, "kernel4_imag.bin"), dtype="float64")) * 1j, (9, 9, 9)))
-        k.append(np.reshape(
-            np.float32(np.fromfile(os.path.join(morphonsPath, "kernel5_real.bin"), dtype="float64")) + np.float32(
-                np.fromfile(os.path.join(morphonsPath, "kernel5_imag.bin"), dtype="float64")) * 1j, (9, 9, 9)))
-        k.append(np.reshape(
-            np.float32(np.fromfile(os.path.join(morphonsPath, "kernel6_real.bin"), dtype="float64")) + np.float32(
-                np.fromfile(os.path.join(morphonsPath, "kernel6_imag.bin"), dtype="float64")) * 1j, (9, 9, 9)))
-
         deformation = Deformation3D()
 
         for s in range(len(scales)):
+            scaleStartTime = time.time()
 
             # Compute grid for new scale
             newGridSize = np.array([round(self.fixed.spacing[1] / scales[s] * self.fixed.gridSize[0]),
@@ -156,10 +431,9 @@ class RegistrationMorphons(Registration):
             logger.info('Morphons scale:' + str(s + 1) + '/' + str(len(scales)) + ' (' + str(round(newVoxelSpacing[0] * 1e2) / 1e2 ) + 'x' + str(round(newVoxelSpacing[1] * 1e2) / 1e2) + 'x' + str(round(newVoxelSpacing[2] * 1e2) / 1e2) + 'mm3)')
 
             # Resample fixed and moving images and deformation according to the considered scale (voxel spacing)
-            fixedResampled = self.fixed.copy()
-            fixedResampled.resample(newVoxelSpacing, newGridSize, self.fixed.origin, tryGPU=self.tryGPU)
-            movingResampled = self.moving.copy()
-            movingResampled.resample(fixedResampled.spacing, fixedResampled.gridSize, fixedResampled.origin, tryGPU=self.tryGPU)
+            # and compute phase on fixed image
+            fixedResampled, qFixed = session.fixedResponses(self.fixed, fixedKey, newVoxelSpacing, newGridSize, tryGPU=self.tryGPU, nbProcesses=self.nbProcesses)
+            movingResampled = session.resampledImage(self.moving, movingKey, fixedResampled.spacing, fixedResampled.gridSize, fixedResampled.origin, tryGPU=self.tryGPU)
 
             if s != 0:
                 deformation.resample(fixedResampled.spacing, fixedResampled.gridSize, fixedResampled.origin, tryGPU=self.tryGPU)
@@ -169,13 +443,6 @@ class RegistrationMorphons(Registration):
                 certainty = fixedResampled.copy()
                 certainty._imageArray = np.zeros_like(certainty._imageArray)
 
-            # Compute phase on fixed image
-            if (self.nbProcesses > 1):
-                pconv = partial(morphonsComplexConvS, fixedResampled._imageArray)
-                qFixed = pool.map(pconv, k)
-            else:
-                qFixed = applyMorphonsKernels(fixedResampled, k, is_fixed=1, tryGPU=self.tryGPU)
-
             for i in range(iterations[s]):
 
                 # Deform moving image then reset displacement field
@@ -193,11 +460,7 @@ class RegistrationMorphons(Registration):
                 b2 = np.zeros_like(qFixed[0], dtype="float64")
                 b3 = np.zeros_like(qFixed[0], dtype="float64")
 
-                if (self.nbProcesses > 1):
-                    pconv = partial(morphonsComplexConvD, deformed.imageArray)
-                    qDeformed = pool.map(pconv, k)
-                else:
-                    qDeformed = applyMorphonsKernels(deformed, k, is_fixed=0, tryGPU=self.tryGPU)
+                qDeformed = session.filterResponses(deformed, is_fixed=0, tryGPU=self.tryGPU, nbProcesses=self.nbProcesses)
 
                 for n in range(6):
                     qq = np.multiply(qFixed[n], qDeformed[n])
@@ -252,7 +515,99 @@ class RegistrationMorphons(Registration):
                 self.regularizeField(deformation, filterType="NormalizedGaussian", sigma=1.25, cert=certainty.imageArray, tryGPU=self.tryGPU)
                 certainty._imageArray = imageFilter3D.normGaussConv(certainty.imageArray, certainty.imageArray, 1.25, tryGPU=self.tryGPU)
 
+            session.scaleTimes.append(time.time() - scaleStartTime)
+            logger.info('Morphons scale ' + str(s + 1) + ' computed in ' + str(round(session.scaleTimes[-1], 2)) + ' s')
+
         self.deformed = deformation.deformImage(self.moving, fillValue='closest', tryGPU=self.tryGPU)
         self.deformed.setName(self.moving.name + '_registered_to_' + self.fixed.name)
 
         return deformation
+
+
+class MorphonsSessionTestCase(unittest.TestCase):
+    def _image(self, value=0., size=16):
+        from opentps.core.data.images import CTImage
+
+        x, y, z = np.meshgrid(*[np.arange(size)] * 3, indexing='ij')
+        return CTImage(imageArray=np.where((x - size // 2) ** 2 + (y - size // 2) ** 2 + (z - size // 2) ** 2 < 16, value, -1000.),
+                       spacing=(2.5, 2.5, 2.5), name='image')
+
+    def testLoadKernels(self):
+        kernels = loadMorphonsKernels()
+
+        self.assertIs(loadMorphonsKernels(), kernels)
+        self.assertEqual(len(kernels), 6)
+        for kernel in kernels:
+            self.assertEqual(kernel.shape, (9, 9, 9))
+            self.assertTrue(np.iscomplexobj(kernel))
+            self.assertFalse(kernel.flags.writeable)
+            self.assertGreater(np.abs(kernel).max(), 0)
+
+    def testFixedResponsesCache(self):
+        fixed = self._image()
+        spacing = np.array([4., 4., 4.])
+        gridSize = np.array([8, 8, 8])
+
+        with MorphonsSession(nbProcesses=1, maxBytes=None) as session:
+            key = _imageKey(fixed, False)
+            resampled, q = session.fixedResponses(fixed, key, spacing, gridSize, tryGPU=False)
+            cachedResampled, cachedQ = session.fixedResponses(fixed, key, spacing, gridSize, tryGPU=False)
+            self.assertEqual(session.statistics, {'hits': 1, 'misses': 1})
+            self.assertIs(cachedResampled, resampled)
+            self.assertIs(cachedQ, q)
+
+            # another scale, and another image content, are misses
+            session.fixedResponses(fixed, key, spacing / 2, gridSize * 2, tryGPU=False)
+            other = self._image(100.)
+            _, otherQ = session.fixedResponses(other, _imageKey(other, False), spacing, gridSize, tryGPU=False)
+            self.assertEqual(session.statistics, {'hits': 1, 'misses': 3})
+            self.assertFalse(np.array_equal(otherQ[0], q[0]))
+
+            # no key, no cache
+            _, uncachedQ = session.fixedResponses(fixed, None, spacing, gridSize, tryGPU=False)
+            self.assertEqual(session.statistics, {'hits': 1, 'misses': 3})
+            for n in range(6):
+                np.testing.assert_array_equal(uncachedQ[n], q[n])
+
+    def testCacheSizeBound(self):
+        fixed = self._image()
+        spacing = np.array([4., 4., 4.])
+        gridSize = np.array([8, 8, 8])
+        entryBytes = 8 ** 3 * (fixed.imageArray.itemsize + 6 * np.dtype(np.complex64).itemsize)
+
+        with MorphonsSession(nbProcesses=1, maxBytes=2 * entryBytes) as session:
+            keys = [_imageKey(self._image(value), False) for value in (0., 100., 200.)]
+            for key in keys:
+                session.fixedResponses(fixed, key, spacing, gridSize, tryGPU=False)
+            self.assertLessEqual(session.cachedBytes, 2 * entryBytes)
+
+            # the least recently used image was removed
+            session.resetStatistics()
+            session.fixedResponses(fixed, keys[2], spacing, gridSize, tryGPU=False)
+            session.fixedResponses(fixed, keys[0], spacing, gridSize, tryGPU=False)
+            self.assertEqual(session.statistics, {'hits': 1, 'misses': 1})
+            self.assertLessEqual(session.cachedBytes, 2 * entryBytes)
+
+            session.clearCache()
+            self.assertEqual(session.cachedBytes, 0)
+
+        with MorphonsSession(nbProcesses=1, maxBytes=0) as session:
+            session.fixedResponses(fixed, keys[0], spacing, gridSize, tryGPU=False)
+            self.assertEqual(session.cachedBytes, 0)
+
+    def testResampledImageCache(self):
+        moving = self._image()
+        key = _imageKey(moving, False)
+
+        with MorphonsSession(nbProcesses=1) as session:
+            resampled = session.resampledImage(moving, key, np.array([4., 4., 4.]), np.array([8, 8, 8]), moving.origin, tryGPU=False)
+            self.assertIs(session.resampledImage(moving, key, np.array([4., 4., 4.]), np.array([8, 8, 8]), moving.origin, tryGPU=False), resampled)
+            session.resampledImage(moving, key, np.array([4., 4., 4.]), np.array([8, 8, 8]), moving.origin + 1, tryGPU=False)
+            self.assertEqual(session.statistics, {'hits': 1, 'misses': 2})
+
+    def testNbProcesses(self):
+        with MorphonsSession(nbProcesses=1) as session:
+            reg = RegistrationMorphons(self._image(size=24), self._image(size=24), baseResolution=2.5, nbProcesses=2, tryGPU=False, session=session)
+            reg.compute()
+            self.assertEqual(reg.nbProcesses, 2)
+            self.assertEqual(session.nbProcesses, 1)